@@ -4,6 +4,7 @@ Xpedit API - Backend de optimización de rutas
 
 import asyncio
 import base64
+import functools
 import hashlib
 import hmac as _hmac
 import json
@@ -12,15 +13,19 @@ import math
 import os
 import random
 import re
+import threading
 import time
 import unicodedata
 import uuid
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime, timedelta, timezone
 from typing import List, Literal, Optional
 from zoneinfo import ZoneInfo
 
 import httpx
 import jwt as pyjwt
+import numpy as np
 import sentry_sdk
 from dotenv import load_dotenv
 
@@ -31,8 +36,9 @@ def sentry_check_in(monitor_slug: str, status: str):
         sentry_sdk.capture_check_in(monitor_slug=monitor_slug, status=status)
     except AttributeError:
         pass  # sentry_sdk version doesn't support cron monitoring
-from fastapi import Depends, FastAPI, File, Header, HTTPException, Query, Request, UploadFile
+from fastapi import BackgroundTasks, Depends, FastAPI, File, Header, HTTPException, Query, Request, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from jwt import PyJWKClient
 from pydantic import BaseModel, Field, field_validator
 from supabase import Client, create_client
@@ -156,6 +162,8 @@ load_dotenv()
 # too tight). This version is more generous: 100/50/keepalive=30s, and
 # the pool timeout is 10s so a small burst doesn't immediately error.
 # Per-request timeout overrides are applied at each call site.
+# The OSRM/ORS road-matrix fetches share the same pool (the OSRM retry loop
+# used to open a new client per attempt); closed on shutdown.
 _google_maps_client: Optional["httpx.AsyncClient"] = None
 
 
@@ -372,6 +380,10 @@ def _haversine_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
     return R * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
 
 
+# 50 m expresados como el término `a` de Haversine: sin²(d / 2R).
+_DIRECTORY_MATCH_HAV = math.sin(0.05 / (2 * 6371.0)) ** 2
+
+
 def enrich_stops_from_directory(company_id: str, stops: list[dict]) -> tuple[list[dict], int]:
     """Enrich stops with customer data from company directory. Returns (stops, match_count)."""
     if not company_id:
@@ -387,17 +399,29 @@ def enrich_stops_from_directory(company_id: str, stops: list[dict]) -> tuple[lis
         addr_lookup[entry["normalized_address"]] = entry
         if entry.get("lat") and entry.get("lng"):
             geo_entries.append(entry)
+    # Directorio en columnas (radianes + coseno precalculado): cada parada se
+    # compara contra todas las entradas en una pasada numpy, no en un bucle
+    # Python parada × directorio.
+    geo_lat = np.radians(np.array([e["lat"] for e in geo_entries], dtype=np.float64))
+    geo_lng = np.radians(np.array([e["lng"] for e in geo_entries], dtype=np.float64))
+    geo_cos = np.cos(geo_lat)
     match_count = 0
     for stop in stops:
         if stop.get("phone") and stop.get("email"):
             continue
         norm = normalize_address(stop.get("address", ""))
         match = addr_lookup.get(norm)
-        if not match and stop.get("lat") and stop.get("lng"):
-            for entry in geo_entries:
-                if _haversine_km(stop["lat"], stop["lng"], entry["lat"], entry["lng"]) <= 0.05:
-                    match = entry
-                    break
+        if not match and geo_entries and stop.get("lat") and stop.get("lng"):
+            s_lat = math.radians(stop["lat"])
+            s_lng = math.radians(stop["lng"])
+            # Término `a` de Haversine contra el umbral ya convertido:
+            # mismo criterio que _haversine_km <= 50 m, sin atan2/sqrt.
+            s1 = np.sin((geo_lat - s_lat) * 0.5)
+            s2 = np.sin((geo_lng - s_lng) * 0.5)
+            hits = np.flatnonzero(s1 * s1 + math.cos(s_lat) * geo_cos * s2 * s2 <= _DIRECTORY_MATCH_HAV)
+            if hits.size:
+                # La primera entrada dentro del radio, como el bucle anterior.
+                match = geo_entries[hits[0]]
         if match:
             if not stop.get("phone") and match.get("phone"):
                 stop["phone"] = match["phone"]
@@ -413,7 +437,11 @@ def enrich_stops_from_directory(company_id: str, stops: list[dict]) -> tuple[lis
 # processed_webhooks table, which survives Railway restarts — before
 # this table, a redeploy in the middle of a retry storm could re-process
 # the same Stripe/RevenueCat event.
-_processed_webhook_events: dict = {}
+# TTL 24h: Stripe reintenta durante ~3 días pero el grueso de las réplicas
+# llega en minutos; lo que caduque aquí lo sigue cubriendo la tabla.
+from cachetools import TTLCache as _TTLCache  # noqa: E402
+
+_processed_webhook_events: _TTLCache = _TTLCache(maxsize=20_000, ttl=86400)
 
 
 def _is_webhook_processed(event_id: str, provider: str) -> bool:
@@ -439,10 +467,6 @@ def _mark_webhook_processed(event_id: str, provider: str) -> None:
     if not event_id:
         return
     _processed_webhook_events[event_id] = True
-    if len(_processed_webhook_events) > 10000:
-        to_remove = list(_processed_webhook_events.keys())[:5000]
-        for k in to_remove:
-            del _processed_webhook_events[k]
     try:
         supabase.table("processed_webhooks").insert({
             "event_id": event_id,
@@ -499,8 +523,6 @@ _jwks_client = PyJWKClient(_jwks_url) if SUPABASE_URL else None
 # Cache profile by user_id for 60s — JWT lifetime is much longer, role
 # changes are rare, and a 60s window is still well within auth security
 # tolerances. Reduces DB load ~60% under typical autocomplete bursts.
-from cachetools import TTLCache as _TTLCache  # noqa: E402
-
 _user_profile_cache: _TTLCache = _TTLCache(maxsize=10000, ttl=60)
 
 
@@ -615,14 +637,20 @@ async def get_user_driver_id(user: dict) -> Optional[str]:
 
 async def verify_route_access(route_id: str, user: dict):
     """Verify the user can access this route. Returns route data or raises 403."""
-    route_result = supabase.table("routes").select("id, driver_id, company_id").eq("id", route_id).limit(1).execute()
+    # The assigned driver's user_id/company_id come embedded in the same
+    # request (left join: unassigned routes have driver_id NULL), instead of
+    # a second drivers lookup for the caller's own driver_id or the driver's
+    # company.
+    route_result = supabase.table("routes").select(
+        "id, driver_id, company_id, drivers(user_id, company_id)"
+    ).eq("id", route_id).limit(1).execute()
     if not route_result.data:
         raise HTTPException(status_code=404, detail="Ruta no encontrada")
-    route = route_result.data[0]
+    route = dict(route_result.data[0])
+    driver = route.pop("drivers", None) or {}
     if user["role"] == "admin":
         return route
-    user_driver_id = await get_user_driver_id(user)
-    if route["driver_id"] == user_driver_id:
+    if route["driver_id"] and driver.get("user_id") == user["id"]:
         return route
     # Company operator (dispatcher / company_admin) can access routes of their company.
     # Match on the route's own company_id FIRST so UNASSIGNED routes (driver_id NULL,
@@ -631,10 +659,8 @@ async def verify_route_access(route_id: str, user: dict):
     if user["role"] in ("dispatcher", "company_admin") and user.get("company_id"):
         if route.get("company_id") and route["company_id"] == user.get("company_id"):
             return route
-        if route["driver_id"]:
-            driver_result = supabase.table("drivers").select("company_id").eq("id", route["driver_id"]).limit(1).execute()
-            if driver_result.data and driver_result.data[0].get("company_id") == user.get("company_id"):
-                return route
+        if route["driver_id"] and driver.get("company_id") == user.get("company_id"):
+            return route
     raise HTTPException(status_code=403, detail="No tienes acceso a esta ruta")
 
 
@@ -762,6 +788,10 @@ app = FastAPI(
     redoc_url=None if _is_production else "/redoc",
     openapi_url=None if _is_production else "/openapi.json",
     openapi_tags=tags_metadata,
+    # orjson serializa los listados grandes (rutas con paradas, stats) varias
+    # veces más rápido que json de la stdlib. Las respuestas que construyen
+    # JSONResponse a mano siguen igual.
+    default_response_class=ORJSONResponse,
 )
 
 
@@ -784,6 +814,15 @@ async def _bump_anyio_thread_pool():
         logger.warning(f"Could not raise anyio thread limiter: {e}")
 
 
+@app.on_event("shutdown")
+async def _close_google_maps_client():
+    """Cierra el pool keep-alive compartido (Google Maps, OSRM, ORS) al parar."""
+    global _google_maps_client
+    if _google_maps_client is not None and not _google_maps_client.is_closed:
+        await _google_maps_client.aclose()
+    _google_maps_client = None
+
+
 @app.on_event("startup")
 async def _startup_smoke_test():
     """SMOKE TEST POST-DEPLOY (22 may 2026 — lessons learned bug HTTP/1.1):
@@ -1133,8 +1172,11 @@ async def rate_limit_middleware(request: Request, call_next):
             check_rate_limit(f"auth:{client_ip}", max_requests=20, window_seconds=60)
         elif path.startswith("/places"):
             check_rate_limit(f"places:{client_ip}", max_requests=30, window_seconds=60)
-        elif path == "/optimize":
+        elif path == "/optimize" or path == "/optimize/jobs":
             check_rate_limit(f"optimize:{client_ip}", max_requests=10, window_seconds=60)
+        elif path.startswith("/optimize/jobs/"):
+            # Polling de jobs: barato (lectura en memoria), pero acotado.
+            check_rate_limit(f"optimize_poll:{client_ip}", max_requests=120, window_seconds=60)
         elif path.startswith("/voice"):
             check_rate_limit(f"voice:{client_ip}", max_requests=30, window_seconds=60)
         elif path.startswith("/email"):
@@ -1203,6 +1245,7 @@ class MultiVehicleOptimizeRequest(BaseModel):
     num_vehicles: int = Field(..., ge=1, le=50)
     depot_index: Optional[int] = Field(default=0)
     max_distance_per_vehicle_km: Optional[float] = None
+    balance_routes: bool = False
 
 
 class ClusterRequest(BaseModel):
@@ -1469,6 +1512,19 @@ ORS_API_KEY = os.getenv("ORS_API_KEY", "")
 ORS_URL = "https://api.openrouteservice.org/v2/matrix/driving-car"
 ORS_MAX_LOCATIONS = 50  # Free tier limit
 
+# Caché en proceso de matrices por carretera. Re-optimizar el mismo set de
+# paradas (reintento, el driver solo cambió el orden) repetía la llamada
+# OSRM/ORS entera — hasta ~26s con reintentos. Clave = sha256 de las coords
+# redondeadas a 5 decimales (~1 m); TTL 1h porque el callejero no cambia en
+# ese plazo. Los fallos (None) NO se cachean para reintentar en la siguiente.
+_ROAD_MATRIX_CACHE_TTL_S = 3600
+_road_matrix_cache: _TTLCache = _TTLCache(maxsize=256, ttl=_ROAD_MATRIX_CACHE_TTL_S)
+
+
+def _road_matrix_cache_key(locations: list) -> str:
+    raw = ";".join(f"{round(loc['lat'], 5)},{round(loc['lng'], 5)}" for loc in locations)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
 
 async def _osrm_table_request(
     coords_str: str,
@@ -1493,34 +1549,34 @@ async def _osrm_table_request(
                 logger.info(f"OSRM: waiting {delay}s before retry {attempt+1}/{OSRM_MAX_RETRIES} ({n_label} locs)")
                 await asyncio.sleep(delay)
 
-            async with httpx.AsyncClient(timeout=10) as client:
-                resp = await client.get(url, timeout=30.0, headers={"User-Agent": "Xpedit/1.0"})
+            # Cliente compartido: los reintentos reutilizan la conexión keep-alive.
+            resp = await google_maps_client().get(url, timeout=30.0, headers={"User-Agent": "Xpedit/1.0"})
 
-                if resp.status_code == 429:
-                    retry_after = float(resp.headers.get("Retry-After", 3.0))
-                    logger.warning(f"OSRM rate limited (429), waiting {retry_after}s (attempt {attempt+1})")
-                    await asyncio.sleep(retry_after)
-                    continue
+            if resp.status_code == 429:
+                retry_after = float(resp.headers.get("Retry-After", 3.0))
+                logger.warning(f"OSRM rate limited (429), waiting {retry_after}s (attempt {attempt+1})")
+                await asyncio.sleep(retry_after)
+                continue
 
-                if resp.status_code >= 500:
-                    logger.warning(f"OSRM server error ({resp.status_code}), attempt {attempt+1}")
-                    continue
+            if resp.status_code >= 500:
+                logger.warning(f"OSRM server error ({resp.status_code}), attempt {attempt+1}")
+                continue
 
-                if resp.status_code >= 400:
-                    logger.error(f"OSRM client error ({resp.status_code}) - cannot recover")
-                    return None
+            if resp.status_code >= 400:
+                logger.error(f"OSRM client error ({resp.status_code}) - cannot recover")
+                return None
 
-                data = resp.json()
-                if data.get("code") == "Ok" and data.get("distances") and data.get("durations"):
-                    return data
+            data = resp.json()
+            if data.get("code") == "Ok" and data.get("distances") and data.get("durations"):
+                return data
 
-                osrm_code = data.get("code", "Unknown")
-                if osrm_code == "TooBig":
-                    logger.warning(f"OSRM TooBig for {n_label} locs")
-                    return None
+            osrm_code = data.get("code", "Unknown")
+            if osrm_code == "TooBig":
+                logger.warning(f"OSRM TooBig for {n_label} locs")
+                return None
 
-                logger.warning(f"OSRM code '{osrm_code}', attempt {attempt+1}")
-                continue
+            logger.warning(f"OSRM code '{osrm_code}', attempt {attempt+1}")
+            continue
 
         except httpx.TimeoutException:
             logger.warning(f"OSRM timeout, attempt {attempt+1}")
@@ -1559,25 +1615,24 @@ async def _ors_matrix_request(locations: list) -> dict | None:
         "Accept": "application/json",
     }
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            resp = await client.post(ORS_URL, json=body, headers=headers)
-            if resp.status_code == 200:
-                data = resp.json()
-                if "distances" in data and "durations" in data:
-                    logger.info(f"ORS matrix OK: {n} locations")
-                    return {
-                        "distances": [[int(d) if d is not None else 999999 for d in row] for row in data["distances"]],
-                        "durations": [[int(d) if d is not None else 999999 for d in row] for row in data["durations"]],
-                    }
-                logger.warning(f"ORS returned 200 but missing fields: {list(data.keys())}")
-                return None
-            if resp.status_code == 403:
-                logger.warning("ORS 403 — quota exceeded or bad API key")
-            elif resp.status_code == 429:
-                logger.warning("ORS 429 rate limit")
-            else:
-                logger.warning(f"ORS {resp.status_code}: {resp.text[:200]}")
+        resp = await google_maps_client().post(ORS_URL, json=body, headers=headers, timeout=30.0)
+        if resp.status_code == 200:
+            data = resp.json()
+            if "distances" in data and "durations" in data:
+                logger.info(f"ORS matrix OK: {n} locations")
+                return {
+                    "distances": [[int(d) if d is not None else 999999 for d in row] for row in data["distances"]],
+                    "durations": [[int(d) if d is not None else 999999 for d in row] for row in data["durations"]],
+                }
+            logger.warning(f"ORS returned 200 but missing fields: {list(data.keys())}")
             return None
+        if resp.status_code == 403:
+            logger.warning("ORS 403 — quota exceeded or bad API key")
+        elif resp.status_code == 429:
+            logger.warning("ORS 429 rate limit")
+        else:
+            logger.warning(f"ORS {resp.status_code}: {resp.text[:200]}")
+        return None
     except Exception as e:
         logger.warning(f"ORS request failed: {type(e).__name__}: {e}")
         return None
@@ -1587,6 +1642,31 @@ async def get_road_distance_matrix(locations: list) -> dict | None:
     """
     Obtiene matrices de distancias y duraciones reales por carretera.
 
+    Memoizada por coordenadas (ver `_road_matrix_cache`). Devuelve copias
+    para que el caller pueda mutar filas (depot open-ended) sin tocar la caché.
+    """
+    if len(locations) < 2 or len(locations) > 500:
+        return None
+
+    key = _road_matrix_cache_key(locations)
+    cached = _road_matrix_cache.get(key)
+    if cached is not None:
+        logger.info(f"Road matrix cache hit: {len(locations)} locations")
+    else:
+        cached = await _fetch_road_distance_matrix(locations)
+        if cached is None:
+            return None
+        _road_matrix_cache[key] = cached
+    return {
+        "distances": [row[:] for row in cached["distances"]],
+        "durations": [row[:] for row in cached["durations"]],
+    }
+
+
+async def _fetch_road_distance_matrix(locations: list) -> dict | None:
+    """
+    Descarga matrices de distancias y duraciones reales por carretera.
+
     Flujo (18 may 2026):
     1. OSRM público — para España y Europa (cobertura full).
     2. ORS API (si OSRM falla y hay API key) — para LATAM/US y resto del mundo.
@@ -1651,12 +1731,26 @@ async def get_road_distance_matrix(locations: list) -> dict | None:
     return {"distances": distances, "durations": durations}
 
 
+async def _run_solver(executor: Optional[ThreadPoolExecutor], fn, *args, **kwargs):
+    """Ejecuta un solver síncrono fuera del event loop: en `executor` si se
+    pasa (carriles de jobs), si no en el pool por defecto (asyncio.to_thread)."""
+    if executor is None:
+        return await asyncio.to_thread(fn, *args, **kwargs)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+
 @app.post("/optimize", tags=["optimize"], summary="Optimizar ruta")
 async def optimize(request: OptimizeRequest, user=Depends(get_current_user)):
     """Calcula el orden óptimo de paradas para minimizar distancia/tiempo. Máximo 500 paradas."""
     if len(request.locations) > 500:
         raise HTTPException(status_code=400, detail="Máximo 500 paradas")
 
+    return await _run_optimize(request)
+
+
+async def _run_optimize(request: OptimizeRequest, executor: Optional[ThreadPoolExecutor] = None) -> dict:
+    """Cuerpo de /optimize, compartido con los jobs en background."""
     locations_data = [loc.model_dump() for loc in request.locations]
     depot_index = request.start_index or 0
 
@@ -1685,7 +1779,7 @@ async def optimize(request: OptimizeRequest, user=Depends(get_current_user)):
             for r in range(biz_matrix_size):
                 biz_dist_matrix[r][0] = 0
                 biz_dur_matrix[r][0] = 0
-            biz_result = await asyncio.to_thread(hybrid_optimize_route, biz_locs, 0, biz_dist_matrix, biz_dur_matrix)
+            biz_result = await _run_solver(executor, hybrid_optimize_route, biz_locs, 0, biz_dist_matrix, biz_dur_matrix)
 
             # Phase 2: Optimize non-business stops (open-ended from last business stop)
             if non_business_indices:
@@ -1699,7 +1793,7 @@ async def optimize(request: OptimizeRequest, user=Depends(get_current_user)):
                 for r in range(non_biz_size):
                     non_biz_dist_matrix[r][0] = 0
                     non_biz_dur_matrix[r][0] = 0
-                non_biz_result = await asyncio.to_thread(hybrid_optimize_route, non_biz_locs, 0, non_biz_dist_matrix, non_biz_dur_matrix)
+                non_biz_result = await _run_solver(executor, hybrid_optimize_route, non_biz_locs, 0, non_biz_dist_matrix, non_biz_dur_matrix)
                 # Combine: depot + business route + non-business route (skip depot of each)
                 combined_route = [locations_data[depot_index]]
                 if biz_result.get("success"):
@@ -1741,17 +1835,18 @@ async def optimize(request: OptimizeRequest, user=Depends(get_current_user)):
         # hilo y mantiene el loop responsivo (mismo patrón ya usado para Supabase).
         if request.solver == "vroom":
             from optimizer import solve_with_vroom
-            result = await asyncio.to_thread(solve_with_vroom, locations_data, depot_index, eff_dist, eff_dur)
+            result = await _run_solver(executor, solve_with_vroom, locations_data, depot_index, eff_dist, eff_dur)
         elif request.solver == "pyvrp":
             from optimizer import solve_with_pyvrp
-            result = await asyncio.to_thread(solve_with_pyvrp, locations_data, depot_index, eff_dist, eff_dur)
+            result = await _run_solver(executor, solve_with_pyvrp, locations_data, depot_index, eff_dist, eff_dur)
         elif request.solver == "ortools":
-            result = await asyncio.to_thread(
-                optimize_route, locations_data, depot_index, distance_matrix=eff_dist, duration_matrix=eff_dur
+            result = await _run_solver(
+                executor, optimize_route, locations_data, depot_index, distance_matrix=eff_dist, duration_matrix=eff_dur
             )
             result["solver"] = "ortools"
         else:
-            result = await asyncio.to_thread(
+            result = await _run_solver(
+                executor,
                 hybrid_optimize_route,
                 locations=locations_data,
                 depot_index=depot_index,
@@ -1775,6 +1870,142 @@ async def optimize(request: OptimizeRequest, user=Depends(get_current_user)):
     return result
 
 
+# --- Jobs de optimización en background -----------------------------------
+# /optimize tiene al cliente colgado de la conexión HTTP durante todo el
+# solve (hasta 45s con PyVRP + ~26s de reintentos OSRM). Con conexiones
+# móviles inestables eso acaba en timeouts y reintentos que repiten el solve.
+# POST /optimize/jobs devuelve un job_id al instante y el cliente hace polling
+# de GET /optimize/jobs/{job_id}.
+#
+# Sin broker (Redis/Celery) en este stack: el estado vive en memoria del
+# proceso web, que corre con un único worker uvicorn (Procfile). Dos carriles
+# con pools de hilos propios para que las rutas cortas (time_limit ~2s) no
+# queden detrás de solves largos (head-of-line blocking).
+#
+# Los jobs PENDING/STARTED viven en un dict aparte y pasan a la TTLCache al
+# terminar: ni el TTL ni el LRU por maxsize pueden expulsar un job en curso
+# (el cliente haría polling de un 404 mientras el solve sigue). El event loop
+# solo guarda referencias débiles a las tasks; _optimize_job_tasks las retiene
+# hasta que acaban para que el GC no se lleve un job a medias.
+_OPTIMIZE_JOB_TTL_S = 3600
+_OPTIMIZE_JOB_SHORT_MAX_STOPS = 20  # mismo corte que el time_limit de 2s de OR-Tools
+_OPTIMIZE_JOB_WORKERS = os.cpu_count() or 2
+_OPTIMIZE_JOB_MAX_ACTIVE = 1000
+_optimize_jobs: _TTLCache = _TTLCache(maxsize=1000, ttl=_OPTIMIZE_JOB_TTL_S)
+_optimize_jobs_active: dict[str, dict] = {}
+_optimize_job_tasks: set[asyncio.Task] = set()
+_optimize_job_pools = {
+    "routing_short": ThreadPoolExecutor(max_workers=_OPTIMIZE_JOB_WORKERS, thread_name_prefix="routing_short"),
+    "routing_long": ThreadPoolExecutor(max_workers=_OPTIMIZE_JOB_WORKERS, thread_name_prefix="routing_long"),
+}
+
+
+def _optimize_job_queue(num_locations: int) -> str:
+    return "routing_short" if num_locations < _OPTIMIZE_JOB_SHORT_MAX_STOPS else "routing_long"
+
+
+async def _execute_optimize_job(job_id: str, request: OptimizeRequest, queue: str) -> None:
+    job = _optimize_jobs_active.get(job_id)
+    if job is None:
+        return
+    job["status"] = "STARTED"
+    try:
+        job["result"] = await _run_optimize(request, executor=_optimize_job_pools[queue])
+        job["status"] = "SUCCESS"
+    except Exception as e:
+        logger.error(f"Optimize job {job_id} failed: {type(e).__name__}: {e}")
+        sentry_sdk.capture_exception(e)
+        job["status"] = "FAILURE"
+        job["error"] = "Error optimizando la ruta"
+    job["finished_at"] = datetime.now(timezone.utc).isoformat()
+    _optimize_jobs[job_id] = _optimize_jobs_active.pop(job_id)
+
+
+@app.post("/optimize/jobs", tags=["optimize"], summary="Optimizar ruta en background")
+async def create_optimize_job(request: OptimizeRequest, user=Depends(get_current_user)):
+    """Encola la optimización y devuelve un job_id para hacer polling. Máximo 500 paradas."""
+    if len(request.locations) > 500:
+        raise HTTPException(status_code=400, detail="Máximo 500 paradas")
+    if len(_optimize_jobs_active) >= _OPTIMIZE_JOB_MAX_ACTIVE:
+        raise HTTPException(status_code=503, detail="Demasiados jobs de optimización en curso, reintentar")
+
+    job_id = str(uuid.uuid4())
+    queue = _optimize_job_queue(len(request.locations))
+    _optimize_jobs_active[job_id] = {
+        "user_id": user["id"],
+        "status": "PENDING",
+        "queue": queue,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+    }
+    task = asyncio.create_task(_execute_optimize_job(job_id, request, queue))
+    _optimize_job_tasks.add(task)
+    task.add_done_callback(_optimize_job_tasks.discard)
+    return {"job_id": job_id, "status": "PENDING", "queue": queue}
+
+
+@app.get("/optimize/jobs/{job_id}", tags=["optimize"], summary="Estado de un job de optimización")
+async def get_optimize_job(job_id: str, user=Depends(get_current_user)):
+    """Devuelve el estado del job (PENDING/STARTED/SUCCESS/FAILURE) y el resultado si terminó."""
+    job = _optimize_jobs_active.get(job_id) or _optimize_jobs.get(job_id)
+    # Mismo 404 para inexistente/expirado y para jobs de otro usuario: no filtra ids.
+    if job is None or job["user_id"] != user["id"]:
+        raise HTTPException(status_code=404, detail="Job no encontrado o expirado")
+
+    response = {"job_id": job_id, "status": job["status"], "queue": job["queue"]}
+    if job["status"] == "SUCCESS":
+        response["result"] = job["result"]
+    elif job["status"] == "FAILURE":
+        response["error"] = job["error"]
+    return response
+
+
+# (dirección normalizada, país) → respuesta OK de /geocode. Los drivers
+# geocodifican las mismas direcciones una y otra vez (depot, clientes fijos);
+# 24h como la caché MSI, conservador frente al máximo de 30 días que permite
+# Google para lat/lng. Solo se cachean aciertos: ZERO_RESULTS y errores se
+# reintentan.
+_GEOCODE_CACHE_TTL_S = 24 * 3600
+_geocode_cache: _TTLCache = _TTLCache(maxsize=10_000, ttl=_GEOCODE_CACHE_TTL_S)
+# L2 persistente (tabla geocode_cache): la caché en memoria se pierde en cada
+# deploy de Railway. 30 días, el máximo que permite Google para lat/lng.
+_GEOCODE_L2_TTL_DAYS = 30
+
+
+def _geocode_cache_l2_get_sync(address_norm: str, country: str) -> Optional[dict]:
+    """L2 lookup (Supabase geocode_cache). Sync — llamado desde asyncio.to_thread.
+    Devuelve la respuesta cacheada si no ha expirado; None en miss o error."""
+    try:
+        r = (
+            supabase.table("geocode_cache")
+            .select("result")
+            .eq("address_normalized", address_norm)
+            .eq("country", country)
+            .gt("expires_at", datetime.now(timezone.utc).isoformat())
+            .limit(1)
+            .execute()
+        )
+        return r.data[0]["result"] if r.data else None
+    except Exception as e:
+        logger.info(f"geocode_cache L2 read failed: {e}")
+        return None
+
+
+def _geocode_cache_l2_set_sync(address_norm: str, country: str, result: dict) -> None:
+    """L2 write. Upsert por (dirección, país): repetirlo con la misma clave deja
+    una sola fila, así que dos workers que geocodifican a la vez no chocan.
+    Sync — fire-and-forget vía asyncio.to_thread; un fallo no rompe la respuesta."""
+    try:
+        expires_at = (datetime.now(timezone.utc) + timedelta(days=_GEOCODE_L2_TTL_DAYS)).isoformat()
+        supabase.table("geocode_cache").upsert({
+            "address_normalized": address_norm,
+            "country": country,
+            "result": result,
+            "expires_at": expires_at,
+        }, on_conflict="address_normalized,country").execute()
+    except Exception as e:
+        logger.info(f"geocode_cache L2 write failed: {e}")
+
+
 @app.post("/geocode", tags=["optimize"], summary="Geocodificar dirección")
 async def geocode(
     request: GeocodeRequest,
@@ -1794,25 +2025,32 @@ async def geocode(
     if not GOOGLE_API_KEY:
         raise HTTPException(status_code=503, detail="Geocoding service not configured")
 
+    cc = (request.country or "").strip().upper()
+    cache_key = (" ".join(request.address.lower().split()), cc)
+    cached = _geocode_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    cached = await asyncio.to_thread(_geocode_cache_l2_get_sync, *cache_key)
+    if cached is not None:
+        _geocode_cache[cache_key] = cached  # backfill L1
+        return cached
+
     params = {
         "address": request.address,
         "language": "es",
         "key": GOOGLE_API_KEY,
     }
-    if request.country:
-        cc = request.country.strip().upper()
-        if cc:
-            params["region"] = cc.lower()
-            params["components"] = f"country:{cc}"
+    if cc:
+        params["region"] = cc.lower()
+        params["components"] = f"country:{cc}"
 
     try:
-        async with httpx.AsyncClient(timeout=10) as client:
-            response = await client.get(
-                "https://maps.googleapis.com/maps/api/geocode/json",
-                params=params,
-                timeout=10.0,
-            )
-            data = response.json()
+        response = await google_maps_client().get(
+            "https://maps.googleapis.com/maps/api/geocode/json",
+            params=params,
+            timeout=10.0,
+        )
+        data = response.json()
     except Exception as e:
         logger.error(f"Geocode error: {e}")
         raise HTTPException(status_code=502, detail="Geocoding service error")
@@ -1827,7 +2065,7 @@ async def geocode(
     r = data["results"][0]
     geom = r.get("geometry", {}) or {}
     loc = geom.get("location", {}) or {}
-    return {
+    result = {
         "success": True,
         "lat": loc.get("lat"),
         "lng": loc.get("lng"),
@@ -1835,6 +2073,9 @@ async def geocode(
         "place_id": r.get("place_id", ""),
         "location_type": geom.get("location_type", ""),
     }
+    _geocode_cache[cache_key] = result
+    asyncio.create_task(asyncio.to_thread(_geocode_cache_l2_set_sync, *cache_key, result))
+    return result
 
 
 # === ENDPOINTS AVANZADOS DE OPTIMIZACIÓN ===
@@ -1861,7 +2102,8 @@ async def optimize_multi(request: MultiVehicleOptimizeRequest, user=Depends(get_
         num_vehicles=request.num_vehicles,
         depot_index=request.depot_index or 0,
         max_distance_per_vehicle=max_distance,
-        distance_matrix=road_matrix,
+        distance_matrix=road_matrix["distances"] if road_matrix else None,
+        balance_routes=request.balance_routes,
     )
     if road_matrix:
         result["distance_source"] = "road"
@@ -2146,10 +2388,44 @@ async def get_driver(driver_id: str, user=Depends(get_current_user)):
 
 # -- Rutas --
 
+_ROUTES_PAGE_SIZE = 50
+
+
+def _encode_routes_cursor(row: dict) -> str:
+    """Cursor opaco de GET /routes: (created_at, id) de la última fila de la
+    página, en base64 urlsafe para que el `+` del offset ISO no se rompa en
+    la query string."""
+    raw = json.dumps([row["created_at"], row["id"]], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def _decode_routes_cursor(cursor: str) -> tuple[str, str]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, route_id = json.loads(base64.urlsafe_b64decode(padded))
+        if not isinstance(created_at, str) or not isinstance(route_id, str):
+            raise ValueError
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="cursor inválido")
+    return created_at, route_id
+
+
 @app.get("/routes", tags=["routes"], summary="Listar rutas")
-async def get_routes(driver_id: Optional[str] = None, date: Optional[str] = None, user=Depends(get_current_user)):
-    """Lista rutas con sus paradas. Filtradas por propiedad del usuario y opcionalmente por conductor o fecha."""
-    query = supabase.table("routes").select("*, stops(*)")
+async def get_routes(
+    driver_id: Optional[str] = None,
+    date: Optional[str] = None,
+    limit: Optional[int] = Query(default=None, ge=1, le=200),
+    cursor: Optional[str] = None,
+    user=Depends(get_current_user),
+):
+    """Lista rutas con sus paradas. Filtradas por propiedad del usuario y opcionalmente por conductor o fecha.
+
+    Paginación keyset opcional por (created_at, id), más recientes primero: solo
+    si se pasa `limit` o `cursor` (sin ellos devuelve todas las rutas, como
+    siempre). `cursor` es el `next_cursor` de la página anterior; `next_cursor`
+    es null en la última página y cuando no se pagina."""
+    routes = supabase.table("routes")
+    query = routes.select("*, stops(*)")
 
     if user["role"] == "admin":
         if driver_id:
@@ -2168,22 +2444,45 @@ async def get_routes(driver_id: Optional[str] = None, date: Optional[str] = None
         elif company_driver_ids:
             query = query.in_("driver_id", company_driver_ids)
         else:
-            return {"routes": []}
-    else:
-        # Regular driver: only own routes
+            return {"routes": [], "next_cursor": None}
+    elif driver_id:
+        # Regular driver pidiendo un driver_id concreto: hay que resolver el suyo
+        # para distinguir "no es tuyo" (403) de "no tienes perfil" ([]).
         user_driver_id = await get_user_driver_id(user)
         if not user_driver_id:
-            return {"routes": []}
-        if driver_id and driver_id != user_driver_id:
+            return {"routes": [], "next_cursor": None}
+        if driver_id != user_driver_id:
             raise HTTPException(status_code=403, detail="No tienes acceso a estas rutas")
         query = query.eq("driver_id", user_driver_id)
+    else:
+        # Regular driver: solo sus rutas, en UNA consulta. El embed vacío
+        # drivers!inner() hace el join para filtrar por drivers.user_id sin
+        # añadir columnas a la respuesta, en vez de resolver antes el driver_id
+        # con otro viaje a Supabase. Sin perfil de driver el join no casa → [].
+        query = routes.select("*, stops(*), drivers!inner()").eq("drivers.user_id", user["id"])
 
     if date:
         query = query.eq("date", date)
 
-    query = query.order("created_at", desc=True)
+    paged = limit is not None or cursor is not None
+    if cursor:
+        # Keyset, no OFFSET: cada página cuesta lo mismo tenga el conductor
+        # 50 rutas o 10 000. El id desempata las rutas con el mismo
+        # created_at para no saltarse ninguna en el borde de página.
+        last_created_at, last_id = _decode_routes_cursor(cursor)
+        query = query.or_(
+            f'created_at.lt."{last_created_at}",'
+            f'and(created_at.eq."{last_created_at}",id.lt."{last_id}")'
+        )
+
+    query = query.order("created_at", desc=True).order("id", desc=True)
+    if paged:
+        limit = limit or _ROUTES_PAGE_SIZE
+        query = query.limit(limit)
     result = query.execute()
-    return {"routes": result.data}
+    rows = result.data or []
+    next_cursor = _encode_routes_cursor(rows[-1]) if paged and len(rows) == limit else None
+    return {"routes": rows, "next_cursor": next_cursor}
 
 
 @app.post("/routes", tags=["routes"], summary="Crear ruta")
@@ -2225,16 +2524,9 @@ async def create_route(route: RouteCreate, user=Depends(get_current_user)):
     if driver_company_id:
         route_data["company_id"] = driver_company_id
 
-    route_result = supabase.table("routes").insert(route_data).execute()
-    route_row = safe_first(route_result)
-    if not route_row:
-        raise HTTPException(status_code=500, detail="Error al crear la ruta")
-    route_id = route_row["id"]
-
     # Crear las paradas
     stops_data = [
         {
-            "route_id": route_id,
             "address": stop.address,
             "lat": stop.lat,
             "lng": stop.lng,
@@ -2260,18 +2552,21 @@ async def create_route(route: RouteCreate, user=Depends(get_current_user)):
         logger.warning(f"Stop enrichment failed: {e}")
         sentry_sdk.capture_exception(e)
 
-    stops_insert = supabase.table("stops").insert(stops_data).execute()
-    if not stops_insert.data:
-        logger.error(f"Failed to insert stops for route {route_id}")
-        raise HTTPException(status_code=500, detail="Error al crear las paradas de la ruta")
+    # Ruta + paradas en una sola transacción (RPC create_route_with_stops):
+    # un viaje en vez de insert routes → insert stops → select final, y si las
+    # paradas fallan no queda una ruta vacía huérfana. Devuelve la ruta con
+    # sus paradas, con la misma forma que select("*, stops(*)").
+    result = supabase.rpc("create_route_with_stops", {"p_route": route_data, "p_stops": stops_data}).execute()
+    if not result.data:
+        logger.error(f"create_route_with_stops returned no data for driver {route_request.driver_id}")
+        raise HTTPException(status_code=500, detail="Error al crear la ruta")
+    route_id = result.data["id"]
 
     # Si quien crea es dispatcher/admin (creando para un driver de la flota, no para sí
     # mismo), avisar al conductor con un push de "nueva ruta asignada".
     if user.get("role") in ("dispatcher", "admin"):
         await notify_driver_route_assigned(route_request.driver_id, route_id)
 
-    # Devolver ruta completa
-    result = supabase.table("routes").select("*, stops(*)").eq("id", route_id).single().execute()
     return result.data
 
 
@@ -2365,9 +2660,8 @@ async def _geocode_address(address: str, country: Optional[str] = None) -> Optio
         params["region"] = cc.lower()
         params["components"] = f"country:{cc}"
     try:
-        async with httpx.AsyncClient(timeout=10) as client:
-            resp = await client.get("https://maps.googleapis.com/maps/api/geocode/json", params=params, timeout=10.0)
-            data = resp.json()
+        resp = await google_maps_client().get("https://maps.googleapis.com/maps/api/geocode/json", params=params, timeout=10.0)
+        data = resp.json()
     except Exception as e:
         logger.warning(f"Geocode (import) error for '{address[:60]}': {e}")
         return None
@@ -4604,20 +4898,40 @@ class AdminResetPasswordRequest(BaseModel):
     password: Optional[str] = None  # If None, generate random
 
 
+# Reglas de contraseña (check, mensaje), en orden; construidas una vez al
+# importar. any(map(str.isupper, ...)) recorre en C, sin frame de generador.
+_PASSWORD_RULES = (
+    (lambda pw: len(pw) >= 8, "La contraseña debe tener al menos 8 caracteres"),
+    (lambda pw: any(map(str.isupper, pw)), "La contraseña debe incluir al menos una mayúscula"),
+    (lambda pw: any(map(str.isdigit, pw)), "La contraseña debe incluir al menos un número"),
+)
+_RESET_PASSWORD_CHARS = "ABCDEFGHJKLMNPQRSTUVWXYZabcdefghjkmnpqrstuvwxyz23456789!@#"
+
+
+def _password_error(password: str) -> Optional[str]:
+    """Mensaje de la primera regla que incumple `password`, o None si es válida."""
+    for check, message in _PASSWORD_RULES:
+        if not check(password):
+            return message
+    return None
+
+
 @app.post("/admin/users/{user_id}/reset-password", tags=["admin"], summary="Resetear contraseña")
 async def admin_reset_password(user_id: str, request: AdminResetPasswordRequest, user=Depends(require_admin)):
     """Resetea la contraseña de un usuario. Genera una aleatoria si no se proporciona. Solo admin."""
     try:
-        # Generate random password if not provided
-        chars = "ABCDEFGHJKLMNPQRSTUVWXYZabcdefghjkmnpqrstuvwxyz23456789!@#"
-        new_password = request.password or "".join(random.choices(chars, k=12))
-
-        if len(new_password) < 8:
-            raise HTTPException(status_code=400, detail="La contraseña debe tener al menos 8 caracteres")
-        if not any(c.isupper() for c in new_password):
-            raise HTTPException(status_code=400, detail="La contraseña debe incluir al menos una mayúscula")
-        if not any(c.isdigit() for c in new_password):
-            raise HTTPException(status_code=400, detail="La contraseña debe incluir al menos un número")
+        new_password = request.password
+        if new_password:
+            error = _password_error(new_password)
+            if error:
+                raise HTTPException(status_code=400, detail=error)
+        else:
+            # Generate random password if not provided. Repetir hasta cumplir
+            # las reglas: ~17% de las de 12 caracteres no traen ningún dígito,
+            # y antes eso devolvía un 400 al admin sin haber enviado nada.
+            new_password = "".join(random.choices(_RESET_PASSWORD_CHARS, k=12))
+            while _password_error(new_password):
+                new_password = "".join(random.choices(_RESET_PASSWORD_CHARS, k=12))
 
         # Update password via Supabase Admin API
         result = supabase.auth.admin.update_user_by_id(user_id, {"password": new_password})
@@ -4848,73 +5162,38 @@ async def get_audit_log(limit: int = 100, offset: int = 0, user=Depends(require_
         raise HTTPException(status_code=500, detail="Error obteniendo audit log")
 
 
+# Respuesta de /admin/stats cacheada 30s: el dashboard admin la sondea y
+# varias pestañas/admins comparten una sola llamada a admin_stats por ventana.
+# Sin lock: el handler no hace await entre el get y el set, así que dos
+# peticiones no se intercalan en el event loop. Solo se cachean éxitos.
+_admin_stats_cache: _TTLCache = _TTLCache(maxsize=1, ttl=30)
+
+
 @app.get("/admin/stats", tags=["admin"], summary="Estadísticas globales")
 async def admin_stats(user=Depends(require_admin)):
     """Estadísticas globales: usuarios, rutas, entregas, fallos. Solo admin."""
+    cached = _admin_stats_cache.get("stats")
+    if cached is not None:
+        return cached
     try:
         now_madrid = datetime.now(ZoneInfo("Europe/Madrid"))
         today_start = now_madrid.replace(hour=0, minute=0, second=0, microsecond=0).astimezone(timezone.utc).isoformat()
         week_start = (now_madrid - timedelta(days=now_madrid.weekday())).replace(hour=0, minute=0, second=0, microsecond=0).astimezone(timezone.utc).isoformat()
         month_start = now_madrid.replace(day=1, hour=0, minute=0, second=0, microsecond=0).astimezone(timezone.utc).isoformat()
 
-        # Total drivers
-        drivers_total = supabase.table("drivers").select("id", count="exact").execute()
-
-        # Active today (have routes created today) — paginar: contamos drivers
-        # DISTINTOS sobre las filas, así que necesitamos TODAS (no solo 1000).
-        routes_today_rows = fetch_all_rows(
-            lambda: supabase.table("routes").select("driver_id").gte("created_at", today_start).order("driver_id")
-        )
-        active_today_ids = {r["driver_id"] for r in routes_today_rows if r.get("driver_id")}
-
-        # Active this week
-        routes_week_rows = fetch_all_rows(
-            lambda: supabase.table("routes").select("driver_id").gte("created_at", week_start).order("driver_id")
-        )
-        active_week_ids = {r["driver_id"] for r in routes_week_rows if r.get("driver_id")}
-
-        # New drivers this month
-        new_month = supabase.table("drivers").select("id", count="exact").gte("created_at", month_start).execute()
-
-        # Routes counts
-        routes_total = supabase.table("routes").select("id", count="exact").execute()
-        routes_month = supabase.table("routes").select("id", count="exact").gte("created_at", month_start).execute()
-
-        # Stops delivered/failed
-        stops_total = supabase.table("stops").select("id", count="exact").eq("status", "completed").execute()
-        stops_today = supabase.table("stops").select("id", count="exact").eq("status", "completed").gte("completed_at", today_start).execute()
-        stops_week = supabase.table("stops").select("id", count="exact").eq("status", "completed").gte("completed_at", week_start).execute()
-        stops_month = supabase.table("stops").select("id", count="exact").eq("status", "completed").gte("completed_at", month_start).execute()
-        failed_today = supabase.table("stops").select("id", count="exact").eq("status", "failed").gte("created_at", today_start).execute()
-        failed_week = supabase.table("stops").select("id", count="exact").eq("status", "failed").gte("created_at", week_start).execute()
+        # Todas las cifras en una sola llamada (RPC admin_stats, migración
+        # 2026-10-16): antes eran 12 consultas secuenciales y los "activos"
+        # paginaban todas las rutas del día/semana para contar driver_id
+        # distintos en Python.
+        result = supabase.rpc("admin_stats", {
+            "p_today": today_start,
+            "p_week": week_start,
+            "p_month": month_start,
+        }).execute()
 
-        return {
-            "success": True,
-            "stats": {
-                "users": {
-                    "total": drivers_total.count or 0,
-                    "active_today": len(active_today_ids),
-                    "active_week": len(active_week_ids),
-                    "new_month": new_month.count or 0,
-                },
-                "routes": {
-                    "today": len(routes_today_rows),
-                    "week": len(routes_week_rows),
-                    "month": routes_month.count or 0,
-                    "total": routes_total.count or 0,
-                },
-                "deliveries": {
-                    "today": stops_today.count or 0,
-                    "week": stops_week.count or 0,
-                    "month": stops_month.count or 0,
-                    "total": stops_total.count or 0,
-                },
-                "failed": {
-                    "today": failed_today.count or 0,
-                    "week": failed_week.count or 0,
-                },
-            },
-        }
+        response = {"success": True, "stats": result.data}
+        _admin_stats_cache["stats"] = response
+        return response
     except Exception as e:
         logger.error(f"Admin stats error: {e}")
         raise HTTPException(status_code=500, detail="Error obteniendo estadísticas")
@@ -4924,43 +5203,15 @@ async def admin_stats(user=Depends(require_admin)):
 async def admin_list_companies(user=Depends(require_admin)):
     """Lista todas las empresas con conteo de drivers y suscripción. Solo admin."""
     try:
+        # Vista admin_companies_detailed (migración 2026-10-16): cada empresa ya
+        # trae driver_count y su suscripción más reciente. Antes eran tres
+        # lecturas paginadas (companies, links, subscriptions) y un bucketizado
+        # en Python.
         companies = fetch_all_rows(
-            lambda: supabase.table("companies").select("*").order("created_at", desc=True).order("id")
+            lambda: supabase.table("admin_companies_detailed").select("*").order("created_at", desc=True).order("id")
         )
-        company_ids = [c["id"] for c in companies]
-
-        # Batch fetch: all driver links and subscriptions in 2 queries instead of 2*N.
-        # Paginar: bucketizamos por company en Python, así que necesitamos TODAS las filas.
-        all_links_rows = fetch_all_rows(
-            lambda: supabase.table("company_driver_links").select("company_id").in_("company_id", company_ids).order("company_id")
-        ) if company_ids else []
-        # Tie-break por id para que el orden created_at desc sea estable entre páginas
-        # (el dedup de abajo asume "primera = más reciente").
-        all_subs_rows = fetch_all_rows(
-            lambda: supabase.table("company_subscriptions").select("*").in_("company_id", company_ids).order("created_at", desc=True).order("id")
-        ) if company_ids else []
-
-        # Build lookup maps
-        driver_counts: dict = {}
-        for link in all_links_rows:
-            cid = link["company_id"]
-            driver_counts[cid] = driver_counts.get(cid, 0) + 1
-
-        sub_map: dict = {}
-        for sub in all_subs_rows:
-            cid = sub["company_id"]
-            if cid not in sub_map:  # first = most recent (ordered desc)
-                sub_map[cid] = sub
-
-        result = []
-        for company in companies:
-            result.append({
-                **company,
-                "driver_count": driver_counts.get(company["id"], 0),
-                "subscription": sub_map.get(company["id"]),
-            })
 
-        return {"success": True, "companies": result}
+        return {"success": True, "companies": companies}
     except Exception as e:
         logger.error(f"Admin companies error: {e}")
         raise HTTPException(status_code=500, detail="Error listando empresas")
@@ -8107,10 +8358,264 @@ async def create_stripe_checkout(request: StripeCheckoutRequest, user=Depends(ge
         raise HTTPException(status_code=500, detail="Error en el servicio de pago")
 
 
+# stripe_customer_id → user_id. La relación no cambia tras el checkout, así que
+# las ráfagas de eventos del mismo customer (updated + invoice.paid + ...)
+# se ahorran el SELECT. Solo se cachean aciertos: un miss puede ser un
+# checkout aún no procesado y no queremos ocultarlo 1h.
+_stripe_customer_user_cache: _TTLCache = _TTLCache(maxsize=10_000, ttl=3600)
+
+
+def _resolve_stripe_customer_user(customer_id: str) -> Optional[str]:
+    """user_id del customer de Stripe (cacheado), o None si no hay usuario."""
+    user_id = _stripe_customer_user_cache.get(customer_id)
+    if user_id is not None:
+        return user_id
+    # maybe_single: PostgREST devuelve el objeto (o nada) en vez de una lista.
+    # limit(1) se queda: sin UNIQUE en stripe_customer_id, dos filas harían
+    # fallar maybe_single.
+    user_result = (
+        supabase.table("users").select("id").eq("stripe_customer_id", customer_id)
+        .limit(1).maybe_single().execute()
+    )
+    if not user_result or not user_result.data:
+        return None
+    user_id = user_result.data["id"]
+    _stripe_customer_user_cache[customer_id] = user_id
+    return user_id
+
+
+# Último `event.created` de customer.subscription.* procesado por customer.
+# Stripe no garantiza orden de entrega: un `updated` reintentado que llega
+# DESPUÉS del `deleted` reactivaba el plan de un usuario ya cancelado.
+_stripe_subscription_last_created: _TTLCache = _TTLCache(maxsize=10_000, ttl=86400)
+
+
+def _is_stale_subscription_event(customer_id: Optional[str], created) -> bool:
+    """True si ya procesamos un evento de suscripción más reciente de este customer.
+    Si no, registra `created` como el último visto."""
+    if not customer_id or not isinstance(created, (int, float)):
+        return False
+    last = _stripe_subscription_last_created.get(customer_id)
+    if last is not None and created < last:
+        return True
+    _stripe_subscription_last_created[customer_id] = created
+    return False
+
+
+def _is_superseded_subscription_event(customer_id: Optional[str], created) -> bool:
+    """Como _is_stale_subscription_event pero sin registrar: para revalidar un
+    evento antes de cada intento en background, cuando puede haber llegado (y
+    aplicado) otro más reciente del mismo customer mientras este reintentaba."""
+    if not customer_id or not isinstance(created, (int, float)):
+        return False
+    last = _stripe_subscription_last_created.get(customer_id)
+    return last is not None and created < last
+
+
+# Un lock por customer: dos eventos del mismo customer nunca se aplican a la
+# vez en el pool de webhooks (2 hilos). Weak values: el lock desaparece en
+# cuanto ningún hilo lo usa, sin crecer con cada customer visto.
+_stripe_customer_locks: "weakref.WeakValueDictionary[str, threading.Lock]" = weakref.WeakValueDictionary()
+_stripe_customer_locks_guard = threading.Lock()
+
+
+def _stripe_customer_lock(customer_id: str) -> threading.Lock:
+    with _stripe_customer_locks_guard:
+        lock = _stripe_customer_locks.get(customer_id)
+        if lock is None:
+            lock = _stripe_customer_locks[customer_id] = threading.Lock()
+        return lock
+
+
+def _apply_plan_change(
+    user_id: str,
+    plan: Optional[str],
+    expires_at: Optional[str],
+    source: Optional[str] = None,
+    customer_id: Optional[str] = None,
+    keep_plan: bool = False,
+) -> None:
+    """Actualiza plan/expiración en drivers + users en UNA llamada y una
+    transacción (RPC apply_plan_change, migración 2026-10-15). Antes eran dos
+    UPDATE secuenciales por webhook y un fallo entre ambos dejaba las tablas
+    desincronizadas. keep_plan=True solo mueve la expiración (renovación)."""
+    supabase.rpc("apply_plan_change", {
+        "p_user": user_id,
+        "p_plan": plan,
+        "p_expires": expires_at,
+        "p_source": source,
+        "p_customer": customer_id,
+        "p_keep_plan": keep_plan,
+    }).execute()
+
+
+def _process_stripe_event_sync(event) -> None:
+    """Un intento de _process_stripe_event: serializado por customer y, para
+    customer.subscription.*, descartado si entretanto se registró uno más
+    reciente (un `updated` reintentado no reactiva un plan ya `deleted`)."""
+    customer_id = getattr(event.data.object, "customer", None)
+    if not isinstance(customer_id, str):
+        _apply_stripe_event(event)
+        return
+    with _stripe_customer_lock(customer_id):
+        if event.type.startswith("customer.subscription.") and _is_superseded_subscription_event(
+            customer_id, getattr(event, "created", None)
+        ):
+            logger.info(f"Stripe webhook {event.type} superseded for {customer_id}, skipped")
+            return
+        _apply_stripe_event(event)
+
+
+def _apply_stripe_event(event) -> None:
+    """Aplica en BD un evento de Stripe ya verificado. Lanza si falla para que
+    _process_stripe_event reintente; todas las escrituras son idempotentes."""
+    event_type = event.type
+    data_obj = event.data.object
+
+    if event_type == "checkout.session.completed":
+        user_id = getattr(data_obj, "client_reference_id", None)
+        metadata = getattr(data_obj, "metadata", {})
+        plan = metadata.get("plan", "pro") if isinstance(metadata, dict) else getattr(metadata, "plan", "pro")
+        customer_id = getattr(data_obj, "customer", None)
+
+        logger.info(f"Stripe checkout.session.completed: user_id={user_id}, plan={plan}, customer={customer_id}")
+
+        if user_id:
+            expires_at = (datetime.now(timezone.utc) + timedelta(days=30)).isoformat()
+            # drivers (if user has a linked driver) + users (plan + stripe
+            # customer id) in one call. subscription_source='stripe' so
+            # getSubscriptionStatus can distinguish a paid subscription
+            # from a promo/trial — the TP-2 fix on the client side relies
+            # on this being set.
+            _apply_plan_change(user_id, plan, expires_at, source="stripe", customer_id=customer_id)
+            if customer_id:
+                _stripe_customer_user_cache[customer_id] = user_id
+            logger.info(f"Stripe plan {plan} activated for user {user_id}")
+
+    elif event_type == "customer.subscription.updated":
+        # Plan change mid-cycle (upgrade / downgrade / cancellation at
+        # period end). Without this handler, the new plan was never
+        # reflected in drivers.promo_plan — a user who upgraded via
+        # the Stripe Customer Portal would still see their old plan.
+        customer_id = getattr(data_obj, "customer", None)
+        status = getattr(data_obj, "status", None)
+        current_period_end = getattr(data_obj, "current_period_end", None)
+        items = getattr(data_obj, "items", None)
+        new_plan = None
+        try:
+            # items.data[0].price.id → map to our plan names
+            price_id = items.data[0].price.id if items and items.data else None
+            if price_id and STRIPE_PLANS:
+                for plan_name, plan_cfg in STRIPE_PLANS.items():
+                    if plan_cfg.get("price_id") == price_id:
+                        new_plan = plan_name
+                        break
+        except Exception:
+            pass
+        if customer_id and status in ("active", "trialing") and new_plan:
+            expires_at = None
+            if current_period_end:
+                expires_at = datetime.fromtimestamp(current_period_end, tz=timezone.utc).isoformat()
+            user_id = _resolve_stripe_customer_user(customer_id)
+            if user_id:
+                _apply_plan_change(user_id, new_plan, expires_at, source="stripe")
+                logger.info(f"Stripe subscription updated for user {user_id} → plan={new_plan}")
+
+    elif event_type == "customer.subscription.deleted":
+        customer_id = getattr(data_obj, "customer", None)
+        if customer_id:
+            user_id = _resolve_stripe_customer_user(customer_id)
+            # La suscripción terminó: no retener la relación en caché.
+            _stripe_customer_user_cache.pop(customer_id, None)
+            if user_id:
+                _apply_plan_change(user_id, None, None)
+                logger.info(f"Stripe subscription deleted for user {user_id}")
+
+    elif event_type in ("invoice.payment_succeeded", "invoice.paid"):
+        customer_id = getattr(data_obj, "customer", None)
+        billing_reason = getattr(data_obj, "billing_reason", None)
+        if customer_id and billing_reason == "subscription_cycle":
+            user_id = _resolve_stripe_customer_user(customer_id)
+            if user_id:
+                expires_at = (datetime.now(timezone.utc) + timedelta(days=30)).isoformat()
+                _apply_plan_change(user_id, None, expires_at, keep_plan=True)
+                logger.info(f"Stripe renewal for user {user_id}")
+
+    elif event_type == "invoice.payment_failed":
+        customer_id = getattr(data_obj, "customer", None)
+        attempt_count = getattr(data_obj, "attempt_count", None)
+        logger.warning(f"Stripe payment failed for customer {customer_id}, attempt {attempt_count}")
+        sentry_sdk.capture_message(
+            f"Stripe payment failed: customer={customer_id}, attempt={attempt_count}",
+            level="warning",
+        )
+        if attempt_count and int(attempt_count) >= 2:
+            try:
+                send_alert_email(
+                    ALERT_EMAIL,
+                    f"ALERTA: Pago Stripe fallido (intento {attempt_count})",
+                    f"Customer: {customer_id}\nIntento: {attempt_count}\n"
+                    f"Timestamp: {datetime.now(timezone.utc).isoformat()}Z\n\n"
+                    "Revisar en Stripe Dashboard: https://dashboard.stripe.com/payments",
+                )
+            except Exception:
+                pass
+
+    else:
+        logger.info(f"Stripe webhook unhandled event type: {event_type} (ignored)")
+
+
+# El procesado de eventos va fuera del request: Stripe corta a los 30s y
+# reintenta si tardamos, sumando carga justo cuando la BD va lenta. Pool propio
+# para que una ráfaga de webhooks no compita con los solvers de /optimize.
+_STRIPE_WEBHOOK_MAX_RETRIES = 5
+_STRIPE_WEBHOOK_RETRY_BASE_S = 1.0
+_STRIPE_WEBHOOK_MAX_BYTES = 65536
+_stripe_webhook_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="stripe_webhook")
+
+
+async def _process_stripe_event(event) -> None:
+    """Procesa el evento en el pool de webhooks con reintentos y backoff
+    exponencial. Ya respondimos 200 a Stripe, así que un fallo definitivo
+    solo queda en logs, Sentry y /health (last_webhook_error)."""
+    global _last_stripe_webhook_ok, _last_stripe_webhook_error
+    event_type = event.type
+    loop = asyncio.get_running_loop()
+    for attempt in range(_STRIPE_WEBHOOK_MAX_RETRIES + 1):
+        try:
+            await loop.run_in_executor(_stripe_webhook_pool, _process_stripe_event_sync, event)
+            _last_stripe_webhook_ok = datetime.now(timezone.utc)
+            return
+        except Exception as e:
+            if attempt < _STRIPE_WEBHOOK_MAX_RETRIES:
+                logger.warning(f"Stripe webhook {event_type} attempt {attempt + 1} failed, retrying: {e}")
+                await asyncio.sleep(_STRIPE_WEBHOOK_RETRY_BASE_S * 2 ** attempt)
+                continue
+            _last_stripe_webhook_error = datetime.now(timezone.utc)
+            logger.error(f"Stripe webhook error processing {event_type}: {type(e).__name__}: {e}")
+            sentry_sdk.capture_exception(e)
+
+
 @app.post("/stripe/webhook", tags=["webhooks"], summary="Webhook de Stripe")
-async def stripe_webhook(request: Request):
-    """Procesa eventos de Stripe (checkout completado, suscripción cancelada, renovación). Verificación por firma."""
-    payload = await request.body()
+async def stripe_webhook(request: Request, background_tasks: BackgroundTasks):
+    """Procesa eventos de Stripe (checkout completado, suscripción cancelada, renovación). Verificación por firma.
+    Responde en cuanto el evento está verificado y deduplicado; las escrituras van en background."""
+    # Los eventos de Stripe pesan <50 KB: cortar antes de leer el body evita
+    # cargar en memoria payloads basura que luego fallarían la firma.
+    try:
+        content_length = int(request.headers.get("content-length", "0"))
+    except ValueError:
+        content_length = 0
+    if content_length > _STRIPE_WEBHOOK_MAX_BYTES:
+        raise HTTPException(status_code=413, detail="Payload too large")
+    # Sin Content-Length (chunked) o si miente: leer por trozos y cortar en
+    # cuanto se pase del límite, sin llegar a acumular el body entero.
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > _STRIPE_WEBHOOK_MAX_BYTES:
+            raise HTTPException(status_code=413, detail="Payload too large")
+    payload = bytes(body)
     sig_header = request.headers.get("stripe-signature")
 
     if not STRIPE_WEBHOOK_SECRET:
@@ -8136,142 +8641,14 @@ async def stripe_webhook(request: Request):
         return {"received": True, "status": "already_processed"}
     _mark_webhook_processed(event_id, "stripe")
 
-    logger.info(f"Stripe webhook received event: {event_type}")
-
-    global _last_stripe_webhook_ok
-    try:
-        data_obj = event.data.object
-
-        if event_type == "checkout.session.completed":
-            user_id = getattr(data_obj, "client_reference_id", None)
-            metadata = getattr(data_obj, "metadata", {})
-            plan = metadata.get("plan", "pro") if isinstance(metadata, dict) else getattr(metadata, "plan", "pro")
-            customer_id = getattr(data_obj, "customer", None)
-
-            logger.info(f"Stripe checkout.session.completed: user_id={user_id}, plan={plan}, customer={customer_id}")
-
-            if user_id:
-                expires_at = (datetime.now(timezone.utc) + timedelta(days=30)).isoformat()
-                # Update drivers table (if user has a linked driver).
-                # subscription_source='stripe' so getSubscriptionStatus can
-                # distinguish a paid subscription from a promo/trial — the
-                # TP-2 fix on the client side relies on this being set.
-                supabase.table("drivers").update({
-                    "promo_plan": plan,
-                    "promo_plan_expires_at": expires_at,
-                    "subscription_source": "stripe",
-                }).eq("user_id", user_id).execute()
-                # Update users table (plan + stripe customer id)
-                supabase.table("users").update({
-                    "stripe_customer_id": customer_id,
-                    "promo_plan": plan,
-                    "promo_plan_expires_at": expires_at,
-                }).eq("id", user_id).execute()
-                logger.info(f"Stripe plan {plan} activated for user {user_id}")
-
-        elif event_type == "customer.subscription.updated":
-            # Plan change mid-cycle (upgrade / downgrade / cancellation at
-            # period end). Without this handler, the new plan was never
-            # reflected in drivers.promo_plan — a user who upgraded via
-            # the Stripe Customer Portal would still see their old plan.
-            customer_id = getattr(data_obj, "customer", None)
-            status = getattr(data_obj, "status", None)
-            current_period_end = getattr(data_obj, "current_period_end", None)
-            items = getattr(data_obj, "items", None)
-            new_plan = None
-            try:
-                # items.data[0].price.id → map to our plan names
-                price_id = items.data[0].price.id if items and items.data else None
-                if price_id and STRIPE_PLANS:
-                    for plan_name, plan_cfg in STRIPE_PLANS.items():
-                        if plan_cfg.get("price_id") == price_id:
-                            new_plan = plan_name
-                            break
-            except Exception:
-                pass
-            if customer_id and status in ("active", "trialing") and new_plan:
-                expires_at = None
-                if current_period_end:
-                    expires_at = datetime.fromtimestamp(current_period_end, tz=timezone.utc).isoformat()
-                user_result = supabase.table("users").select("id").eq("stripe_customer_id", customer_id).limit(1).execute()
-                if user_result.data:
-                    user_id = user_result.data[0]["id"]
-                    supabase.table("drivers").update({
-                        "promo_plan": new_plan,
-                        "promo_plan_expires_at": expires_at,
-                        "subscription_source": "stripe",
-                    }).eq("user_id", user_id).execute()
-                    supabase.table("users").update({
-                        "promo_plan": new_plan,
-                        "promo_plan_expires_at": expires_at,
-                    }).eq("id", user_id).execute()
-                    logger.info(f"Stripe subscription updated for user {user_id} → plan={new_plan}")
-
-        elif event_type == "customer.subscription.deleted":
-            customer_id = getattr(data_obj, "customer", None)
-            if customer_id:
-                user_result = supabase.table("users").select("id").eq("stripe_customer_id", customer_id).limit(1).execute()
-                if user_result.data:
-                    user_id = user_result.data[0]["id"]
-                    supabase.table("drivers").update({
-                        "promo_plan": None,
-                        "promo_plan_expires_at": None,
-                        "subscription_source": None,
-                    }).eq("user_id", user_id).execute()
-                    supabase.table("users").update({
-                        "promo_plan": None,
-                        "promo_plan_expires_at": None,
-                    }).eq("id", user_id).execute()
-                    logger.info(f"Stripe subscription deleted for user {user_id}")
-
-        elif event_type in ("invoice.payment_succeeded", "invoice.paid"):
-            customer_id = getattr(data_obj, "customer", None)
-            billing_reason = getattr(data_obj, "billing_reason", None)
-            if customer_id and billing_reason == "subscription_cycle":
-                user_result = supabase.table("users").select("id").eq("stripe_customer_id", customer_id).limit(1).execute()
-                if user_result.data:
-                    user_id = user_result.data[0]["id"]
-                    expires_at = (datetime.now(timezone.utc) + timedelta(days=30)).isoformat()
-                    supabase.table("drivers").update({
-                        "promo_plan_expires_at": expires_at,
-                    }).eq("user_id", user_id).execute()
-                    supabase.table("users").update({
-                        "promo_plan_expires_at": expires_at,
-                    }).eq("id", user_id).execute()
-                    logger.info(f"Stripe renewal for user {user_id}")
-
-        elif event_type == "invoice.payment_failed":
-            customer_id = getattr(data_obj, "customer", None)
-            attempt_count = getattr(data_obj, "attempt_count", None)
-            logger.warning(f"Stripe payment failed for customer {customer_id}, attempt {attempt_count}")
-            sentry_sdk.capture_message(
-                f"Stripe payment failed: customer={customer_id}, attempt={attempt_count}",
-                level="warning",
-            )
-            if attempt_count and int(attempt_count) >= 2:
-                try:
-                    send_alert_email(
-                        ALERT_EMAIL,
-                        f"ALERTA: Pago Stripe fallido (intento {attempt_count})",
-                        f"Customer: {customer_id}\nIntento: {attempt_count}\n"
-                        f"Timestamp: {datetime.now(timezone.utc).isoformat()}Z\n\n"
-                        "Revisar en Stripe Dashboard: https://dashboard.stripe.com/payments",
-                    )
-                except Exception:
-                    pass
-
-        else:
-            logger.info(f"Stripe webhook unhandled event type: {event_type} (ignored)")
-
-        _last_stripe_webhook_ok = datetime.now(timezone.utc)
-
-    except Exception as e:
-        global _last_stripe_webhook_error
-        _last_stripe_webhook_error = datetime.now(timezone.utc)
-        logger.error(f"Stripe webhook error processing {event_type}: {type(e).__name__}: {e}")
-        sentry_sdk.capture_exception(e)
-        raise HTTPException(status_code=500, detail="Internal webhook error")
+    if event_type.startswith("customer.subscription.") and _is_stale_subscription_event(
+        getattr(event.data.object, "customer", None), getattr(event, "created", None)
+    ):
+        logger.info(f"Stripe webhook stale {event_type} ignored: {event_id}")
+        return {"received": True, "status": "stale"}
 
+    logger.info(f"Stripe webhook received event: {event_type}")
+    background_tasks.add_task(_process_stripe_event, event)
     return {"received": True}
 
 
@@ -8587,8 +8964,10 @@ async def create_stripe_portal(user=Depends(get_current_user)):
 
     try:
         # Get stripe_customer_id from users table
-        user_result = supabase.table("users").select("stripe_customer_id").eq("id", user["id"]).single().execute()
-        customer_id = user_result.data.get("stripe_customer_id") if user_result.data else None
+        # maybe_single: un usuario sin fila en users es un 404 limpio, no la
+        # excepción 406 de .single() que acababa en 500.
+        user_result = supabase.table("users").select("stripe_customer_id").eq("id", user["id"]).maybe_single().execute()
+        customer_id = user_result.data.get("stripe_customer_id") if user_result and user_result.data else None
 
         if not customer_id:
             raise HTTPException(status_code=404, detail="No tienes una suscripcion activa")
@@ -9495,6 +9874,16 @@ async def places_autocomplete(
     return {"status": "ZERO_RESULTS", "predictions": [], "error_message": last_error}
 
 
+# place_id → respuesta de Details. El place_id es estable y el mismo lugar se
+# pide una y otra vez (depot, clientes recurrentes), así que 7 días es seguro.
+# Solo se cachea status OK. Solo se sirve a peticiones SIN sessiontoken: con
+# sesión, el Details Basic sale a $0 y es el que cierra la sesión de
+# autocomplete; un hit la dejaría abierta y cada pulsación pasaría a
+# facturarse como "Autocomplete – Per Request".
+_PLACES_DETAILS_CACHE_TTL_S = 7 * 86400
+_places_details_cache: _TTLCache = _TTLCache(maxsize=5000, ttl=_PLACES_DETAILS_CACHE_TTL_S)
+
+
 @app.get("/places/details", tags=["places"], summary="Detalles de lugar")
 async def places_details(
     place_id: str = Query(..., min_length=1, max_length=300),  # (S3) acota place_id
@@ -9518,6 +9907,11 @@ async def places_details(
     # se llama Places API New con field mask Essentials ($5/1000) en vez de
     # Legacy Place Details Basic ($17/1000). Mapper devuelve formato Legacy.
     api_version = await _get_places_api_version()
+    cache_key = (api_version, place_id)
+    cached = None if sessiontoken else _places_details_cache.get(cache_key)
+    if cached is not None:
+        logger.info(f"places_event=cache_hit endpoint=details place_id={place_id[:20]}")
+        return cached
     if api_version == "v1":
         client_v1 = google_maps_client()
         data = await places_v1.details_v1(
@@ -9530,6 +9924,8 @@ async def places_details(
             f"places_event=v1_called endpoint=details status={data.get('status')} "
             f"place_id={place_id[:20]}"
         )
+        if data.get("status") == "OK":
+            _places_details_cache[cache_key] = data
         return data
 
     # Field mask 21 may 2026: quitado `opening_hours` (Miguel + auditoría agentes 21 may 00:24).
@@ -9551,7 +9947,10 @@ async def places_details(
         params=params,
         timeout=10.0,
     )
-    return resp.json()
+    data = resp.json()
+    if data.get("status") == "OK":
+        _places_details_cache[cache_key] = data
+    return data
 
 
 @app.get("/places/snap", tags=["places"], summary="Alinear coordenadas a la red de carreteras de Google")
@@ -12076,19 +12475,15 @@ async def delete_account(user=Depends(get_current_user)):
                     except Exception as e:
                         deletion_errors.append(f"delivery_proofs: {e}")
 
-                # Batch delete tracking_links and stops for all routes at once (trocear route_ids)
+                # Batch delete tracking_links for all routes at once (trocear route_ids)
                 try:
                     for rid_chunk in chunked(route_ids, 500):
                         supabase.table("tracking_links").delete().in_("route_id", rid_chunk).execute()
                 except Exception as e:
                     deletion_errors.append(f"tracking_links: {e}")
-                try:
-                    for rid_chunk in chunked(route_ids, 500):
-                        supabase.table("stops").delete().in_("route_id", rid_chunk).execute()
-                except Exception as e:
-                    deletion_errors.append(f"stops delete: {e}")
 
-                # Delete all routes
+                # Delete all routes: las paradas caen por la FK
+                # stops.route_id ON DELETE CASCADE (migración 2026-10-16).
                 try:
                     supabase.table("routes").delete().eq("driver_id", driver_id).execute()
                 except Exception as e:
@@ -12120,6 +12515,7 @@ async def delete_account(user=Depends(get_current_user)):
             #   location_history    (driver_id)
             #   daily_usage         (driver_id)
             #   referrals           (referrer_driver_id, referred_driver_id)
+            #                       -- single DELETE with or_() below, not one per column
             tables_driver = [
                 ("trial_claims", "driver_id"),
                 ("app_events", "driver_id"),
@@ -12129,14 +12525,18 @@ async def delete_account(user=Depends(get_current_user)):
                 ("tracking_links", "driver_id"),
                 ("location_history", "driver_id"),
                 ("daily_usage", "driver_id"),
-                ("referrals", "referrer_driver_id"),
-                ("referrals", "referred_driver_id"),
             ]
             for table, column in tables_driver:
                 try:
                     supabase.table(table).delete().eq(column, driver_id).execute()
                 except Exception as e:
                     deletion_errors.append(f"{table}.{column}: {e}")
+            try:
+                supabase.table("referrals").delete().or_(
+                    f"referrer_driver_id.eq.{driver_id},referred_driver_id.eq.{driver_id}"
+                ).execute()
+            except Exception as e:
+                deletion_errors.append(f"referrals: {e}")
 
             # Delete the driver record
             try:
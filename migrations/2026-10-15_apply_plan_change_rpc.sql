@@ -0,0 +1,45 @@
+-- Migration: apply_plan_change RPC for the Stripe webhook
+-- Date: 2026-10-15
+-- Context: every plan-affecting Stripe event (checkout completed,
+-- subscription updated/deleted, renewal) issued two sequential UPDATEs from
+-- the backend, one on drivers and one on users. Two HTTP round trips per
+-- webhook, and no atomicity: a failure between them left drivers and users
+-- disagreeing on the plan. This function does both in a single call and a
+-- single transaction.
+--
+-- p_keep_plan = TRUE only moves the expiry (renewal), leaving promo_plan and
+-- subscription_source untouched. p_customer NULL keeps the stored
+-- stripe_customer_id.
+--
+-- ROLLBACK:
+--   DROP FUNCTION IF EXISTS public.apply_plan_change(UUID, TEXT, TIMESTAMPTZ, TEXT, TEXT, BOOLEAN);
+
+CREATE OR REPLACE FUNCTION public.apply_plan_change(
+  p_user UUID,
+  p_plan TEXT,
+  p_expires TIMESTAMPTZ,
+  p_source TEXT DEFAULT NULL,
+  p_customer TEXT DEFAULT NULL,
+  p_keep_plan BOOLEAN DEFAULT FALSE
+)
+RETURNS VOID
+LANGUAGE SQL
+SECURITY DEFINER
+SET search_path = public
+AS $$
+  UPDATE drivers
+  SET promo_plan = CASE WHEN p_keep_plan THEN promo_plan ELSE p_plan END,
+      promo_plan_expires_at = p_expires,
+      subscription_source = CASE WHEN p_keep_plan THEN subscription_source ELSE p_source END
+  WHERE user_id = p_user;
+
+  UPDATE users
+  SET stripe_customer_id = COALESCE(p_customer, stripe_customer_id),
+      promo_plan = CASE WHEN p_keep_plan THEN promo_plan ELSE p_plan END,
+      promo_plan_expires_at = p_expires
+  WHERE id = p_user;
+$$;
+
+-- Permisos: solo service_role (el backend) puede invocar.
+REVOKE ALL ON FUNCTION public.apply_plan_change(UUID, TEXT, TIMESTAMPTZ, TEXT, TEXT, BOOLEAN) FROM PUBLIC;
+GRANT EXECUTE ON FUNCTION public.apply_plan_change(UUID, TEXT, TIMESTAMPTZ, TEXT, TEXT, BOOLEAN) TO service_role;
@@ -0,0 +1,16 @@
+-- Migration: index users.stripe_customer_id
+-- Date: 2026-10-15
+-- Context: customer.subscription.updated/deleted and invoice renewals resolve
+-- the user with `SELECT id FROM users WHERE stripe_customer_id = ?`. Without
+-- an index that is a seq scan over users on every webhook. Partial index:
+-- most users never went through Stripe checkout (NULL customer id).
+--
+-- CONCURRENTLY → run outside a transaction block (Supabase SQL editor runs
+-- each statement on its own, OK).
+--
+-- ROLLBACK:
+--   DROP INDEX CONCURRENTLY IF EXISTS public.users_stripe_customer_idx;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS users_stripe_customer_idx
+  ON public.users (stripe_customer_id)
+  WHERE stripe_customer_id IS NOT NULL;
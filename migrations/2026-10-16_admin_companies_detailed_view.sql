@@ -0,0 +1,38 @@
+-- Migration: admin_companies_detailed view for GET /admin/companies
+-- Date: 2026-10-16
+-- Context: the admin company list fetched companies, then every
+-- company_driver_links row and every company_subscriptions row of those
+-- companies (paginated), and bucketed them in Python to get driver_count and
+-- the latest subscription. This view returns each company already joined
+-- with both, so the endpoint is one paginated read.
+--
+-- c.* is expanded when the view is created: after adding a column to
+-- companies, re-run this file so the view picks it up.
+--
+-- security_invoker: the view runs with the caller's privileges, so RLS on
+-- the base tables still applies to anyone but service_role.
+--
+-- ROLLBACK:
+--   DROP VIEW IF EXISTS public.admin_companies_detailed;
+
+CREATE OR REPLACE VIEW public.admin_companies_detailed
+WITH (security_invoker = true) AS
+SELECT
+  c.*,
+  (
+    SELECT COUNT(*)::INT
+    FROM company_driver_links l
+    WHERE l.company_id = c.id
+  ) AS driver_count,
+  (
+    SELECT to_jsonb(s)
+    FROM company_subscriptions s
+    WHERE s.company_id = c.id
+    ORDER BY s.created_at DESC, s.id
+    LIMIT 1
+  ) AS subscription
+FROM companies c;
+
+-- Permisos: solo service_role (el backend) puede leerla.
+REVOKE ALL ON public.admin_companies_detailed FROM PUBLIC, anon, authenticated;
+GRANT SELECT ON public.admin_companies_detailed TO service_role;
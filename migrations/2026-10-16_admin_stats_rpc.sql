@@ -0,0 +1,82 @@
+-- Migration: admin_stats RPC for GET /admin/stats
+-- Date: 2026-10-16
+-- Context: the admin dashboard stats endpoint issued 12 sequential queries
+-- (2 on drivers, 4 on routes, 6 on stops), and for "active drivers" paged
+-- every routes row of the day/week back to Python just to count distinct
+-- driver_id. This function computes every figure in one call, using
+-- COUNT(*) FILTER (...) and COUNT(DISTINCT driver_id) in SQL, returning
+-- the same nested JSON the endpoint already serves.
+--
+-- The window starts (today / week / month, Europe/Madrid) are computed by the
+-- backend and passed in as timestamptz.
+--
+-- ROLLBACK:
+--   DROP FUNCTION IF EXISTS public.admin_stats(TIMESTAMPTZ, TIMESTAMPTZ, TIMESTAMPTZ);
+
+CREATE OR REPLACE FUNCTION public.admin_stats(
+  p_today TIMESTAMPTZ,
+  p_week TIMESTAMPTZ,
+  p_month TIMESTAMPTZ
+)
+RETURNS JSONB
+LANGUAGE SQL
+STABLE
+SECURITY DEFINER
+SET search_path = public
+AS $$
+  WITH d AS (
+    SELECT COUNT(*) AS total,
+           COUNT(*) FILTER (WHERE created_at >= p_month) AS new_month
+    FROM drivers
+  ), r_all AS (
+    SELECT COUNT(*) AS total FROM routes
+  ), r AS (
+    -- Solo el rango reciente: con routes_created_at_driver_idx es un
+    -- index-only scan y COUNT(DISTINCT driver_id) no lee la tabla.
+    SELECT COUNT(*) FILTER (WHERE created_at >= p_today) AS today,
+           COUNT(*) FILTER (WHERE created_at >= p_week) AS week,
+           COUNT(*) FILTER (WHERE created_at >= p_month) AS month,
+           COUNT(DISTINCT driver_id) FILTER (WHERE created_at >= p_today) AS active_today,
+           COUNT(DISTINCT driver_id) FILTER (WHERE created_at >= p_week) AS active_week
+    FROM routes
+    WHERE created_at >= LEAST(p_today, p_week, p_month)
+  ), s AS (
+    SELECT COUNT(*) FILTER (WHERE status = 'completed') AS delivered_total,
+           COUNT(*) FILTER (WHERE status = 'completed' AND completed_at >= p_today) AS delivered_today,
+           COUNT(*) FILTER (WHERE status = 'completed' AND completed_at >= p_week) AS delivered_week,
+           COUNT(*) FILTER (WHERE status = 'completed' AND completed_at >= p_month) AS delivered_month,
+           COUNT(*) FILTER (WHERE status = 'failed' AND created_at >= p_today) AS failed_today,
+           COUNT(*) FILTER (WHERE status = 'failed' AND created_at >= p_week) AS failed_week
+    FROM stops
+    WHERE status IN ('completed', 'failed')
+  )
+  SELECT jsonb_build_object(
+    'users', jsonb_build_object(
+      'total', d.total,
+      'active_today', r.active_today,
+      'active_week', r.active_week,
+      'new_month', d.new_month
+    ),
+    'routes', jsonb_build_object(
+      'today', r.today,
+      'week', r.week,
+      'month', r.month,
+      'total', r_all.total
+    ),
+    'deliveries', jsonb_build_object(
+      'today', s.delivered_today,
+      'week', s.delivered_week,
+      'month', s.delivered_month,
+      'total', s.delivered_total
+    ),
+    'failed', jsonb_build_object(
+      'today', s.failed_today,
+      'week', s.failed_week
+    )
+  )
+  FROM d, r_all, r, s;
+$$;
+
+-- Permisos: solo service_role (el backend) puede invocar.
+REVOKE ALL ON FUNCTION public.admin_stats(TIMESTAMPTZ, TIMESTAMPTZ, TIMESTAMPTZ) FROM PUBLIC;
+GRANT EXECUTE ON FUNCTION public.admin_stats(TIMESTAMPTZ, TIMESTAMPTZ, TIMESTAMPTZ) TO service_role;
@@ -0,0 +1,72 @@
+-- Migration: create_route_with_stops RPC for POST /routes
+-- Date: 2026-10-16
+-- Context: creating a route took three sequential PostgREST calls after the
+-- access checks: INSERT routes, INSERT stops, then SELECT the route with its
+-- stops to return it. A failed stops insert left an empty route behind
+-- (the endpoint answered 500 but the routes row stayed). This function does
+-- both inserts in one transaction and returns the route with its stops in
+-- the same shape as `select("*, stops(*)")`.
+--
+-- Access checks (driver ownership / dispatcher company) and the customer
+-- directory enrichment stay in the backend; the payloads arrive ready to
+-- insert. Only the columns the endpoint sets are read, so every other column
+-- keeps its table default.
+--
+-- ROLLBACK:
+--   DROP FUNCTION IF EXISTS public.create_route_with_stops(JSONB, JSONB);
+
+CREATE OR REPLACE FUNCTION public.create_route_with_stops(
+  p_route JSONB,
+  p_stops JSONB
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+DECLARE
+  v_route routes%ROWTYPE;
+BEGIN
+  INSERT INTO routes (driver_id, name, total_distance_km, total_stops, status, company_id)
+  VALUES (
+    (p_route->>'driver_id')::uuid,
+    p_route->>'name',
+    (p_route->>'total_distance_km')::numeric,
+    (p_route->>'total_stops')::integer,
+    COALESCE(p_route->>'status', 'pending'),
+    (p_route->>'company_id')::uuid
+  )
+  RETURNING * INTO v_route;
+
+  INSERT INTO stops (
+    route_id, address, lat, lng, position, notes, phone, email,
+    time_window_start, time_window_end, packages
+  )
+  SELECT v_route.id, s.address, s.lat, s.lng, s.position, s.notes, s.phone, s.email,
+         s.time_window_start, s.time_window_end, s.packages
+  FROM jsonb_to_recordset(p_stops) AS s(
+    address TEXT,
+    lat NUMERIC,
+    lng NUMERIC,
+    position INTEGER,
+    notes TEXT,
+    phone TEXT,
+    email TEXT,
+    time_window_start TIME,
+    time_window_end TIME,
+    packages INTEGER
+  );
+
+  RETURN to_jsonb(v_route) || jsonb_build_object(
+    'stops',
+    COALESCE(
+      (SELECT jsonb_agg(to_jsonb(st) ORDER BY st.position) FROM stops st WHERE st.route_id = v_route.id),
+      '[]'::jsonb
+    )
+  );
+END;
+$$;
+
+-- Permisos: solo service_role (el backend) puede invocar.
+REVOKE ALL ON FUNCTION public.create_route_with_stops(JSONB, JSONB) FROM PUBLIC;
+GRANT EXECUTE ON FUNCTION public.create_route_with_stops(JSONB, JSONB) TO service_role;
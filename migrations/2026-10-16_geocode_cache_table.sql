@@ -0,0 +1,37 @@
+-- Migration: geocode_cache (L2 persistente de /geocode)
+-- Date: 2026-10-16
+-- Context: /geocode cachea aciertos en memoria (_geocode_cache, 24h), pero
+-- esa caché se vacía en cada deploy/restart de Railway y las direcciones
+-- recurrentes (depot, clientes fijos) vuelven a pagar Google Geocoding.
+-- Esta tabla es el segundo nivel: el backend la consulta en un miss de
+-- memoria y la rellena con upsert por (dirección normalizada, país), así que
+-- repetir la escritura es idempotente. TTL 30 días (máximo que permite
+-- Google para lat/lng).
+--
+-- ROLLBACK:
+--   SELECT cron.unschedule('purge_geocode_cache_expired');
+--   DROP TABLE IF EXISTS public.geocode_cache;
+
+CREATE TABLE IF NOT EXISTS public.geocode_cache (
+  address_normalized TEXT NOT NULL,      -- minúsculas, espacios colapsados
+  country            TEXT NOT NULL DEFAULT '',  -- ISO-2 en mayúsculas o ''
+  result             JSONB NOT NULL,     -- respuesta OK de /geocode
+  expires_at         TIMESTAMPTZ NOT NULL,
+  created_at         TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  PRIMARY KEY (address_normalized, country)
+);
+
+-- Index para purga de expirados (cron)
+CREATE INDEX IF NOT EXISTS geocode_cache_expires_idx
+  ON public.geocode_cache (expires_at);
+
+-- Tabla operacional: solo service_role (el backend), que bypassa RLS.
+ALTER TABLE public.geocode_cache ENABLE ROW LEVEL SECURITY;
+
+-- Purga diaria de expirados (pg_cron): el TTL de aplicación solo evita
+-- servir filas caducadas, no las borra.
+SELECT cron.schedule(
+  'purge_geocode_cache_expired',
+  '20 4 * * *',  -- 04:20 UTC
+  $$DELETE FROM public.geocode_cache WHERE expires_at < NOW()$$
+);
@@ -0,0 +1,16 @@
+-- Migration: index routes (created_at, driver_id)
+-- Date: 2026-10-16
+-- Context: admin_stats() counts routes and DISTINCT driver_id for today /
+-- this week / this month with `WHERE created_at >= ...`. Without an index
+-- that is a seq scan over routes on every dashboard load. With driver_id as
+-- the second key column the recent-range aggregate is an index-only scan:
+-- the distinct count never touches the heap.
+--
+-- CONCURRENTLY → run outside a transaction block (Supabase SQL editor runs
+-- each statement on its own, OK).
+--
+-- ROLLBACK:
+--   DROP INDEX CONCURRENTLY IF EXISTS public.routes_created_at_driver_idx;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS routes_created_at_driver_idx
+  ON public.routes (created_at, driver_id);
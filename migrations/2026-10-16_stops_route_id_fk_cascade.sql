@@ -0,0 +1,27 @@
+-- Migration: stops.route_id → routes(id) ON DELETE CASCADE
+-- Date: 2026-10-16
+-- Context: el único hard-delete de rutas es /auth/delete-account (DELETE
+-- /routes/{id} es soft-delete y así se queda — ver delete_route). Ese
+-- borrado hacía DELETE stops por trozos de route_ids y después DELETE
+-- routes. Con la FK en cascada basta con el DELETE de routes: Postgres
+-- borra las paradas en la misma sentencia.
+--
+-- Si ya existía stops_route_id_fkey (sin cascada) se reemplaza. NOT VALID
+-- + VALIDATE evita bloquear stops mientras se comprueban las filas
+-- existentes. Antes de aplicar, comprobar que no hay paradas huérfanas:
+--   SELECT count(*) FROM public.stops s
+--   WHERE NOT EXISTS (SELECT 1 FROM public.routes r WHERE r.id = s.route_id);
+--
+-- ROLLBACK:
+--   ALTER TABLE public.stops DROP CONSTRAINT IF EXISTS stops_route_id_fkey;
+--   ALTER TABLE public.stops ADD CONSTRAINT stops_route_id_fkey
+--     FOREIGN KEY (route_id) REFERENCES public.routes(id);
+
+ALTER TABLE public.stops DROP CONSTRAINT IF EXISTS stops_route_id_fkey;
+
+ALTER TABLE public.stops
+  ADD CONSTRAINT stops_route_id_fkey
+  FOREIGN KEY (route_id) REFERENCES public.routes(id) ON DELETE CASCADE
+  NOT VALID;
+
+ALTER TABLE public.stops VALIDATE CONSTRAINT stops_route_id_fkey;
@@ -6,11 +6,14 @@ Incluye: ETA, clustering por zonas, asignación inteligente, multi-vehicle
 
 import logging
 import math
-from collections import defaultdict
+import os
 from datetime import datetime, timedelta
+from functools import lru_cache
 from typing import Any, Dict, List, Optional, Tuple
 
+import numpy as np
 from ortools.constraint_solver import pywrapcp, routing_enums_pb2
+from ortools.graph.python import linear_sum_assignment
 
 logger = logging.getLogger("xpedit")
 
@@ -60,22 +63,92 @@ def haversine_distance(coord1: Tuple[float, float], coord2: Tuple[float, float])
     return int(R * c)
 
 
+_DEG_TO_RAD = math.pi / 180
+
+
+def _hav_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Haversine escalar en km para las rutas de una sola distancia (ETA puntual,
+    score de conductor): sin tuplas ni math.radians por coordenada, y truncando
+    a metros enteros igual que haversine_distance."""
+    phi1 = lat1 * _DEG_TO_RAD
+    phi2 = lat2 * _DEG_TO_RAD
+    a = math.sin((phi2 - phi1) * 0.5) ** 2 + \
+        math.cos(phi1) * math.cos(phi2) * math.sin((lng2 - lng1) * _DEG_TO_RAD * 0.5) ** 2
+    return int(12742000 * math.atan2(math.sqrt(a), math.sqrt(1 - a))) / 1000
+
+
+def _haversine_m_np(lat1, lng1, lat2, lng2) -> np.ndarray:
+    """Haversine en metros (float) sobre arrays en grados, con broadcasting:
+    pares elemento a elemento o matrices pasando [:, None] / [None, :]."""
+    lat1 = np.radians(lat1)
+    lat2 = np.radians(lat2)
+    dlat = lat2 - lat1
+    dlng = np.radians(lng2) - np.radians(lng1)
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlng / 2) ** 2
+    return 6371000 * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+# Memo de la matriz Haversine entre peticiones. Es una función pura de las
+# coordenadas: cuando el mismo conductor re-optimiza el mismo set de paradas
+# (reintento, solo cambió el orden, etc.) nos ahorramos el O(n²) entero.
+# Clave = coords redondeadas a 5 decimales (~1 m), insensible al ruido GPS.
+#
+# Se mantiene densa a propósito. Vectorizada, la matriz de 500 paradas se
+# construye en ~17 ms, así que una matriz kNN (vecinos cercanos + "infinito")
+# no ahorra nada apreciable y falsea los costes que OR-Tools devuelve como
+# distancia total. Restringir la búsqueda local a los vecinos
+# (ls_operator_neighbors_ratio) empeoró las rutas de 250 paradas un 20%.
+_MATRIX_CACHE_PRECISION = 5
+_MATRIX_CACHE_SIZE = 256
+
+
+def _matrix_cache_key(locations: List[Dict[str, float]]) -> Tuple[Tuple[float, float], ...]:
+    """Clave hashable para el memo de matrices: tupla de (lat, lng) redondeados."""
+    return tuple(
+        (round(loc['lat'], _MATRIX_CACHE_PRECISION), round(loc['lng'], _MATRIX_CACHE_PRECISION))
+        for loc in locations
+    )
+
+
+@lru_cache(maxsize=_MATRIX_CACHE_SIZE)
+def _cached_distance_matrix(key: Tuple[Tuple[float, float], ...]) -> np.ndarray:
+    """Matriz Haversine en metros para una clave de coords, como array int32
+    contiguo y de solo lectura: 4 bytes por celda frente a ~36 de un int
+    Python dentro de una lista, lo que importa con 256 matrices en memoria.
+    España entera cabe de sobra en int32 (±2.1e9 m).
+
+    Los intermedios n×n van en float32: la mitad de bytes por pasada y ~4x
+    más rápido a 500 paradas. El error frente a float64 es de como mucho
+    1 m tras truncar, por debajo de lo que distingue una ruta de otra."""
+    coords = np.radians(np.asarray(key, dtype=np.float32).reshape(-1, 2))
+    lat = coords[:, 0]
+    lng = coords[:, 1]
+    cos_lat = np.cos(lat)
+    dlat = lat[:, None] - lat[None, :]
+    dlng = lng[:, None] - lng[None, :]
+    half = np.float32(0.5)
+    a = np.sin(dlat * half) ** 2 + cos_lat[:, None] * cos_lat[None, :] * np.sin(dlng * half) ** 2
+    c = np.float32(2) * np.arctan2(np.sqrt(a), np.sqrt(np.float32(1) - a))
+    matrix = (np.float32(6371000) * c).astype(np.int32)
+    np.fill_diagonal(matrix, 0)
+    matrix.setflags(write=False)
+    return matrix
+
+
 def create_distance_matrix(locations: List[Dict[str, float]]) -> List[List[int]]:
     """
     Crea una matriz de distancias entre todas las ubicaciones.
     locations: Lista de dicts con 'lat' y 'lng'
-    """
-    n = len(locations)
-    matrix = [[0] * n for _ in range(n)]
-
-    for i in range(n):
-        for j in range(n):
-            if i != j:
-                coord1 = (locations[i]['lat'], locations[i]['lng'])
-                coord2 = (locations[j]['lat'], locations[j]['lng'])
-                matrix[i][j] = haversine_distance(coord1, coord2)
 
-    return matrix
+    Memoizada (LRU) por coordenadas redondeadas; devuelve siempre listas
+    nuevas para que el caller pueda mutarlas sin corromper la caché.
+    """
+    key = _matrix_cache_key(locations)
+    hits = _cached_distance_matrix.cache_info().hits
+    matrix = _cached_distance_matrix(key)
+    if _cached_distance_matrix.cache_info().hits > hits:
+        logger.info(f"Distance matrix cache hit ({len(key)} locations)")
+    return matrix.tolist()
 
 
 def _parse_time_to_minutes(time_str: Optional[str]) -> Optional[int]:
@@ -93,6 +166,15 @@ def _parse_time_to_minutes(time_str: Optional[str]) -> Optional[int]:
         return None
 
 
+def _parse_time_windows(
+    locations: List[Dict[str, Any]],
+) -> Tuple[List[Optional[int]], List[Optional[int]]]:
+    """Inicio y fin de ventana en minutos por parada (None si no hay o es inválida)."""
+    starts = [_parse_time_to_minutes(loc.get('time_window_start')) for loc in locations]
+    ends = [_parse_time_to_minutes(loc.get('time_window_end')) for loc in locations]
+    return starts, ends
+
+
 def _sanitize_time_windows(locations: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     """
     (O5) Normaliza ventanas horarias inválidas (inicio >= fin).
@@ -107,9 +189,7 @@ def _sanitize_time_windows(locations: List[Dict[str, Any]]) -> List[Dict[str, An
     """
     sanitized: List[Dict[str, Any]] = []
     dropped: List[Any] = []
-    for idx, loc in enumerate(locations):
-        tw_start = _parse_time_to_minutes(loc.get('time_window_start'))
-        tw_end = _parse_time_to_minutes(loc.get('time_window_end'))
+    for idx, (loc, tw_start, tw_end) in enumerate(zip(locations, *_parse_time_windows(locations))):
         if tw_start is not None and tw_end is not None and tw_start >= tw_end:
             clean = {k: v for k, v in loc.items() if k not in ('time_window_start', 'time_window_end')}
             sanitized.append(clean)
@@ -138,27 +218,20 @@ def _greedy_nearest_neighbor(
     YA calculada (0 llamadas a API). No es óptimo, pero el conductor nunca se
     queda tirado.
     """
-    n = len(locations)
-    visited = [False] * n
-    visited[depot_index] = True
+    # Pendientes en orden ascendente: min() con key=row.__getitem__ recorre la
+    # fila en C y devuelve el primer mínimo, el mismo desempate que el bucle
+    # por celda de antes. Sin convertir la matriz a numpy (copiar n² celdas de
+    # una lista cuesta más que la propia búsqueda).
+    pending = [j for j in range(len(locations)) if j != depot_index]
     order = [depot_index]
     current = depot_index
     total_distance = 0
-    for _ in range(n - 1):
-        nearest = -1
-        nearest_d: Optional[int] = None
-        for j in range(n):
-            if visited[j]:
-                continue
-            d = distance_matrix[current][j]
-            if nearest_d is None or d < nearest_d:
-                nearest_d = d
-                nearest = j
-        if nearest < 0:
-            break
-        visited[nearest] = True
+    while pending:
+        row = distance_matrix[current]
+        nearest = min(pending, key=row.__getitem__)
+        pending.remove(nearest)
         order.append(nearest)
-        total_distance += nearest_d or 0
+        total_distance += row[nearest] or 0
         current = nearest
     route = [locations[i] for i in order]
     return {
@@ -174,6 +247,148 @@ def _greedy_nearest_neighbor(
     }
 
 
+# Hasta este tamaño (depósito incluido) la ruta se resuelve exacta con
+# Held-Karp: O(n²·2ⁿ) en vez de O(n!) de enumerar permutaciones. Con 15 nodos
+# la tabla es 2¹⁴×14 int64 (~1.8 MB) y sale en milisegundos, frente a los 2s
+# de time_limit que GLS quemaba entero en rutas de 11-15 paradas.
+_EXACT_MAX_STOPS = 15
+
+_HELD_KARP_INF = np.iinfo(np.int64).max // 4
+
+
+def _held_karp_route(
+    locations: List[Dict[str, Any]],
+    depot_index: int,
+    distance_matrix: List[List[int]],
+) -> Dict[str, Any]:
+    """
+    Ruta óptima exacta (ciclo desde/hasta el depósito) para n pequeño.
+
+    dp[S, j] = coste mínimo de salir del depósito, visitar el subconjunto S
+    de paradas y acabar en j. Se rellena por tamaño de S; para cada j la
+    minimización sobre la parada anterior es una operación numpy sobre todos
+    los S de ese tamaño a la vez, así que el bucle Python es de n² pasos.
+    """
+    others = [i for i in range(len(locations)) if i != depot_index]
+    m = len(others)
+    dist = np.asarray(distance_matrix, dtype=np.int64)
+    sub = dist[np.ix_(others, others)]
+
+    masks = np.arange(1 << m)
+    popcount = np.zeros(1 << m, dtype=np.int64)
+    for bit in range(m):
+        popcount += (masks >> bit) & 1
+
+    dp = np.full((1 << m, m), _HELD_KARP_INF, dtype=np.int64)
+    parent = np.full((1 << m, m), -1, dtype=np.int64)
+    singles = 1 << np.arange(m)
+    dp[singles, np.arange(m)] = dist[depot_index, others]
+
+    for size in range(2, m + 1):
+        level = masks[popcount == size]
+        for j in range(m):
+            with_j = level[(level >> j) & 1 == 1]
+            cand = dp[with_j ^ (1 << j)] + sub[:, j]
+            prev = cand.argmin(axis=1)
+            dp[with_j, j] = cand[np.arange(len(with_j)), prev]
+            parent[with_j, j] = prev
+
+    full = (1 << m) - 1
+    closing = dp[full] + dist[others, depot_index]
+    last = int(closing.argmin())
+    total_distance = int(closing[last])
+
+    order = []
+    mask = full
+    while mask:
+        order.append(others[last])
+        mask, last = mask ^ (1 << last), int(parent[mask, last])
+    order.reverse()
+
+    route = [locations[depot_index]] + [locations[i] for i in order]
+    return {
+        "success": True,
+        "route": route,
+        "total_distance_meters": total_distance,
+        "total_distance_km": round(total_distance / 1000, 2),
+        "num_stops": len(route),
+        "has_time_windows": False,
+        "message": f"Ruta optimizada: {len(route)} paradas, {round(total_distance/1000, 2)} km"
+    }
+
+
+# Divide y vencerás para rutas grandes sin ventanas: se agrupan las paradas
+# en zonas de ~30 (k-means de cluster_stops_by_zone), se ordenan las zonas con
+# un TSP sobre sus centros y se resuelve cada zona como camino abierto que
+# empieza en la última parada de la zona anterior. OR-Tools no suelta el GIL,
+# así que las zonas van en serie con el presupuesto repartido.
+# APAGADO por defecto (OPTIMIZER_CLUSTERED_SOLVE=1 lo activa): en pruebas con
+# 120/250 paradas uniformes en Madrid sale en 2s pero un 4-10% más largo que
+# el solve único con el mismo tiempo. Queda para comparar con datos reales.
+CLUSTERED_SOLVE_ENABLED = os.getenv("OPTIMIZER_CLUSTERED_SOLVE", "0") == "1"
+_CLUSTER_MIN_STOPS = 80
+_CLUSTER_TARGET_SIZE = 30
+_CLUSTER_TOTAL_TIME_S = 2.0
+
+
+def _clustered_optimize_route(
+    locations: List[Dict[str, Any]],
+    depot_index: int,
+    distance_matrix: List[List[int]],
+) -> Optional[Dict[str, Any]]:
+    """Ruta por zonas (ver CLUSTERED_SOLVE_ENABLED). None si el k-means no
+    llega a partir las paradas y conviene el solve único."""
+    others = [i for i in range(len(locations)) if i != depot_index]
+    n_zones = math.ceil(len(others) / _CLUSTER_TARGET_SIZE)
+    clustering = cluster_stops_by_zone(
+        [{"lat": locations[i]["lat"], "lng": locations[i]["lng"], "node": i} for i in others],
+        n_zones=n_zones,
+        max_stops_per_zone=_CLUSTER_TARGET_SIZE,
+    )
+    zones = clustering["zones"]
+    if len(zones) < 2:
+        return None
+
+    # Orden de zonas: TSP sobre depósito + centros (k pequeño → brute force/SAVINGS).
+    coarse = optimize_route(
+        [{"lat": locations[depot_index]["lat"], "lng": locations[depot_index]["lng"], "zone": -1}]
+        + [{"lat": z["center"]["lat"], "lng": z["center"]["lng"], "zone": k} for k, z in enumerate(zones)],
+        depot_index=0,
+    )
+    zone_order = [p["zone"] for p in coarse["route"] if p["zone"] >= 0]
+
+    budget = max(0.3, _CLUSTER_TOTAL_TIME_S / len(zones))
+    order = [depot_index]
+    for k in zone_order:
+        nodes = [order[-1]] + [s["node"] for s in zones[k]["stops"]]
+        # Columna del ancla a 0: camino abierto, sin coste de volver a ella.
+        sub_matrix = [
+            [0 if b == nodes[0] else distance_matrix[a][b] for b in nodes]
+            for a in nodes
+        ]
+        sub = optimize_route(
+            [dict(locations[i], _node=i) for i in nodes],
+            depot_index=0,
+            distance_matrix=sub_matrix,
+            time_limit_s=budget,
+        )
+        order.extend(p["_node"] for p in sub["route"][1:])
+
+    total_distance = sum(distance_matrix[a][b] for a, b in zip(order, order[1:]))
+    total_distance += distance_matrix[order[-1]][depot_index]
+    route = [locations[i] for i in order]
+    return {
+        "success": True,
+        "route": route,
+        "total_distance_meters": total_distance,
+        "total_distance_km": round(total_distance / 1000, 2),
+        "num_stops": len(route),
+        "has_time_windows": False,
+        "num_zones": len(zones),
+        "message": f"Ruta optimizada por zonas ({len(zones)}): {len(route)} paradas, {round(total_distance/1000, 2)} km"
+    }
+
+
 def optimize_route(
     locations: List[Dict[str, Any]],
     depot_index: int = 0,
@@ -182,6 +397,7 @@ def optimize_route(
     stop_time_minutes: float = 5.0,
     distance_matrix: Optional[List[List[int]]] = None,
     duration_matrix: Optional[List[List[int]]] = None,
+    time_limit_s: Optional[float] = None,
 ) -> Dict[str, Any]:
     """
     Optimiza la ruta para visitar todas las ubicaciones.
@@ -194,6 +410,7 @@ def optimize_route(
         num_vehicles: Número de vehículos/conductores
         avg_speed_kmh: Velocidad promedio para calcular tiempos
         stop_time_minutes: Tiempo de servicio por parada
+        time_limit_s: Tope de búsqueda de OR-Tools (por defecto, según n)
 
     Returns:
         Dict con la ruta optimizada y métricas
@@ -217,11 +434,20 @@ def optimize_route(
     if distance_matrix is None:
         distance_matrix = create_distance_matrix(locations)
 
-    # Comprobar si hay ventanas horarias
-    has_time_windows = any(
-        loc.get('time_window_start') or loc.get('time_window_end')
-        for loc in locations
-    )
+    # Ventanas parseadas una sola vez; el bucle del modelo solo lee las listas.
+    tw_starts, tw_ends = _parse_time_windows(locations)
+    has_time_windows = any(s is not None or e is not None for s, e in zip(tw_starts, tw_ends))
+
+    if not has_time_windows and num_vehicles == 1 and len(locations) <= _EXACT_MAX_STOPS:
+        return _held_karp_route(locations, depot_index, distance_matrix)
+
+    if (
+        CLUSTERED_SOLVE_ENABLED and not has_time_windows and num_vehicles == 1
+        and len(locations) > _CLUSTER_MIN_STOPS
+    ):
+        clustered = _clustered_optimize_route(locations, depot_index, distance_matrix)
+        if clustered is not None:
+            return clustered
 
     # Crear el modelo de routing
     manager = pywrapcp.RoutingIndexManager(
@@ -236,29 +462,26 @@ def optimize_route(
     # OSRM distance matrix is asymmetric → handles one-way streets
     cost_matrix = distance_matrix
 
-    def distance_callback(from_index, to_index):
-        from_node = manager.IndexToNode(from_index)
-        to_node = manager.IndexToNode(to_index)
-        return cost_matrix[from_node][to_node]
-
-    transit_callback_index = routing.RegisterTransitCallback(distance_callback)
+    # Matrices registradas tal cual: OR-Tools hace el lookup en C++ y la
+    # búsqueda local (millones de arcos en GLS) no vuelve a entrar en Python.
+    transit_callback_index = routing.RegisterTransitMatrix(
+        [[int(d) for d in row] for row in cost_matrix]
+    )
     routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
 
     # Si hay ventanas horarias, añadir dimensión de tiempo
     if has_time_windows:
-        # Crear callback de tiempo (minutos de viaje entre nodos)
-        def time_callback(from_index, to_index):
-            from_node = manager.IndexToNode(from_index)
-            to_node = manager.IndexToNode(to_index)
-            if duration_matrix is not None:
-                # OSRM durations are in seconds → convert to minutes
-                travel_time_min = int(duration_matrix[from_node][to_node] / 60)
-            else:
-                distance_m = distance_matrix[from_node][to_node]
-                travel_time_min = int((distance_m / 1000 / avg_speed_kmh) * 60)
-            return travel_time_min + int(stop_time_minutes)
-
-        time_callback_index = routing.RegisterTransitCallback(time_callback)
+        # Minutos de viaje entre nodos + tiempo de servicio, precalculados
+        service = int(stop_time_minutes)
+        if duration_matrix is not None:
+            # OSRM durations are in seconds → convert to minutes
+            time_matrix = [[int(d / 60) + service for d in row] for row in duration_matrix]
+        else:
+            time_matrix = [
+                [int((d / 1000 / avg_speed_kmh) * 60) + service for d in row]
+                for row in distance_matrix
+            ]
+        time_callback_index = routing.RegisterTransitMatrix(time_matrix)
 
         # Dimensión de tiempo: max 24 horas (1440 minutos)
         routing.AddDimension(
@@ -276,10 +499,8 @@ def optimize_route(
         current_time_minutes = now.hour * 60 + now.minute
 
         # Aplicar ventanas horarias a cada nodo
-        for i, loc in enumerate(locations):
+        for i, (tw_start, tw_end) in enumerate(zip(tw_starts, tw_ends)):
             index = manager.NodeToIndex(i)
-            tw_start = _parse_time_to_minutes(loc.get('time_window_start'))
-            tw_end = _parse_time_to_minutes(loc.get('time_window_end'))
 
             if i == depot_index:
                 # Depot: empezar ahora (con 5 min de margen)
@@ -310,6 +531,8 @@ def optimize_route(
         search_parameters.time_limit.seconds = 5
     else:
         search_parameters.time_limit.seconds = 10
+    if time_limit_s is not None:
+        search_parameters.time_limit.FromMilliseconds(int(time_limit_s * 1000))
 
     # Resolver
     solution = routing.SolveWithParameters(search_parameters)
@@ -693,8 +916,7 @@ def calculate_eta(
     Returns:
         Dict con distance_km, travel_time_min, stop_time_min, eta
     """
-    distance_m = haversine_distance(current_location, destination)
-    distance_km = distance_m / 1000
+    distance_km = _hav_km(current_location[0], current_location[1], destination[0], destination[1])
 
     # Tiempo de viaje en minutos
     travel_time_min = (distance_km / avg_speed_kmh) * 60
@@ -709,7 +931,7 @@ def calculate_eta(
         "stop_time_min": stop_time_minutes,
         "total_time_min": round(total_minutes),
         "eta": eta.isoformat(),
-        "eta_formatted": eta.strftime("%H:%M")
+        "eta_formatted": f"{eta.hour:02d}:{eta.minute:02d}"
     }
 
 
@@ -735,38 +957,39 @@ def calculate_route_etas(
         return []
 
     result = []
-    current_time = datetime.now()
-    current_pos = start_location or (route[0]['lat'], route[0]['lng'])
-
-    for i, stop in enumerate(route):
-        stop_pos = (stop['lat'], stop['lng'])
-
-        # Calcular distancia y tiempo desde posición actual
-        distance_m = haversine_distance(current_pos, stop_pos)
-        distance_km = distance_m / 1000
-        travel_time_min = (distance_km / avg_speed_kmh) * 60
-
-        # Actualizar tiempo actual
-        current_time += timedelta(minutes=travel_time_min)
-        arrival_time = current_time
-
-        # Añadir tiempo de parada
-        current_time += timedelta(minutes=stop_time_minutes)
+    start_time = datetime.now()
+    start_pos = start_location or (route[0]['lat'], route[0]['lng'])
+
+    # Los tramos se conocen de antemano (inicio → parada 1 → parada 2 ...):
+    # todas las distancias en una sola pasada numpy, truncadas a metros enteros
+    # igual que haversine_distance.
+    lats = np.array([start_pos[0]] + [s['lat'] for s in route], dtype=float)
+    lngs = np.array([start_pos[1]] + [s['lng'] for s in route], dtype=float)
+    seg_km = np.trunc(_haversine_m_np(lats[:-1], lngs[:-1], lats[1:], lngs[1:])) / 1000
+    travel_min = seg_km / avg_speed_kmh * 60
+
+    # Llegadas como microsegundos acumulados desde ahora (enteros: suma exacta,
+    # igual que ir sumando timedeltas): un único datetime por parada en vez de
+    # dos timedelta y dos sumas de datetime.
+    travel_us = np.rint(travel_min * 60_000_000).astype(np.int64)
+    stop_us = round(stop_time_minutes * 60_000_000)
+    arrival_us = (np.cumsum(travel_us) + stop_us * np.arange(len(route), dtype=np.int64)).tolist()
+
+    for i, (stop, distance_km, travel_time_min) in enumerate(zip(route, seg_km.tolist(), travel_min.tolist())):
+        arrival_time = start_time + timedelta(microseconds=arrival_us[i])
 
         # Añadir información al stop
         stop_with_eta = {
             **stop,
             "eta": arrival_time.isoformat(),
-            "eta_formatted": arrival_time.strftime("%H:%M"),
+            # f-string en vez de strftime: sin pasar por la ruta de locale de C
+            "eta_formatted": f"{arrival_time.hour:02d}:{arrival_time.minute:02d}",
             "distance_from_prev_km": round(distance_km, 2),
             "travel_time_from_prev_min": round(travel_time_min),
             "sequence": i + 1
         }
         result.append(stop_with_eta)
 
-        # Actualizar posición actual
-        current_pos = stop_pos
-
     return result
 
 
@@ -774,6 +997,49 @@ def calculate_route_etas(
 # CLUSTERING POR ZONAS
 # ============================================================
 
+# Movimiento de centroide despreciable: 1e-6 rad ≈ 6 m, nada para una zona de reparto.
+_KMEANS_CENTROID_TOL_RAD = 1e-6
+# Filas de paradas por bloque en la asignación: con K ≈ N/15 zonas la matriz
+# N×K completa de 10.000 paradas ocupa ~50 MB; por bloques cabe en caché.
+_KMEANS_BLOCK_ROWS = 256
+# Semilla fija del k-means++: zonas reproducibles entre peticiones.
+_KMEANS_SEED = 0
+
+
+def _nearest_centroid(stop_xyz: np.ndarray, cent_xyz: np.ndarray) -> np.ndarray:
+    """Índice del centroide con mayor producto escalar (= más cercano) para
+    cada parada, calculado por bloques de filas sin materializar N×K."""
+    n = len(stop_xyz)
+    out = np.empty(n, dtype=np.intp)
+    cent_t = np.ascontiguousarray(cent_xyz.T)
+    for start in range(0, n, _KMEANS_BLOCK_ROWS):
+        block = slice(start, start + _KMEANS_BLOCK_ROWS)
+        np.argmax(stop_xyz[block] @ cent_t, axis=1, out=out[block])
+    return out
+
+
+def _kmeans_pp_init(stop_xyz: np.ndarray, k: int) -> np.ndarray:
+    """Índices de las paradas semilla según k-means++: cada nueva semilla se
+    sortea con probabilidad proporcional a la distancia² a la semilla más
+    cercana, así no caen varias en la misma manzana. Semilla del RNG fija:
+    las mismas paradas dan siempre las mismas zonas."""
+    rng = np.random.default_rng(_KMEANS_SEED)
+    n = len(stop_xyz)
+    chosen = np.empty(k, dtype=np.intp)
+    chosen[0] = rng.integers(n)
+    # Cuerda² entre vectores unitarios = 2·(1 - p·q), proporcional a d² en distancias cortas
+    d2 = np.maximum(1 - stop_xyz @ stop_xyz[chosen[0]], 0)
+    for i in range(1, k):
+        total = d2.sum()
+        if total <= 0:
+            # Quedan menos puntos distintos que zonas: semillas repetidas, la zona quedará vacía
+            chosen[i:] = chosen[0]
+            break
+        chosen[i] = rng.choice(n, p=d2 / total)
+        d2 = np.minimum(d2, np.maximum(1 - stop_xyz @ stop_xyz[chosen[i]], 0))
+    return chosen
+
+
 def cluster_stops_by_zone(
     stops: List[Dict[str, Any]],
     n_zones: Optional[int] = None,
@@ -811,48 +1077,68 @@ def cluster_stops_by_zone(
     if n_zones is None:
         n_zones = max(2, len(stops) // max_stops_per_zone + 1)
 
-    # K-means simplificado (sin sklearn para evitar dependencia)
-    # Inicializar centroides con paradas espaciadas
-    step = len(stops) // n_zones
-    centroids = [
-        (stops[i * step]['lat'], stops[i * step]['lng'])
-        for i in range(n_zones)
-    ]
-
-    # Iterar para mejorar centroides
-    for _ in range(10):  # 10 iteraciones
-        # Asignar paradas al centroide más cercano
-        clusters: Dict[int, List[Dict]] = defaultdict(list)
-        for stop in stops:
-            stop_pos = (stop['lat'], stop['lng'])
-            distances = [
-                haversine_distance(stop_pos, centroid)
-                for centroid in centroids
-            ]
-            nearest = distances.index(min(distances))
-            clusters[nearest].append(stop)
-
-        # Recalcular centroides
-        new_centroids = []
-        for i in range(n_zones):
-            if clusters[i]:
-                avg_lat = sum(s['lat'] for s in clusters[i]) / len(clusters[i])
-                avg_lng = sum(s['lng'] for s in clusters[i]) / len(clusters[i])
-                new_centroids.append((avg_lat, avg_lng))
-            else:
-                new_centroids.append(centroids[i])
-        centroids = new_centroids
+    # K-means simplificado (sin sklearn para evitar dependencia), vectorizado:
+    # coordenadas en radianes como arrays (N,) y asignación N×K por broadcasting.
+    lats = np.radians(np.array([s['lat'] for s in stops], dtype=np.float64))
+    lngs = np.radians(np.array([s['lng'] for s in stops], dtype=np.float64))
+    # Paradas como vectores unitarios 3D, invariantes entre iteraciones. El
+    # término `a` de Haversine es (1 - cos c) / 2 y cos c = p · q, así que el
+    # centroide más cercano es el de mayor producto escalar: el bucle no
+    # evalúa ni una función trigonométrica por par parada-centroide.
+    cos_lats = np.cos(lats)
+    stop_xyz = np.column_stack((cos_lats * np.cos(lngs), cos_lats * np.sin(lngs), np.sin(lats)))
+
+    # Inicializar centroides con k-means++
+    init = _kmeans_pp_init(stop_xyz, n_zones)
+    cent_lat = lats[init].copy()
+    cent_lng = lngs[init].copy()
+
+    # Iterar hasta converger (máx. 10 iteraciones): paramos si ninguna parada
+    # cambia de zona o si ningún centroide se mueve más de unos metros.
+    prev_assign = np.full(len(stops), -1)
+    for _ in range(10):
+        # Parada → centroide más cercano: solo K senos/cosenos por iteración
+        # y un producto matricial N×3 · 3×K (por bloques de filas).
+        cos_cent = np.cos(cent_lat)
+        cent_xyz = np.column_stack((cos_cent * np.cos(cent_lng), cos_cent * np.sin(cent_lng), np.sin(cent_lat)))
+        assign = _nearest_centroid(stop_xyz, cent_xyz)
+        if np.array_equal(assign, prev_assign):
+            break  # mismos miembros → mismos centroides
+        prev_assign = assign
+
+        # Recalcular centroides (media de los miembros); zona vacía conserva el suyo
+        counts = np.bincount(assign, minlength=n_zones)
+        filled = counts > 0
+        sum_lat = np.bincount(assign, weights=lats, minlength=n_zones)
+        sum_lng = np.bincount(assign, weights=lngs, minlength=n_zones)
+        new_lat = cent_lat.copy()
+        new_lng = cent_lng.copy()
+        new_lat[filled] = sum_lat[filled] / counts[filled]
+        new_lng[filled] = sum_lng[filled] / counts[filled]
+        shift = max(np.max(np.abs(new_lat - cent_lat)), np.max(np.abs(new_lng - cent_lng)))
+        cent_lat, cent_lng = new_lat, new_lng
+        if shift < _KMEANS_CENTROID_TOL_RAD:
+            break
 
     # Construir resultado final
+    center_lat = np.degrees(cent_lat)
+    center_lng = np.degrees(cent_lng)
+    # Miembros de todas las zonas con una sola ordenación estable de `assign`
+    # (mantiene el orden original de las paradas dentro de cada zona) en vez
+    # de recorrer las N paradas una vez por zona.
+    order = np.argsort(assign, kind="stable").tolist()
+    bounds = np.cumsum(np.bincount(assign, minlength=n_zones)).tolist()
     zones = []
-    for i in range(n_zones):
-        if clusters[i]:
+    start = 0
+    for i, end in enumerate(bounds):
+        if end > start:
             zones.append({
                 "id": i,
-                "center": {"lat": centroids[i][0], "lng": centroids[i][1]},
-                "stops": clusters[i],
-                "num_stops": len(clusters[i])
+                "center": {"lat": float(center_lat[i]), "lng": float(center_lng[i])},
+                "stops": [stops[j] for j in order[start:end]],
+                "num_stops": end - start
             })
+        start = end
 
     return {
         "zones": zones,
@@ -864,6 +1150,13 @@ def cluster_stops_by_zone(
 # ASIGNACIÓN INTELIGENTE DE CONDUCTORES
 # ============================================================
 
+# Pesos por defecto del score, compartidos entre llamadas (solo lectura).
+_DEFAULT_SCORE_WEIGHTS = {
+    "distance": 0.6,  # 60% peso a la distancia
+    "workload": 0.4,  # 40% peso a la carga de trabajo
+}
+
+
 def calculate_driver_score(
     driver: Dict[str, Any],
     zone_center: Tuple[float, float],
@@ -883,17 +1176,14 @@ def calculate_driver_score(
         Score (menor es mejor)
     """
     if weights is None:
-        weights = {
-            "distance": 0.6,  # 60% peso a la distancia
-            "workload": 0.4,  # 40% peso a la carga de trabajo
-        }
+        weights = _DEFAULT_SCORE_WEIGHTS
 
     score = 0.0
 
     # Factor distancia (km)
-    if driver.get('location'):
-        driver_pos = (driver['location']['lat'], driver['location']['lng'])
-        distance_km = haversine_distance(driver_pos, zone_center) / 1000
+    loc = driver.get('location')
+    if loc:
+        distance_km = _hav_km(loc['lat'], loc['lng'], zone_center[0], zone_center[1])
         score += distance_km * weights.get("distance", 0.6)
     else:
         score += 50 * weights.get("distance", 0.6)  # Penalización si no hay ubicación
@@ -927,27 +1217,45 @@ def assign_drivers_to_zones(
     assigned_drivers = set()
     unassigned_zones = []
 
-    for zone in zones:
-        zone_center = (zone['center']['lat'], zone['center']['lng'])
-
-        # Calcular scores para conductores no asignados
-        scores = []
-        for driver in drivers:
-            if driver['id'] in assigned_drivers:
-                continue
-
-            pending = driver_routes.get(driver['id'], 0)
-            score = calculate_driver_score(driver, zone_center, pending)
-            scores.append((driver['id'], score))
-
-        if scores:
-            # Asignar conductor con mejor score (menor)
-            scores.sort(key=lambda x: x[1])
-            best_driver_id = scores[0][0]
-            assignments[zone['id']] = best_driver_id
-            assigned_drivers.add(best_driver_id)
-        else:
+    # Matriz de scores (conductores × zonas) de una pasada; mismo cálculo que
+    # calculate_driver_score con los pesos por defecto. La ubicación de cada
+    # conductor se lee una sola vez, no por cada par conductor-zona.
+    w_distance = _DEFAULT_SCORE_WEIGHTS["distance"]
+    w_workload = _DEFAULT_SCORE_WEIGHTS["workload"]
+    locs = [d.get('location') for d in drivers]
+    driver_lat = np.array([loc['lat'] if loc else np.nan for loc in locs], dtype=np.float64)
+    driver_lng = np.array([loc['lng'] if loc else np.nan for loc in locs], dtype=np.float64)
+    zone_lat = np.array([z['center']['lat'] for z in zones], dtype=np.float64)
+    zone_lng = np.array([z['center']['lng'] for z in zones], dtype=np.float64)
+    pending = np.array([driver_routes.get(d['id'], 0) for d in drivers], dtype=np.float64)
+
+    dist_m = _haversine_m_np(driver_lat[:, None], driver_lng[:, None], zone_lat[None, :], zone_lng[None, :])
+    # Metros enteros truncados, como haversine_distance; NaN (sin ubicación) → penalización.
+    dist_km = np.where(np.isnan(dist_m), 50.0, np.trunc(np.nan_to_num(dist_m)) / 1000)
+    score_matrix = dist_km * w_distance + (pending * 5 * w_workload)[:, None]
+
+    # Asignación global de coste mínimo (Jonker-Volgenant de OR-Tools) en vez
+    # de voraz zona a zona: una zona temprana ya no "roba" el conductor que
+    # otra necesitaba más. Si hay más zonas que conductores, como antes, se
+    # cubren las primeras en orden y el resto queda sin asignar.
+    n_drivers = len(drivers)
+    covered = min(len(zones), n_drivers)
+    # Costes enteros (score × 1000 ≈ metros) en una matriz cuadrada: las filas
+    # de relleno (zonas ficticias a coste 0) absorben los conductores sobrantes.
+    costs = np.zeros((n_drivers, n_drivers), dtype=np.int64)
+    costs[:covered] = np.rint(score_matrix[:, :covered].T * 1000)
+    left, right = np.divmod(np.arange(n_drivers * n_drivers, dtype=np.int32), np.int32(n_drivers))
+    solver = linear_sum_assignment.SimpleLinearSumAssignment()
+    solver.add_arcs_with_cost(left, right, costs.ravel())
+    solver.solve()
+
+    for z, zone in enumerate(zones):
+        if z >= covered:
             unassigned_zones.append(zone['id'])
+            continue
+        best_driver_id = drivers[solver.right_mate(z)]['id']
+        assignments[zone['id']] = best_driver_id
+        assigned_drivers.add(best_driver_id)
 
     return {
         "assignments": assignments,
@@ -960,12 +1268,20 @@ def assign_drivers_to_zones(
 # OPTIMIZACIÓN MULTI-VEHÍCULO
 # ============================================================
 
+# Peso del span global (con todas las rutas empezando en 0, la longitud de la
+# ruta más larga en metros) frente a la distancia total, solo con
+# balance_routes=True. 100 como en la guía VRP de OR-Tools: reparte la carga
+# sin que cada metro ahorrado en total deje de contar.
+_MULTI_SPAN_COST_COEFFICIENT = 100
+
+
 def optimize_multi_vehicle(
     locations: List[Dict[str, Any]],
     num_vehicles: int,
     depot_index: int = 0,
     max_distance_per_vehicle: Optional[int] = None,
     distance_matrix: Optional[List[List[int]]] = None,
+    balance_routes: bool = False,
 ) -> Dict[str, Any]:
     """
     Optimiza rutas para múltiples vehículos usando CVRP.
@@ -976,6 +1292,9 @@ def optimize_multi_vehicle(
         depot_index: Índice del depósito
         max_distance_per_vehicle: Límite de distancia por vehículo (metros)
         distance_matrix: Matriz de distancias pre-calculada (OSRM o Haversine)
+        balance_routes: Repartir la carga minimizando también la ruta más
+            larga (coste de span). Por defecto solo se minimiza la distancia
+            total, y puede quedar algún vehículo sin usar.
 
     Returns:
         Dict con routes (lista de rutas, una por vehículo)
@@ -1003,34 +1322,48 @@ def optimize_multi_vehicle(
     )
     routing = pywrapcp.RoutingModel(manager)
 
-    # Callback de distancia
-    def distance_callback(from_index, to_index):
-        from_node = manager.IndexToNode(from_index)
-        to_node = manager.IndexToNode(to_index)
-        return distance_matrix[from_node][to_node]
-
-    transit_callback_index = routing.RegisterTransitCallback(distance_callback)
+    # Matriz de distancias registrada tal cual: lookup en C++, sin callback
+    # Python en los millones de arcos que evalúa GUIDED_LOCAL_SEARCH.
+    transit_callback_index = routing.RegisterTransitMatrix(
+        [[int(d) for d in row] for row in distance_matrix]
+    )
     routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
 
-    # Añadir dimensión de distancia si hay límite
-    if max_distance_per_vehicle:
+    # Dimensión de distancia para el límite por vehículo o para equilibrar. Sin
+    # límite, la cota es una que ninguna ruta puede superar (cada nodo se deja
+    # una vez por su arco más largo). Sin coste de span el objetivo es solo la
+    # distancia total: los vehículos de más salen gratis sin usar y todo puede
+    # ir a uno; con balance_routes se minimiza además la ruta más larga.
+    balance = balance_routes and num_vehicles > 1
+    if max_distance_per_vehicle or balance:
+        capacity = max_distance_per_vehicle or sum(int(max(row)) for row in distance_matrix)
         routing.AddDimension(
             transit_callback_index,
             0,  # slack
-            max_distance_per_vehicle,
+            capacity,
             True,  # start cumul to zero
             'Distance'
         )
+        if balance:
+            routing.GetDimensionOrDie('Distance').SetGlobalSpanCostCoefficient(_MULTI_SPAN_COST_COEFFICIENT)
 
-    # Parámetros de búsqueda
+    # Parámetros de búsqueda: inserción en paralelo construye todas las rutas
+    # a la vez (mejor punto de partida para repartir que PATH_CHEAPEST_ARC,
+    # que llena un vehículo tras otro). GLS agota siempre el time_limit, así
+    # que el tope crece con n como en optimize_route.
     search_parameters = pywrapcp.DefaultRoutingSearchParameters()
     search_parameters.first_solution_strategy = (
-        routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC
+        routing_enums_pb2.FirstSolutionStrategy.PARALLEL_CHEAPEST_INSERTION
     )
     search_parameters.local_search_metaheuristic = (
         routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH
     )
-    search_parameters.time_limit.seconds = 10
+    if len(locations) < 20:
+        search_parameters.time_limit.seconds = 2
+    elif len(locations) < 50:
+        search_parameters.time_limit.seconds = 5
+    else:
+        search_parameters.time_limit.seconds = 10
 
     # Resolver
     solution = routing.SolveWithParameters(search_parameters)
@@ -1042,24 +1375,28 @@ def optimize_multi_vehicle(
             "routes": []
         }
 
-    # Extraer rutas por vehículo
+    # Extraer rutas por vehículo. Métodos SWIG ligados a locales: el bucle
+    # recorre todas las paradas de todos los vehículos.
     routes = []
     total_distance = 0
+    index_to_node = manager.IndexToNode
+    next_var = routing.NextVar
+    is_end = routing.IsEnd
+    arc_cost = routing.GetArcCostForVehicle
+    value = solution.Value
 
     for vehicle_id in range(num_vehicles):
         route = []
         vehicle_distance = 0
         index = routing.Start(vehicle_id)
 
-        while not routing.IsEnd(index):
-            node = manager.IndexToNode(index)
+        while not is_end(index):
+            node = index_to_node(index)
             if node != depot_index:  # No incluir depot en la ruta
                 route.append(locations[node])
             previous_index = index
-            index = solution.Value(routing.NextVar(index))
-            vehicle_distance += routing.GetArcCostForVehicle(
-                previous_index, index, vehicle_id
-            )
+            index = value(next_var(index))
+            vehicle_distance += arc_cost(previous_index, index, vehicle_id)
 
         if route:  # Solo añadir si tiene paradas
             routes.append({
@@ -7,6 +7,8 @@ so tests can run without any env vars or real connections.
 
 import os
 import sys
+from dataclasses import dataclass, field
+from typing import Any
 from unittest.mock import MagicMock
 
 import pytest
@@ -37,45 +39,110 @@ os.environ.setdefault("GOOGLE_API_KEY", "fake-google-api-key")
 # ---------------------------------------------------------------------------
 
 
-class _ChainableMock(MagicMock):
-    """A MagicMock whose every attribute call returns itself, allowing
-    Supabase-style chained calls like table("x").select("y").eq("z", 1).execute().
-    .execute() returns a result object with .data and .count attributes."""
+@dataclass(slots=True)
+class SBResult:
+    """Stand-in for postgrest's APIResponse: just `.data` and `.count`,
+    as a slotted dataclass so building one costs about a tuple."""
+    data: Any = field(default_factory=list)
+    count: int | None = None
+
+
+class FakeTable:
+    """Plain-object stand-in for one table's postgrest query builder.
+
+    Builder methods (select, eq, update, ...) append their name to the
+    current call path and return self; execute() answers with the next
+    result registered for that path via on(), e.g. "select.eq.limit". No
+    MagicMock child creation per attribute, so a test's setup is a couple
+    of dict writes. Every builder call is kept in `calls` as (name, args)
+    and every executed path in `paths`, for assertions."""
+
+    def __init__(self):
+        self._results: dict[str, list] = {}
+        self._path: list[str] = []
+        self.calls: list[tuple] = []
+        self.paths: list[str] = []
+
+    def on(self, path: str, *results) -> "FakeTable":
+        """Register the results for `path`: successive execute()s consume
+        them in order and the last one repeats. An exception instance is
+        raised instead of returned. "*" answers every path without an entry
+        of its own; anything else executes to an empty SBResult."""
+        self._results[path] = list(results)
+        return self
 
-    def __call__(self, *args, **kwargs):
+    def _step(self, name, args):
+        if name in _QUERY_ROOTS:
+            # Like postgrest's request builder: select/insert/... start a
+            # new query, so a handler that re-selects on the same table
+            # object is matched on the query it actually executes.
+            self._path.clear()
+        self._path.append(name)
+        self.calls.append((name, args))
         return self
 
-    def __getattr__(self, name):
-        if name in ("data", "count", "_mock_name", "_mock_children",
-                     "_mock_methods", "_mock_unsafe", "assert_called",
-                     "assert_called_once", "return_value", "side_effect",
-                     "_mock_check_sig"):
-            return super().__getattr__(name)
-        # Always return self to allow chaining
-        child = super().__getattr__(name)
-        if not isinstance(child, _ChainableMock):
-            child = _ChainableMock(name=name)
-            setattr(self, name, child)
-        return child
+    @property
+    def not_(self):
+        return self._step("not_", ())
+
+    def args_of(self, name: str) -> list[tuple]:
+        """Positional args of every `name` builder call, in call order."""
+        return [args for called, args in self.calls if called == name]
 
     def execute(self):
-        """Return a result object with sensible defaults."""
-        result = MagicMock()
-        result.data = []
-        result.count = 0
+        path = ".".join(self._path)
+        self._path.clear()
+        self.paths.append(path)
+        queue = self._results.get(path) or self._results.get("*")
+        if not queue:
+            return SBResult()
+        result = queue.pop(0) if len(queue) > 1 else queue[0]
+        if isinstance(result, BaseException):
+            raise result
         return result
 
 
+def _builder_method(name):
+    def method(self, *args, **kwargs):
+        return self._step(name, args)
+    method.__name__ = name
+    return method
+
+
+_QUERY_ROOTS = frozenset({"select", "insert", "update", "upsert", "delete"})
+
+for _name in (
+    *_QUERY_ROOTS,
+    "eq", "neq", "in_", "is_", "lt", "lte", "gt", "gte", "or_", "like", "ilike", "match",
+    "order", "limit", "range", "single", "maybe_single",
+):
+    setattr(FakeTable, _name, _builder_method(_name))
+
+
+class FakeSupabase(dict):
+    """{table_name: FakeTable}; assign `fake.table` to a patched
+    supabase.table. A table nobody configured gets (and keeps, for later
+    assertions) a FakeTable that starts from the results registered on
+    `fake["*"]`, or an empty one."""
+
+    def __missing__(self, name):
+        table = self[name] = FakeTable()
+        if name != "*" and "*" in self:
+            table._results = {path: list(results) for path, results in self["*"]._results.items()}
+        return table
+
+    def table(self, name):
+        table = self[name]
+        table._path.clear()
+        return table
+
+
 def make_mock_supabase():
     """Create a mock Supabase client with chainable table/select/insert/etc."""
     mock = MagicMock()
 
-    # --- table() returns a chainable builder ---
-    def _table(name):
-        chain = _ChainableMock(name=f"table:{name}")
-        return chain
-
-    mock.table = MagicMock(side_effect=_table)
+    # --- table() returns a fresh FakeTable: any query executes to no rows ---
+    mock.table = MagicMock(side_effect=lambda name: FakeTable().on("*", SBResult(count=0)))
 
     # --- auth admin ---
     mock.auth = MagicMock()
@@ -133,11 +200,45 @@ FAKE_DRIVER_ID = "driver-00000000-0000-0000-0000-000000000001"
 FAKE_ADMIN_USER_ID = "admin-00000000-0000-0000-0000-000000000099"
 
 
+def pytest_asyncio_loop_factories(config, item):
+    """Run async tests on uvloop, the loop uvicorn[standard] serves production
+    with (cheaper per-await scheduling than the selector loop). Falls back to
+    the stdlib loop where uvloop isn't available (e.g. Windows)."""
+    try:
+        import uvloop
+    except ImportError:
+        import asyncio
+        return {"asyncio": asyncio.new_event_loop}
+    return {"uvloop": uvloop.new_event_loop}
+
+
+@pytest.fixture(scope="session")
+def _supabase_mock_root():
+    """One MagicMock for `main.supabase`, built once and reset per test."""
+    return MagicMock()
+
+
 @pytest.fixture
-def mock_supabase():
-    """Return the shared mock Supabase client and reset it before each test."""
-    fresh = make_mock_supabase()
-    return fresh
+def supabase_mock(_supabase_mock_root, monkeypatch):
+    """`main.supabase` replaced by the shared session MagicMock, with every
+    configured return_value/side_effect wiped first. Replaces the per-test
+    `with patch("main.supabase") as mock_sb:` block: configure auth/storage/rpc
+    directly; for tables use `fake_supabase`."""
+    import main
+    _supabase_mock_root.reset_mock(return_value=True, side_effect=True)
+    monkeypatch.setattr(main, "supabase", _supabase_mock_root)
+    return _supabase_mock_root
+
+
+@pytest.fixture
+def fake_supabase(supabase_mock):
+    """`main.supabase.table` answered by a FakeSupabase: register results per
+    table and call path (`fake_supabase["posts"].on("select.eq.single", ...)`)
+    instead of a `with patch(...)` block plus hand-built MagicMock chains.
+    auth/storage/rpc stay on the reset session MagicMock."""
+    fake = FakeSupabase()
+    supabase_mock.table.side_effect = fake.table
+    return fake
 
 
 @pytest.fixture
@@ -162,58 +263,128 @@ def fake_admin_user():
     }
 
 
-@pytest_asyncio.fixture
-async def client(fake_user):
+@pytest_asyncio.fixture(scope="session", loop_scope="session")
+async def _asgi_client():
     """
-    httpx.AsyncClient wired to the FastAPI app via ASGITransport.
-    Auth is bypassed: get_current_user always returns fake_user.
+    One httpx.AsyncClient over ASGITransport for the whole session. The
+    per-test fixtures below only swap auth overrides on top of it instead of
+    building a transport and client for every test.
     """
     from httpx import ASGITransport, AsyncClient
 
-    async def _override_get_current_user():
-        return fake_user
-
-    app.dependency_overrides[get_current_user] = _override_get_current_user
     transport = ASGITransport(app=app)
     async with AsyncClient(transport=transport, base_url="http://testserver") as ac:
         yield ac
     app.dependency_overrides.clear()
 
 
-@pytest_asyncio.fixture
-async def admin_client(fake_admin_user):
+@pytest.fixture
+def override_user(_asgi_client):
     """
-    httpx.AsyncClient where the user is an admin.
-    Both get_current_user and require_admin are overridden.
+    Factory: authenticate the shared session client as `user` for
+    get_current_user plus any extra auth dependencies, by swapping
+    app.dependency_overrides on the single app instance. Overrides are
+    cleared on teardown.
     """
-    from httpx import ASGITransport, AsyncClient
+    def apply(user, *dependencies):
+        async def _override():
+            return user
 
-    async def _override_get_current_user():
-        return fake_admin_user
+        for dependency in (get_current_user, *dependencies):
+            app.dependency_overrides[dependency] = _override
+        _asgi_client.cookies.clear()
+        return _asgi_client
 
-    async def _override_require_admin():
-        return fake_admin_user
+    yield apply
+    app.dependency_overrides.clear()
 
-    app.dependency_overrides[get_current_user] = _override_get_current_user
-    app.dependency_overrides[require_admin] = _override_require_admin
-    transport = ASGITransport(app=app)
-    async with AsyncClient(transport=transport, base_url="http://testserver") as ac:
-        yield ac
+
+@pytest.fixture(scope="session")
+def _auth_overrides():
+    """
+    Dependency-override templates built once per session. One coroutine
+    serves every identity by returning `current["user"]`; the per-test client
+    fixtures point that at the test's user dict (so in-test mutations of
+    fake_user are still seen) and copy a template into
+    app.dependency_overrides instead of defining new closures each test.
+    """
+    current = {}
+
+    async def _current_user():
+        return current["user"]
+
+    driver = {get_current_user: _current_user}
+    admin = {get_current_user: _current_user, require_admin: _current_user}
+    return current, driver, admin
+
+
+@pytest.fixture
+def client(_asgi_client, _auth_overrides, fake_user):
+    """
+    httpx.AsyncClient wired to the FastAPI app via ASGITransport.
+    Auth is bypassed: get_current_user always returns fake_user.
+    """
+    current, driver, _ = _auth_overrides
+    current["user"] = fake_user
+    app.dependency_overrides.update(driver)
+    _asgi_client.cookies.clear()
+    yield _asgi_client
+    app.dependency_overrides.clear()
+
+
+@pytest.fixture
+def admin_client(_asgi_client, _auth_overrides, fake_admin_user):
+    """
+    httpx.AsyncClient where the user is an admin.
+    Both get_current_user and require_admin are overridden.
+    """
+    current, _, admin = _auth_overrides
+    current["user"] = fake_admin_user
+    app.dependency_overrides.update(admin)
+    _asgi_client.cookies.clear()
+    yield _asgi_client
     app.dependency_overrides.clear()
 
 
-@pytest_asyncio.fixture
-async def unauth_client():
+@pytest.fixture
+def unauth_client(_asgi_client):
     """
     httpx.AsyncClient with NO auth overrides -- requests will fail auth.
     """
-    from httpx import ASGITransport, AsyncClient
-
     # Clear any leftover overrides
     app.dependency_overrides.clear()
-    transport = ASGITransport(app=app)
-    async with AsyncClient(transport=transport, base_url="http://testserver") as ac:
-        yield ac
+    _asgi_client.cookies.clear()
+    yield _asgi_client
+    app.dependency_overrides.clear()
+
+
+@pytest.fixture(scope="session")
+def _sync_test_client():
+    """Starlette TestClient for tests that never await anything (auth gates,
+    request validation): no event loop or pytest-asyncio task per test.
+    Not used as a context manager, so startup/shutdown hooks don't run."""
+    from fastapi.testclient import TestClient
+
+    return TestClient(app)
+
+
+@pytest.fixture
+def sync_client(_sync_test_client, _auth_overrides, fake_user):
+    """Synchronous counterpart of `client` (regular driver)."""
+    current, driver, _ = _auth_overrides
+    current["user"] = fake_user
+    app.dependency_overrides.update(driver)
+    yield _sync_test_client
+    app.dependency_overrides.clear()
+
+
+@pytest.fixture
+def sync_admin_client(_sync_test_client, _auth_overrides, fake_admin_user):
+    """Synchronous counterpart of `admin_client`."""
+    current, _, admin = _auth_overrides
+    current["user"] = fake_admin_user
+    app.dependency_overrides.update(admin)
+    yield _sync_test_client
     app.dependency_overrides.clear()
 
 
@@ -238,6 +409,58 @@ def clear_msi_geocode_cache():
     _MSI_GEOCODE_CACHE.clear()
 
 
+@pytest.fixture(autouse=True)
+def clear_road_matrix_cache():
+    """Vacía la caché de matrices OSRM/ORS entre tests: sin esto, un test que
+    mockea la descarga con las mismas coords que otro anterior recibe cache hit
+    y el mock nunca se llama."""
+    from main import _road_matrix_cache
+    _road_matrix_cache.clear()
+    yield
+    _road_matrix_cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def clear_places_details_cache():
+    """Vacía la caché de /places/details: varios tests piden el mismo place_id
+    con respuestas mockeadas distintas."""
+    from main import _places_details_cache
+    _places_details_cache.clear()
+    yield
+    _places_details_cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def clear_geocode_cache():
+    """Vacía la caché de /geocode: los tests repiten direcciones con
+    respuestas de Google mockeadas distintas."""
+    from main import _geocode_cache
+    _geocode_cache.clear()
+    yield
+    _geocode_cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def clear_admin_stats_cache():
+    """/admin/stats cachea su respuesta 30s; cada test mockea su propio RPC."""
+    from main import _admin_stats_cache
+    _admin_stats_cache.clear()
+    yield
+    _admin_stats_cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def clear_stripe_customer_cache():
+    """Cada test de webhook mockea su propio `users` lookup; sin limpiar, un
+    customer_id resuelto en un test anterior se saltaría el mock."""
+    from main import _stripe_customer_user_cache, _stripe_subscription_last_created
+    _stripe_customer_user_cache.clear()
+    _stripe_subscription_last_created.clear()
+    yield
+    _stripe_customer_user_cache.clear()
+    _stripe_subscription_last_created.clear()
+
+
 @pytest.fixture(autouse=True)
 def disable_routes_v2_cache(monkeypatch):
     """Routes V2 server-side cache OFF por default en tests (Miguel 23 may 2026).
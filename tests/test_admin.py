@@ -10,220 +10,126 @@ Tests for admin endpoints:
   - GET /admin/stats
   - GET /admin/companies (list)
   - Admin-only access control
+
+Safe under pytest-xdist (`make test-parallel`): each test gets a freshly
+reset `supabase_mock` and its own auth overrides, and the session-scoped
+clients are per worker, so nothing is shared across workers.
 """
 
-from unittest.mock import MagicMock, patch
+import json
+from unittest.mock import patch
 
 import pytest
 
-from tests.conftest import FAKE_USER_ID
+from main import _password_error
+from tests.conftest import FAKE_USER_ID, SBResult
 
+# Every test in this module runs against the shared, freshly reset
+# `supabase_mock`; tests that configure it still take it as an argument.
+pytestmark = pytest.mark.usefixtures("supabase_mock")
 
-def _chain(result):
-    """Mock de builder Supabase chain-agnostic: cualquier secuencia de metodos
-    (select/order/range/eq/in_/gte/...) devuelve el mismo mock y .execute()
-    devuelve `result`. Robusto a la paginacion con fetch_all_rows (.range) y a
-    cambios de encadenamiento; los mocks que fijaban la cadena exacta se rompian
-    al anadir .order()/.range()."""
-    c = MagicMock()
-    for _m in ("select", "order", "range", "eq", "neq", "in_", "gte", "lte",
-               "lt", "gt", "not_", "is_", "or_", "filter", "limit", "ilike", "like"):
-        getattr(c, _m).return_value = c
-    c.execute.return_value = result
-    return c
 
+# URLs y cuerpos estáticos formateados/serializados una sola vez al importar.
+_GRANT_URL = f"/admin/users/{FAKE_USER_ID}/grant"
+_RESET_PW_URL = f"/admin/users/{FAKE_USER_ID}/reset-password"
+_JSON_HEADERS = {"content-type": "application/json"}
 
-class TestAdminAccessControl:
-    """Admin endpoints should reject non-admin users."""
 
-    @pytest.mark.asyncio
-    async def test_admin_users_requires_admin(self, client):
-        """Regular driver should get 403 on admin endpoints."""
-        response = await client.get("/admin/users")
-        assert response.status_code == 403
+def _json_kwargs(payload):
+    return {"content": json.dumps(payload).encode(), "headers": _JSON_HEADERS}
 
-    @pytest.mark.asyncio
-    async def test_admin_promo_codes_requires_admin(self, client):
-        """Regular driver should get 403 on promo codes listing."""
-        response = await client.get("/admin/promo-codes")
-        assert response.status_code == 403
 
-    @pytest.mark.asyncio
-    async def test_admin_grant_plan_requires_admin(self, client):
-        """Regular driver should get 403 on grant plan."""
-        response = await client.patch(
-            f"/admin/users/{FAKE_USER_ID}/grant",
-            json={"plan": "pro", "days": 30}
-        )
-        assert response.status_code == 403
+# (method, url, kwargs de request) de cada endpoint admin-only, resuelto una vez.
+_ADMIN_ONLY_CASES = (
+    ("get", "/admin/users", {}),
+    ("get", "/admin/promo-codes", {}),
+    ("patch", _GRANT_URL, _json_kwargs({"plan": "pro", "days": 30})),
+    ("post", "/admin/broadcast-email", _json_kwargs({"subject": "Test", "body": "<p>Test</p>", "target": "all"})),
+)
 
-    @pytest.mark.asyncio
-    async def test_admin_broadcast_requires_admin(self, client):
-        """Regular driver should get 403 on broadcast email."""
-        response = await client.post("/admin/broadcast-email", json={
-            "subject": "Test",
-            "body": "<p>Test</p>",
-            "target": "all"
-        })
-        assert response.status_code == 403
-
-    @pytest.mark.asyncio
-    async def test_admin_create_company_requires_admin(self, client):
-        """Regular driver should get 403 on create company."""
-        response = await client.post("/admin/companies", json={
-            "name": "Test Company"
-        })
-        assert response.status_code == 403
 
+class TestAdminAccessControl:
+    """Admin endpoints should reject non-admin users."""
 
-class TestAdminUsers:
-    """Tests for GET /admin/users"""
+    @pytest.mark.parametrize("method,url,kwargs", _ADMIN_ONLY_CASES,
+                             ids=["users", "promo_codes", "grant", "broadcast"])
+    def test_admin_endpoint_requires_admin(self, sync_client, method, url, kwargs):
+        """Regular driver should get 403 on admin endpoints."""
+        response = getattr(sync_client, method)(url, **kwargs)
+        assert response.status_code == 403
 
-    @pytest.mark.asyncio
-    async def test_list_users_success(self, admin_client):
-        """Admin should see all users/drivers."""
-        with patch("main.supabase") as mock_sb:
-            users_result = MagicMock()
-            users_result.data = [
-                {"id": "d1", "name": "Driver 1", "email": "d1@test.com", "promo_plan": None},
-                {"id": "d2", "name": "Driver 2", "email": "d2@test.com", "promo_plan": "pro"},
-            ]
 
-            def table_dispatch(name):
-                if name == "drivers":
-                    return _chain(users_result)
-                return _chain(MagicMock(data=[], count=0))
+class TestAdminListings:
+    """Tests for GET /admin/users and GET /admin/promo-codes"""
 
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+    @pytest.mark.parametrize("table,url,key,rows", [
+        ("drivers", "/admin/users", "users", [
+            {"id": "d1", "name": "Driver 1", "email": "d1@test.com", "promo_plan": None},
+            {"id": "d2", "name": "Driver 2", "email": "d2@test.com", "promo_plan": "pro"},
+        ]),
+        ("promo_codes", "/admin/promo-codes", "promo_codes", [
+            {"id": "pc1", "code": "TEST10", "active": True, "current_uses": 5},
+            {"id": "pc2", "code": "PROMO20", "active": False, "current_uses": 20},
+        ]),
+    ], ids=["users", "promo_codes"])
+    async def test_admin_listing(self, admin_client, fake_supabase, table, url, key, rows):
+        """Admin should see every row of the listed table."""
+        fake_supabase[table].on("*", SBResult(data=rows))
 
-            response = await admin_client.get("/admin/users")
+        response = await admin_client.get(url)
 
         assert response.status_code == 200
         data = response.json()
         assert data["success"] is True
-        assert len(data["users"]) == 2
+        assert len(data[key]) == 2
 
 
 class TestAdminGrantPlan:
     """Tests for PATCH /admin/users/{user_id}/grant"""
 
-    @pytest.mark.asyncio
-    async def test_grant_pro_plan(self, admin_client):
-        """Admin should be able to grant Pro plan with days."""
-        with patch("main.supabase") as mock_sb:
-            update_result = MagicMock()
-            update_result.data = [{"id": "d1", "promo_plan": "pro"}]
-
-            driver_data = MagicMock()
-            driver_data.data = {"email": "driver@test.com", "name": "Test Driver"}
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.update.return_value.eq.return_value.execute.return_value = update_result
-                    chain.select.return_value.eq.return_value.single.return_value.execute.return_value = driver_data
-                return chain
-
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-
-            with patch("main.send_plan_activated_email", return_value={"success": True}):
-                response = await admin_client.patch("/admin/users/d1/grant", json={
-                    "plan": "pro",
-                    "days": 30,
-                })
-
-        assert response.status_code == 200
-        data = response.json()
-        assert data["success"] is True
-        assert data["plan"] == "pro"
-        assert data["days"] == 30
-        assert data["expires_at"] is not None
-
-    @pytest.mark.asyncio
-    async def test_grant_permanent_plan(self, admin_client):
-        """Admin should be able to grant permanent plan."""
-        with patch("main.supabase") as mock_sb:
-            update_result = MagicMock()
-            update_result.data = [{"id": "d1", "promo_plan": "pro_plus"}]
-
-            driver_data = MagicMock()
-            driver_data.data = {"email": "driver@test.com", "name": "Test Driver"}
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.update.return_value.eq.return_value.execute.return_value = update_result
-                    chain.select.return_value.eq.return_value.single.return_value.execute.return_value = driver_data
-                return chain
-
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-
-            with patch("main.send_plan_activated_email", return_value={"success": True}):
-                response = await admin_client.patch("/admin/users/d1/grant", json={
-                    "plan": "pro_plus",
-                    "permanent": True,
-                })
-
-        assert response.status_code == 200
-        data = response.json()
-        assert data["success"] is True
-        assert data["permanent"] is True
-        assert data["expires_at"] is None
+    @pytest.mark.parametrize("body,expected,has_expiry", [
+        ({"plan": "pro", "days": 30}, {"plan": "pro", "days": 30}, True),
+        ({"plan": "pro_plus", "permanent": True}, {"permanent": True}, False),
+        ({"plan": "free"}, {"plan": "free"}, None),
+    ], ids=["pro_days", "permanent", "revoke_to_free"])
+    async def test_grant_plan(self, admin_client, fake_supabase, body, expected, has_expiry):
+        """Admin can grant a temporary or permanent plan, or set a user back to free."""
+        promo_plan = None if body["plan"] == "free" else body["plan"]
+        update_result = SBResult(data=[{"id": "d1", "promo_plan": promo_plan}])
+        driver_data = SBResult(data={"email": "driver@test.com", "name": "Test Driver"})
 
-    @pytest.mark.asyncio
-    async def test_revoke_plan_set_free(self, admin_client):
-        """Admin should be able to set a user back to free."""
-        with patch("main.supabase") as mock_sb:
-            update_result = MagicMock()
-            update_result.data = [{"id": "d1", "promo_plan": None}]
+        fake_supabase["drivers"].on("update.eq", update_result).on("select.eq.single", driver_data)
 
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.update.return_value.eq.return_value.execute.return_value = update_result
-                return chain
-
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-
-            response = await admin_client.patch("/admin/users/d1/grant", json={
-                "plan": "free",
-            })
+        with patch("main.send_plan_activated_email", return_value={"success": True}):
+            response = await admin_client.patch("/admin/users/d1/grant", json=body)
 
         assert response.status_code == 200
         data = response.json()
         assert data["success"] is True
-        assert data["plan"] == "free"
-
-    @pytest.mark.asyncio
-    async def test_grant_temporary_requires_positive_days(self, admin_client):
-        """Temporary plan with days <= 0 should return 400."""
-        with patch("main.supabase"):
-            response = await admin_client.patch("/admin/users/d1/grant", json={
-                "plan": "pro",
-                "days": 0,
-            })
+        for key, value in expected.items():
+            assert data[key] == value
+        if has_expiry is not None:
+            assert (data["expires_at"] is not None) is has_expiry
+
+    def test_grant_temporary_requires_positive_days(self, sync_admin_client):
+        """Temporary plan with days <= 0 should return 400 before any DB call."""
+        response = sync_admin_client.patch("/admin/users/d1/grant", json={
+            "plan": "pro",
+            "days": 0,
+        })
 
         assert response.status_code == 400
 
-    @pytest.mark.asyncio
-    async def test_grant_user_not_found(self, admin_client):
+    async def test_grant_user_not_found(self, admin_client, fake_supabase):
         """Granting plan to non-existent user should return 404."""
-        with patch("main.supabase") as mock_sb:
-            update_result = MagicMock()
-            update_result.data = []  # No rows updated
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.update.return_value.eq.return_value.execute.return_value = update_result
-                return chain
+        update_result = SBResult(data=[])  # No rows updated
 
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+        fake_supabase["drivers"].on("update.eq", update_result)
 
-            response = await admin_client.patch("/admin/users/nonexistent/grant", json={
-                "plan": "pro",
-                "days": 30,
-            })
+        response = await admin_client.patch("/admin/users/nonexistent/grant", json={
+            "plan": "pro",
+            "days": 30,
+        })
 
         assert response.status_code == 404
 
@@ -231,127 +137,65 @@ class TestAdminGrantPlan:
 class TestAdminPromoCodes:
     """Tests for promo code admin endpoints"""
 
-    @pytest.mark.asyncio
-    async def test_list_promo_codes(self, admin_client):
-        """Admin should see all promo codes."""
-        with patch("main.supabase") as mock_sb:
-            codes_result = MagicMock()
-            codes_result.data = [
-                {"id": "pc1", "code": "TEST10", "active": True, "current_uses": 5},
-                {"id": "pc2", "code": "PROMO20", "active": False, "current_uses": 20},
-            ]
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "promo_codes":
-                    chain.select.return_value.order.return_value.execute.return_value = codes_result
-                return chain
-
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-
-            response = await admin_client.get("/admin/promo-codes")
-
-        assert response.status_code == 200
-        data = response.json()
-        assert data["success"] is True
-        assert len(data["promo_codes"]) == 2
-
-    @pytest.mark.asyncio
-    async def test_create_promo_code(self, admin_client):
+    async def test_create_promo_code(self, admin_client, fake_supabase):
         """Admin should be able to create a new promo code."""
-        with patch("main.supabase") as mock_sb:
-            # Check existing (no duplicate)
-            existing_result = MagicMock()
-            existing_result.data = []
-
-            # Insert result
-            insert_result = MagicMock()
-            insert_result.data = [{
-                "id": "new-pc",
-                "code": "NEWCODE",
-                "active": True,
-                "benefit_plan": "pro_plus",
-                "benefit_value": 30,
-            }]
-
-            call_count = {"promo_codes": 0}
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "promo_codes":
-                    call_count["promo_codes"] += 1
-                    if call_count["promo_codes"] == 1:
-                        # Check existing
-                        chain.select.return_value.eq.return_value.execute.return_value = existing_result
-                    else:
-                        # Insert
-                        chain.insert.return_value.execute.return_value = insert_result
-                return chain
-
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-
-            response = await admin_client.post("/admin/promo-codes", json={
-                "code": "NEWCODE",
-                "benefit_value": 30,
-                "benefit_plan": "pro_plus",
-            })
+        # Check existing (no duplicate)
+        existing_result = SBResult(data=[])
+
+        # Insert result
+        insert_result = SBResult(data=[{
+            "id": "new-pc",
+            "code": "NEWCODE",
+            "active": True,
+            "benefit_plan": "pro_plus",
+            "benefit_value": 30,
+        }])
+
+        # First promo_codes query checks for a duplicate, the second inserts.
+        fake_supabase["promo_codes"].on("select.eq", existing_result).on("insert", insert_result)
+
+        response = await admin_client.post("/admin/promo-codes", json={
+            "code": "NEWCODE",
+            "benefit_value": 30,
+            "benefit_plan": "pro_plus",
+        })
 
         assert response.status_code == 200
         data = response.json()
         assert data["success"] is True
         assert data["promo_code"]["code"] == "NEWCODE"
 
-    @pytest.mark.asyncio
-    async def test_create_duplicate_promo_code(self, admin_client):
+    async def test_create_duplicate_promo_code(self, admin_client, fake_supabase):
         """Creating a duplicate promo code should return 400."""
-        with patch("main.supabase") as mock_sb:
-            existing_result = MagicMock()
-            existing_result.data = [{"id": "existing-pc"}]
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "promo_codes":
-                    chain.select.return_value.eq.return_value.execute.return_value = existing_result
-                return chain
+        existing_result = SBResult(data=[{"id": "existing-pc"}])
 
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+        fake_supabase["promo_codes"].on("select.eq", existing_result)
 
-            response = await admin_client.post("/admin/promo-codes", json={
-                "code": "EXISTING",
-                "benefit_value": 30,
-            })
+        response = await admin_client.post("/admin/promo-codes", json={
+            "code": "EXISTING",
+            "benefit_value": 30,
+        })
 
         assert response.status_code == 400
         assert "already exists" in response.json()["detail"]
 
-    @pytest.mark.asyncio
-    async def test_update_promo_code(self, admin_client):
+    async def test_update_promo_code(self, admin_client, fake_supabase):
         """Admin should be able to deactivate a promo code."""
-        with patch("main.supabase") as mock_sb:
-            update_result = MagicMock()
-            update_result.data = [{"id": "pc1", "active": False}]
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "promo_codes":
-                    chain.update.return_value.eq.return_value.execute.return_value = update_result
-                return chain
+        update_result = SBResult(data=[{"id": "pc1", "active": False}])
 
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+        fake_supabase["promo_codes"].on("update.eq", update_result)
 
-            response = await admin_client.patch("/admin/promo-codes/pc1", json={
-                "active": False,
-            })
+        response = await admin_client.patch("/admin/promo-codes/pc1", json={
+            "active": False,
+        })
 
         assert response.status_code == 200
         data = response.json()
         assert data["success"] is True
 
-    @pytest.mark.asyncio
-    async def test_update_promo_code_no_fields(self, admin_client):
-        """Updating with no fields should return 400."""
-        with patch("main.supabase"):
-            response = await admin_client.patch("/admin/promo-codes/pc1", json={})
+    def test_update_promo_code_no_fields(self, sync_admin_client):
+        """Updating with no fields should return 400 before any DB call."""
+        response = sync_admin_client.patch("/admin/promo-codes/pc1", json={})
 
         assert response.status_code == 400
 
@@ -359,137 +203,64 @@ class TestAdminPromoCodes:
 class TestAdminResetPassword:
     """Tests for POST /admin/users/{user_id}/reset-password"""
 
-    @pytest.mark.asyncio
-    async def test_reset_password_auto_generate(self, admin_client):
-        """Reset password without providing one should auto-generate."""
-        with patch("main.supabase") as mock_sb:
-            mock_sb.auth.admin.update_user_by_id.return_value = MagicMock()
-
-            driver_result = MagicMock()
-            driver_result.data = [{"id": "d1"}]
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.select.return_value.eq.return_value.execute.return_value = driver_result
-                    chain.update.return_value.eq.return_value.execute.return_value = MagicMock()
-                return chain
-
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-
-            response = await admin_client.post(
-                f"/admin/users/{FAKE_USER_ID}/reset-password",
-                json={"password": "AutoTest2026x"}
-            )
-
-        assert response.status_code == 200
-        data = response.json()
-        assert data["success"] is True
-
-    @pytest.mark.asyncio
-    async def test_reset_password_custom(self, admin_client):
-        """Reset with a custom password should use the provided password."""
-        with patch("main.supabase") as mock_sb:
-            mock_sb.auth.admin.update_user_by_id.return_value = MagicMock()
-
-            driver_result = MagicMock()
-            driver_result.data = [{"id": "d1", "email": "test@example.com", "name": "Test User"}]
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.select.return_value.eq.return_value.execute.return_value = driver_result
-                    chain.update.return_value.eq.return_value.execute.return_value = MagicMock()
-                return chain
-
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-
-            response = await admin_client.post(
-                f"/admin/users/{FAKE_USER_ID}/reset-password",
-                json={"password": "NewPass123!"}
-            )
-
-        assert response.status_code == 200
+    @pytest.mark.parametrize("password,status", [
+        ("Ab1", 400),              # shorter than 8 chars
+        ("alllowercase123", 400),  # no uppercase
+        ("NoDigitsHere!", 400),    # no digit
+        ("AutoTest2026x", 200),
+        ("NewPass123!", 200),
+        (None, 200),               # generated server-side
+    ])
+    def test_reset_password(self, sync_admin_client, supabase_mock, fake_supabase, password, status):
+        """Strong passwords are applied without echoing them back; weak ones
+        are rejected with 400 before touching Supabase Auth."""
+        driver_result = SBResult(data=[{"id": "d1", "email": "test@example.com", "name": "Test User"}])
+        fake_supabase["drivers"].on("select.eq", driver_result)
+
+        response = sync_admin_client.post(_RESET_PW_URL, json={"password": password})
+
+        assert response.status_code == status
+        update_user = supabase_mock.auth.admin.update_user_by_id
+        if status == 400:
+            update_user.assert_not_called()
+            return
+        update_user.assert_called_once()
+        applied = update_user.call_args.args[1]["password"]
+        assert _password_error(applied) is None
+        if password:
+            assert applied == password
         data = response.json()
         assert data["success"] is True
         assert "password" not in data  # Password must not be exposed in response
         assert "email_sent" in data
 
-    @pytest.mark.asyncio
-    async def test_reset_password_too_short(self, admin_client):
-        """Password shorter than 8 chars should be rejected."""
-        with patch("main.supabase") as mock_sb:
-            mock_sb.auth.admin.update_user_by_id.return_value = MagicMock()
-
-            response = await admin_client.post(
-                f"/admin/users/{FAKE_USER_ID}/reset-password",
-                json={"password": "Ab1"}
-            )
-
-        assert response.status_code == 400
-
-    @pytest.mark.asyncio
-    async def test_reset_password_no_uppercase(self, admin_client):
-        """Password without uppercase should be rejected."""
-        with patch("main.supabase") as mock_sb:
-            mock_sb.auth.admin.update_user_by_id.return_value = MagicMock()
 
-            response = await admin_client.post(
-                f"/admin/users/{FAKE_USER_ID}/reset-password",
-                json={"password": "alllowercase123"}
-            )
-
-        assert response.status_code == 400
-
-    @pytest.mark.asyncio
-    async def test_reset_password_no_digit(self, admin_client):
-        """Password without digits should be rejected."""
-        with patch("main.supabase") as mock_sb:
-            mock_sb.auth.admin.update_user_by_id.return_value = MagicMock()
+class TestAdminCreateCompany:
+    """Tests for POST /admin/companies"""
 
-            response = await admin_client.post(
-                f"/admin/users/{FAKE_USER_ID}/reset-password",
-                json={"password": "NoDigitsHere!"}
-            )
+    @pytest.mark.parametrize("user_fixture,expected", [("client", 403), ("admin_client", 200)])
+    async def test_create_company(self, request, fake_supabase, user_fixture, expected):
+        """Admin can create a company; a regular driver gets 403."""
+        http = request.getfixturevalue(user_fixture)
+        company_result = SBResult(data=[{
+            "id": "company-1",
+            "name": "Test Company",
+            "active": True,
+        }])
 
-        assert response.status_code == 400
+        sub_result = SBResult(data=[{"id": "sub-1"}])
 
+        fake_supabase["companies"].on("insert", company_result)
+        fake_supabase["company_subscriptions"].on("insert", sub_result)
 
-class TestAdminCreateCompany:
-    """Tests for POST /admin/companies"""
-
-    @pytest.mark.asyncio
-    async def test_create_company_success(self, admin_client):
-        """Admin should be able to create a company."""
-        with patch("main.supabase") as mock_sb:
-            company_result = MagicMock()
-            company_result.data = [{
-                "id": "company-1",
-                "name": "Test Company",
-                "active": True,
-            }]
-
-            sub_result = MagicMock()
-            sub_result.data = [{"id": "sub-1"}]
-
-            call_count = {"companies": 0}
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "companies":
-                    chain.insert.return_value.execute.return_value = company_result
-                elif name == "company_subscriptions":
-                    chain.insert.return_value.execute.return_value = sub_result
-                return chain
-
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-
-            response = await admin_client.post("/admin/companies", json={
-                "name": "Test Company",
-                "email": "company@test.com",
-            })
+        response = await http.post("/admin/companies", json={
+            "name": "Test Company",
+            "email": "company@test.com",
+        })
 
-        assert response.status_code == 200
+        assert response.status_code == expected
+        if expected == 403:
+            return
         data = response.json()
         assert data["success"] is True
         assert data["company"]["name"] == "Test Company"
@@ -498,151 +269,67 @@ class TestAdminCreateCompany:
 class TestAdminStats:
     """Tests for GET /admin/stats"""
 
-    @pytest.mark.asyncio
-    async def test_stats_success(self, admin_client):
-        """Admin should get global stats."""
-        with patch("main.supabase") as mock_sb:
-            # Build mock results for each query
-            drivers_result = MagicMock()
-            drivers_result.count = 50
-            drivers_result.data = []
-
-            routes_today_result = MagicMock()
-            routes_today_result.count = 5
-            routes_today_result.data = [
-                {"driver_id": "d1"}, {"driver_id": "d2"}, {"driver_id": "d1"},
-            ]
-
-            routes_week_result = MagicMock()
-            routes_week_result.count = 20
-            routes_week_result.data = [
-                {"driver_id": "d1"}, {"driver_id": "d2"}, {"driver_id": "d3"},
-            ]
-
-            new_month_result = MagicMock()
-            new_month_result.count = 8
-            new_month_result.data = []
-
-            routes_total_result = MagicMock()
-            routes_total_result.count = 200
-            routes_total_result.data = []
-
-            routes_month_result = MagicMock()
-            routes_month_result.count = 40
-            routes_month_result.data = []
-
-            stops_total_result = MagicMock()
-            stops_total_result.count = 1000
-            stops_total_result.data = []
-
-            stops_today_result = MagicMock()
-            stops_today_result.count = 15
-            stops_today_result.data = []
-
-            stops_week_result = MagicMock()
-            stops_week_result.count = 80
-            stops_week_result.data = []
-
-            stops_month_result = MagicMock()
-            stops_month_result.count = 300
-            stops_month_result.data = []
-
-            failed_today_result = MagicMock()
-            failed_today_result.count = 2
-            failed_today_result.data = []
-
-            failed_week_result = MagicMock()
-            failed_week_result.count = 5
-            failed_week_result.data = []
-
-            call_index = {"drivers": 0, "routes": 0, "stops": 0}
-
-            def table_dispatch(name):
-                if name == "drivers":
-                    call_index["drivers"] += 1
-                    return _chain(drivers_result if call_index["drivers"] == 1 else new_month_result)
-                elif name == "routes":
-                    call_index["routes"] += 1
-                    return _chain({
-                        1: routes_today_result,
-                        2: routes_week_result,
-                        3: routes_total_result,
-                    }.get(call_index["routes"], routes_month_result))
-                elif name == "stops":
-                    call_index["stops"] += 1
-                    return _chain({
-                        1: stops_total_result,
-                        2: stops_today_result,
-                        3: stops_week_result,
-                        4: stops_month_result,
-                        5: failed_today_result,
-                    }.get(call_index["stops"], failed_week_result))
-                return _chain(MagicMock(data=[], count=0))
-
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-
-            response = await admin_client.get("/admin/stats")
-
-        assert response.status_code == 200
+    @pytest.mark.parametrize("user_fixture,expected", [("client", 403), ("admin_client", 200)])
+    async def test_stats(self, request, supabase_mock, user_fixture, expected):
+        """Admin gets global stats from the single admin_stats RPC; a regular
+        driver gets 403."""
+        http = request.getfixturevalue(user_fixture)
+        stats_payload = {
+            "users": {"total": 50, "active_today": 2, "active_week": 3, "new_month": 8},
+            "routes": {"today": 5, "week": 20, "month": 40, "total": 200},
+            "deliveries": {"today": 15, "week": 80, "month": 300, "total": 1000},
+            "failed": {"today": 2, "week": 5},
+        }
+        supabase_mock.rpc.return_value.execute.return_value = SBResult(data=stats_payload)
+
+        response = await http.get("/admin/stats")
+
+        assert response.status_code == expected
+        if expected == 403:
+            supabase_mock.rpc.assert_not_called()
+            return
         data = response.json()
         assert data["success"] is True
-        stats = data["stats"]
-        assert "users" in stats
-        assert "routes" in stats
-        assert "deliveries" in stats
-        assert "failed" in stats
-        assert stats["users"]["total"] == 50
-        assert stats["users"]["active_today"] == 2  # d1, d2 unique
-        assert stats["users"]["active_week"] == 3  # d1, d2, d3 unique
-
-    @pytest.mark.asyncio
-    async def test_stats_requires_admin(self, client):
-        """Regular driver should get 403 on stats."""
-        response = await client.get("/admin/stats")
-        assert response.status_code == 403
+        assert data["stats"] == stats_payload
+        supabase_mock.table.assert_not_called()
+        name, params = supabase_mock.rpc.call_args.args
+        assert name == "admin_stats"
+        assert set(params) == {"p_today", "p_week", "p_month"}
+        assert params["p_week"] <= params["p_today"]
+
+
+    async def test_stats_cached_between_polls(self, admin_client, supabase_mock):
+        """A second poll inside the TTL is served from cache: one RPC call."""
+        supabase_mock.rpc.return_value.execute.return_value = SBResult(data={"users": {"total": 1}})
+
+        first = await admin_client.get("/admin/stats")
+        second = await admin_client.get("/admin/stats")
+
+        assert first.status_code == second.status_code == 200
+        assert second.json() == first.json()
+        supabase_mock.rpc.assert_called_once()
 
 
 class TestAdminListCompanies:
     """Tests for GET /admin/companies (list)"""
 
-    @pytest.mark.asyncio
-    async def test_list_companies_success(self, admin_client):
-        """Admin should see all companies with driver count and subscription."""
-        with patch("main.supabase") as mock_sb:
-            companies_result = MagicMock()
-            companies_result.data = [
-                {"id": "c1", "name": "Company A", "active": True},
-                {"id": "c2", "name": "Company B", "active": False},
-            ]
-
-            # Batch links result: 5 links for c1, 2 for c2
-            all_links_result = MagicMock()
-            all_links_result.data = [
-                {"company_id": "c1"} for _ in range(5)
-            ] + [
-                {"company_id": "c2"} for _ in range(2)
-            ]
-
-            # Batch subscriptions result (ordered desc)
-            all_subs_result = MagicMock()
-            all_subs_result.data = [
-                {"company_id": "c1", "id": "s1", "plan": "pro", "status": "active", "created_at": "2026-01-01"},
-            ]
-
-            def table_dispatch(name):
-                if name == "companies":
-                    return _chain(companies_result)
-                elif name == "company_driver_links":
-                    return _chain(all_links_result)
-                elif name == "company_subscriptions":
-                    return _chain(all_subs_result)
-                return _chain(MagicMock(data=[], count=0))
-
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-
-            response = await admin_client.get("/admin/companies")
-
-        assert response.status_code == 200
+    @pytest.mark.parametrize("user_fixture,expected", [("client", 403), ("admin_client", 200)])
+    async def test_list_companies(self, request, fake_supabase, user_fixture, expected):
+        """Admin sees all companies with driver count and subscription; a
+        regular driver gets 403."""
+        http = request.getfixturevalue(user_fixture)
+        fake_supabase["admin_companies_detailed"].on("*", SBResult(data=[
+            {"id": "c1", "name": "Company A", "active": True, "driver_count": 5,
+             "subscription": {"company_id": "c1", "id": "s1", "plan": "pro", "status": "active",
+                              "created_at": "2026-01-01"}},
+            {"id": "c2", "name": "Company B", "active": False, "driver_count": 2, "subscription": None},
+        ]))
+
+        response = await http.get("/admin/companies")
+
+        assert response.status_code == expected
+        if expected == 403:
+            return
         data = response.json()
         assert data["success"] is True
         assert len(data["companies"]) == 2
@@ -650,9 +337,3 @@ class TestAdminListCompanies:
         assert data["companies"][0]["subscription"]["plan"] == "pro"
         assert data["companies"][1]["driver_count"] == 2
         assert data["companies"][1]["subscription"] is None
-
-    @pytest.mark.asyncio
-    async def test_list_companies_requires_admin(self, client):
-        """Regular driver should get 403 on list companies."""
-        response = await client.get("/admin/companies")
-        assert response.status_code == 403
@@ -12,15 +12,16 @@ empresa. El endpoint debe:
 from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
-import pytest_asyncio
 from fastapi import HTTPException
-from httpx import ASGITransport, AsyncClient
 
-from main import app, get_current_user, require_admin_or_dispatcher
+from main import require_admin_or_dispatcher
+from tests.conftest import SBResult
 
 FAKE_COMPANY_A = "company-aaaa-0000-0000-000000000001"
 FAKE_ROUTE_ID = "route-0000-0000-0000-000000000001"
 TARGET_DRIVER = "driver-aaaa-0000-0000-000000000010"
+# drivers select(company_id).eq(id).limit(1) for a driver of company A.
+_DRIVER_IN_COMPANY_A = SBResult(data=[{"company_id": FAKE_COMPANY_A}])
 
 
 def _dispatcher_user(company_id=FAKE_COMPANY_A):
@@ -32,83 +33,45 @@ def _dispatcher_user(company_id=FAKE_COMPANY_A):
     }
 
 
-@pytest_asyncio.fixture
-async def dispatcher_client():
-    user = _dispatcher_user()
-
-    async def _override():
-        return user
-
-    app.dependency_overrides[get_current_user] = _override
-    app.dependency_overrides[require_admin_or_dispatcher] = _override
-    transport = ASGITransport(app=app)
-    async with AsyncClient(transport=transport, base_url="http://testserver") as ac:
-        yield ac
-    app.dependency_overrides.clear()
+@pytest.fixture
+def dispatcher_client(override_user):
+    return override_user(_dispatcher_user(), require_admin_or_dispatcher)
 
 
 class TestAssignRouteDriver:
     @pytest.mark.asyncio
-    async def test_assign_success_persists_driver_and_company(self, dispatcher_client):
+    async def test_assign_success_persists_driver_and_company(self, dispatcher_client, fake_supabase):
         """Dispatcher asigna una ruta de su empresa a un conductor de su empresa:
         200 + update con driver_id y company_id + audit registrado."""
-        captured = {}
-
-        def table_dispatch(name):
-            chain = MagicMock()
-            if name == "drivers":
-                dl = MagicMock()
-                dl.data = [{"company_id": FAKE_COMPANY_A}]
-                chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = dl
-            elif name == "routes":
-                def capture_update(data):
-                    captured["update"] = data
-                    upd = MagicMock()
-                    upd.data = [{"id": FAKE_ROUTE_ID, "driver_id": TARGET_DRIVER, "company_id": FAKE_COMPANY_A}]
-                    m = MagicMock()
-                    m.eq.return_value.execute.return_value = upd
-                    return m
-                chain.update.side_effect = capture_update
-            return chain
+        fake_supabase["drivers"].on("select.eq.limit", _DRIVER_IN_COMPANY_A)
+        fake_supabase["routes"].on("update.eq", SBResult(data=[
+            {"id": FAKE_ROUTE_ID, "driver_id": TARGET_DRIVER, "company_id": FAKE_COMPANY_A},
+        ]))
 
         with patch("main.verify_route_access", new=AsyncMock(return_value={"id": FAKE_ROUTE_ID, "driver_id": "old"})), \
              patch("main.verify_driver_access", new=AsyncMock(return_value=True)), \
-             patch("main.log_audit") as mock_audit, \
-             patch("main.supabase") as mock_sb:
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+             patch("main.log_audit") as mock_audit:
             resp = await dispatcher_client.patch(
                 f"/routes/{FAKE_ROUTE_ID}/assign-driver", json={"driver_id": TARGET_DRIVER}
             )
 
         assert resp.status_code == 200
-        assert captured["update"]["driver_id"] == TARGET_DRIVER
-        assert captured["update"]["company_id"] == FAKE_COMPANY_A
+        [(update,)] = fake_supabase["routes"].args_of("update")
+        assert update["driver_id"] == TARGET_DRIVER
+        assert update["company_id"] == FAKE_COMPANY_A
         mock_audit.assert_called_once()
 
     @pytest.mark.asyncio
-    async def test_assign_triggers_push_notification(self, dispatcher_client):
+    async def test_assign_triggers_push_notification(self, dispatcher_client, fake_supabase):
         """Al asignar una ruta a un conductor se le envía push de 'nueva ruta asignada'."""
-        def table_dispatch(name):
-            chain = MagicMock()
-            if name == "drivers":
-                dl = MagicMock()
-                dl.data = [{"company_id": FAKE_COMPANY_A}]
-                chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = dl
-            elif name == "routes":
-                upd = MagicMock()
-                upd.data = [{"id": FAKE_ROUTE_ID, "driver_id": TARGET_DRIVER}]
-                m = MagicMock()
-                m.eq.return_value.execute.return_value = upd
-                chain.update.side_effect = lambda _d: m
-            return chain
+        fake_supabase["drivers"].on("select.eq.limit", _DRIVER_IN_COMPANY_A)
+        fake_supabase["routes"].on("update.eq", SBResult(data=[{"id": FAKE_ROUTE_ID, "driver_id": TARGET_DRIVER}]))
 
         notify = AsyncMock()
         with patch("main.verify_route_access", new=AsyncMock(return_value={"id": FAKE_ROUTE_ID, "driver_id": "old"})), \
              patch("main.verify_driver_access", new=AsyncMock(return_value=True)), \
              patch("main.notify_driver_route_assigned", new=notify), \
-             patch("main.log_audit"), \
-             patch("main.supabase") as mock_sb:
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+             patch("main.log_audit"):
             resp = await dispatcher_client.patch(
                 f"/routes/{FAKE_ROUTE_ID}/assign-driver", json={"driver_id": TARGET_DRIVER}
             )
@@ -117,67 +80,40 @@ class TestAssignRouteDriver:
         notify.assert_awaited_once_with(TARGET_DRIVER, FAKE_ROUTE_ID)
 
     @pytest.mark.asyncio
-    async def test_unassign_sets_driver_null_without_driver_check(self, dispatcher_client):
+    async def test_unassign_sets_driver_null_without_driver_check(self, dispatcher_client, fake_supabase):
         """driver_id=None desasigna la ruta: 200, update driver_id=None, sin validar
         conductor (verify_driver_access NO se llama) ni tocar company_id."""
-        captured = {}
-
-        def table_dispatch(name):
-            chain = MagicMock()
-            if name == "routes":
-                def capture_update(data):
-                    captured["update"] = data
-                    upd = MagicMock()
-                    upd.data = [{"id": FAKE_ROUTE_ID, "driver_id": None}]
-                    m = MagicMock()
-                    m.eq.return_value.execute.return_value = upd
-                    return m
-                chain.update.side_effect = capture_update
-            return chain
+        fake_supabase["routes"].on("update.eq", SBResult(data=[{"id": FAKE_ROUTE_ID, "driver_id": None}]))
 
         vda = AsyncMock(return_value=True)
         notify = AsyncMock()
         with patch("main.verify_route_access", new=AsyncMock(return_value={"id": FAKE_ROUTE_ID, "driver_id": "old"})), \
              patch("main.verify_driver_access", new=vda), \
              patch("main.notify_driver_route_assigned", new=notify), \
-             patch("main.log_audit"), \
-             patch("main.supabase") as mock_sb:
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+             patch("main.log_audit"):
             resp = await dispatcher_client.patch(
                 f"/routes/{FAKE_ROUTE_ID}/assign-driver", json={"driver_id": None}
             )
 
         assert resp.status_code == 200
-        assert captured["update"]["driver_id"] is None
-        assert "company_id" not in captured["update"]
+        [(update,)] = fake_supabase["routes"].args_of("update")
+        assert update["driver_id"] is None
+        assert "company_id" not in update
         vda.assert_not_called()
         notify.assert_not_awaited()
 
     @pytest.mark.asyncio
-    async def test_assign_cross_company_driver_forbidden(self, dispatcher_client):
+    async def test_assign_cross_company_driver_forbidden(self, dispatcher_client, fake_supabase):
         """Asignar a un conductor de OTRA empresa: verify_driver_access lanza 403
         y NO se debe tocar la ruta."""
-        routes_touched = {"update": False}
-
-        def table_dispatch(name):
-            chain = MagicMock()
-            if name == "routes":
-                def _upd(_data):
-                    routes_touched["update"] = True
-                    return MagicMock()
-                chain.update.side_effect = _upd
-            return chain
-
         with patch("main.verify_route_access", new=AsyncMock(return_value={"id": FAKE_ROUTE_ID, "driver_id": "old"})), \
-             patch("main.verify_driver_access", new=AsyncMock(side_effect=HTTPException(status_code=403, detail="no"))), \
-             patch("main.supabase") as mock_sb:
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+             patch("main.verify_driver_access", new=AsyncMock(side_effect=HTTPException(status_code=403, detail="no"))):
             resp = await dispatcher_client.patch(
                 f"/routes/{FAKE_ROUTE_ID}/assign-driver", json={"driver_id": "driver-of-company-b"}
             )
 
         assert resp.status_code == 403
-        assert routes_touched["update"] is False
+        assert fake_supabase["routes"].args_of("update") == []
 
     @pytest.mark.asyncio
     async def test_assign_route_other_company_forbidden(self, dispatcher_client):
@@ -204,35 +140,19 @@ class TestDispatcherCreateRoute:
             "stops": [{"address": "Calle 1", "lat": 40.4, "lng": -3.7, "position": 0}],
             "total_distance_km": 1.0,
         }
-        call = {"routes": 0}
-
-        def table_dispatch(name):
-            chain = MagicMock()
-            if name == "drivers":
-                dl = MagicMock()
-                dl.data = [{"company_id": FAKE_COMPANY_A}]
-                chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = dl
-            elif name == "routes":
-                call["routes"] += 1
-                if call["routes"] <= 1:
-                    ins = MagicMock()
-                    ins.data = [{"id": "new-route-id", "driver_id": TARGET_DRIVER}]
-                    chain.insert.return_value.execute.return_value = ins
-                else:
-                    fin = MagicMock()
-                    fin.data = {"id": "new-route-id", "stops": []}
-                    chain.select.return_value.eq.return_value.single.return_value.execute.return_value = fin
-            elif name == "stops":
-                st = MagicMock()
-                st.data = [{"id": "s1"}]
-                chain.insert.return_value.execute.return_value = st
-            return chain
-
         with patch("main.verify_driver_access", new=AsyncMock(return_value=True)), \
+             patch("main.enrich_stops_from_directory", side_effect=lambda company_id, stops: (stops, 0)), \
+             patch("main.notify_driver_route_assigned", new=AsyncMock()) as notify, \
              patch("main.supabase") as mock_sb:
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+            mock_sb.table.return_value.select.return_value.eq.return_value.limit.return_value.execute.return_value = (
+                MagicMock(data=[{"company_id": FAKE_COMPANY_A}])
+            )
+            mock_sb.rpc.return_value.execute.return_value = MagicMock(
+                data={"id": "new-route-id", "driver_id": TARGET_DRIVER, "stops": []}
+            )
             resp = await dispatcher_client.post("/routes", json=payload)
 
+        notify.assert_awaited_once_with(TARGET_DRIVER, "new-route-id")
         assert resp.status_code == 200
 
     @pytest.mark.asyncio
@@ -254,39 +174,18 @@ class TestDispatcherCreateRoute:
 class TestImportRoute:
     """POST /company/routes/import: dispatcher importa pedidos (CSV) → ruta geocodificada (Fase 1)."""
 
-    def _table_dispatch_factory(self, captured):
-        def table_dispatch(name):
-            chain = MagicMock()
-            if name == "drivers":
-                dl = MagicMock()
-                dl.data = [{"company_id": FAKE_COMPANY_A}]
-                chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = dl
-            elif name == "routes":
-                def cap_route(data):
-                    captured["route"] = data
-                    ins = MagicMock()
-                    ins.data = [{"id": "imp-route-1"}]
-                    m = MagicMock()
-                    m.execute.return_value = ins
-                    return m
-                chain.insert.side_effect = cap_route
-            elif name == "stops":
-                def cap_stops(data):
-                    captured["stops"] = data
-                    st = MagicMock()
-                    st.data = [{"id": f"s{i}"} for i in range(len(data))]
-                    m = MagicMock()
-                    m.execute.return_value = st
-                    return m
-                chain.insert.side_effect = cap_stops
-            return chain
-        return table_dispatch
+    @staticmethod
+    def _import_tables(fake_supabase):
+        """Driver of company A; the route and stop INSERTs succeed."""
+        fake_supabase["drivers"].on("select.eq.limit", _DRIVER_IN_COMPANY_A)
+        fake_supabase["routes"].on("insert", SBResult(data=[{"id": "imp-route-1"}]))
+        fake_supabase["stops"].on("insert", SBResult(data=[{"id": "s0"}]))
 
     @pytest.mark.asyncio
-    async def test_import_creates_route_with_geocoded_stops(self, dispatcher_client):
+    async def test_import_creates_route_with_geocoded_stops(self, dispatcher_client, fake_supabase):
         payload = {"driver_id": TARGET_DRIVER, "name": "Import test", "country": "ES",
                    "rows": [{"address": "Calle A 1"}, {"address": "Calle B 2", "phone": "600"}]}
-        captured = {}
+        self._import_tables(fake_supabase)
 
         async def fake_geocode(addr, country=None):
             return {"lat": 40.0, "lng": -3.0, "display_name": f"{addr} (geo)"}
@@ -294,25 +193,25 @@ class TestImportRoute:
         with patch("main.verify_driver_access", new=AsyncMock(return_value=True)), \
              patch("main._geocode_address", new=AsyncMock(side_effect=fake_geocode)), \
              patch("main.notify_driver_route_assigned", new=AsyncMock()) as notify, \
-             patch("main.log_audit"), \
-             patch("main.supabase") as mock_sb:
-            mock_sb.table = MagicMock(side_effect=self._table_dispatch_factory(captured))
+             patch("main.log_audit"):
             resp = await dispatcher_client.post("/company/routes/import", json=payload)
 
         assert resp.status_code == 200
         body = resp.json()
         assert body["imported"] == 2
         assert body["failed_count"] == 0
-        assert captured["route"]["company_id"] == FAKE_COMPANY_A
-        assert captured["route"]["total_stops"] == 2
-        assert len(captured["stops"]) == 2
+        [(route,)] = fake_supabase["routes"].args_of("insert")
+        assert route["company_id"] == FAKE_COMPANY_A
+        assert route["total_stops"] == 2
+        [(stops,)] = fake_supabase["stops"].args_of("insert")
+        assert len(stops) == 2
         notify.assert_awaited_once()
 
     @pytest.mark.asyncio
-    async def test_import_skips_failed_geocode(self, dispatcher_client):
+    async def test_import_skips_failed_geocode(self, dispatcher_client, fake_supabase):
         payload = {"driver_id": TARGET_DRIVER,
                    "rows": [{"address": "Calle OK"}, {"address": "Calle FAIL"}]}
-        captured = {}
+        self._import_tables(fake_supabase)
 
         async def fake_geocode(addr, country=None):
             if "FAIL" in addr:
@@ -322,9 +221,7 @@ class TestImportRoute:
         with patch("main.verify_driver_access", new=AsyncMock(return_value=True)), \
              patch("main._geocode_address", new=AsyncMock(side_effect=fake_geocode)), \
              patch("main.notify_driver_route_assigned", new=AsyncMock()), \
-             patch("main.log_audit"), \
-             patch("main.supabase") as mock_sb:
-            mock_sb.table = MagicMock(side_effect=self._table_dispatch_factory(captured))
+             patch("main.log_audit"):
             resp = await dispatcher_client.post("/company/routes/import", json=payload)
 
         assert resp.status_code == 200
@@ -332,7 +229,8 @@ class TestImportRoute:
         assert body["imported"] == 1
         assert body["failed_count"] == 1
         assert body["failed_addresses"] == ["Calle FAIL"]
-        assert len(captured["stops"]) == 1
+        [(stops,)] = fake_supabase["stops"].args_of("insert")
+        assert len(stops) == 1
 
     @pytest.mark.asyncio
     async def test_import_all_failed_returns_422(self, dispatcher_client):
@@ -4,210 +4,127 @@ Tests for auth-related endpoints:
   - Unauthenticated access (auth required endpoints return 401)
 """
 
-from unittest.mock import MagicMock, patch
+import re
 
 import pytest
+from fastapi import HTTPException
 
-from tests.conftest import FAKE_DRIVER_ID
+from main import delete_account
+from tests.conftest import FAKE_DRIVER_ID, SBResult
 
+# Accepted wording of the delete-account confirmation, in any locale we ship.
+_DELETED_MESSAGE = re.compile(r"eliminada|deleted", re.IGNORECASE)
+_OWN_DRIVER = SBResult(data=[{"id": FAKE_DRIVER_ID}])
 
-class TestAuthRequired:
-    """Endpoints that require authentication should return 401 without a token."""
-
-    @pytest.mark.asyncio
-    async def test_optimize_requires_auth(self, unauth_client):
-        response = await unauth_client.post("/optimize", json={
-            "locations": [{"lat": 40.0, "lng": -3.0}]
-        })
-        assert response.status_code == 401
-
-    @pytest.mark.asyncio
-    async def test_routes_requires_auth(self, unauth_client):
-        response = await unauth_client.get("/routes")
-        assert response.status_code == 401
 
-    @pytest.mark.asyncio
-    async def test_drivers_requires_auth(self, unauth_client):
-        response = await unauth_client.get("/drivers")
-        assert response.status_code == 401
+def _delete_filters(table):
+    """(name, args) of the filter applied to each DELETE on a FakeTable."""
+    calls = table.calls
+    return [calls[i + 1] for i, (name, _) in enumerate(calls) if name == "delete"]
 
-    @pytest.mark.asyncio
-    async def test_delete_account_requires_auth(self, unauth_client):
-        response = await unauth_client.delete("/auth/delete-account")
-        assert response.status_code == 401
 
-    @pytest.mark.asyncio
-    async def test_stats_daily_requires_auth(self, unauth_client):
-        response = await unauth_client.get("/stats/daily")
-        assert response.status_code == 401
+class TestAuthRequired:
+    """Endpoints that require authentication should return 401 without a token."""
 
-    @pytest.mark.asyncio
-    async def test_referral_code_requires_auth(self, unauth_client):
-        response = await unauth_client.get("/referral/code")
+    @pytest.mark.parametrize("method,path,kwargs", [
+        ("post", "/optimize", {"json": {"locations": [{"lat": 40.0, "lng": -3.0}]}}),
+        ("get", "/routes", {}),
+        ("get", "/drivers", {}),
+        ("delete", "/auth/delete-account", {}),
+        ("get", "/stats/daily", {}),
+        ("get", "/referral/code", {}),
+    ], ids=["optimize", "routes", "drivers", "delete_account", "stats_daily", "referral_code"])
+    async def test_endpoint_requires_auth(self, unauth_client, method, path, kwargs):
+        response = await getattr(unauth_client, method)(path, **kwargs)
         assert response.status_code == 401
 
 
 class TestDeleteAccount:
-    """Tests for DELETE /auth/delete-account"""
+    """Tests for DELETE /auth/delete-account. Clean-path outcomes call the
+    handler coroutine directly; the referrals and 207 cases go through the
+    HTTP client so routing and the JSONResponse path stay covered."""
 
     @pytest.mark.asyncio
-    async def test_delete_account_success(self, client):
-        """Deleting an account should return 200 with deletion confirmation."""
-        with patch("main.supabase") as mock_sb:
-            # Driver lookup
-            driver_result = MagicMock()
-            driver_result.data = [{"id": FAKE_DRIVER_ID}]
-
-            # Routes lookup (no routes)
-            routes_result = MagicMock()
-            routes_result.data = []
-
-            # Chain: table("drivers").select("id").eq("user_id", ...).execute()
-            drivers_chain = MagicMock()
-            drivers_chain.select.return_value.eq.return_value.execute.return_value = driver_result
-
-            # Make table() return the right chain depending on table name
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.select.return_value.eq.return_value.execute.return_value = driver_result
-                    chain.delete.return_value.eq.return_value.execute.return_value = MagicMock()
-                elif name == "routes":
-                    chain.select.return_value.eq.return_value.execute.return_value = routes_result
-                    chain.delete.return_value.eq.return_value.execute.return_value = MagicMock()
-                else:
-                    chain.select.return_value.eq.return_value.execute.return_value = MagicMock(data=[])
-                    chain.delete.return_value.eq.return_value.execute.return_value = MagicMock()
-                return chain
-
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-            mock_sb.auth.admin.delete_user = MagicMock(return_value=True)
-
-            response = await client.delete("/auth/delete-account")
+    async def test_delete_account_success(self, fake_user, supabase_mock, fake_supabase):
+        """Deleting an account should return the deletion confirmation."""
+        fake_supabase["drivers"].on("select.eq", _OWN_DRIVER)
+        supabase_mock.auth.admin.delete_user.return_value = True
+
+        data = await delete_account(user=fake_user)
 
-        assert response.status_code == 200
-        data = response.json()
         assert data["status"] == "deleted"
-        assert "eliminada" in data["message"].lower() or "deleted" in data["message"].lower()
+        assert _DELETED_MESSAGE.search(data["message"])
 
     @pytest.mark.asyncio
-    async def test_delete_account_no_driver(self, client):
+    async def test_delete_account_no_driver(self, fake_user, supabase_mock, fake_supabase):
         """Should still succeed if user has no driver profile."""
-        with patch("main.supabase") as mock_sb:
-            # No driver found for user
-            driver_result = MagicMock()
-            driver_result.data = []
+        supabase_mock.auth.admin.delete_user.return_value = True
+
+        data = await delete_account(user=fake_user)
 
-            def table_dispatch(name):
-                chain = MagicMock()
-                chain.select.return_value.eq.return_value.execute.return_value = MagicMock(data=[])
-                chain.delete.return_value.eq.return_value.execute.return_value = MagicMock()
-                return chain
+        assert data["status"] == "deleted"
+        assert "routes" not in fake_supabase
 
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-            mock_sb.auth.admin.delete_user = MagicMock(return_value=True)
+    @pytest.mark.asyncio
+    async def test_delete_account_with_routes(self, fake_user, supabase_mock, fake_supabase):
+        """Should delete routes and related data; stops go with their routes
+        through the ON DELETE CASCADE foreign key, not a DELETE of their own."""
+        fake_supabase["drivers"].on("select.eq", _OWN_DRIVER)
+        # fetch_all_rows pages: select(...).<filter>(...).order("id").range(...)
+        fake_supabase["routes"].on("select.eq.order.range", SBResult(data=[{"id": "route-1"}, {"id": "route-2"}]))
+        fake_supabase["stops"].on("select.in_.order.range", SBResult(data=[{"id": "stop-1"}, {"id": "stop-2"}]))
+        supabase_mock.auth.admin.delete_user.return_value = True
 
-            response = await client.delete("/auth/delete-account")
+        data = await delete_account(user=fake_user)
 
-        assert response.status_code == 200
-        data = response.json()
         assert data["status"] == "deleted"
+        assert _delete_filters(fake_supabase["routes"]) == [("eq", ("driver_id", FAKE_DRIVER_ID))]
+        assert _delete_filters(fake_supabase["delivery_proofs"]) == [
+            ("in_", ("stop_id", ["stop-1", "stop-2"])),
+            ("eq", ("driver_id", FAKE_DRIVER_ID)),
+        ]
+        assert _delete_filters(fake_supabase["stops"]) == []
 
     @pytest.mark.asyncio
-    async def test_delete_account_with_routes(self, client):
-        """Should delete routes, stops, and related data."""
-        with patch("main.supabase") as mock_sb:
-            # Driver lookup
-            driver_result = MagicMock()
-            driver_result.data = [{"id": FAKE_DRIVER_ID}]
-
-            # Routes with stops
-            routes_result = MagicMock()
-            routes_result.data = [{"id": "route-1"}, {"id": "route-2"}]
-
-            stops_result = MagicMock()
-            stops_result.data = [{"id": "stop-1"}, {"id": "stop-2"}]
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.select.return_value.eq.return_value.execute.return_value = driver_result
-                    chain.delete.return_value.eq.return_value.execute.return_value = MagicMock()
-                elif name == "routes":
-                    chain.select.return_value.eq.return_value.execute.return_value = routes_result
-                    chain.delete.return_value.eq.return_value.execute.return_value = MagicMock()
-                elif name == "stops":
-                    chain.select.return_value.eq.return_value.execute.return_value = stops_result
-                    chain.delete.return_value.eq.return_value.execute.return_value = MagicMock()
-                else:
-                    chain.select.return_value.eq.return_value.execute.return_value = MagicMock(data=[])
-                    chain.delete.return_value.eq.return_value.execute.return_value = MagicMock()
-                return chain
-
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-            mock_sb.auth.admin.delete_user = MagicMock(return_value=True)
-
-            response = await client.delete("/auth/delete-account")
+    async def test_delete_account_referrals_single_delete(self, client, supabase_mock, fake_supabase):
+        """Both referral sides go in one DELETE ... WHERE a OR b round trip."""
+        fake_supabase["drivers"].on("select.eq", _OWN_DRIVER)
+        supabase_mock.auth.admin.delete_user.return_value = True
+
+        response = await client.delete("/auth/delete-account")
 
         assert response.status_code == 200
-        assert response.json()["status"] == "deleted"
+        assert _delete_filters(fake_supabase["referrals"]) == [
+            ("or_", (f"referrer_driver_id.eq.{FAKE_DRIVER_ID},referred_driver_id.eq.{FAKE_DRIVER_ID}",)),
+        ]
 
     @pytest.mark.asyncio
-    async def test_delete_account_auth_user_failure_returns_502(self, client):
+    async def test_delete_account_auth_user_failure_returns_502(self, fake_user, supabase_mock, fake_supabase):
         """If supabase.auth.admin.delete_user raises, the auth row is still
         alive — the endpoint MUST NOT lie with 200. GDPR requires we either
         actually delete or surface the failure. Added 2026-05-10 (#248) after
         2 incidents of users left in limbo (zamorakareilys + arroceriadevicent)."""
-        with patch("main.supabase") as mock_sb:
-            driver_result = MagicMock()
-            driver_result.data = [{"id": FAKE_DRIVER_ID}]
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.select.return_value.eq.return_value.execute.return_value = driver_result
-                    chain.delete.return_value.eq.return_value.execute.return_value = MagicMock()
-                else:
-                    chain.select.return_value.eq.return_value.execute.return_value = MagicMock(data=[])
-                    chain.delete.return_value.eq.return_value.execute.return_value = MagicMock()
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-            mock_sb.auth.admin.delete_user = MagicMock(
-                side_effect=Exception("Database error deleting user")
-            )
-
-            response = await client.delete("/auth/delete-account")
-
-        assert response.status_code == 502
-        body = response.json()
-        assert body["detail"]["error"] == "deletion_incomplete"
-        assert "errors_count" in body["detail"]
+        fake_supabase["drivers"].on("select.eq", _OWN_DRIVER)
+        supabase_mock.auth.admin.delete_user.side_effect = Exception("Database error deleting user")
+
+        with pytest.raises(HTTPException) as exc_info:
+            await delete_account(user=fake_user)
+
+        assert exc_info.value.status_code == 502
+        assert exc_info.value.detail["error"] == "deletion_incomplete"
+        assert "errors_count" in exc_info.value.detail
 
     @pytest.mark.asyncio
-    async def test_delete_account_partial_returns_207(self, client):
+    async def test_delete_account_partial_returns_207(self, client, supabase_mock, fake_supabase):
         """If a peripheral table delete fails but auth.users IS deleted, return
         207 Multi-Status (data gone, audit log notes the gap). The user still
         has their identity removed — the failure is auxiliary cleanup."""
-        with patch("main.supabase") as mock_sb:
-            driver_result = MagicMock()
-            driver_result.data = [{"id": FAKE_DRIVER_ID}]
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.select.return_value.eq.return_value.execute.return_value = driver_result
-                    chain.delete.return_value.eq.return_value.execute.return_value = MagicMock()
-                elif name == "trial_claims":
-                    # Simulate trial_claims delete failing — peripheral.
-                    chain.delete.return_value.eq.return_value.execute.side_effect = (
-                        Exception("transient connection error")
-                    )
-                else:
-                    chain.select.return_value.eq.return_value.execute.return_value = MagicMock(data=[])
-                    chain.delete.return_value.eq.return_value.execute.return_value = MagicMock()
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-            mock_sb.auth.admin.delete_user = MagicMock(return_value=True)
-
-            response = await client.delete("/auth/delete-account")
+        fake_supabase["drivers"].on("select.eq", _OWN_DRIVER)
+        # Simulate trial_claims delete failing — peripheral.
+        fake_supabase["trial_claims"].on("delete.eq", Exception("transient connection error"))
+        supabase_mock.auth.admin.delete_user.return_value = True
+
+        response = await client.delete("/auth/delete-account")
 
         assert response.status_code == 207
         body = response.json()
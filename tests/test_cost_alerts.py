@@ -10,23 +10,9 @@ Plus anti-spam: same alert_key within 4h must NOT re-fire.
 """
 
 import time
-from unittest.mock import MagicMock, patch
+from unittest.mock import patch
 
-
-class _FixedResultChain:
-    """Chainable mock returning fixed data on .execute()."""
-    def __init__(self, data=None):
-        self._data = data if data is not None else []
-    def __getattr__(self, name):
-        if name.startswith("_"):
-            raise AttributeError(name)
-        return self
-    def __call__(self, *args, **kwargs):
-        return self
-    def execute(self):
-        result = MagicMock()
-        result.data = self._data
-        return result
+from tests.conftest import SBResult
 
 
 def _setup_counters_under_threshold():
@@ -41,27 +27,23 @@ def _setup_counters_under_threshold():
 # =============== 1) Routes V2 €/day TOTAL ===============
 
 class TestRoutesV2EurDayThreshold:
-    def test_under_amber_does_not_fire(self):
+    def test_under_amber_does_not_fire(self, fake_supabase):
         _setup_counters_under_threshold()
         # 800 calls × 0.0162 = €12.96 < €15 amber (precio recalibrado 25 may)
         rows = [{"count": 800}]
-        mock_sb = MagicMock()
-        mock_sb.table = MagicMock(return_value=_FixedResultChain(rows))
-        with patch("main.supabase", mock_sb), \
-             patch("main.send_alert_email") as mock_send:
+        fake_supabase["*"].on("*", SBResult(data=rows))
+        with patch("main.send_alert_email") as mock_send:
             from main import check_cost_alerts
             result = check_cost_alerts()
         assert mock_send.call_count == 0
         assert all(f["metric"] != "routes_v2_eur_day" for f in result["fired"])
 
-    def test_amber_fires_amber(self):
+    def test_amber_fires_amber(self, fake_supabase):
         _setup_counters_under_threshold()
         # 1100 calls × 0.0162 = €17.82 > €15 amber, < €25 red (precio recalibrado)
         rows = [{"count": 1100}]
-        mock_sb = MagicMock()
-        mock_sb.table = MagicMock(return_value=_FixedResultChain(rows))
-        with patch("main.supabase", mock_sb), \
-             patch("main.send_alert_email") as mock_send, \
+        fake_supabase["*"].on("*", SBResult(data=rows))
+        with patch("main.send_alert_email") as mock_send, \
              patch("main._cost_alert_already_sent_recently", return_value=False):
             from main import check_cost_alerts
             result = check_cost_alerts()
@@ -74,14 +56,12 @@ class TestRoutesV2EurDayThreshold:
         all_titles = [c[0][1] for c in mock_send.call_args_list]
         assert any("AMBER" in t and "Routes V2" in t for t in all_titles), all_titles
 
-    def test_red_fires_red(self):
+    def test_red_fires_red(self, fake_supabase):
         _setup_counters_under_threshold()
         # 1700 × 0.0162 = €27.54 > €25 red (precio recalibrado 25 may)
         rows = [{"count": 1700}]
-        mock_sb = MagicMock()
-        mock_sb.table = MagicMock(return_value=_FixedResultChain(rows))
-        with patch("main.supabase", mock_sb), \
-             patch("main.send_alert_email") as mock_send, \
+        fake_supabase["*"].on("*", SBResult(data=rows))
+        with patch("main.send_alert_email") as mock_send, \
              patch("main._cost_alert_already_sent_recently", return_value=False):
             from main import check_cost_alerts
             result = check_cost_alerts()
@@ -94,29 +74,25 @@ class TestRoutesV2EurDayThreshold:
 # =============== 2) Source individual calls/hour ===============
 
 class TestSourceCallsHourThreshold:
-    def test_resume_under_amber(self):
+    def test_resume_under_amber(self, fake_supabase):
         _setup_counters_under_threshold()
         import main
         main._api_source_counters["places_directions"] = {"resume": 25}  # <30 amber
-        mock_sb = MagicMock()
-        mock_sb.table = MagicMock(return_value=_FixedResultChain([]))
-        with patch("main.supabase", mock_sb), \
-             patch("main.send_alert_email") as mock_send, \
+        fake_supabase["*"].on("*", SBResult(data=[]))
+        with patch("main.send_alert_email") as mock_send, \
              patch("main._cost_alert_already_sent_recently", return_value=False):
             from main import check_cost_alerts
             result = check_cost_alerts()
         source_fired = [f for f in result["fired"] if "source_" in f.get("metric", "")]
         assert source_fired == []
 
-    def test_resume_red_threshold_fires(self):
+    def test_resume_red_threshold_fires(self, fake_supabase):
         """Caso bug #266: si resume vuelve a dispararse >80/h, alarma roja."""
         _setup_counters_under_threshold()
         import main
         main._api_source_counters["places_directions"] = {"resume": 90}  # >80 red
-        mock_sb = MagicMock()
-        mock_sb.table = MagicMock(return_value=_FixedResultChain([]))
-        with patch("main.supabase", mock_sb), \
-             patch("main.send_alert_email") as mock_send, \
+        fake_supabase["*"].on("*", SBResult(data=[]))
+        with patch("main.send_alert_email") as mock_send, \
              patch("main._cost_alert_already_sent_recently", return_value=False):
             from main import check_cost_alerts
             result = check_cost_alerts()
@@ -124,48 +100,42 @@ class TestSourceCallsHourThreshold:
         assert len(source_fired) == 1
         assert source_fired[0]["level"] == "red"
 
-    def test_address_search_high_volume_does_not_fire(self):
+    def test_address_search_high_volume_does_not_fire(self, fake_supabase):
         """11-jun: address-search es alto volumen LEGÍTIMO (~cientos/h en punta).
         Con el override (amber 450 / red 800) un volumen normal de mañana NO debe
         alertar (antes saltaba RED con el umbral genérico 80 → falso positivo)."""
         _setup_counters_under_threshold()
         import main
         main._api_source_counters["places_autocomplete"] = {"address-search": 350}  # ~382/h, <450
-        mock_sb = MagicMock()
-        mock_sb.table = MagicMock(return_value=_FixedResultChain([]))
-        with patch("main.supabase", mock_sb), \
-             patch("main.send_alert_email"), \
+        fake_supabase["*"].on("*", SBResult(data=[]))
+        with patch("main.send_alert_email"), \
              patch("main._cost_alert_already_sent_recently", return_value=False):
             from main import check_cost_alerts
             result = check_cost_alerts()
         assert [f for f in result["fired"] if "address-search" in f.get("metric", "")] == []
 
-    def test_address_search_real_leak_still_fires(self):
+    def test_address_search_real_leak_still_fires(self, fake_supabase):
         """Pero una FUGA real (muy por encima del pico normal) SÍ alerta."""
         _setup_counters_under_threshold()
         import main
         main._api_source_counters["places_autocomplete"] = {"address-search": 800}  # ~873/h > 800 red
-        mock_sb = MagicMock()
-        mock_sb.table = MagicMock(return_value=_FixedResultChain([]))
-        with patch("main.supabase", mock_sb), \
-             patch("main.send_alert_email"), \
+        fake_supabase["*"].on("*", SBResult(data=[]))
+        with patch("main.send_alert_email"), \
              patch("main._cost_alert_already_sent_recently", return_value=False):
             from main import check_cost_alerts
             result = check_cost_alerts()
         fired = [f for f in result["fired"] if "address-search" in f.get("metric", "")]
         assert len(fired) == 1 and fired[0]["level"] == "red"
 
-    def test_fresh_boot_under_20min_does_not_fire(self):
+    def test_fresh_boot_under_20min_does_not_fire(self, fake_supabase):
         """Tras un deploy (counter reseteado), <20min de uptime NO evalúa la alerta
         horaria — evita el falso RED que disparó el incidente del 11-jun."""
         _setup_counters_under_threshold()
         import main
         main._api_counters_started_at = time.time() - 8 * 60  # 8min uptime
         main._api_source_counters["places_directions"] = {"resume": 200}  # acumulado alto post-boot
-        mock_sb = MagicMock()
-        mock_sb.table = MagicMock(return_value=_FixedResultChain([]))
-        with patch("main.supabase", mock_sb), \
-             patch("main.send_alert_email"), \
+        fake_supabase["*"].on("*", SBResult(data=[]))
+        with patch("main.send_alert_email"), \
              patch("main._cost_alert_already_sent_recently", return_value=False):
             from main import check_cost_alerts
             result = check_cost_alerts()
@@ -175,18 +145,13 @@ class TestSourceCallsHourThreshold:
 # =============== 3) Unknown calls/day ===============
 
 class TestUnknownCallsDayThreshold:
-    def test_unknown_red_fires(self):
+    def test_unknown_red_fires(self, fake_supabase):
         _setup_counters_under_threshold()
         # places_directions/source='unknown' = 60 calls > 50 red
-        def table_dispatch(name):
-            if name == "api_source_daily":
-                # Will be called twice: once for routes_v2 total (empty), once for unknown
-                return _FixedResultChain([{"endpoint": "places_directions", "count": 60}])
-            return _FixedResultChain([])
-        mock_sb = MagicMock()
-        mock_sb.table = MagicMock(side_effect=table_dispatch)
-        with patch("main.supabase", mock_sb), \
-             patch("main.send_alert_email") as mock_send, \
+        # api_source_daily is read twice: routes_v2 total and unknown-per-endpoint
+        fake_supabase["*"].on("*", SBResult(data=[]))
+        fake_supabase["api_source_daily"].on("*", SBResult(data=[{"endpoint": "places_directions", "count": 60}]))
+        with patch("main.send_alert_email") as mock_send, \
              patch("main._cost_alert_already_sent_recently", return_value=False):
             from main import check_cost_alerts
             result = check_cost_alerts()
@@ -197,26 +162,20 @@ class TestUnknownCallsDayThreshold:
 # =============== 4) Driver individual €/day ===============
 
 class TestDriverEurDayThreshold:
-    def test_driver_red_fires(self):
+    def test_driver_red_fires(self, fake_supabase):
         _setup_counters_under_threshold()
         # 1500 calls × 0.0073 = €10.95 > €10 red. La columna se llama user_id
         # desde 23 may 2026 (antes mal-nombrada driver_id pese a contener
         # auth.users.id). El email resuelve nombre vía JOIN drivers.user_id.
         rows = [{"user_id": "aaaaaaaa-bbbb-cccc-dddd-eeeeeeeeeeee", "endpoint": "places_directions", "count": 1500}]
-        def table_dispatch(name):
-            if name == "api_source_driver_daily":
-                return _FixedResultChain(rows)
-            if name == "drivers":
-                # JOIN devuelve el driver real con su id, email, name
-                return _FixedResultChain([{
-                    "id": "drv-real-uuid", "user_id": "aaaaaaaa-bbbb-cccc-dddd-eeeeeeeeeeee",
-                    "email": "victor@example.com", "name": "Victor Tique",
-                }])
-            return _FixedResultChain([])
-        mock_sb = MagicMock()
-        mock_sb.table = MagicMock(side_effect=table_dispatch)
-        with patch("main.supabase", mock_sb), \
-             patch("main.send_alert_email") as mock_send, \
+        fake_supabase["*"].on("*", SBResult(data=[]))
+        fake_supabase["api_source_driver_daily"].on("*", SBResult(data=rows))
+        # JOIN devuelve el driver real con su id, email, name
+        fake_supabase["drivers"].on("*", SBResult(data=[{
+            "id": "drv-real-uuid", "user_id": "aaaaaaaa-bbbb-cccc-dddd-eeeeeeeeeeee",
+            "email": "victor@example.com", "name": "Victor Tique",
+        }]))
+        with patch("main.send_alert_email") as mock_send, \
              patch("main._cost_alert_already_sent_recently", return_value=False):
             from main import check_cost_alerts
             result = check_cost_alerts()
@@ -231,14 +190,12 @@ class TestDriverEurDayThreshold:
 # =============== Anti-spam ===============
 
 class TestAntiSpam:
-    def test_repeated_call_does_not_resend(self):
+    def test_repeated_call_does_not_resend(self, fake_supabase):
         """Si _cost_alert_already_sent_recently devuelve True, NO se envía email."""
         _setup_counters_under_threshold()
         rows = [{"count": 3500}]  # red threshold
-        mock_sb = MagicMock()
-        mock_sb.table = MagicMock(return_value=_FixedResultChain(rows))
-        with patch("main.supabase", mock_sb), \
-             patch("main.send_alert_email") as mock_send, \
+        fake_supabase["*"].on("*", SBResult(data=rows))
+        with patch("main.send_alert_email") as mock_send, \
              patch("main._cost_alert_already_sent_recently", return_value=True):
             from main import check_cost_alerts
             check_cost_alerts()
@@ -14,50 +14,7 @@ from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
 
-from tests.conftest import make_mock_supabase
-
-
-class _FixedResultChain:
-    """A chainable mock where .execute() ALWAYS returns the same fixed result,
-    regardless of how many chained methods are called before it.
-    Every attribute access and every call returns self."""
-
-    def __init__(self, data=None, count=0):
-        self._data = data if data is not None else []
-        self._count = count
-
-    def __getattr__(self, name):
-        if name.startswith("_"):
-            raise AttributeError(name)
-        return self
-
-    def __call__(self, *args, **kwargs):
-        return self
-
-    def execute(self):
-        result = MagicMock()
-        result.data = self._data
-        result.count = self._count
-        return result
-
-
-class _ErrorChain:
-    """A chainable mock where .execute() raises an exception."""
-
-    def __init__(self, exc=None):
-        self._exc = exc or Exception("DB error")
-
-    def __getattr__(self, name):
-        if name.startswith("_"):
-            raise AttributeError(name)
-        return self
-
-    def __call__(self, *args, **kwargs):
-        return self
-
-    def execute(self):
-        raise self._exc
-
+from tests.conftest import SBResult
 
 # ===================== BACKUP CRITICAL TABLES =====================
 
@@ -65,28 +22,18 @@ class TestBackupCriticalTables:
     """Tests for backup_critical_tables cron job."""
 
     @pytest.mark.asyncio
-    async def test_backup_success(self):
-        mock_sb = make_mock_supabase()
-
-        def table_dispatch(name):
-            return _FixedResultChain(data=[{"id": "1", "name": "test"}], count=1)
-
-        mock_sb.table = MagicMock(side_effect=table_dispatch)
+    async def test_backup_success(self, supabase_mock, fake_supabase):
+        fake_supabase["*"].on("*", SBResult(data=[{"id": "1", "name": "test"}], count=1))
 
-        with patch("main.supabase", mock_sb), \
-             patch("main.SENTRY_DSN", ""):
+        with patch("main.SENTRY_DSN", ""):
             from main import backup_critical_tables
             await backup_critical_tables()
 
-        mock_sb.storage.from_.assert_called_with("backups")
+        supabase_mock.storage.from_.assert_called_with("backups")
 
     @pytest.mark.asyncio
-    async def test_backup_with_sentry(self):
-        mock_sb = make_mock_supabase()
-        mock_sb.table = MagicMock(side_effect=lambda name: _FixedResultChain())
-
-        with patch("main.supabase", mock_sb), \
-             patch("main.SENTRY_DSN", "https://sentry.io/fake"), \
+    async def test_backup_with_sentry(self, fake_supabase):
+        with patch("main.SENTRY_DSN", "https://sentry.io/fake"), \
              patch("main.sentry_sdk") as mock_sentry:
             from main import backup_critical_tables
             await backup_critical_tables()
@@ -94,36 +41,25 @@ class TestBackupCriticalTables:
         assert mock_sentry.capture_check_in.call_count >= 2
 
     @pytest.mark.asyncio
-    async def test_backup_table_error_continues(self):
+    async def test_backup_table_error_continues(self, supabase_mock, fake_supabase):
         """Even if one table fails, backup continues for others."""
-        mock_sb = make_mock_supabase()
-
-        def table_dispatch(name):
-            if name == "routes":
-                return _ErrorChain(Exception("DB error"))
-            return _FixedResultChain()
-
-        mock_sb.table = MagicMock(side_effect=table_dispatch)
+        fake_supabase["routes"].on("*", Exception("DB error"))
 
-        with patch("main.supabase", mock_sb), \
-             patch("main.SENTRY_DSN", ""):
+        with patch("main.SENTRY_DSN", ""):
             from main import backup_critical_tables
             await backup_critical_tables()
 
-        mock_sb.storage.from_.assert_called_with("backups")
+        supabase_mock.storage.from_.assert_called_with("backups")
 
     @pytest.mark.asyncio
-    async def test_backup_upload_error(self):
+    async def test_backup_upload_error(self, supabase_mock, fake_supabase):
         """If storage upload fails, sentry reports error."""
-        mock_sb = make_mock_supabase()
-        mock_sb.table = MagicMock(side_effect=lambda name: _FixedResultChain())
 
         bucket = MagicMock()
         bucket.upload = MagicMock(side_effect=Exception("Upload failed"))
-        mock_sb.storage.from_ = MagicMock(return_value=bucket)
+        supabase_mock.storage.from_.return_value = bucket
 
-        with patch("main.supabase", mock_sb), \
-             patch("main.SENTRY_DSN", "https://sentry.io/fake"), \
+        with patch("main.SENTRY_DSN", "https://sentry.io/fake"), \
              patch("main.sentry_sdk") as mock_sentry:
             from main import backup_critical_tables
             await backup_critical_tables()
@@ -196,25 +132,14 @@ class TestSendWeeklyReengagementPush:
     """Tests for send_weekly_reengagement_push cron job."""
 
     @pytest.mark.asyncio
-    async def test_push_to_inactive_drivers(self):
-        mock_sb = make_mock_supabase()
-        call_count = {"n": 0}
-
-        def table_dispatch(name):
-            call_count["n"] += 1
-            if name == "drivers":
-                return _FixedResultChain(data=[
-                    {"id": "d1", "name": "Driver 1", "push_token": "ExponentPushToken[abc]"},
-                    {"id": "d2", "name": "Driver 2", "push_token": "ExponentPushToken[def]"},
-                ])
-            elif name == "routes":
-                return _FixedResultChain(data=[{"driver_id": "d1"}])
-            return _FixedResultChain()
-
-        mock_sb.table = MagicMock(side_effect=table_dispatch)
-
-        with patch("main.supabase", mock_sb), \
-             patch("main.send_push_to_token", new_callable=AsyncMock, return_value=True) as mock_push:
+    async def test_push_to_inactive_drivers(self, fake_supabase):
+        fake_supabase["drivers"].on("*", SBResult(data=[
+            {"id": "d1", "name": "Driver 1", "push_token": "ExponentPushToken[abc]"},
+            {"id": "d2", "name": "Driver 2", "push_token": "ExponentPushToken[def]"},
+        ]))
+        fake_supabase["routes"].on("*", SBResult(data=[{"driver_id": "d1"}]))
+
+        with patch("main.send_push_to_token", new_callable=AsyncMock, return_value=True) as mock_push:
             from main import send_weekly_reengagement_push
             await send_weekly_reengagement_push()
 
@@ -222,91 +147,64 @@ class TestSendWeeklyReengagementPush:
         mock_push.assert_called_once()
 
     @pytest.mark.asyncio
-    async def test_no_recent_drivers(self):
-        mock_sb = make_mock_supabase()
-        mock_sb.table = MagicMock(side_effect=lambda name: _FixedResultChain())
-
-        with patch("main.supabase", mock_sb), \
-             patch("main.send_push_to_token", new_callable=AsyncMock) as mock_push:
+    async def test_no_recent_drivers(self, fake_supabase):
+        with patch("main.send_push_to_token", new_callable=AsyncMock) as mock_push:
             from main import send_weekly_reengagement_push
             await send_weekly_reengagement_push()
 
         mock_push.assert_not_called()
 
     @pytest.mark.asyncio
-    async def test_all_drivers_have_routes(self):
-        mock_sb = make_mock_supabase()
-        call_count = {"n": 0}
-
-        def table_dispatch(name):
-            call_count["n"] += 1
-            if name == "drivers":
-                return _FixedResultChain(data=[
-                    {"id": "d1", "name": "Driver 1", "push_token": "ExponentPushToken[abc]"},
-                ])
-            elif name == "routes":
-                return _FixedResultChain(data=[{"driver_id": "d1"}])
-            return _FixedResultChain()
-
-        mock_sb.table = MagicMock(side_effect=table_dispatch)
-
-        with patch("main.supabase", mock_sb), \
-             patch("main.send_push_to_token", new_callable=AsyncMock) as mock_push:
+    async def test_all_drivers_have_routes(self, fake_supabase):
+        fake_supabase["drivers"].on("*", SBResult(data=[
+            {"id": "d1", "name": "Driver 1", "push_token": "ExponentPushToken[abc]"},
+        ]))
+        fake_supabase["routes"].on("*", SBResult(data=[{"driver_id": "d1"}]))
+
+        with patch("main.send_push_to_token", new_callable=AsyncMock) as mock_push:
             from main import send_weekly_reengagement_push
             await send_weekly_reengagement_push()
 
         mock_push.assert_not_called()
 
     @pytest.mark.asyncio
-    async def test_push_error_handled(self):
-        mock_sb = make_mock_supabase()
+    async def test_push_error_handled(self, fake_supabase):
+        fake_supabase["drivers"].on("*", Exception("DB error"))
 
-        def table_dispatch(name):
-            if name == "drivers":
-                return _ErrorChain(Exception("DB error"))
-            return _FixedResultChain()
-
-        mock_sb.table = MagicMock(side_effect=table_dispatch)
-
-        with patch("main.supabase", mock_sb):
-            from main import send_weekly_reengagement_push
-            # Should not raise
-            await send_weekly_reengagement_push()
+        from main import send_weekly_reengagement_push
+        # Should not raise
+        await send_weekly_reengagement_push()
 
 
 # ===================== CHECK EXPIRING TRIALS =====================
 
-def _expiry_dispatch(drivers_data, email_log_existing=False, routes_count=0, stops_count=0):
-    """Build a side_effect for supabase.table(name) used by check_expiring_trials.
+def _expiry_tables(fake, drivers_data, email_log_existing=False, routes_count=0, stops_count=0):
+    """Register on `fake` (the fake_supabase fixture) the tables
+    check_expiring_trials reads.
 
     drivers query → returns the supplied driver rows.
     email_log query (dedup probe) → returns either empty (no prior send) or one row.
-    email_log INSERT → goes through the same chain harmlessly.
+    email_log INSERT → goes through the same table harmlessly.
     routes / stops → consumed by _compute_trial_kpis on the D-2 cohort, harmless
                      for D-3/D-1 (those buckets don't query KPIs).
     """
-    def dispatch(name):
-        if name == "drivers":
-            return _FixedResultChain(data=drivers_data)
-        if name == "routes":
-            # Each row needs id (para filtrar stops por route_id) +
-            # total_distance_km + optimized_hash for the KPI sum.
-            return _FixedResultChain(
-                data=[{"id": f"route-{i}", "total_distance_km": 12.5, "optimized_hash": "h"} for i in range(routes_count)],
-                count=routes_count,
-            )
-        if name == "stops":
-            return _FixedResultChain(data=[], count=stops_count)
-        # email_log: only the dedup SELECT needs realistic data; INSERT is fire-and-forget
-        return _FixedResultChain(data=[{"id": "prior"}] if email_log_existing else [])
-    return dispatch
+    fake["drivers"].on("*", SBResult(data=drivers_data))
+    # Each row needs id (para filtrar stops por route_id) +
+    # total_distance_km + optimized_hash for the KPI sum.
+    fake["routes"].on("*", SBResult(
+        data=[{"id": f"route-{i}", "total_distance_km": 12.5, "optimized_hash": "h"} for i in range(routes_count)],
+        count=routes_count,
+    ))
+    fake["stops"].on("*", SBResult(data=[], count=stops_count))
+    # email_log: only the dedup SELECT needs realistic data; INSERT is fire-and-forget
+    fake["email_log"].on("*", SBResult(data=[{"id": "prior"}] if email_log_existing else []))
 
 
 class TestCheckExpiringTrials:
     """Tests for check_expiring_trials cron job — D-3 and D-1 conversion touchpoints."""
 
     @pytest.mark.asyncio
-    async def test_d3_cohort_sends_d3_email(self):
+    async def test_d3_cohort_sends_d3_email(self, fake_supabase):
         # Trial expires in 3 days + 12h → falls in [72h, 96h) bucket
         expires_at = (datetime.now(timezone.utc) + timedelta(days=3, hours=12)).isoformat()
         drivers = [{
@@ -318,11 +216,9 @@ class TestCheckExpiringTrials:
             "subscription_source": None,
         }]
 
-        mock_sb = make_mock_supabase()
-        mock_sb.table = MagicMock(side_effect=_expiry_dispatch(drivers))
+        _expiry_tables(fake_supabase, drivers)
 
-        with patch("main.supabase", mock_sb), \
-             patch("main.SENTRY_DSN", ""), \
+        with patch("main.SENTRY_DSN", ""), \
              patch("main.send_trial_expiring_email", return_value={"success": True, "id": "msg1"}) as mock_d3, \
              patch("main.send_trial_last_day_email", return_value={"success": True}) as mock_d1:
             from main import check_expiring_trials
@@ -332,7 +228,7 @@ class TestCheckExpiringTrials:
         mock_d1.assert_not_called()
 
     @pytest.mark.asyncio
-    async def test_d1_cohort_sends_d1_email(self):
+    async def test_d1_cohort_sends_d1_email(self, fake_supabase):
         # Trial expires in 1 day + 12h → falls in [24h, 48h) bucket
         expires_at = (datetime.now(timezone.utc) + timedelta(days=1, hours=12)).isoformat()
         drivers = [{
@@ -344,11 +240,9 @@ class TestCheckExpiringTrials:
             "subscription_source": None,
         }]
 
-        mock_sb = make_mock_supabase()
-        mock_sb.table = MagicMock(side_effect=_expiry_dispatch(drivers))
+        _expiry_tables(fake_supabase, drivers)
 
-        with patch("main.supabase", mock_sb), \
-             patch("main.SENTRY_DSN", ""), \
+        with patch("main.SENTRY_DSN", ""), \
              patch("main.send_trial_expiring_email", return_value={"success": True}) as mock_d3, \
              patch("main.send_trial_last_day_email", return_value={"success": True, "id": "msg2"}) as mock_d1:
             from main import check_expiring_trials
@@ -358,7 +252,7 @@ class TestCheckExpiringTrials:
         mock_d3.assert_not_called()
 
     @pytest.mark.asyncio
-    async def test_outside_all_buckets_skipped(self):
+    async def test_outside_all_buckets_skipped(self, fake_supabase):
         # Trial expires in ~5 days (>96h) → outside D-3/D-2/D-1 windows entirely.
         # Used to be the "2 day cohort" test; now D-2 IS handled, so we move
         # outside to a cleanly-skipped value.
@@ -374,11 +268,9 @@ class TestCheckExpiringTrials:
             "push_token": None,
         }]
 
-        mock_sb = make_mock_supabase()
-        mock_sb.table = MagicMock(side_effect=_expiry_dispatch(drivers))
+        _expiry_tables(fake_supabase, drivers)
 
-        with patch("main.supabase", mock_sb), \
-             patch("main.SENTRY_DSN", ""), \
+        with patch("main.SENTRY_DSN", ""), \
              patch("main.send_trial_expiring_email") as mock_d3, \
              patch("main.send_trial_value_recap_email") as mock_d2, \
              patch("main.send_trial_last_day_email") as mock_d1:
@@ -390,7 +282,7 @@ class TestCheckExpiringTrials:
         mock_d1.assert_not_called()
 
     @pytest.mark.asyncio
-    async def test_d2_cohort_sends_value_recap_email(self):
+    async def test_d2_cohort_sends_value_recap_email(self, fake_supabase):
         # Trial expires in 2d + 12h → 60h → falls in [48h, 72h) D-2 bucket.
         # D-2 also fires _compute_trial_kpis, so the mock provides routes/stops.
         expires_at = (datetime.now(timezone.utc) + timedelta(days=2, hours=12)).isoformat()
@@ -406,13 +298,9 @@ class TestCheckExpiringTrials:
             "push_token": None,
         }]
 
-        mock_sb = make_mock_supabase()
-        mock_sb.table = MagicMock(
-            side_effect=_expiry_dispatch(drivers, routes_count=4, stops_count=18)
-        )
+        _expiry_tables(fake_supabase, drivers, routes_count=4, stops_count=18)
 
-        with patch("main.supabase", mock_sb), \
-             patch("main.SENTRY_DSN", ""), \
+        with patch("main.SENTRY_DSN", ""), \
              patch("main.send_trial_expiring_email") as mock_d3, \
              patch("main.send_trial_value_recap_email", return_value={"success": True, "id": "msg2"}) as mock_d2, \
              patch("main.send_trial_last_day_email") as mock_d1:
@@ -430,7 +318,7 @@ class TestCheckExpiringTrials:
         assert call_args.args[4] == 50.0  # total_km
 
     @pytest.mark.asyncio
-    async def test_d2_cohort_with_empty_kpis_sends_generic_not_zero_recap(self):
+    async def test_d2_cohort_with_empty_kpis_sends_generic_not_zero_recap(self, fake_supabase):
         """GUARD anti-basura: si los KPIs del trial salen a 0 (usuario no usó
         la app o la query falló), NO enviar el recap de valor con '0 entregas'
         — enviar el email genérico de trial expirando. Protege contra el
@@ -448,14 +336,10 @@ class TestCheckExpiringTrials:
             "push_token": None,
         }]
 
-        mock_sb = make_mock_supabase()
         # routes_count=0, stops_count=0 → KPIs vacíos → debe activar el guard
-        mock_sb.table = MagicMock(
-            side_effect=_expiry_dispatch(drivers, routes_count=0, stops_count=0)
-        )
+        _expiry_tables(fake_supabase, drivers, routes_count=0, stops_count=0)
 
-        with patch("main.supabase", mock_sb), \
-             patch("main.SENTRY_DSN", ""), \
+        with patch("main.SENTRY_DSN", ""), \
              patch("main.send_trial_expiring_email", return_value={"success": True, "id": "gen"}) as mock_generic, \
              patch("main.send_trial_value_recap_email") as mock_recap, \
              patch("main.send_trial_last_day_email"):
@@ -468,7 +352,7 @@ class TestCheckExpiringTrials:
         mock_generic.assert_called_once()
 
     @pytest.mark.asyncio
-    async def test_d1_cohort_also_sends_push_when_token_present(self):
+    async def test_d1_cohort_also_sends_push_when_token_present(self, fake_supabase):
         # D-1 driver with a push_token → email + push both fire.
         expires_at = (datetime.now(timezone.utc) + timedelta(days=1, hours=12)).isoformat()
         drivers = [{
@@ -482,11 +366,9 @@ class TestCheckExpiringTrials:
             "push_token": "ExponentPushToken[abc123]",
         }]
 
-        mock_sb = make_mock_supabase()
-        mock_sb.table = MagicMock(side_effect=_expiry_dispatch(drivers))
+        _expiry_tables(fake_supabase, drivers)
 
-        with patch("main.supabase", mock_sb), \
-             patch("main.SENTRY_DSN", ""), \
+        with patch("main.SENTRY_DSN", ""), \
              patch("main.send_trial_last_day_email", return_value={"success": True, "id": "msg-d1"}) as mock_d1, \
              patch("main.send_push_to_token", new=AsyncMock(return_value=True)) as mock_push:
             from main import check_expiring_trials
@@ -499,7 +381,7 @@ class TestCheckExpiringTrials:
         assert push_kwargs.get("data", {}).get("deeplink") == "xpedit://upgrade"
 
     @pytest.mark.asyncio
-    async def test_dedup_via_email_log(self):
+    async def test_dedup_via_email_log(self, fake_supabase):
         # D-3 driver, but email_log already contains the D-3 send → skipped
         expires_at = (datetime.now(timezone.utc) + timedelta(days=3, hours=12)).isoformat()
         drivers = [{
@@ -511,11 +393,9 @@ class TestCheckExpiringTrials:
             "subscription_source": None,
         }]
 
-        mock_sb = make_mock_supabase()
-        mock_sb.table = MagicMock(side_effect=_expiry_dispatch(drivers, email_log_existing=True))
+        _expiry_tables(fake_supabase, drivers, email_log_existing=True)
 
-        with patch("main.supabase", mock_sb), \
-             patch("main.SENTRY_DSN", ""), \
+        with patch("main.SENTRY_DSN", ""), \
              patch("main.send_trial_expiring_email") as mock_d3, \
              patch("main.send_trial_last_day_email") as mock_d1:
             from main import check_expiring_trials
@@ -525,7 +405,7 @@ class TestCheckExpiringTrials:
         mock_d1.assert_not_called()
 
     @pytest.mark.asyncio
-    async def test_excludes_admin_and_test_ids(self):
+    async def test_excludes_admin_and_test_ids(self, fake_supabase):
         expires_at = (datetime.now(timezone.utc) + timedelta(days=3, hours=12)).isoformat()
         drivers = [
             {
@@ -554,11 +434,9 @@ class TestCheckExpiringTrials:
             },
         ]
 
-        mock_sb = make_mock_supabase()
-        mock_sb.table = MagicMock(side_effect=_expiry_dispatch(drivers))
+        _expiry_tables(fake_supabase, drivers)
 
-        with patch("main.supabase", mock_sb), \
-             patch("main.SENTRY_DSN", ""), \
+        with patch("main.SENTRY_DSN", ""), \
              patch("main.send_trial_expiring_email") as mock_d3, \
              patch("main.send_trial_last_day_email") as mock_d1:
             from main import check_expiring_trials
@@ -568,12 +446,10 @@ class TestCheckExpiringTrials:
         mock_d1.assert_not_called()
 
     @pytest.mark.asyncio
-    async def test_no_expiring_trials(self):
-        mock_sb = make_mock_supabase()
-        mock_sb.table = MagicMock(side_effect=_expiry_dispatch([]))
+    async def test_no_expiring_trials(self, fake_supabase):
+        _expiry_tables(fake_supabase, [])
 
-        with patch("main.supabase", mock_sb), \
-             patch("main.SENTRY_DSN", ""), \
+        with patch("main.SENTRY_DSN", ""), \
              patch("main.send_trial_expiring_email") as mock_d3, \
              patch("main.send_trial_last_day_email") as mock_d1:
             from main import check_expiring_trials
@@ -583,7 +459,7 @@ class TestCheckExpiringTrials:
         mock_d1.assert_not_called()
 
     @pytest.mark.asyncio
-    async def test_email_failure_counted(self):
+    async def test_email_failure_counted(self, fake_supabase):
         expires_at = (datetime.now(timezone.utc) + timedelta(days=1, hours=12)).isoformat()
         drivers = [{
             "id": "driver-x",
@@ -594,11 +470,9 @@ class TestCheckExpiringTrials:
             "subscription_source": None,
         }]
 
-        mock_sb = make_mock_supabase()
-        mock_sb.table = MagicMock(side_effect=_expiry_dispatch(drivers))
+        _expiry_tables(fake_supabase, drivers)
 
-        with patch("main.supabase", mock_sb), \
-             patch("main.SENTRY_DSN", ""), \
+        with patch("main.SENTRY_DSN", ""), \
              patch("main.send_trial_last_day_email", return_value={"success": False, "error": "fail"}) as mock_d1:
             from main import check_expiring_trials
             await check_expiring_trials()
@@ -606,7 +480,7 @@ class TestCheckExpiringTrials:
         mock_d1.assert_called_once()
 
     @pytest.mark.asyncio
-    async def test_driver_without_email_skipped(self):
+    async def test_driver_without_email_skipped(self, fake_supabase):
         expires_at = (datetime.now(timezone.utc) + timedelta(days=3, hours=12)).isoformat()
         drivers = [{
             "id": "driver-no-email",
@@ -617,11 +491,9 @@ class TestCheckExpiringTrials:
             "subscription_source": None,
         }]
 
-        mock_sb = make_mock_supabase()
-        mock_sb.table = MagicMock(side_effect=_expiry_dispatch(drivers))
+        _expiry_tables(fake_supabase, drivers)
 
-        with patch("main.supabase", mock_sb), \
-             patch("main.SENTRY_DSN", ""), \
+        with patch("main.SENTRY_DSN", ""), \
              patch("main.send_trial_expiring_email") as mock_d3, \
              patch("main.send_trial_last_day_email") as mock_d1:
             from main import check_expiring_trials
@@ -631,12 +503,10 @@ class TestCheckExpiringTrials:
         mock_d1.assert_not_called()
 
     @pytest.mark.asyncio
-    async def test_db_error_with_sentry(self):
-        mock_sb = make_mock_supabase()
-        mock_sb.table = MagicMock(side_effect=lambda name: _ErrorChain(Exception("DB failure")))
+    async def test_db_error_with_sentry(self, fake_supabase):
+        fake_supabase["*"].on("*", Exception("DB failure"))
 
-        with patch("main.supabase", mock_sb), \
-             patch("main.SENTRY_DSN", "https://sentry.io/fake"), \
+        with patch("main.SENTRY_DSN", "https://sentry.io/fake"), \
              patch("main.sentry_sdk") as mock_sentry:
             from main import check_expiring_trials
             await check_expiring_trials()
@@ -650,28 +520,19 @@ class TestDegradeExpiredTrials:
     """Tests for degrade_expired_trials cron job."""
 
     @pytest.mark.asyncio
-    async def test_downgrades_expired_trial(self):
-        mock_sb = make_mock_supabase()
-        call_count = {"n": 0}
-
-        def table_dispatch(name):
-            call_count["n"] += 1
-            if name == "drivers" and call_count["n"] == 1:
-                return _FixedResultChain(data=[
-                    {
-                        "id": "driver-expired",
-                        "email": "user@test.com",
-                        "name": "User",
-                        "promo_plan": "pro",
-                        "promo_plan_expires_at": (datetime.now(timezone.utc) - timedelta(days=1)).isoformat(),
-                    }
-                ])
-            return _FixedResultChain()
-
-        mock_sb.table = MagicMock(side_effect=table_dispatch)
-
-        with patch("main.supabase", mock_sb), \
-             patch("main.SENTRY_DSN", ""), \
+    async def test_downgrades_expired_trial(self, fake_supabase):
+        # The expired-trials select, then the downgrade UPDATE.
+        fake_supabase["drivers"].on("*", SBResult(data=[
+            {
+                "id": "driver-expired",
+                "email": "user@test.com",
+                "name": "User",
+                "promo_plan": "pro",
+                "promo_plan_expires_at": (datetime.now(timezone.utc) - timedelta(days=1)).isoformat(),
+            }
+        ]), SBResult())
+
+        with patch("main.SENTRY_DSN", ""), \
              patch("main.send_trial_expired_email", return_value={"success": True}) as mock_email:
             from main import degrade_expired_trials
             await degrade_expired_trials()
@@ -679,10 +540,8 @@ class TestDegradeExpiredTrials:
         mock_email.assert_called_once_with("user@test.com", "User", "pro")
 
     @pytest.mark.asyncio
-    async def test_excludes_admin_ids(self):
-        mock_sb = make_mock_supabase()
-
-        mock_sb.table = MagicMock(side_effect=lambda name: _FixedResultChain(data=[
+    async def test_excludes_admin_ids(self, fake_supabase):
+        fake_supabase["*"].on("*", SBResult(data=[
             {
                 "id": "8c0aa30a-6de1-43e8-8a6c-71c1c8a6670b",  # excluded
                 "email": "admin@xpedit.es",
@@ -692,8 +551,7 @@ class TestDegradeExpiredTrials:
             }
         ]))
 
-        with patch("main.supabase", mock_sb), \
-             patch("main.SENTRY_DSN", ""), \
+        with patch("main.SENTRY_DSN", ""), \
              patch("main.send_trial_expired_email") as mock_email:
             from main import degrade_expired_trials
             await degrade_expired_trials()
@@ -701,37 +559,23 @@ class TestDegradeExpiredTrials:
         mock_email.assert_not_called()
 
     @pytest.mark.asyncio
-    async def test_does_not_degrade_paying_subscribers_D1(self):
+    async def test_does_not_degrade_paying_subscribers_D1(self, fake_supabase):
         """(#79 D1) El cron SOLO debe tocar trials: la query DEBE filtrar
         subscription_source IS NULL para no degradar a un pagante Stripe/RC
         cuyo expires_at se quedó atrás por un webhook de renovación fallido."""
-        is_calls = []
-
-        class _RecordingChain(_FixedResultChain):
-            def is_(self, col, val):
-                is_calls.append((col, val))
-                return self
-
-        mock_sb = make_mock_supabase()
-        mock_sb.table = MagicMock(side_effect=lambda name: _RecordingChain())
-
-        with patch("main.supabase", mock_sb), \
-             patch("main.SENTRY_DSN", ""), \
+        with patch("main.SENTRY_DSN", ""), \
              patch("main.send_trial_expired_email", return_value={"success": True}):
             from main import degrade_expired_trials
             await degrade_expired_trials()
 
         # El filtro que protege a los pagantes tiene que estar en la query.
+        is_calls = [args for name, args in fake_supabase["drivers"].calls if name == "is_"]
         assert ("subscription_source", "null") in is_calls, \
             f"degrade_expired_trials NO filtra subscription_source IS NULL → degradaría pagantes. is_ calls: {is_calls}"
 
     @pytest.mark.asyncio
-    async def test_no_expired_trials(self):
-        mock_sb = make_mock_supabase()
-        mock_sb.table = MagicMock(side_effect=lambda name: _FixedResultChain())
-
-        with patch("main.supabase", mock_sb), \
-             patch("main.SENTRY_DSN", ""), \
+    async def test_no_expired_trials(self, fake_supabase):
+        with patch("main.SENTRY_DSN", ""), \
              patch("main.send_trial_expired_email") as mock_email:
             from main import degrade_expired_trials
             await degrade_expired_trials()
@@ -739,28 +583,18 @@ class TestDegradeExpiredTrials:
         mock_email.assert_not_called()
 
     @pytest.mark.asyncio
-    async def test_driver_without_email_skips_notification(self):
-        mock_sb = make_mock_supabase()
-        call_count = {"n": 0}
-
-        def table_dispatch(name):
-            call_count["n"] += 1
-            if name == "drivers" and call_count["n"] == 1:
-                return _FixedResultChain(data=[
-                    {
-                        "id": "driver-no-email",
-                        "email": None,
-                        "name": "NoEmail",
-                        "promo_plan": "pro_plus",
-                        "promo_plan_expires_at": (datetime.now(timezone.utc) - timedelta(days=1)).isoformat(),
-                    }
-                ])
-            return _FixedResultChain()
-
-        mock_sb.table = MagicMock(side_effect=table_dispatch)
-
-        with patch("main.supabase", mock_sb), \
-             patch("main.SENTRY_DSN", ""), \
+    async def test_driver_without_email_skips_notification(self, fake_supabase):
+        fake_supabase["drivers"].on("*", SBResult(data=[
+            {
+                "id": "driver-no-email",
+                "email": None,
+                "name": "NoEmail",
+                "promo_plan": "pro_plus",
+                "promo_plan_expires_at": (datetime.now(timezone.utc) - timedelta(days=1)).isoformat(),
+            }
+        ]), SBResult())
+
+        with patch("main.SENTRY_DSN", ""), \
              patch("main.send_trial_expired_email") as mock_email:
             from main import degrade_expired_trials
             await degrade_expired_trials()
@@ -768,12 +602,10 @@ class TestDegradeExpiredTrials:
         mock_email.assert_not_called()
 
     @pytest.mark.asyncio
-    async def test_db_error_with_sentry(self):
-        mock_sb = make_mock_supabase()
-        mock_sb.table = MagicMock(side_effect=lambda name: _ErrorChain(Exception("DB failure")))
+    async def test_db_error_with_sentry(self, fake_supabase):
+        fake_supabase["*"].on("*", Exception("DB failure"))
 
-        with patch("main.supabase", mock_sb), \
-             patch("main.SENTRY_DSN", "https://sentry.io/fake"), \
+        with patch("main.SENTRY_DSN", "https://sentry.io/fake"), \
              patch("main.sentry_sdk") as mock_sentry:
             from main import degrade_expired_trials
             await degrade_expired_trials()
@@ -781,7 +613,7 @@ class TestDegradeExpiredTrials:
         mock_sentry.capture_exception.assert_called_once()
 
     @pytest.mark.asyncio
-    async def test_skips_email_if_already_logged_O4(self):
+    async def test_skips_email_if_already_logged_O4(self, fake_supabase):
         """(#81 O4) Si email_log ya tiene un 'trial_expired' para el driver (otra
         réplica ya lo mandó en la misma hora), NO se reenvía → cero spam al usuario."""
         expired = {
@@ -791,20 +623,11 @@ class TestDegradeExpiredTrials:
             "promo_plan": "pro",
             "promo_plan_expires_at": (datetime.now(timezone.utc) - timedelta(days=1)).isoformat(),
         }
+        # el probe de dedup encuentra un envío previo
+        fake_supabase["email_log"].on("*", SBResult(data=[{"id": "prior-send"}]))
+        fake_supabase["drivers"].on("*", SBResult(data=[expired]))
 
-        def table_dispatch(name):
-            if name == "email_log":
-                # el probe de dedup encuentra un envío previo
-                return _FixedResultChain(data=[{"id": "prior-send"}])
-            if name == "drivers":
-                return _FixedResultChain(data=[expired])
-            return _FixedResultChain()
-
-        mock_sb = make_mock_supabase()
-        mock_sb.table = MagicMock(side_effect=table_dispatch)
-
-        with patch("main.supabase", mock_sb), \
-             patch("main.SENTRY_DSN", ""), \
+        with patch("main.SENTRY_DSN", ""), \
              patch("main.send_trial_expired_email", return_value={"success": True}) as mock_email:
             from main import degrade_expired_trials
             await degrade_expired_trials()
@@ -818,9 +641,8 @@ class TestPeriodicHealthCheck:
     """Tests for periodic_health_check cron job."""
 
     @pytest.mark.asyncio
-    async def test_healthy_status(self):
-        mock_sb = make_mock_supabase()
-        mock_sb.table = MagicMock(side_effect=lambda name: _FixedResultChain(count=5))
+    async def test_healthy_status(self, fake_supabase):
+        fake_supabase["*"].on("*", SBResult(count=5))
 
         mock_scheduler = MagicMock()
         mock_scheduler.running = True
@@ -833,8 +655,7 @@ class TestPeriodicHealthCheck:
         mock_http.__aenter__.return_value = mock_http
         mock_http.__aexit__.return_value = False
 
-        with patch("main.supabase", mock_sb), \
-             patch("main.social_scheduler", mock_scheduler), \
+        with patch("main.social_scheduler", mock_scheduler), \
              patch("main.SENTRY_DSN", "https://sentry.io/fake"), \
              patch("main.sentry_sdk") as mock_sentry, \
              patch("main.httpx.AsyncClient", return_value=mock_http):
@@ -846,15 +667,13 @@ class TestPeriodicHealthCheck:
         )
 
     @pytest.mark.asyncio
-    async def test_degraded_db(self):
-        mock_sb = make_mock_supabase()
-        mock_sb.table = MagicMock(side_effect=lambda name: _FixedResultChain(count=None))
+    async def test_degraded_db(self, fake_supabase):
+        fake_supabase["*"].on("*", SBResult(count=None))
 
         mock_scheduler = MagicMock()
         mock_scheduler.running = True
 
-        with patch("main.supabase", mock_sb), \
-             patch("main.social_scheduler", mock_scheduler), \
+        with patch("main.social_scheduler", mock_scheduler), \
              patch("main.SENTRY_DSN", "https://sentry.io/fake"), \
              patch("main.sentry_sdk") as mock_sentry:
             from main import periodic_health_check
@@ -865,15 +684,13 @@ class TestPeriodicHealthCheck:
         )
 
     @pytest.mark.asyncio
-    async def test_scheduler_not_running(self):
-        mock_sb = make_mock_supabase()
-        mock_sb.table = MagicMock(side_effect=lambda name: _FixedResultChain(count=5))
+    async def test_scheduler_not_running(self, fake_supabase):
+        fake_supabase["*"].on("*", SBResult(count=5))
 
         mock_scheduler = MagicMock()
         mock_scheduler.running = False
 
-        with patch("main.supabase", mock_sb), \
-             patch("main.social_scheduler", mock_scheduler), \
+        with patch("main.social_scheduler", mock_scheduler), \
              patch("main.SENTRY_DSN", "https://sentry.io/fake"), \
              patch("main.sentry_sdk") as mock_sentry:
             from main import periodic_health_check
@@ -884,12 +701,10 @@ class TestPeriodicHealthCheck:
         )
 
     @pytest.mark.asyncio
-    async def test_db_exception(self):
-        mock_sb = make_mock_supabase()
-        mock_sb.table = MagicMock(side_effect=lambda name: _ErrorChain(Exception("DB down")))
+    async def test_db_exception(self, fake_supabase):
+        fake_supabase["*"].on("*", Exception("DB down"))
 
-        with patch("main.supabase", mock_sb), \
-             patch("main.social_scheduler", MagicMock(running=True)), \
+        with patch("main.social_scheduler", MagicMock(running=True)), \
              patch("main.SENTRY_DSN", "https://sentry.io/fake"), \
              patch("main.sentry_sdk") as mock_sentry:
             from main import periodic_health_check
@@ -898,16 +713,14 @@ class TestPeriodicHealthCheck:
         mock_sentry.capture_exception.assert_called_once()
 
     @pytest.mark.asyncio
-    async def test_no_sentry(self):
+    async def test_no_sentry(self, fake_supabase):
         """When SENTRY_DSN is empty, health check still runs without error."""
-        mock_sb = make_mock_supabase()
-        mock_sb.table = MagicMock(side_effect=lambda name: _FixedResultChain(count=3))
+        fake_supabase["*"].on("*", SBResult(count=3))
 
         mock_scheduler = MagicMock()
         mock_scheduler.running = True
 
-        with patch("main.supabase", mock_sb), \
-             patch("main.social_scheduler", mock_scheduler), \
+        with patch("main.social_scheduler", mock_scheduler), \
              patch("main.SENTRY_DSN", ""):
             from main import periodic_health_check
             await periodic_health_check()
@@ -1129,16 +942,14 @@ class TestSendDailyHealthDigestJob:
 class TestComputeDailyHealthDigest:
     """Tests for compute_daily_health_digest (collects metrics from DB)."""
 
-    def test_returns_date_and_metrics_shape(self):
+    def test_returns_date_and_metrics_shape(self, supabase_mock, fake_supabase):
         """Must return a dict with 'date' (str) and 'metrics' (list of dicts)
         — every metric must have label + status."""
-        mock_sb = make_mock_supabase()
-        mock_sb.table = MagicMock(side_effect=lambda name: _FixedResultChain(count=0))
-        mock_sb.rpc = MagicMock(side_effect=lambda name, params=None: _FixedResultChain(data=[]))
+        fake_supabase["*"].on("*", SBResult(count=0))
+        supabase_mock.rpc.return_value.execute.return_value = SBResult()
 
-        with patch("main.supabase", mock_sb):
-            from main import compute_daily_health_digest
-            digest = compute_daily_health_digest()
+        from main import compute_daily_health_digest
+        digest = compute_daily_health_digest()
 
         assert isinstance(digest, dict)
         assert isinstance(digest.get("date"), str) and digest["date"]
@@ -1151,16 +962,14 @@ class TestComputeDailyHealthDigest:
             # from a failed lookup, email shows '?' instead of fake 0.
             assert m["status"] in ("ok", "warn", "bad", "error"), f"invalid status: {m}"
 
-    def test_survives_google_signin_rpc_failure(self):
+    def test_survives_google_signin_rpc_failure(self, supabase_mock, fake_supabase):
         """RPC to google_signin_stats can fail — digest must still produce
         a complete output with both platforms defaulted to 0 counts."""
-        mock_sb = make_mock_supabase()
-        mock_sb.table = MagicMock(side_effect=lambda name: _FixedResultChain(count=0))
-        mock_sb.rpc = MagicMock(side_effect=Exception("RPC exploded"))
+        fake_supabase["*"].on("*", SBResult(count=0))
+        supabase_mock.rpc.side_effect = Exception("RPC exploded")
 
-        with patch("main.supabase", mock_sb):
-            from main import compute_daily_health_digest
-            digest = compute_daily_health_digest()
+        from main import compute_daily_health_digest
+        digest = compute_daily_health_digest()
 
         labels = [m["label"] for m in digest["metrics"]]
         assert "Google Sign-In Android (7d)" in labels
@@ -1170,7 +979,7 @@ class TestComputeDailyHealthDigest:
         assert android["value"] == 0
         assert android["status"] == "bad"
 
-    def test_processing_rate_flagged_bad_when_under_30_percent(self):
+    def test_processing_rate_flagged_bad_when_under_30_percent(self, supabase_mock, fake_supabase):
         """THE metric that catches the April 2026 silent-sync class of bugs.
         When processed/total < 30%, status MUST be 'bad' with an alerting note."""
         # 100 stops created, only 10 processed = 10% — must flag as bad.
@@ -1178,25 +987,12 @@ class TestComputeDailyHealthDigest:
         #   1. stops created last_24h  (total)   -> 100
         #   2. stops created last_7d   (total)   -> 700
         #   3. stops processed last_24h          -> 10
-        call_counter = {"stops_calls": 0}
-
-        def table_dispatch(name):
-            if name != "stops":
-                return _FixedResultChain(count=0)
-            call_counter["stops_calls"] += 1
-            if call_counter["stops_calls"] == 1:
-                return _FixedResultChain(count=100)
-            if call_counter["stops_calls"] == 2:
-                return _FixedResultChain(count=700)
-            return _FixedResultChain(count=10)
-
-        mock_sb = make_mock_supabase()
-        mock_sb.table = MagicMock(side_effect=table_dispatch)
-        mock_sb.rpc = MagicMock(side_effect=lambda name, params=None: _FixedResultChain(data=[]))
-
-        with patch("main.supabase", mock_sb):
-            from main import compute_daily_health_digest
-            digest = compute_daily_health_digest()
+        fake_supabase["*"].on("*", SBResult(count=0))
+        fake_supabase["stops"].on("*", SBResult(count=100), SBResult(count=700), SBResult(count=10))
+        supabase_mock.rpc.return_value.execute.return_value = SBResult()
+
+        from main import compute_daily_health_digest
+        digest = compute_daily_health_digest()
 
         rate_metric = next(
             (m for m in digest["metrics"] if m["label"] == "Paradas procesadas (24h)"),
@@ -1207,7 +1003,7 @@ class TestComputeDailyHealthDigest:
         assert "ALERTA" in rate_metric.get("note", ""), "bad rate must come with an alert note"
         assert "10/100" in str(rate_metric["value"])
 
-    def test_processing_rate_low_volume_is_warn_not_bad(self):
+    def test_processing_rate_low_volume_is_warn_not_bad(self, supabase_mock, fake_supabase):
         """Weekend / low-volume days create few stops; a handful still pending
         gives a noisy <30% rate that does NOT mean a sync bug. With < 100 stops
         created in 24h, the rate must degrade to 'warn' (visible in the digest)
@@ -1215,25 +1011,12 @@ class TestComputeDailyHealthDigest:
         recurring weekend false positive without blinding the abr-2026 watchdog."""
         # 48 stops created, only 7 processed = 15% — but only 48 created (< 100),
         # so it must NOT be flagged bad. Same stops-query order as the test above.
-        call_counter = {"stops_calls": 0}
-
-        def table_dispatch(name):
-            if name != "stops":
-                return _FixedResultChain(count=0)
-            call_counter["stops_calls"] += 1
-            if call_counter["stops_calls"] == 1:
-                return _FixedResultChain(count=48)
-            if call_counter["stops_calls"] == 2:
-                return _FixedResultChain(count=300)
-            return _FixedResultChain(count=7)
-
-        mock_sb = make_mock_supabase()
-        mock_sb.table = MagicMock(side_effect=table_dispatch)
-        mock_sb.rpc = MagicMock(side_effect=lambda name, params=None: _FixedResultChain(data=[]))
-
-        with patch("main.supabase", mock_sb):
-            from main import compute_daily_health_digest
-            digest = compute_daily_health_digest()
+        fake_supabase["*"].on("*", SBResult(count=0))
+        fake_supabase["stops"].on("*", SBResult(count=48), SBResult(count=300), SBResult(count=7))
+        supabase_mock.rpc.return_value.execute.return_value = SBResult()
+
+        from main import compute_daily_health_digest
+        digest = compute_daily_health_digest()
 
         rate_metric = next(
             (m for m in digest["metrics"] if m["label"] == "Paradas procesadas (24h)"),
@@ -1245,29 +1028,16 @@ class TestComputeDailyHealthDigest:
         assert "bajo volumen" in rate_metric.get("note", ""), "note must explain low volume"
         assert "7/48" in str(rate_metric["value"])
 
-    def test_processing_rate_high_volume_still_bad(self):
+    def test_processing_rate_high_volume_still_bad(self, supabase_mock, fake_supabase):
         """The watchdog must remain sharp: with >= 100 stops created and < 30%
         processed (the abr-2026 mass-pending signature), status stays 'bad'."""
         # 500 created, 50 processed = 10%, well above the low-volume threshold.
-        call_counter = {"stops_calls": 0}
-
-        def table_dispatch(name):
-            if name != "stops":
-                return _FixedResultChain(count=0)
-            call_counter["stops_calls"] += 1
-            if call_counter["stops_calls"] == 1:
-                return _FixedResultChain(count=500)
-            if call_counter["stops_calls"] == 2:
-                return _FixedResultChain(count=3500)
-            return _FixedResultChain(count=50)
-
-        mock_sb = make_mock_supabase()
-        mock_sb.table = MagicMock(side_effect=table_dispatch)
-        mock_sb.rpc = MagicMock(side_effect=lambda name, params=None: _FixedResultChain(data=[]))
-
-        with patch("main.supabase", mock_sb):
-            from main import compute_daily_health_digest
-            digest = compute_daily_health_digest()
+        fake_supabase["*"].on("*", SBResult(count=0))
+        fake_supabase["stops"].on("*", SBResult(count=500), SBResult(count=3500), SBResult(count=50))
+        supabase_mock.rpc.return_value.execute.return_value = SBResult()
+
+        from main import compute_daily_health_digest
+        digest = compute_daily_health_digest()
 
         rate_metric = next(
             (m for m in digest["metrics"] if m["label"] == "Paradas procesadas (24h)"),
@@ -24,7 +24,7 @@ from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
 
-from tests.conftest import FAKE_DRIVER_ID, FAKE_USER_ID
+from tests.conftest import FAKE_DRIVER_ID, FAKE_USER_ID, SBResult
 
 # ===================== STRIPE ENDPOINTS =====================
 
@@ -37,8 +37,7 @@ class TestStripeCheckout:
              patch("main.STRIPE_PLANS", {"pro": {"name": "Pro", "price_id": "price_123"}}), \
              patch("main.supabase") as mock_sb, \
              patch("main.stripe") as mock_stripe:
-            user_result = MagicMock()
-            user_result.data = {"email": "user@test.com"}
+            user_result = SBResult(data={"email": "user@test.com"})
             mock_sb.table.return_value.select.return_value.eq.return_value.single.return_value.execute.return_value = user_result
 
             mock_session = MagicMock()
@@ -72,9 +71,8 @@ class TestStripePortal:
         with patch("main.STRIPE_SECRET_KEY", "sk_test_fake"), \
              patch("main.supabase") as mock_sb, \
              patch("main.stripe") as mock_stripe:
-            user_result = MagicMock()
-            user_result.data = {"stripe_customer_id": "cus_123"}
-            mock_sb.table.return_value.select.return_value.eq.return_value.single.return_value.execute.return_value = user_result
+            user_result = SBResult(data={"stripe_customer_id": "cus_123"})
+            mock_sb.table.return_value.select.return_value.eq.return_value.maybe_single.return_value.execute.return_value = user_result
 
             mock_session = MagicMock()
             mock_session.url = "https://billing.stripe.com/session_123"
@@ -90,9 +88,8 @@ class TestStripePortal:
     async def test_portal_no_customer(self, client):
         with patch("main.STRIPE_SECRET_KEY", "sk_test_fake"), \
              patch("main.supabase") as mock_sb:
-            user_result = MagicMock()
-            user_result.data = {"stripe_customer_id": None}
-            mock_sb.table.return_value.select.return_value.eq.return_value.single.return_value.execute.return_value = user_result
+            user_result = SBResult(data={"stripe_customer_id": None})
+            mock_sb.table.return_value.select.return_value.eq.return_value.maybe_single.return_value.execute.return_value = user_result
 
             response = await client.post("/stripe/portal")
         assert response.status_code == 404
@@ -131,7 +128,7 @@ class TestStripeWebhook:
     async def test_webhook_checkout_completed(self, client):
         with patch("main.STRIPE_WEBHOOK_SECRET", "whsec_test"), \
              patch("main.stripe") as mock_stripe, \
-             patch("main.supabase") as mock_sb, \
+             patch("main.supabase"), \
              patch("main._processed_webhook_events", {}):
 
             mock_data_obj = MagicMock()
@@ -146,12 +143,6 @@ class TestStripeWebhook:
             mock_event.get.return_value = "evt_test_123"
             mock_stripe.Webhook.construct_event.return_value = mock_event
 
-            def table_dispatch(name):
-                chain = MagicMock()
-                chain.update.return_value.eq.return_value.execute.return_value = MagicMock()
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-
             response = await client.post(
                 "/stripe/webhook",
                 content=b'{"type": "checkout.session.completed"}',
@@ -177,15 +168,9 @@ class TestStripeWebhook:
             mock_event.get.return_value = "evt_test_del"
             mock_stripe.Webhook.construct_event.return_value = mock_event
 
-            user_result = MagicMock()
-            user_result.data = [{"id": FAKE_USER_ID}]
+            user_result = SBResult(data={"id": FAKE_USER_ID})
 
-            def table_dispatch(name):
-                chain = MagicMock()
-                chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = user_result
-                chain.update.return_value.eq.return_value.execute.return_value = MagicMock()
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+            mock_sb.table.return_value.select.return_value.eq.return_value.limit.return_value.maybe_single.return_value.execute.return_value = user_result
 
             response = await client.post(
                 "/stripe/webhook",
@@ -203,8 +188,7 @@ class TestDriverEndpoints:
     @pytest.mark.asyncio
     async def test_list_drivers(self, client):
         with patch("main.supabase") as mock_sb:
-            drivers_result = MagicMock()
-            drivers_result.data = [{"id": "d1", "name": "Driver 1"}]
+            drivers_result = SBResult(data=[{"id": "d1", "name": "Driver 1"}])
             mock_sb.table.return_value.select.return_value.eq.return_value.eq.return_value.execute.return_value = drivers_result
 
             response = await client.get("/drivers")
@@ -212,62 +196,35 @@ class TestDriverEndpoints:
         assert "drivers" in response.json()
 
     @pytest.mark.asyncio
-    async def test_get_driver(self, client):
-        with patch("main.supabase") as mock_sb:
-            driver_access = MagicMock()
-            driver_access.data = [{"id": FAKE_DRIVER_ID, "user_id": FAKE_USER_ID}]
-
-            driver_result = MagicMock()
-            driver_result.data = {"id": FAKE_DRIVER_ID, "name": "Test Driver"}
-
-            call_count = {"drivers": 0}
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    call_count["drivers"] += 1
-                    if call_count["drivers"] <= 2:
-                        chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = driver_access
-                    else:
-                        chain.select.return_value.eq.return_value.single.return_value.execute.return_value = driver_result
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-
-            response = await client.get(f"/drivers/{FAKE_DRIVER_ID}")
+    async def test_get_driver(self, client, fake_supabase):
+        driver_access = SBResult(data=[{"id": FAKE_DRIVER_ID, "user_id": FAKE_USER_ID}])
+        driver_result = SBResult(data={"id": FAKE_DRIVER_ID, "name": "Test Driver"})
+
+        fake_supabase["drivers"].on("select.eq.limit", driver_access)
+        fake_supabase["drivers"].on("select.eq.single", driver_result)
+
+        response = await client.get(f"/drivers/{FAKE_DRIVER_ID}")
         assert response.status_code == 200
 
     @pytest.mark.asyncio
-    async def test_update_push_token(self, client):
-        with patch("main.supabase") as mock_sb:
-            driver_result = MagicMock()
-            driver_result.data = [{"id": FAKE_DRIVER_ID, "user_id": FAKE_USER_ID}]
+    async def test_update_push_token(self, client, fake_supabase):
+        driver_result = SBResult(data=[{"id": FAKE_DRIVER_ID, "user_id": FAKE_USER_ID}])
 
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.select.return_value.eq.return_value.execute.return_value = driver_result
-                    chain.update.return_value.eq.return_value.execute.return_value = MagicMock()
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+        fake_supabase["drivers"].on("select.eq", driver_result)
 
-            response = await client.put(
-                f"/drivers/{FAKE_DRIVER_ID}/push-token",
-                json={"push_token": "ExponentPushToken[abc123]"}
-            )
+        response = await client.put(
+            f"/drivers/{FAKE_DRIVER_ID}/push-token",
+            json={"push_token": "ExponentPushToken[abc123]"}
+        )
         assert response.status_code == 200
         assert response.json()["success"] is True
 
     @pytest.mark.asyncio
     async def test_update_push_token_wrong_driver(self, client):
         with patch("main.supabase") as mock_sb:
-            driver_result = MagicMock()
-            driver_result.data = [{"id": "other-driver", "user_id": "other-user"}]
+            driver_result = SBResult(data=[{"id": "other-driver", "user_id": "other-user"}])
 
-            def table_dispatch(name):
-                chain = MagicMock()
-                chain.select.return_value.eq.return_value.execute.return_value = driver_result
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+            mock_sb.table.return_value.select.return_value.eq.return_value.execute.return_value = driver_result
 
             response = await client.put(
                 "/drivers/other-driver/push-token",
@@ -278,14 +235,9 @@ class TestDriverEndpoints:
     @pytest.mark.asyncio
     async def test_update_push_token_not_found(self, client):
         with patch("main.supabase") as mock_sb:
-            empty_result = MagicMock()
-            empty_result.data = []
+            empty_result = SBResult(data=[])
 
-            def table_dispatch(name):
-                chain = MagicMock()
-                chain.select.return_value.eq.return_value.execute.return_value = empty_result
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+            mock_sb.table.return_value.select.return_value.eq.return_value.execute.return_value = empty_result
 
             response = await client.put(
                 "/drivers/nonexistent/push-token",
@@ -300,81 +252,48 @@ class TestLocationEndpoints:
     """Tests for location tracking endpoints"""
 
     @pytest.mark.asyncio
-    async def test_update_location(self, client):
-        with patch("main.supabase") as mock_sb:
-            driver_lookup = MagicMock()
-            driver_lookup.data = [{"id": FAKE_DRIVER_ID, "company_id": None}]
-
-            location_result = MagicMock()
-            location_result.data = [{"id": "loc-1"}]
-
-            call_count = {"drivers": 0}
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = driver_lookup
-                elif name == "location_history":
-                    chain.insert.return_value.execute.return_value = location_result
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-
-            response = await client.post("/location", json={
-                "driver_id": FAKE_DRIVER_ID,
-                "lat": 40.416,
-                "lng": -3.703
-            })
+    async def test_update_location(self, client, fake_supabase):
+        driver_lookup = SBResult(data=[{"id": FAKE_DRIVER_ID, "company_id": None}])
+        location_result = SBResult(data=[{"id": "loc-1"}])
+
+        fake_supabase["drivers"].on("select.eq.limit", driver_lookup)
+        fake_supabase["location_history"].on("insert", location_result)
+
+        response = await client.post("/location", json={
+            "driver_id": FAKE_DRIVER_ID,
+            "lat": 40.416,
+            "lng": -3.703
+        })
         assert response.status_code == 200
         assert response.json()["success"] is True
 
     @pytest.mark.asyncio
-    async def test_get_latest_location(self, client):
-        with patch("main.supabase") as mock_sb:
-            # verify_driver_access needs driver lookup
-            driver_lookup = MagicMock()
-            driver_lookup.data = [{"id": FAKE_DRIVER_ID, "company_id": None}]
+    async def test_get_latest_location(self, client, fake_supabase):
+        # verify_driver_access needs driver lookup
+        driver_lookup = SBResult(data=[{"id": FAKE_DRIVER_ID, "company_id": None}])
+        location_result = SBResult(data=[{"id": "loc-1", "lat": 40.416, "lng": -3.703}])
 
-            location_result = MagicMock()
-            location_result.data = [{"id": "loc-1", "lat": 40.416, "lng": -3.703}]
+        fake_supabase["drivers"].on("select.eq.limit", driver_lookup)
+        fake_supabase["location_history"].on("select.eq.order.limit", location_result)
 
-            call_count = {"calls": 0}
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = driver_lookup
-                elif name == "location_history":
-                    chain.select.return_value.eq.return_value.order.return_value.limit.return_value.execute.return_value = location_result
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-
-            response = await client.get(f"/location/{FAKE_DRIVER_ID}/latest")
+        response = await client.get(f"/location/{FAKE_DRIVER_ID}/latest")
         assert response.status_code == 200
         assert response.json()["success"] is True
 
     @pytest.mark.asyncio
-    async def test_get_location_history(self, client):
-        with patch("main.supabase") as mock_sb:
-            driver_lookup = MagicMock()
-            driver_lookup.data = [{"id": FAKE_DRIVER_ID, "company_id": None}]
+    async def test_get_location_history(self, client, fake_supabase):
+        driver_lookup = SBResult(data=[{"id": FAKE_DRIVER_ID, "company_id": None}])
 
-            history_result = MagicMock()
-            history_result.data = [
-                {"id": "loc-1", "lat": 40.416, "lng": -3.703},
-                {"id": "loc-2", "lat": 40.417, "lng": -3.704},
-            ]
+        history_result = SBResult(data=[
+            {"id": "loc-1", "lat": 40.416, "lng": -3.703},
+            {"id": "loc-2", "lat": 40.417, "lng": -3.704},
+        ])
+
+        fake_supabase["drivers"].on("select.eq.limit", driver_lookup)
+        fake_supabase["location_history"].on("select.eq.order.limit", history_result)
+        fake_supabase["location_history"].on("select.eq.eq.order.limit", history_result)
 
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = driver_lookup
-                elif name == "location_history":
-                    chain.select.return_value.eq.return_value.order.return_value.limit.return_value.execute.return_value = history_result
-                    chain.select.return_value.eq.return_value.eq.return_value.order.return_value.limit.return_value.execute.return_value = history_result
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-
-            response = await client.get(f"/location/{FAKE_DRIVER_ID}/history")
+        response = await client.get(f"/location/{FAKE_DRIVER_ID}/history")
         assert response.status_code == 200
         assert "locations" in response.json()
 
@@ -453,88 +372,39 @@ class TestStopEndpoints:
     """Tests for /stops/{id}/complete and /stops/{id}/fail"""
 
     @pytest.mark.asyncio
-    async def test_complete_stop(self, client):
-        with patch("main.supabase") as mock_sb:
-            stop_result = MagicMock()
-            stop_result.data = [{"id": "stop-1", "route_id": "route-1"}]
-
-            route_access = MagicMock()
-            route_access.data = [{"id": "route-1", "driver_id": FAKE_DRIVER_ID}]
-
-            driver_lookup = MagicMock()
-            driver_lookup.data = [{"id": FAKE_DRIVER_ID, "company_id": None}]
-
-            update_result = MagicMock()
-            update_result.data = [{"id": "stop-1", "status": "completed"}]
-
-            call_count = {"stops": 0, "routes": 0}
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "stops":
-                    call_count["stops"] += 1
-                    if call_count["stops"] == 1:
-                        chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = stop_result
-                    else:
-                        chain.update.return_value.eq.return_value.execute.return_value = update_result
-                elif name == "routes":
-                    chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = route_access
-                elif name == "drivers":
-                    chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = driver_lookup
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-
-            response = await client.patch("/stops/stop-1/complete")
+    async def test_complete_stop(self, client, fake_supabase):
+        stop_result = SBResult(data=[{"id": "stop-1", "route_id": "route-1"}])
+        route_access = SBResult(data=[{"id": "route-1", "driver_id": FAKE_DRIVER_ID, "drivers": {"user_id": FAKE_USER_ID, "company_id": None}}])
+        update_result = SBResult(data=[{"id": "stop-1", "status": "completed"}])
+
+        fake_supabase["stops"].on("select.eq.limit", stop_result)
+        fake_supabase["stops"].on("update.eq", update_result)
+        fake_supabase["routes"].on("select.eq.limit", route_access)
+
+        response = await client.patch("/stops/stop-1/complete")
         assert response.status_code == 200
         assert response.json()["success"] is True
 
     @pytest.mark.asyncio
-    async def test_fail_stop(self, client):
-        with patch("main.supabase") as mock_sb:
-            stop_result = MagicMock()
-            stop_result.data = [{"id": "stop-1", "route_id": "route-1"}]
-
-            route_access = MagicMock()
-            route_access.data = [{"id": "route-1", "driver_id": FAKE_DRIVER_ID}]
-
-            driver_lookup = MagicMock()
-            driver_lookup.data = [{"id": FAKE_DRIVER_ID, "company_id": None}]
-
-            update_result = MagicMock()
-            update_result.data = [{"id": "stop-1", "status": "failed"}]
-
-            call_count = {"stops": 0}
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "stops":
-                    call_count["stops"] += 1
-                    if call_count["stops"] == 1:
-                        chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = stop_result
-                    else:
-                        chain.update.return_value.eq.return_value.execute.return_value = update_result
-                elif name == "routes":
-                    chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = route_access
-                elif name == "drivers":
-                    chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = driver_lookup
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-
-            response = await client.patch("/stops/stop-1/fail")
+    async def test_fail_stop(self, client, fake_supabase):
+        stop_result = SBResult(data=[{"id": "stop-1", "route_id": "route-1"}])
+        route_access = SBResult(data=[{"id": "route-1", "driver_id": FAKE_DRIVER_ID, "drivers": {"user_id": FAKE_USER_ID, "company_id": None}}])
+        update_result = SBResult(data=[{"id": "stop-1", "status": "failed"}])
+
+        fake_supabase["stops"].on("select.eq.limit", stop_result)
+        fake_supabase["stops"].on("update.eq", update_result)
+        fake_supabase["routes"].on("select.eq.limit", route_access)
+
+        response = await client.patch("/stops/stop-1/fail")
         assert response.status_code == 200
         assert response.json()["success"] is True
 
     @pytest.mark.asyncio
     async def test_complete_stop_not_found(self, client):
         with patch("main.supabase") as mock_sb:
-            empty_result = MagicMock()
-            empty_result.data = []
+            empty_result = SBResult(data=[])
 
-            def table_dispatch(name):
-                chain = MagicMock()
-                chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = empty_result
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+            mock_sb.table.return_value.select.return_value.eq.return_value.limit.return_value.execute.return_value = empty_result
 
             response = await client.patch("/stops/nonexistent/complete")
         assert response.status_code == 404
@@ -546,45 +416,26 @@ class TestReferralEndpoints:
     """Tests for /referral/*"""
 
     @pytest.mark.asyncio
-    async def test_get_referral_code_existing(self, client):
-        with patch("main.supabase") as mock_sb:
-            driver_lookup = MagicMock()
-            driver_lookup.data = [{"id": FAKE_DRIVER_ID, "company_id": None}]
+    async def test_get_referral_code_existing(self, client, fake_supabase):
+        driver_lookup = SBResult(data=[{"id": FAKE_DRIVER_ID, "company_id": None}])
+        code_result = SBResult(data={"referral_code": "XPD-ABCD"})
 
-            code_result = MagicMock()
-            code_result.data = {"referral_code": "XPD-ABCD"}
+        fake_supabase["drivers"].on("select.eq.limit", driver_lookup)
+        fake_supabase["drivers"].on("select.eq.single", code_result)
 
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = driver_lookup
-                    chain.select.return_value.eq.return_value.single.return_value.execute.return_value = code_result
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-
-            response = await client.get("/referral/code")
+        response = await client.get("/referral/code")
         assert response.status_code == 200
         assert response.json()["code"] == "XPD-ABCD"
 
     @pytest.mark.asyncio
-    async def test_get_referral_stats(self, client):
-        with patch("main.supabase") as mock_sb:
-            driver_lookup = MagicMock()
-            driver_lookup.data = [{"id": FAKE_DRIVER_ID, "company_id": None}]
-
-            referrals_result = MagicMock()
-            referrals_result.data = [{"id": "r1"}, {"id": "r2"}]
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = driver_lookup
-                elif name == "referrals":
-                    chain.select.return_value.eq.return_value.execute.return_value = referrals_result
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-
-            response = await client.get("/referral/stats")
+    async def test_get_referral_stats(self, client, fake_supabase):
+        driver_lookup = SBResult(data=[{"id": FAKE_DRIVER_ID, "company_id": None}])
+        referrals_result = SBResult(data=[{"id": "r1"}, {"id": "r2"}])
+
+        fake_supabase["drivers"].on("select.eq.limit", driver_lookup)
+        fake_supabase["referrals"].on("select.eq", referrals_result)
+
+        response = await client.get("/referral/stats")
         assert response.status_code == 200
         assert response.json()["total_referrals"] == 2
 
@@ -670,6 +521,42 @@ class TestPlacesEndpoints:
         called_params = mock_http.get.call_args.kwargs.get("params", {})
         assert called_params.get("sessiontoken") == "abc-123-uuid"
 
+    @pytest.mark.asyncio
+    async def test_places_details_cached_by_place_id(self, client):
+        """Second Details for the same place_id is served from cache; errors are not cached."""
+        ok = MagicMock()
+        ok.json.return_value = {"status": "OK", "result": {"name": "Depot"}}
+        denied = MagicMock()
+        denied.json.return_value = {"status": "REQUEST_DENIED"}
+
+        mock_http = AsyncMock()
+        mock_http.get.side_effect = [denied, ok, ok]
+
+        with patch("main.httpx.AsyncClient", return_value=mock_http):
+            r0 = await client.get("/places/details?place_id=PID_CACHE")
+            r1 = await client.get("/places/details?place_id=PID_CACHE")
+            r2 = await client.get("/places/details?place_id=PID_CACHE")
+        assert r0.json()["status"] == "REQUEST_DENIED"
+        assert r1.json() == r2.json() == {"status": "OK", "result": {"name": "Depot"}}
+        assert mock_http.get.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_places_details_with_sessiontoken_skips_cache(self, client):
+        """With a sessiontoken the Details call is what closes the autocomplete
+        session (and Basic Details is $0 then): a cached place must still go to
+        Google so the session is billed as one, not per keystroke."""
+        ok = MagicMock()
+        ok.json.return_value = {"status": "OK", "result": {"name": "Depot"}}
+        mock_http = AsyncMock()
+        mock_http.get.return_value = ok
+
+        with patch("main.httpx.AsyncClient", return_value=mock_http):
+            await client.get("/places/details?place_id=PID_SESSION")
+            response = await client.get("/places/details?place_id=PID_SESSION&sessiontoken=tok-2")
+        assert response.json() == {"status": "OK", "result": {"name": "Depot"}}
+        assert mock_http.get.call_count == 2
+        assert mock_http.get.call_args.kwargs["params"]["sessiontoken"] == "tok-2"
+
     @pytest.mark.asyncio
     async def test_places_details_field_mask_does_not_include_opening_hours(self, client):
         """REGRESSION GUARD (21 may 2026): el field mask de Place Details NO debe
@@ -1026,53 +913,35 @@ class TestDailyStats:
     """Tests for GET /stats/daily"""
 
     @pytest.mark.asyncio
-    async def test_daily_stats_no_driver(self, client):
-        with patch("main.supabase") as mock_sb:
-            no_driver = MagicMock()
-            no_driver.data = []
+    async def test_daily_stats_no_driver(self, client, fake_supabase):
+        no_driver = SBResult(data=[])
 
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = no_driver
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+        fake_supabase["drivers"].on("select.eq.limit", no_driver)
 
-            response = await client.get("/stats/daily")
+        response = await client.get("/stats/daily")
         assert response.status_code == 200
         data = response.json()
         assert data["success"] is True
         assert data["routes"]["total"] == 0
 
     @pytest.mark.asyncio
-    async def test_daily_stats_with_routes(self, client):
-        with patch("main.supabase") as mock_sb:
-            driver_lookup = MagicMock()
-            driver_lookup.data = [{"id": FAKE_DRIVER_ID, "company_id": None}]
-
-            routes_result = MagicMock()
-            routes_result.data = [
-                {
-                    "id": "r1", "status": "completed", "total_distance_km": 15.2,
-                    "stops": [
-                        {"id": "s1", "status": "completed"},
-                        {"id": "s2", "status": "failed"},
-                    ]
-                }
-            ]
+    async def test_daily_stats_with_routes(self, client, fake_supabase):
+        driver_lookup = SBResult(data=[{"id": FAKE_DRIVER_ID, "company_id": None}])
 
-            call_count = {"drivers": 0}
+        routes_result = SBResult(data=[
+            {
+                "id": "r1", "status": "completed", "total_distance_km": 15.2,
+                "stops": [
+                    {"id": "s1", "status": "completed"},
+                    {"id": "s2", "status": "failed"},
+                ]
+            }
+        ])
 
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = driver_lookup
-                elif name == "routes":
-                    chain.select.return_value.gte.return_value.eq.return_value.execute.return_value = routes_result
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+        fake_supabase["drivers"].on("select.eq.limit", driver_lookup)
+        fake_supabase["routes"].on("select.gte.eq", routes_result)
 
-            response = await client.get("/stats/daily")
+        response = await client.get("/stats/daily")
         assert response.status_code == 200
 
 
@@ -1096,22 +965,11 @@ class TestAdminEmailEndpoints:
     """Tests for admin email and push endpoints"""
 
     @pytest.mark.asyncio
-    async def test_admin_send_email_to_user(self, admin_client):
-        with patch("main.supabase") as mock_sb, \
-             patch("main.send_custom_email", return_value={"success": True, "id": "msg1"}):
-            driver_result = MagicMock()
-            driver_result.data = {"email": "user@test.com", "name": "User"}
+    async def test_admin_send_email_to_user(self, admin_client, fake_supabase):
+        with patch("main.send_custom_email", return_value={"success": True, "id": "msg1"}):
+            driver_result = SBResult(data={"email": "user@test.com", "name": "User"})
 
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.select.return_value.eq.return_value.single.return_value.execute.return_value = driver_result
-                elif name == "email_log":
-                    chain.insert.return_value.execute.return_value = MagicMock()
-                elif name == "audit_log":
-                    chain.insert.return_value.execute.return_value = MagicMock()
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+            fake_supabase["drivers"].on("select.eq.single", driver_result)
 
             response = await admin_client.post(
                 f"/admin/users/{FAKE_USER_ID}/send-email",
@@ -1121,24 +979,15 @@ class TestAdminEmailEndpoints:
         assert response.json()["success"] is True
 
     @pytest.mark.asyncio
-    async def test_admin_broadcast_email(self, admin_client):
-        with patch("main.supabase") as mock_sb, \
-             patch("main.send_broadcast_email", return_value={"sent": 2, "failed": 0}):
-            drivers_result = MagicMock()
-            drivers_result.data = [
+    async def test_admin_broadcast_email(self, admin_client, fake_supabase):
+        with patch("main.send_broadcast_email", return_value={"sent": 2, "failed": 0}):
+            drivers_result = SBResult(data=[
                 {"email": "a@test.com", "name": "A", "promo_plan": None},
                 {"email": "b@test.com", "name": "B", "promo_plan": None},
-            ]
+            ])
 
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.select.return_value.is_.return_value.execute.return_value = drivers_result
-                    chain.select.return_value.execute.return_value = drivers_result
-                elif name in ("email_log", "audit_log"):
-                    chain.insert.return_value.execute.return_value = MagicMock()
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+            fake_supabase["drivers"].on("select.is_", drivers_result)
+            fake_supabase["drivers"].on("select", drivers_result)
 
             response = await admin_client.post("/admin/broadcast-email", json={
                 "subject": "Test Broadcast",
@@ -1149,47 +998,27 @@ class TestAdminEmailEndpoints:
         assert response.json()["success"] is True
 
     @pytest.mark.asyncio
-    async def test_admin_reengagement_broadcast(self, admin_client):
-        with patch("main.supabase") as mock_sb, \
-             patch("main.send_reengagement_broadcast", return_value={"sent": 1, "failed": 0}):
-            drivers_result = MagicMock()
-            drivers_result.data = [
+    async def test_admin_reengagement_broadcast(self, admin_client, fake_supabase):
+        with patch("main.send_reengagement_broadcast", return_value={"sent": 1, "failed": 0}):
+            drivers_result = SBResult(data=[
                 {"id": "d1", "email": "a@test.com", "name": "A"},
-            ]
+            ])
 
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.select.return_value.not_.is_.return_value.execute.return_value = drivers_result
-                elif name in ("email_log", "audit_log"):
-                    chain.insert.return_value.execute.return_value = MagicMock()
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+            fake_supabase["drivers"].on("select.not_.is_", drivers_result)
 
             response = await admin_client.post("/admin/reengagement-broadcast")
         assert response.status_code == 200
 
     @pytest.mark.asyncio
-    async def test_admin_push_blast(self, admin_client):
-        with patch("main.supabase") as mock_sb, \
-             patch("main.send_push_to_token", new_callable=AsyncMock, return_value=True):
-            drivers_result = MagicMock()
-            drivers_result.data = [
+    async def test_admin_push_blast(self, admin_client, fake_supabase):
+        with patch("main.send_push_to_token", new_callable=AsyncMock, return_value=True):
+            drivers_result = SBResult(data=[
                 {"id": "d1", "name": "Driver 1", "push_token": "ExponentPushToken[abc]"},
-            ]
-            routes_result = MagicMock()
-            routes_result.data = []  # no routes = inactive
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.select.return_value.not_.is_.return_value.execute.return_value = drivers_result
-                elif name == "routes":
-                    chain.select.return_value.in_.return_value.execute.return_value = routes_result
-                elif name == "audit_log":
-                    chain.insert.return_value.execute.return_value = MagicMock()
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+            ])
+            routes_result = SBResult(data=[])  # no routes = inactive
+
+            fake_supabase["drivers"].on("select.not_.is_", drivers_result)
+            fake_supabase["routes"].on("select.in_", routes_result)
 
             response = await admin_client.post("/admin/push-blast", json={
                 "title": "Test Push",
@@ -1206,23 +1035,14 @@ class TestAdminFeatureToggle:
     """Tests for PATCH /admin/drivers/{id}/features"""
 
     @pytest.mark.asyncio
-    async def test_toggle_ambassador(self, admin_client):
-        with patch("main.supabase") as mock_sb:
-            update_result = MagicMock()
-            update_result.data = [{"id": "d1", "is_ambassador": True}]
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.update.return_value.eq.return_value.execute.return_value = update_result
-                elif name == "audit_log":
-                    chain.insert.return_value.execute.return_value = MagicMock()
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-
-            response = await admin_client.patch("/admin/drivers/d1/features", json={
-                "is_ambassador": True
-            })
+    async def test_toggle_ambassador(self, admin_client, fake_supabase):
+        update_result = SBResult(data=[{"id": "d1", "is_ambassador": True}])
+
+        fake_supabase["drivers"].on("update.eq", update_result)
+
+        response = await admin_client.patch("/admin/drivers/d1/features", json={
+            "is_ambassador": True
+        })
         assert response.status_code == 200
         assert response.json()["success"] is True
 
@@ -1235,14 +1055,9 @@ class TestAdminFeatureToggle:
     @pytest.mark.asyncio
     async def test_toggle_driver_not_found(self, admin_client):
         with patch("main.supabase") as mock_sb:
-            empty_result = MagicMock()
-            empty_result.data = []
+            empty_result = SBResult(data=[])
 
-            def table_dispatch(name):
-                chain = MagicMock()
-                chain.update.return_value.eq.return_value.execute.return_value = empty_result
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+            mock_sb.table.return_value.update.return_value.eq.return_value.execute.return_value = empty_result
 
             response = await admin_client.patch("/admin/drivers/nonexistent/features", json={
                 "voice_assistant_enabled": True
@@ -1256,23 +1071,14 @@ class TestAdminToggleCompany:
     """Tests for PATCH /admin/companies/{id}"""
 
     @pytest.mark.asyncio
-    async def test_toggle_company_success(self, admin_client):
-        with patch("main.supabase") as mock_sb:
-            update_result = MagicMock()
-            update_result.data = [{"id": "c1", "active": False}]
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "companies":
-                    chain.update.return_value.eq.return_value.execute.return_value = update_result
-                elif name == "audit_log":
-                    chain.insert.return_value.execute.return_value = MagicMock()
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-
-            response = await admin_client.patch("/admin/companies/c1", json={
-                "active": False
-            })
+    async def test_toggle_company_success(self, admin_client, fake_supabase):
+        update_result = SBResult(data=[{"id": "c1", "active": False}])
+
+        fake_supabase["companies"].on("update.eq", update_result)
+
+        response = await admin_client.patch("/admin/companies/c1", json={
+            "active": False
+        })
         assert response.status_code == 200
         assert response.json()["success"] is True
 
@@ -1289,47 +1095,21 @@ class TestAdminAuditLog:
     """Tests for GET /admin/audit-log"""
 
     @pytest.mark.asyncio
-    async def test_audit_log_success(self, admin_client):
-        with patch("main.supabase") as mock_sb:
-            logs_result = MagicMock()
-            logs_result.data = [
-                {"id": "log1", "admin_id": "admin1", "action": "grant_plan", "resource_type": "driver", "resource_id": "d1"},
-            ]
+    async def test_audit_log_success(self, admin_client, fake_supabase):
+        logs_result = SBResult(data=[
+            {"id": "log1", "admin_id": "admin1", "action": "grant_plan", "resource_type": "driver", "resource_id": "d1"},
+        ])
+
+        count_result = SBResult(count=1)
+        admins_result = SBResult(data=[{"user_id": "admin1", "name": "Admin", "email": "admin@test.com"}])
+        drivers_result = SBResult(data=[{"user_id": "d1", "name": "Driver", "email": "d@test.com"}])
+        driver_by_id = SBResult(data=[{"id": "d1", "name": "Driver", "email": "d@test.com"}])
+
+        fake_supabase["audit_log"].on("select.order.range", logs_result)
+        fake_supabase["audit_log"].on("select", count_result)
+        fake_supabase["drivers"].on("select.in_", admins_result, drivers_result, driver_by_id)
 
-            count_result = MagicMock()
-            count_result.count = 1
-
-            admins_result = MagicMock()
-            admins_result.data = [{"user_id": "admin1", "name": "Admin", "email": "admin@test.com"}]
-
-            drivers_result = MagicMock()
-            drivers_result.data = [{"user_id": "d1", "name": "Driver", "email": "d@test.com"}]
-
-            driver_by_id = MagicMock()
-            driver_by_id.data = [{"id": "d1", "name": "Driver", "email": "d@test.com"}]
-
-            call_count = {"audit_log": 0, "drivers": 0}
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "audit_log":
-                    call_count["audit_log"] += 1
-                    if call_count["audit_log"] == 1:
-                        chain.select.return_value.order.return_value.range.return_value.execute.return_value = logs_result
-                    else:
-                        chain.select.return_value.execute.return_value = count_result
-                elif name == "drivers":
-                    call_count["drivers"] += 1
-                    if call_count["drivers"] <= 1:
-                        chain.select.return_value.in_.return_value.execute.return_value = admins_result
-                    elif call_count["drivers"] == 2:
-                        chain.select.return_value.in_.return_value.execute.return_value = drivers_result
-                    else:
-                        chain.select.return_value.in_.return_value.execute.return_value = driver_by_id
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-
-            response = await admin_client.get("/admin/audit-log")
+        response = await admin_client.get("/admin/audit-log")
         assert response.status_code == 200
         assert response.json()["success"] is True
 
@@ -1340,23 +1120,13 @@ class TestCustomerNotification:
     """Tests for POST /notifications/customer/send"""
 
     @pytest.mark.asyncio
-    async def test_send_upcoming_notification(self, client):
-        with patch("main.supabase") as mock_sb, \
-             patch("main.send_upcoming_email", return_value={"success": True}):
-            driver_lookup = MagicMock()
-            driver_lookup.data = [{"id": FAKE_DRIVER_ID, "company_id": None}]
+    async def test_send_upcoming_notification(self, client, fake_supabase):
+        with patch("main.send_upcoming_email", return_value={"success": True}):
+            driver_lookup = SBResult(data=[{"id": FAKE_DRIVER_ID, "company_id": None}])
+            notif_result = SBResult(data=[{"id": "notif-1"}])
 
-            notif_result = MagicMock()
-            notif_result.data = [{"id": "notif-1"}]
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = driver_lookup
-                elif name == "customer_notifications":
-                    chain.insert.return_value.execute.return_value = notif_result
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+            fake_supabase["drivers"].on("select.eq.limit", driver_lookup)
+            fake_supabase["customer_notifications"].on("insert", notif_result)
 
             response = await client.post("/notifications/customer/send", json={
                 "alert_type": "upcoming",
@@ -1377,28 +1147,13 @@ class TestPromoEndpoints:
     """Tests for /promo/redeem and /promo/check/{driver_id}"""
 
     @pytest.mark.asyncio
-    async def test_promo_check_no_plan(self, client):
-        with patch("main.supabase") as mock_sb:
-            driver_check = MagicMock()
-            driver_check.data = {"user_id": FAKE_USER_ID}
-
-            driver_result = MagicMock()
-            driver_result.data = {"promo_plan": None, "promo_plan_expires_at": None, "is_ambassador": False}
-
-            call_count = {"drivers": 0}
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    call_count["drivers"] += 1
-                    if call_count["drivers"] == 1:
-                        chain.select.return_value.eq.return_value.single.return_value.execute.return_value = driver_check
-                    else:
-                        chain.select.return_value.eq.return_value.single.return_value.execute.return_value = driver_result
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-
-            response = await client.get(f"/promo/check/{FAKE_DRIVER_ID}")
+    async def test_promo_check_no_plan(self, client, fake_supabase):
+        driver_check = SBResult(data={"user_id": FAKE_USER_ID})
+        driver_result = SBResult(data={"promo_plan": None, "promo_plan_expires_at": None, "is_ambassador": False})
+
+        fake_supabase["drivers"].on("select.eq.single", driver_check, driver_result)
+
+        response = await client.get(f"/promo/check/{FAKE_DRIVER_ID}")
         assert response.status_code == 200
         assert response.json()["has_promo"] is False
 
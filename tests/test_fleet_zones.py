@@ -8,10 +8,8 @@ Tests for fleet zones IDOR protection:
 from unittest.mock import MagicMock, patch
 
 import pytest
-import pytest_asyncio
-from httpx import ASGITransport, AsyncClient
 
-from main import app, get_current_user, require_admin_or_dispatcher
+from main import require_admin_or_dispatcher
 
 # --------------------------------------------------------------------------
 # Helpers
@@ -56,52 +54,22 @@ def _admin_user():
 # Fixtures: clients with different user contexts
 # --------------------------------------------------------------------------
 
-@pytest_asyncio.fixture
-async def dispatcher_client():
+@pytest.fixture
+def dispatcher_client(override_user):
     """Client authenticated as a dispatcher with company_id."""
-    user = _dispatcher_user()
+    return override_user(_dispatcher_user(), require_admin_or_dispatcher)
 
-    async def _override():
-        return user
 
-    app.dependency_overrides[get_current_user] = _override
-    app.dependency_overrides[require_admin_or_dispatcher] = _override
-    transport = ASGITransport(app=app)
-    async with AsyncClient(transport=transport, base_url="http://testserver") as ac:
-        yield ac
-    app.dependency_overrides.clear()
-
-
-@pytest_asyncio.fixture
-async def dispatcher_no_company_client():
+@pytest.fixture
+def dispatcher_no_company_client(override_user):
     """Client authenticated as a dispatcher WITHOUT company_id."""
-    user = _dispatcher_no_company()
-
-    async def _override():
-        return user
+    return override_user(_dispatcher_no_company(), require_admin_or_dispatcher)
 
-    app.dependency_overrides[get_current_user] = _override
-    app.dependency_overrides[require_admin_or_dispatcher] = _override
-    transport = ASGITransport(app=app)
-    async with AsyncClient(transport=transport, base_url="http://testserver") as ac:
-        yield ac
-    app.dependency_overrides.clear()
 
-
-@pytest_asyncio.fixture
-async def zone_admin_client():
+@pytest.fixture
+def zone_admin_client(override_user):
     """Client authenticated as admin (no company_id, global access)."""
-    user = _admin_user()
-
-    async def _override():
-        return user
-
-    app.dependency_overrides[get_current_user] = _override
-    app.dependency_overrides[require_admin_or_dispatcher] = _override
-    transport = ASGITransport(app=app)
-    async with AsyncClient(transport=transport, base_url="http://testserver") as ac:
-        yield ac
-    app.dependency_overrides.clear()
+    return override_user(_admin_user(), require_admin_or_dispatcher)
 
 
 # ==========================================================================
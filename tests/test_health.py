@@ -2,10 +2,36 @@
 Tests for the /health and / (root) endpoints.
 """
 
-from unittest.mock import MagicMock, patch
+from unittest.mock import Mock
 
 import pytest
 
+import main
+
+_EXECUTE = "table.return_value.select.return_value.limit.return_value.execute"
+
+
+def _sb_mock(count=0, raise_exc=None):
+    """Supabase client whose table().select().limit().execute() returns a
+    result with `.count` (or raises `raise_exc`). spec_set keeps typos in the
+    top-level attribute from silently passing."""
+    sb = Mock(spec_set=["table"])
+    if raise_exc is not None:
+        sb.configure_mock(**{f"{_EXECUTE}.side_effect": raise_exc})
+    else:
+        sb.configure_mock(**{f"{_EXECUTE}.return_value": Mock(count=count)})
+    return sb
+
+
+@pytest.fixture
+def health_deps(monkeypatch):
+    """Install the /health dependencies: `health_deps(count=..., raise_exc=...,
+    scheduler_running=...)`."""
+    def install(count=0, raise_exc=None, scheduler_running=False):
+        monkeypatch.setattr(main, "supabase", _sb_mock(count, raise_exc))
+        monkeypatch.setattr(main, "social_scheduler", Mock(spec_set=["running"], running=scheduler_running))
+    return install
+
 # === Root Endpoint Tests ===
 
 class TestRootEndpoint:
@@ -19,6 +45,7 @@ class TestRootEndpoint:
     @pytest.mark.asyncio
     async def test_root_response_structure(self, client):
         response = await client.get("/")
+        assert response.status_code == 200
         data = response.json()
         assert data["status"] == "ok"
         assert data["service"] == "Xpedit API"
@@ -33,37 +60,15 @@ class TestHealthEndpoint:
     """Tests for GET /health"""
 
     @pytest.mark.asyncio
-    async def test_health_returns_200_when_db_ok(self, client):
-        """Health check should return 200 when database is reachable."""
-        # The supabase mock's table().select().limit().execute() returns
-        # a result with .data=[] and .count=0 by default, which is fine --
-        # the health endpoint just needs the call to not throw.
-        with patch("main.supabase") as mock_sb:
-            mock_result = MagicMock()
-            mock_result.count = 5
-            mock_sb.table.return_value.select.return_value.limit.return_value.execute.return_value = mock_result
-            # Also need scheduler mock
-            with patch("main.social_scheduler") as mock_sched:
-                mock_sched.running = True
-                response = await client.get("/health")
+    async def test_health_ok_full_contract(self, client, health_deps):
+        """With the database reachable: 200, status healthy, every check key
+        present and version 1.1.4 -- all from a single request."""
+        health_deps(count=5, scheduler_running=True)
+        response = await client.get("/health")
 
         assert response.status_code == 200
         data = response.json()
         assert data["status"] == "healthy"
-
-    @pytest.mark.asyncio
-    async def test_health_response_structure(self, client):
-        """Health check response should contain checks dict with expected keys."""
-        with patch("main.supabase") as mock_sb:
-            mock_result = MagicMock()
-            mock_result.count = 3
-            mock_sb.table.return_value.select.return_value.limit.return_value.execute.return_value = mock_result
-            with patch("main.social_scheduler") as mock_sched:
-                mock_sched.running = False
-                response = await client.get("/health")
-
-        data = response.json()
-        assert "checks" in data
         checks = data["checks"]
         assert "database" in checks
         assert "sentry" in checks
@@ -71,29 +76,13 @@ class TestHealthEndpoint:
         assert "version" in checks
         assert "uptime_seconds" in checks
         assert "environment" in checks
+        assert checks["version"] == "1.1.4"
 
     @pytest.mark.asyncio
-    async def test_health_version_matches(self, client):
-        """Version in health check should be 1.1.4."""
-        with patch("main.supabase") as mock_sb:
-            mock_result = MagicMock()
-            mock_result.count = 0
-            mock_sb.table.return_value.select.return_value.limit.return_value.execute.return_value = mock_result
-            with patch("main.social_scheduler") as mock_sched:
-                mock_sched.running = False
-                response = await client.get("/health")
-
-        data = response.json()
-        assert data["checks"]["version"] == "1.1.4"
-
-    @pytest.mark.asyncio
-    async def test_health_returns_503_when_db_fails(self, client):
+    async def test_health_returns_503_when_db_fails(self, client, health_deps):
         """Health check should return 503 when database query fails."""
-        with patch("main.supabase") as mock_sb:
-            mock_sb.table.return_value.select.return_value.limit.return_value.execute.side_effect = Exception("DB down")
-            with patch("main.social_scheduler") as mock_sched:
-                mock_sched.running = True
-                response = await client.get("/health")
+        health_deps(raise_exc=Exception("DB down"), scheduler_running=True)
+        response = await client.get("/health")
 
         assert response.status_code == 503
         data = response.json()
@@ -101,16 +90,12 @@ class TestHealthEndpoint:
         assert data["checks"]["database"]["status"] == "error"
 
     @pytest.mark.asyncio
-    async def test_health_sentry_not_configured(self, client):
+    async def test_health_sentry_not_configured(self, client, health_deps, monkeypatch):
         """Sentry should show as not_configured when DSN is empty."""
-        with patch("main.supabase") as mock_sb:
-            mock_result = MagicMock()
-            mock_result.count = 0
-            mock_sb.table.return_value.select.return_value.limit.return_value.execute.return_value = mock_result
-            with patch("main.social_scheduler") as mock_sched:
-                mock_sched.running = False
-                with patch("main.SENTRY_DSN", ""):
-                    response = await client.get("/health")
+        health_deps()
+        monkeypatch.setattr(main, "SENTRY_DSN", "")
+        response = await client.get("/health")
 
+        assert response.status_code == 200
         data = response.json()
         assert data["checks"]["sentry"]["status"] == "not_configured"
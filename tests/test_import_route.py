@@ -6,10 +6,9 @@ llamada a Google Geocoding; solo las direcciones nuevas se geocodifican.
 from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
-import pytest_asyncio
-from httpx import ASGITransport, AsyncClient
 
-from main import app, get_current_user, normalize_address, require_admin_or_dispatcher
+from main import normalize_address, require_admin_or_dispatcher
+from tests.conftest import SBResult
 
 FAKE_COMPANY = "company-aaaa-0000-0000-000000000001"
 TARGET_DRIVER = "driver-aaaa-0000-0000-000000000010"
@@ -22,58 +21,36 @@ def _dispatcher():
     return {"id": "disp-1", "email": "d@c.com", "role": "company_admin", "company_id": FAKE_COMPANY}
 
 
-@pytest_asyncio.fixture
-async def client():
-    async def _override():
-        return _dispatcher()
-    app.dependency_overrides[get_current_user] = _override
-    app.dependency_overrides[require_admin_or_dispatcher] = _override
-    transport = ASGITransport(app=app)
-    async with AsyncClient(transport=transport, base_url="http://testserver") as ac:
-        yield ac
-    app.dependency_overrides.clear()
+@pytest.fixture
+def client(override_user):
+    return override_user(_dispatcher(), require_admin_or_dispatcher)
+
+
+def _import_tables(fake, directory, route_id):
+    """Driver of FAKE_COMPANY, `directory` as its customer_directory, and
+    route/stop INSERTs that succeed."""
+    fake["drivers"].on("select.eq.limit", SBResult(data=[{"company_id": FAKE_COMPANY}]))
+    fake["customer_directory"].on("select.eq", directory)
+    fake["routes"].on("insert", SBResult(data=[{"id": route_id}]))
+    fake["stops"].on("insert", SBResult(data=[{"id": "s1"}, {"id": "s2"}]))
 
 
 class TestImportUsesDirectoryCache:
     @pytest.mark.asyncio
-    async def test_cached_address_skips_google_geocoding(self, client):
+    async def test_cached_address_skips_google_geocoding(self, client, fake_supabase):
         # El directorio ya tiene CACHED_ADDR geocodificada.
-        directory_data = MagicMock()
-        directory_data.data = [{
+        directory_data = SBResult(data=[{
             "normalized_address": normalize_address(CACHED_ADDR),
             "lat": 40.41, "lng": -3.70, "phone": "600111222", "email": "cli@x.com",
-        }]
-        captured = {}
-
-        def table_dispatch(name):
-            chain = MagicMock()
-            if name == "drivers":
-                dl = MagicMock()
-                dl.data = [{"company_id": FAKE_COMPANY}]
-                chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = dl
-            elif name == "customer_directory":
-                chain.select.return_value.eq.return_value.execute.return_value = directory_data
-            elif name == "routes":
-                rr = MagicMock()
-                rr.data = [{"id": "imported-route-1"}]
-                chain.insert.return_value.execute.return_value = rr
-            elif name == "stops":
-                def cap(rows):
-                    captured["stops"] = rows
-                    m = MagicMock()
-                    m.execute.return_value = MagicMock(data=[{"id": "s1"}, {"id": "s2"}])
-                    return m
-                chain.insert.side_effect = cap
-            return chain
+        }])
+        _import_tables(fake_supabase, directory_data, "imported-route-1")
 
         geocode_mock = AsyncMock(return_value={"lat": 41.0, "lng": -3.0, "display_name": NEW_ADDR})
 
         with patch("main.verify_driver_access", new=AsyncMock(return_value=True)), \
              patch("main.notify_driver_route_assigned", new=AsyncMock()), \
              patch("main.log_audit"), \
-             patch("main._geocode_address", geocode_mock), \
-             patch("main.supabase") as mock_sb:
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+             patch("main._geocode_address", geocode_mock):
             resp = await client.post("/company/routes/import", json={
                 "driver_id": TARGET_DRIVER,
                 "name": "Import test",
@@ -94,54 +71,31 @@ class TestImportUsesDirectoryCache:
         assert geocode_mock.await_count == 1
         assert geocode_mock.await_args.args[0] == NEW_ADDR
         # La parada cacheada heredó lat/lng y datos del directorio
-        cached_stop = next(s for s in captured["stops"] if s["lat"] == 40.41)
+        [(stops,)] = fake_supabase["stops"].args_of("insert")
+        cached_stop = next(s for s in stops if s["lat"] == 40.41)
         assert cached_stop["phone"] == "600111222"
         assert cached_stop["email"] == "cli@x.com"
 
     @pytest.mark.asyncio
-    async def test_imp05_same_street_diff_cp_does_not_cache_hit(self, client):
+    async def test_imp05_same_street_diff_cp_does_not_cache_hit(self, client, fake_supabase):
         """IMP-05: dos direcciones de igual calle+ciudad pero DISTINTO CP colapsan
         en la misma clave (normalize_address borra el CP). El cache-hit solo debe
         aceptarse si el CP coincide: mismo CP → hit (0€); CP distinto → geocodificar
         (no heredar coords erróneas en silencio)."""
         # El directorio tiene la de 28001 geocodificada.
-        directory_data = MagicMock()
-        directory_data.data = [{
+        directory_data = SBResult(data=[{
             "normalized_address": normalize_address("Calle Sol 1, 28001 Madrid"),
             "address": "Calle Sol 1, 28001 Madrid",
             "lat": 40.41, "lng": -3.70, "phone": None, "email": None,
-        }]
-        captured = {}
-
-        def table_dispatch(name):
-            chain = MagicMock()
-            if name == "drivers":
-                dl = MagicMock()
-                dl.data = [{"company_id": FAKE_COMPANY}]
-                chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = dl
-            elif name == "customer_directory":
-                chain.select.return_value.eq.return_value.execute.return_value = directory_data
-            elif name == "routes":
-                rr = MagicMock()
-                rr.data = [{"id": "imported-route-2"}]
-                chain.insert.return_value.execute.return_value = rr
-            elif name == "stops":
-                def cap(rows):
-                    captured["stops"] = rows
-                    m = MagicMock()
-                    m.execute.return_value = MagicMock(data=[{"id": "s1"}, {"id": "s2"}])
-                    return m
-                chain.insert.side_effect = cap
-            return chain
+        }])
+        _import_tables(fake_supabase, directory_data, "imported-route-2")
 
         geocode_mock = AsyncMock(return_value={"lat": 41.99, "lng": -3.99, "display_name": "x"})
 
         with patch("main.verify_driver_access", new=AsyncMock(return_value=True)), \
              patch("main.notify_driver_route_assigned", new=AsyncMock()), \
              patch("main.log_audit"), \
-             patch("main._geocode_address", geocode_mock), \
-             patch("main.supabase") as mock_sb:
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+             patch("main._geocode_address", geocode_mock):
             resp = await client.post("/company/routes/import", json={
                 "driver_id": TARGET_DRIVER,
                 "name": "IMP-05 test",
@@ -161,6 +115,41 @@ class TestImportUsesDirectoryCache:
         assert "28100" in geocode_mock.await_args.args[0]
         # Comprobar coords: una parada heredó 40.41 (cache-hit 28001), la otra
         # tiene 41.99 (geocodificada, NO heredó las coords erróneas del directorio).
-        lats = sorted(s["lat"] for s in captured["stops"])
+        [(stops,)] = fake_supabase["stops"].args_of("insert")
+        lats = sorted(s["lat"] for s in stops)
         assert 40.41 in lats   # 28001 → cache-hit
         assert 41.99 in lats   # 28100 → geocodificada (IMP-05: no heredó 40.41)
+
+
+class TestEnrichStopsFromDirectory:
+    """Match geográfico (<= 50 m) contra customer_directory."""
+
+    def _run(self, stop, *entries):
+        from main import enrich_stops_from_directory
+        with patch("main.supabase") as mock_sb:
+            mock_sb.table.return_value.select.return_value.eq.return_value.execute.return_value = MagicMock(
+                data=[dict(entry, normalized_address="otra direccion") for entry in entries]
+            )
+            return enrich_stops_from_directory(FAKE_COMPANY, [stop])
+
+    def test_match_within_50m_matches_haversine(self):
+        from main import _haversine_km
+        entry = {"lat": 40.4168, "lng": -3.7038, "phone": "600000000", "email": None}
+        for dlat, expected in ((0.0004, True), (0.0005, False)):  # ~44 m / ~56 m
+            stop = {"address": "x", "lat": 40.4168 + dlat, "lng": -3.7038}
+            assert (_haversine_km(stop["lat"], stop["lng"], entry["lat"], entry["lng"]) <= 0.05) is expected
+            stops, matches = self._run(stop, entry)
+            assert matches == (1 if expected else 0)
+            assert (stops[0].get("phone") == "600000000") is expected
+
+    def test_first_directory_entry_within_radius_wins(self):
+        """Entries without coords are skipped; among those within 50 m the
+        first one in directory order is used."""
+        stop = {"address": "x", "lat": 40.4168, "lng": -3.7038}
+        far = {"lat": 40.5, "lng": -3.7038, "phone": "far", "email": None}
+        no_coords = {"lat": None, "lng": None, "phone": "none", "email": None}
+        near_a = {"lat": 40.4170, "lng": -3.7038, "phone": "a", "email": None}
+        near_b = {"lat": 40.4168, "lng": -3.7038, "phone": "b", "email": None}
+        stops, matches = self._run(stop, far, no_coords, near_a, near_b)
+        assert matches == 1
+        assert stops[0]["phone"] == "a"
@@ -3,7 +3,38 @@ Tests for the optimizer module.
 These tests verify core route optimization logic without external dependencies.
 """
 
-from optimizer import calculate_eta, calculate_route_etas, haversine_distance, optimize_route
+from datetime import datetime, timedelta
+from types import MappingProxyType
+
+import numpy as np
+
+from optimizer import (
+    calculate_eta,
+    calculate_route_etas,
+    create_distance_matrix,
+    haversine_distance,
+    optimize_route,
+)
+
+# [lat, lng]: Madrid, Barcelona, ~1 km north of Madrid, then three nearby Madrid points.
+COORDS = np.array([
+    [40.4168, -3.7038],
+    [41.3851, 2.1734],
+    [40.4258, -3.7038],
+    [40.4200, -3.7000],
+    [40.4250, -3.6950],
+    [40.4300, -3.6900],
+])
+
+# Read-only payloads shared by the ETA tests instead of rebuilding dict
+# literals per test; calculate_eta / calculate_route_etas never mutate them.
+_ORIGIN = (40.4168, -3.7038)
+_DESTINATION = (40.4200, -3.7000)
+_ROUTE_2 = (
+    MappingProxyType({"lat": 40.4168, "lng": -3.7038}),
+    MappingProxyType({"lat": 40.4200, "lng": -3.7000}),
+)
+_ROUTE_3 = _ROUTE_2 + (MappingProxyType({"lat": 40.4250, "lng": -3.6950}),)
 
 
 class TestHaversineDistance:
@@ -34,74 +65,90 @@ class TestHaversineDistance:
         distance = haversine_distance(coord_a, coord_b)
         assert isinstance(distance, int)
 
+    def test_matrix_metric_properties(self):
+        """Symmetry, zero diagonal and triangle inequality of the matrix the
+        solver gets, over a seeded batch of points spread across mainland
+        Spain (truncation to whole metres allows for up to 2 m of slack in
+        the triangle check)."""
+        rng = np.random.default_rng(0)
+        points = [
+            {"lat": lat, "lng": lng}
+            for lat, lng in zip(rng.uniform(36.0, 43.8, 50), rng.uniform(-9.3, 3.3, 50))
+        ]
+        d = np.array(create_distance_matrix(points), dtype=np.int64)
+
+        assert (d == d.T).all()
+        assert not np.diagonal(d).any()
+        assert (d[:, None, :] <= d[:, :, None] + d[None, :, :] + 2).all()
+
 
 class TestCalculateEta:
     """Tests for ETA calculation between two points."""
 
-    def test_returns_dict(self):
-        origin = (40.4168, -3.7038)
-        destination = (40.4200, -3.7000)
-        result = calculate_eta(origin, destination)
-        assert isinstance(result, dict)
-
     def test_contains_expected_keys(self):
-        origin = (40.4168, -3.7038)
-        destination = (40.4200, -3.7000)
-        result = calculate_eta(origin, destination)
-        assert "distance_km" in result or "eta_minutes" in result or "distance_meters" in result
+        before = datetime.now()
+        result = calculate_eta(_ORIGIN, _DESTINATION)
+        after = datetime.now()
+
+        assert set(result) == {
+            "distance_km", "travel_time_min", "stop_time_min", "total_time_min", "eta", "eta_formatted",
+        }
+        distance_km = haversine_distance(_ORIGIN, _DESTINATION) / 1000
+        assert result["distance_km"] == round(distance_km, 2)
+        assert result["travel_time_min"] == round(distance_km / 30.0 * 60)
+        assert result["stop_time_min"] == 5.0
+        assert result["total_time_min"] == round(distance_km / 30.0 * 60 + 5.0)
+        eta = datetime.fromisoformat(result["eta"])
+        total = timedelta(minutes=distance_km / 30.0 * 60 + 5.0)
+        assert before + total <= eta <= after + total
+        assert result["eta_formatted"] == f"{eta.hour:02d}:{eta.minute:02d}"
 
     def test_same_location_zero_distance(self):
-        point = (40.4168, -3.7038)
-        result = calculate_eta(point, point)
-        assert isinstance(result, dict)
+        before = datetime.now()
+        result = calculate_eta(_ORIGIN, _ORIGIN)
+        after = datetime.now()
+
+        assert result["distance_km"] == 0
+        assert result["travel_time_min"] == 0
+        assert result["total_time_min"] == 5
+        # Only the stop time remains.
+        eta = datetime.fromisoformat(result["eta"])
+        assert before + timedelta(minutes=5) <= eta <= after + timedelta(minutes=5)
 
 
 class TestCalculateRouteEtas:
     """Tests for calculating ETAs across a multi-stop route."""
 
-    def test_returns_list(self):
-        route = [
-            {"lat": 40.4168, "lng": -3.7038},
-            {"lat": 40.4200, "lng": -3.7000},
-            {"lat": 40.4250, "lng": -3.6950},
-        ]
-        result = calculate_route_etas(route)
-        assert isinstance(result, list)
-
     def test_result_length_matches_route(self):
-        route = [
-            {"lat": 40.4168, "lng": -3.7038},
-            {"lat": 40.4200, "lng": -3.7000},
-        ]
-        result = calculate_route_etas(route)
-        assert len(result) == len(route)
+        for route in (_ROUTE_2, _ROUTE_3):
+            result = calculate_route_etas(route)
+            assert len(result) == len(route)
+            assert [stop["sequence"] for stop in result] == list(range(1, len(route) + 1))
+            for stop, original in zip(result, route):
+                assert stop["lat"] == original["lat"] and stop["lng"] == original["lng"]
+            # Starts at the first stop, so the first leg is empty.
+            assert result[0]["distance_from_prev_km"] == 0
+            for prev, stop in zip(route, result[1:]):
+                leg_km = haversine_distance((prev["lat"], prev["lng"]), (stop["lat"], stop["lng"])) / 1000
+                assert stop["distance_from_prev_km"] == round(leg_km, 2)
+            etas = [datetime.fromisoformat(stop["eta"]) for stop in result]
+            assert etas == sorted(etas)
 
 
 class TestOptimizeRoute:
     """Tests for the main route optimization function."""
 
-    def test_two_stops_returns_valid_result(self):
-        locations = [
-            {"lat": 40.4168, "lng": -3.7038, "id": "depot", "address": "Madrid Centro"},
-            {"lat": 40.4200, "lng": -3.7000, "id": "stop1", "address": "Calle A"},
-        ]
-        result = optimize_route(locations, depot_index=0)
-        assert isinstance(result, dict)
-
-    def test_three_stops_returns_ordered_route(self):
-        locations = [
-            {"lat": 40.4168, "lng": -3.7038, "id": "depot", "address": "Madrid Centro"},
-            {"lat": 40.4300, "lng": -3.6900, "id": "stop1", "address": "Calle A"},
-            {"lat": 40.4200, "lng": -3.7000, "id": "stop2", "address": "Calle B"},
-        ]
-        result = optimize_route(locations, depot_index=0)
-        assert isinstance(result, dict)
-        # Should have a route key with ordered stops
-        assert "route" in result or "ordered" in result or "stops" in result or "total_distance" in result
-
-    def test_single_stop(self):
+    def test_routes_every_prefix_of_coords(self):
+        """One node covering 1..len(COORDS) stops: the result starts at the
+        depot and visits every input stop exactly once."""
         locations = [
-            {"lat": 40.4168, "lng": -3.7038, "id": "depot", "address": "Depot"},
+            {"lat": lat, "lng": lng, "id": f"stop{i}", "address": f"Calle {i}"}
+            for i, (lat, lng) in enumerate(COORDS.tolist())
         ]
-        result = optimize_route(locations, depot_index=0)
-        assert isinstance(result, dict)
+        for n in range(1, len(locations) + 1):
+            result = optimize_route(locations[:n], depot_index=0)
+            assert result["success"] is True, n
+            route_ids = [stop["id"] for stop in result["route"]]
+            assert route_ids[0] == "stop0", n
+            assert sorted(route_ids) == sorted(loc["id"] for loc in locations[:n]), n
+            assert result["total_distance_meters"] >= 0
@@ -18,8 +18,11 @@ Extended tests for optimizer.py to increase coverage:
 from unittest.mock import patch
 
 import pytest
+from ortools.constraint_solver import pywrapcp
 
 from optimizer import (
+    _kmeans_pp_init,
+    _nearest_centroid,
     _parse_time_to_minutes,
     assign_drivers_to_zones,
     calculate_driver_score,
@@ -117,6 +120,59 @@ class TestCreateDistanceMatrix:
             for val in row:
                 assert isinstance(val, int)
 
+    def test_repeated_call_hits_cache(self):
+        from optimizer import _cached_distance_matrix
+        locs = [
+            {"lat": 40.4168, "lng": -3.7038},
+            {"lat": 40.4065, "lng": -3.6895},
+        ]
+        first = create_distance_matrix(locs)
+        hits = _cached_distance_matrix.cache_info().hits
+        second = create_distance_matrix([dict(loc) for loc in locs])
+        assert _cached_distance_matrix.cache_info().hits == hits + 1
+        assert second == first
+
+    def test_cached_matrix_is_compact_int32(self):
+        """El memo guarda un array int32 de solo lectura, no listas de ints."""
+        import numpy as np
+
+        from optimizer import _cached_distance_matrix, _matrix_cache_key
+        locs = [
+            {"lat": 40.4168, "lng": -3.7038},
+            {"lat": 40.4065, "lng": -3.6895},
+            {"lat": 40.4153, "lng": -3.6845},
+        ]
+        cached = _cached_distance_matrix(_matrix_cache_key(locs))
+        assert cached.dtype == np.int32
+        assert not cached.flags.writeable
+        expected = haversine_distance((40.4168, -3.7038), (40.4065, -3.6895))
+        assert abs(int(cached[0, 1]) - expected) <= 1
+
+    def test_float32_matrix_within_a_metre_of_scalar(self):
+        """The float32 build stays within 1 m of haversine_distance, from
+        same-street pairs to opposite ends of Spain, and stays symmetric.
+        Coordinates carry 5 decimals, the cache key's own rounding."""
+        import random
+
+        rng = random.Random(7)
+        locs = [{"lat": 40.4168, "lng": -3.7038}, {"lat": 40.41685, "lng": -3.70385}]
+        locs += [{"lat": round(rng.uniform(36.0, 43.5), 5), "lng": round(rng.uniform(-9.0, 3.0), 5)} for _ in range(40)]
+        matrix = create_distance_matrix(locs)
+        for i, a in enumerate(locs):
+            for j, b in enumerate(locs):
+                assert matrix[i][j] == matrix[j][i]
+                assert abs(matrix[i][j] - haversine_distance((a["lat"], a["lng"]), (b["lat"], b["lng"]))) <= 1
+
+    def test_cached_matrix_is_not_shared(self):
+        """Mutating a returned matrix must not corrupt later cache hits."""
+        locs = [
+            {"lat": 40.4168, "lng": -3.7038},
+            {"lat": 40.4065, "lng": -3.6895},
+        ]
+        first = create_distance_matrix(locs)
+        first[0][1] = 0
+        assert create_distance_matrix(locs)[0][1] > 0
+
 
 # ===================== PARSE TIME TO MINUTES =====================
 
@@ -147,6 +203,16 @@ class TestParseTimeToMinutes:
     def test_partial_format(self):
         assert _parse_time_to_minutes("9") is None
 
+    def test_parse_time_windows_single_pass(self):
+        from optimizer import _parse_time_windows
+        starts, ends = _parse_time_windows([
+            {"time_window_start": "09:00", "time_window_end": "10:30"},
+            {},
+            {"time_window_start": "25:00", "time_window_end": "12:00"},
+        ])
+        assert starts == [540, None, None]
+        assert ends == [630, None, 720]
+
 
 # ===================== OPTIMIZE ROUTE (OR-Tools) =====================
 
@@ -209,6 +275,7 @@ class TestOptimizeRoute:
         result = optimize_route(locs, distance_matrix=matrix)
         assert result["success"] is True
 
+    @pytest.mark.slow
     def test_with_time_windows(self):
         """Time windows are passed to OR-Tools. Result depends on current time
         (the solver may fall back to no-time-windows if current time is past the window).
@@ -233,6 +300,82 @@ class TestOptimizeRoute:
         assert result["success"] is True
 
 
+    def test_small_route_held_karp_is_exact(self):
+        """n pequeño sin ventanas se resuelve exacto (Held-Karp): el coste es el
+        mínimo sobre todas las permutaciones y el depósito va primero."""
+        from itertools import permutations
+        locs = [
+            {"id": 1, "lat": 40.4168, "lng": -3.7038},
+            {"id": 2, "lat": 40.4155, "lng": -3.7074},
+            {"id": 3, "lat": 40.4153, "lng": -3.6845},
+            {"id": 4, "lat": 40.4203, "lng": -3.7016},
+            {"id": 5, "lat": 40.4065, "lng": -3.6895},
+        ]
+        m = create_distance_matrix(locs)
+        best = min(
+            m[0][p[0]] + sum(m[a][b] for a, b in zip(p, p[1:])) + m[p[-1]][0]
+            for p in permutations(range(1, 5))
+        )
+        with patch("optimizer.pywrapcp.RoutingModel") as mock_model:
+            result = optimize_route(locs)
+        mock_model.assert_not_called()
+        assert result["total_distance_meters"] == best
+        assert result["route"][0]["id"] == 1
+        assert sorted(s["id"] for s in result["route"]) == [1, 2, 3, 4, 5]
+
+    def test_held_karp_matches_enumeration_up_to_exact_limit(self):
+        """Hasta _EXACT_MAX_STOPS no se monta el modelo de OR-Tools, y el
+        resultado coincide con el óptimo por enumeración (aquí con 9 nodos y
+        el depósito en medio, sobre una matriz asimétrica)."""
+        from itertools import permutations
+        n, depot = 9, 4
+        m = [[0 if i == j else (i * 37 + j * 11) % 53 + 1 for j in range(n)] for i in range(n)]
+        locs = [{"id": i, "lat": 40.40 + i * 0.003, "lng": -3.70} for i in range(n)]
+        others = [i for i in range(n) if i != depot]
+        best = min(
+            m[depot][p[0]] + sum(m[a][b] for a, b in zip(p, p[1:])) + m[p[-1]][depot]
+            for p in permutations(others)
+        )
+        with patch("optimizer.pywrapcp.RoutingModel") as mock_model:
+            result = optimize_route(locs, depot_index=depot, distance_matrix=m)
+        mock_model.assert_not_called()
+        ids = [s["id"] for s in result["route"]]
+        assert ids[0] == depot and sorted(ids) == list(range(n))
+        assert result["total_distance_meters"] == best
+        assert sum(m[a][b] for a, b in zip(ids, ids[1:] + ids[:1])) == best
+
+    @pytest.mark.slow
+    def test_transit_costs_registered_as_matrices(self):
+        """Distancia y tiempo van por RegisterTransitMatrix: ningún callback Python
+        en el bucle de búsqueda."""
+        locs = [{"id": i, "lat": 40.40 + i * 0.003, "lng": -3.70 + (i % 4) * 0.004} for i in range(12)]
+        locs[3]["time_window_start"] = "00:00"
+        locs[3]["time_window_end"] = "23:59"
+        with patch.object(pywrapcp.RoutingModel, "RegisterTransitCallback",
+                          side_effect=AssertionError("python callback")):
+            result = optimize_route(locs)
+        assert result["success"] is True
+        assert result["num_stops"] == 12
+
+
+    def test_clustered_solve_visits_every_stop_once(self):
+        """Con el flag activo, >80 paradas se resuelven por zonas: depósito
+        primero, todas las paradas una vez y el total coincide con la matriz."""
+        import random
+        rnd = random.Random(7)
+        locs = [{"id": i, "lat": 40.3 + rnd.random() * 0.2, "lng": -3.8 + rnd.random() * 0.2} for i in range(90)]
+        with patch("optimizer.CLUSTERED_SOLVE_ENABLED", True), \
+             patch("optimizer._CLUSTER_TOTAL_TIME_S", 0.3):
+            result = optimize_route(locs)
+        assert result["num_zones"] >= 2
+        ids = [p["id"] for p in result["route"]]
+        assert ids[0] == 0
+        assert sorted(ids) == list(range(90))
+        m = create_distance_matrix(locs)
+        expected = sum(m[a][b] for a, b in zip(ids, ids[1:])) + m[ids[-1]][0]
+        assert result["total_distance_meters"] == expected
+
+
 # ===================== HYBRID OPTIMIZE ROUTE =====================
 
 class TestHybridOptimizeRoute:
@@ -356,6 +499,12 @@ class TestCalculateEta:
         parts = result["eta_formatted"].split(":")
         assert len(parts) == 2
 
+    def test_distance_matches_haversine(self):
+        current = (40.4168, -3.7038)
+        dest = (41.3874, 2.1686)
+        result = calculate_eta(current, dest)
+        assert result["distance_km"] == round(haversine_distance(current, dest) / 1000, 2)
+
 
 # ===================== CALCULATE ROUTE ETAS =====================
 
@@ -410,6 +559,20 @@ class TestCalculateRouteEtas:
         slow = calculate_route_etas(route, avg_speed_kmh=15)
         assert fast[1]["travel_time_from_prev_min"] <= slow[1]["travel_time_from_prev_min"]
 
+    def test_segment_distances_match_scalar_haversine(self):
+        route = [
+            {"lat": 40.4168, "lng": -3.7038, "id": 1},
+            {"lat": 40.4065, "lng": -3.6895, "id": 2},
+            {"lat": 40.4153, "lng": -3.6845, "id": 3},
+        ]
+        start = (40.42, -3.71)
+        result = calculate_route_etas(route, start_location=start)
+        prev = start
+        for stop in result:
+            pos = (stop["lat"], stop["lng"])
+            assert stop["distance_from_prev_km"] == round(haversine_distance(prev, pos) / 1000, 2)
+            prev = pos
+
 
 # ===================== CLUSTER STOPS BY ZONE =====================
 
@@ -472,6 +635,40 @@ class TestClusterStopsByZone:
         assert result["num_zones"] == 1
         assert result["zones"][0]["num_stops"] == 1
 
+    def test_separated_groups_converge_early(self):
+        """Dos barrios bien separados: las asignaciones se estabilizan y el
+        bucle sale antes de las 10 iteraciones."""
+        madrid = [{"id": f"m{i}", "lat": 40.41 + i * 0.001, "lng": -3.70} for i in range(10)]
+        bcn = [{"id": f"b{i}", "lat": 41.38 + i * 0.001, "lng": 2.17} for i in range(10)]
+        with patch("optimizer._nearest_centroid", wraps=_nearest_centroid) as spy:
+            result = cluster_stops_by_zone(madrid + bcn, n_zones=2, max_stops_per_zone=10)
+        assert spy.call_count < 10
+        groups = sorted(sorted(s["id"][0] for s in z["stops"]) for z in result["zones"])
+        assert groups == [["b"] * 10, ["m"] * 10]
+
+    def test_kmeans_pp_seeds_spread_and_reproducible(self):
+        """k-means++ no repite semilla con puntos distintos y, con RNG de
+        semilla fija, las mismas paradas dan siempre las mismas zonas."""
+        stops = [{"id": i, "lat": 40.40 + (i % 7) * 0.01, "lng": -3.70 + (i // 7) * 0.01} for i in range(70)]
+        first = cluster_stops_by_zone(stops, n_zones=5)
+        second = cluster_stops_by_zone(stops, n_zones=5)
+        assert first == second
+        import numpy as np
+        xyz = np.random.default_rng(1).normal(size=(50, 3))
+        xyz /= np.linalg.norm(xyz, axis=1)[:, None]
+        seeds = _kmeans_pp_init(xyz, 10)
+        assert len(set(seeds.tolist())) == 10
+
+    def test_blocked_assignment_matches_full_argmax(self):
+        """La asignación por bloques de filas da lo mismo que la matriz N×K entera,
+        también con un último bloque incompleto."""
+        import numpy as np
+        rnd = np.random.default_rng(3)
+        stop_xyz = rnd.normal(size=(1000, 3))
+        cent_xyz = rnd.normal(size=(40, 3))
+        expected = np.argmax(stop_xyz @ cent_xyz.T, axis=1)
+        assert np.array_equal(_nearest_centroid(stop_xyz, cent_xyz), expected)
+
 
 # ===================== CALCULATE DRIVER SCORE =====================
 
@@ -568,6 +765,20 @@ class TestAssignDriversToZones:
         result = assign_drivers_to_zones(zones, drivers, {"d1": 10, "d2": 0})
         assert result["assignments"][0] == "d2"
 
+    def test_assignment_is_globally_optimal(self):
+        """d1 está algo más cerca de la zona 0, pero es el único cerca de la 1:
+        el voraz daría d1→0 y d2→1 (~20 km); el óptimo global d2→0, d1→1 (~12 km)."""
+        zones = [
+            {"id": 0, "center": {"lat": 40.00, "lng": -3.70}, "stops": []},
+            {"id": 1, "center": {"lat": 40.10, "lng": -3.70}, "stops": []},
+        ]
+        drivers = [
+            {"id": "d1", "location": {"lat": 40.04, "lng": -3.70}},
+            {"id": "d2", "location": {"lat": 39.95, "lng": -3.70}},
+        ]
+        result = assign_drivers_to_zones(zones, drivers, {"d1": 0, "d2": 0})
+        assert result["assignments"] == {0: "d2", 1: "d1"}
+
 
 # ===================== OPTIMIZE MULTI VEHICLE =====================
 
@@ -580,6 +791,7 @@ class TestOptimizeMultiVehicle:
         assert result["success"] is True
         assert result["total_distance_km"] == 0
 
+    @pytest.mark.slow
     def test_basic_two_vehicles(self):
         locs = [
             {"lat": 40.4168, "lng": -3.7038, "id": 1},  # depot
@@ -610,6 +822,7 @@ class TestOptimizeMultiVehicle:
         result = optimize_multi_vehicle(locs, num_vehicles=2, distance_matrix=matrix)
         assert result["success"] is True
 
+    @pytest.mark.slow
     def test_with_max_distance(self):
         locs = [
             {"lat": 40.4168, "lng": -3.7038, "id": 1},
@@ -621,6 +834,7 @@ class TestOptimizeMultiVehicle:
         )
         assert result["success"] is True
 
+    @pytest.mark.slow
     def test_result_structure(self):
         locs = [
             {"lat": 40.4168, "lng": -3.7038, "id": 1},
@@ -638,6 +852,45 @@ class TestOptimizeMultiVehicle:
             assert "distance_km" in route
             assert "num_stops" in route
 
+    # Depósito en medio de dos grupos de 3 paradas (~2,2 km al norte y al sur).
+    _TWO_CLUSTERS = [{"lat": 40.4168, "lng": -3.7038, "id": 0}] + [
+        {"lat": 40.4168 + sign * 0.02, "lng": -3.7038 + k * 0.002, "id": f"{sign}-{k}"}
+        for sign in (1, -1) for k in range(3)
+    ]
+
+    @pytest.mark.slow
+    def test_span_cost_spreads_stops_across_vehicles(self):
+        """Con balance_routes el span global reparte la carga: sin él los
+        vehículos de más salen gratis y todo puede ir al vehículo 0."""
+        result = optimize_multi_vehicle(self._TWO_CLUSTERS, num_vehicles=2, balance_routes=True)
+        assert result["success"] is True
+        assert result["num_vehicles_used"] == 2
+        assert sorted(r["num_stops"] for r in result["routes"]) == [3, 3]
+
+    @pytest.mark.slow
+    def test_default_objective_total_distance_does_not_regress(self):
+        """Sin balance_routes el objetivo es solo la distancia total: con más
+        vehículos disponibles el total nunca supera al de un único vehículo."""
+        single = optimize_multi_vehicle(self._TWO_CLUSTERS, num_vehicles=1)
+        multi = optimize_multi_vehicle(self._TWO_CLUSTERS, num_vehicles=2)
+        assert single["success"] is True and multi["success"] is True
+        assert multi["total_distance_km"] <= single["total_distance_km"]
+        assert sum(r["num_stops"] for r in multi["routes"]) == 6
+
+    @pytest.mark.slow
+    def test_transit_cost_registered_as_matrix(self):
+        """La distancia va por RegisterTransitMatrix, también con límite por vehículo."""
+        locs = [
+            {"lat": 40.4168, "lng": -3.7038, "id": 1},
+            {"lat": 40.4065, "lng": -3.6895, "id": 2},
+            {"lat": 40.4153, "lng": -3.6845, "id": 3},
+        ]
+        with patch.object(pywrapcp.RoutingModel, "RegisterTransitCallback",
+                          side_effect=AssertionError("python callback")):
+            result = optimize_multi_vehicle(locs, num_vehicles=2, max_distance_per_vehicle=50000)
+        assert result["success"] is True
+        assert sum(r["num_stops"] for r in result["routes"]) == 2
+
 
 # ===================== SOLVER-SPECIFIC TESTS =====================
 
@@ -8,25 +8,14 @@ and the EXPIRATION/BILLING_ISSUE revocation branches.
 from unittest.mock import MagicMock, patch
 
 import pytest
-import pytest_asyncio
-from httpx import ASGITransport, AsyncClient
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def rc_headers():
+    """Built once per session; tests only read it."""
     return {"Authorization": "Bearer test-rc-secret", "Content-Type": "application/json"}
 
 
-@pytest_asyncio.fixture
-async def unauth_client():
-    """Client without auth override — needed for webhook tests
-    (RevenueCat webhook doesn't use get_current_user)."""
-    from main import app
-    transport = ASGITransport(app=app)
-    async with AsyncClient(transport=transport, base_url="http://testserver") as ac:
-        yield ac
-
-
 def _purchase_event(event_id="evt-1", entitlements=None, expiration_ms=None):
     return {
         "event": {
@@ -12,20 +12,22 @@ Tests for route optimization and route CRUD endpoints:
   - POST /geocode
 """
 
+import asyncio
+import re
 from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
 
-from tests.conftest import FAKE_DRIVER_ID
+from tests.conftest import FAKE_DRIVER_ID, FAKE_USER_ID, SBResult
 
-
-class AttrDict(dict):
-    """Dict subclass that supports attribute access (for Supabase-style results)."""
-    def __getattr__(self, key):
-        try:
-            return self[key]
-        except KeyError:
-            raise AttributeError(key)
+# verify_route_access: one routes select with the assigned driver embedded.
+_ACCESS_PATH = "select.eq.limit"
+_OWN_ROUTE = SBResult(data=[
+    {"id": "route-1", "driver_id": FAKE_DRIVER_ID, "drivers": {"user_id": FAKE_USER_ID, "company_id": None}},
+])
+_OTHER_ROUTE = SBResult(data=[
+    {"id": "route-1", "driver_id": "different-driver", "drivers": {"user_id": "different-user", "company_id": None}},
+])
 
 
 # === Optimize Endpoint Tests ===
@@ -42,7 +44,8 @@ class TestOptimizeEndpoint:
             {"lat": 40.420000, "lng": -3.710000, "address": "Stop 2"},
         ]
 
-        with patch("main.hybrid_optimize_route") as mock_optimize:
+        with patch("main.hybrid_optimize_route") as mock_optimize, \
+             patch("main.get_road_distance_matrix", AsyncMock(return_value=None)):
             mock_optimize.return_value = {
                 "success": True,
                 "route": locations,
@@ -117,6 +120,158 @@ class TestOptimizeEndpoint:
         assert response.status_code == 422
 
 
+class TestOptimizeJobs:
+    """Tests for POST /optimize/jobs + GET /optimize/jobs/{job_id}"""
+
+    LOCATIONS = [
+        {"lat": 40.416775, "lng": -3.703790, "address": "Depot - Madrid"},
+        {"lat": 40.453054, "lng": -3.688344, "address": "Stop 1"},
+    ]
+
+    @pytest.mark.asyncio
+    async def test_job_lifecycle(self, client):
+        import asyncio
+
+        import main
+
+        result = {"success": True, "route": self.LOCATIONS, "total_distance_meters": 4200,
+                  "total_distance_km": 4.2, "num_stops": 2, "solver": "pyvrp"}
+        with patch("main.hybrid_optimize_route", return_value=result), \
+             patch("main.get_road_distance_matrix", AsyncMock(return_value=None)):
+            response = await client.post("/optimize/jobs", json={"locations": self.LOCATIONS})
+            assert response.status_code == 200
+            created = response.json()
+            assert created["status"] == "PENDING"
+            assert created["queue"] == "routing_short"
+
+            job_id = created["job_id"]
+            # La task sigue referenciada hasta terminar; al acabar se suelta.
+            await asyncio.gather(*main._optimize_job_tasks)
+            assert not main._optimize_job_tasks
+
+            response = await client.get(f"/optimize/jobs/{job_id}")
+
+        assert response.status_code == 200
+        data = response.json()
+        assert data["status"] == "SUCCESS"
+        assert data["result"]["total_distance_km"] == 4.2
+        assert data["result"]["distance_source"] == "haversine"
+        assert job_id not in main._optimize_jobs_active
+
+    @pytest.mark.asyncio
+    async def test_running_job_task_is_retained_until_done(self, client):
+        import asyncio
+
+        import main
+
+        release = asyncio.Event()
+
+        async def slow_optimize(request, executor=None):
+            await release.wait()
+            return {"success": True}
+
+        with patch("main._run_optimize", slow_optimize):
+            response = await client.post("/optimize/jobs", json={"locations": self.LOCATIONS})
+            job_id = response.json()["job_id"]
+            await asyncio.sleep(0)
+
+            assert len(main._optimize_job_tasks) == 1
+            assert main._optimize_jobs_active[job_id]["status"] == "STARTED"
+            release.set()
+            await asyncio.gather(*main._optimize_job_tasks)
+
+        assert not main._optimize_job_tasks
+        assert main._optimize_jobs[job_id]["status"] == "SUCCESS"
+
+    @pytest.mark.asyncio
+    async def test_running_job_survives_full_finished_cache(self, client, fake_user, monkeypatch):
+        """Un job en curso no sale de la caché aunque los terminados la llenen."""
+        import main
+
+        monkeypatch.setattr(main, "_optimize_jobs", main._TTLCache(maxsize=2, ttl=3600))
+        monkeypatch.setitem(main._optimize_jobs_active, "job-en-curso",
+                            {"user_id": fake_user["id"], "status": "STARTED", "queue": "routing_long"})
+        for i in range(5):
+            main._optimize_jobs[f"job-{i}"] = {"user_id": fake_user["id"], "status": "SUCCESS",
+                                               "queue": "routing_short", "result": {}}
+
+        response = await client.get("/optimize/jobs/job-en-curso")
+        assert response.status_code == 200
+        assert response.json()["status"] == "STARTED"
+
+    @pytest.mark.asyncio
+    async def test_too_many_active_jobs_is_503(self, client, monkeypatch):
+        import main
+
+        monkeypatch.setattr(main, "_OPTIMIZE_JOB_MAX_ACTIVE", 0)
+        response = await client.post("/optimize/jobs", json={"locations": self.LOCATIONS})
+        assert response.status_code == 503
+
+    @pytest.mark.asyncio
+    async def test_job_of_other_user_is_404(self, client):
+        import main
+
+        main._optimize_jobs["job-ajeno"] = {"user_id": "otro-usuario", "status": "PENDING", "queue": "routing_short"}
+        response = await client.get("/optimize/jobs/job-ajeno")
+        assert response.status_code == 404
+
+    @pytest.mark.asyncio
+    async def test_unknown_job_is_404(self, client):
+        response = await client.get("/optimize/jobs/no-existe")
+        assert response.status_code == 404
+
+    @pytest.mark.asyncio
+    async def test_large_routes_use_long_queue(self):
+        import main
+
+        assert main._optimize_job_queue(19) == "routing_short"
+        assert main._optimize_job_queue(120) == "routing_long"
+
+
+class TestRoadMatrixCache:
+    """get_road_distance_matrix memoizes successful OSRM/ORS downloads."""
+
+    LOCATIONS = [
+        {"lat": 40.416775, "lng": -3.703790},
+        {"lat": 40.453054, "lng": -3.688344},
+    ]
+    MATRIX = {"distances": [[0, 4200], [4300, 0]], "durations": [[0, 400], [410, 0]]}
+
+    @pytest.mark.asyncio
+    async def test_second_call_skips_download(self):
+        import main
+
+        fetch = AsyncMock(return_value=self.MATRIX)
+        with patch("main._fetch_road_distance_matrix", fetch):
+            first = await main.get_road_distance_matrix(self.LOCATIONS)
+            second = await main.get_road_distance_matrix(self.LOCATIONS)
+
+        assert fetch.await_count == 1
+        assert first == second == self.MATRIX
+
+    @pytest.mark.asyncio
+    async def test_failures_are_not_cached(self):
+        import main
+
+        fetch = AsyncMock(side_effect=[None, self.MATRIX])
+        with patch("main._fetch_road_distance_matrix", fetch):
+            assert await main.get_road_distance_matrix(self.LOCATIONS) is None
+            assert await main.get_road_distance_matrix(self.LOCATIONS) == self.MATRIX
+
+        assert fetch.await_count == 2
+
+    @pytest.mark.asyncio
+    async def test_returned_rows_are_copies(self):
+        import main
+
+        with patch("main._fetch_road_distance_matrix", AsyncMock(return_value=self.MATRIX)):
+            first = await main.get_road_distance_matrix(self.LOCATIONS)
+            first["distances"][1][0] = 0
+            second = await main.get_road_distance_matrix(self.LOCATIONS)
+
+        assert second["distances"][1][0] == 4300
+
+
 class TestOptimizeMultiEndpoint:
     """Tests for POST /optimize-multi"""
 
@@ -130,7 +285,8 @@ class TestOptimizeMultiEndpoint:
             {"lat": 40.430, "lng": -3.700},
         ]
 
-        with patch("main.optimize_multi_vehicle") as mock_opt:
+        with patch("main.optimize_multi_vehicle") as mock_opt, \
+             patch("main.get_road_distance_matrix", AsyncMock(return_value=None)):
             mock_opt.return_value = {
                 "success": True,
                 "vehicle_routes": [[0, 1], [0, 2, 3]],
@@ -145,6 +301,24 @@ class TestOptimizeMultiEndpoint:
         data = response.json()
         assert data["success"] is True
 
+    @pytest.mark.asyncio
+    async def test_optimize_multi_passes_road_distances(self, client):
+        """get_road_distance_matrix returns {"distances", "durations"}; the
+        solver must get the distance rows, not the dict."""
+        locations = [{"lat": 40.416, "lng": -3.703}, {"lat": 40.453, "lng": -3.688}]
+        road = {"distances": [[0, 4200], [4300, 0]], "durations": [[0, 600], [620, 0]]}
+
+        with patch("main.get_road_distance_matrix", return_value=road), \
+             patch("main.optimize_multi_vehicle", return_value={"success": True}) as mock_opt:
+            response = await client.post("/optimize-multi", json={
+                "locations": locations,
+                "num_vehicles": 2,
+            })
+
+        assert response.status_code == 200
+        assert response.json()["distance_source"] == "road"
+        assert mock_opt.call_args.kwargs["distance_matrix"] == road["distances"]
+
     @pytest.mark.asyncio
     async def test_optimize_multi_too_many_stops(self, client):
         """More than 500 stops should be rejected."""
@@ -208,10 +382,8 @@ class TestGeocodeEndpoint:
 
         mock_http_client = AsyncMock()
         mock_http_client.get.return_value = mock_response
-        mock_http_client.__aenter__.return_value = mock_http_client
-        mock_http_client.__aexit__.return_value = False
 
-        with patch("main.httpx.AsyncClient", return_value=mock_http_client), \
+        with patch("main.google_maps_client", return_value=mock_http_client), \
              patch("main.GOOGLE_API_KEY", "fake-key"):
             response = await client.post("/geocode", json={
                 "address": "Puerta del Sol, Madrid",
@@ -230,6 +402,73 @@ class TestGeocodeEndpoint:
         assert call_params["components"] == "country:ES"
         assert call_params["region"] == "es"
 
+    @pytest.mark.asyncio
+    async def test_geocode_caches_by_normalized_address(self, client):
+        """A repeat of the same address (case/whitespace aside) is served from
+        the cache without a second Google call; another country is a miss."""
+        mock_response = MagicMock()
+        mock_response.json.return_value = {
+            "status": "OK",
+            "results": [{
+                "geometry": {"location": {"lat": 40.4168, "lng": -3.7038}, "location_type": "ROOFTOP"},
+                "formatted_address": "Puerta del Sol, 28013 Madrid, Spain",
+                "place_id": "ChIJSomePlaceId",
+            }],
+        }
+        mock_http_client = AsyncMock()
+        mock_http_client.get.return_value = mock_response
+
+        with patch("main.google_maps_client", return_value=mock_http_client), \
+             patch("main.GOOGLE_API_KEY", "fake-key"):
+            first = await client.post("/geocode", json={"address": "Puerta del Sol, Madrid", "country": "ES"})
+            second = await client.post("/geocode", json={"address": "  puerta del SOL,   madrid ", "country": "es"})
+            assert mock_http_client.get.call_count == 1
+            await client.post("/geocode", json={"address": "Puerta del Sol, Madrid", "country": "PT"})
+            assert mock_http_client.get.call_count == 2
+
+        assert second.json() == first.json()
+
+    @pytest.mark.asyncio
+    async def test_geocode_persistent_cache_tier(self, client, fake_supabase):
+        """After a process-cache miss the geocode_cache table is checked: a
+        stored row is served without Google (and backfills memory); a Google
+        hit is upserted there keyed by (normalized address, country)."""
+        stored = {"success": True, "lat": 41.3874, "lng": 2.1686, "display_name": "Barcelona",
+                  "place_id": "ChIJ5TCOcRaYpBIRCmZHTz37sEQ", "location_type": "APPROXIMATE"}
+        mock_response = MagicMock()
+        mock_response.json.return_value = {
+            "status": "OK",
+            "results": [{
+                "geometry": {"location": {"lat": 40.4168, "lng": -3.7038}, "location_type": "ROOFTOP"},
+                "formatted_address": "Puerta del Sol, 28013 Madrid, Spain",
+                "place_id": "ChIJSomePlaceId",
+            }],
+        }
+        mock_http_client = AsyncMock()
+        mock_http_client.get.return_value = mock_response
+        fake_supabase["geocode_cache"].on("select.eq.eq.gt.limit", SBResult(data=[{"result": stored}]), SBResult(data=[]))
+
+        with patch("main.google_maps_client", return_value=mock_http_client), \
+             patch("main.GOOGLE_API_KEY", "fake-key"):
+            from_table = await client.post("/geocode", json={"address": "Barcelona", "country": "ES"})
+            from_memory = await client.post("/geocode", json={"address": "barcelona", "country": "ES"})
+            assert mock_http_client.get.call_count == 0
+            from_google = await client.post("/geocode", json={"address": "Puerta del Sol, Madrid", "country": "ES"})
+            for _ in range(20):  # let the fire-and-forget write run
+                if "upsert" in fake_supabase["geocode_cache"].paths:
+                    break
+                await asyncio.sleep(0.01)
+
+        assert from_table.json() == stored
+        assert from_memory.json() == stored
+        assert from_google.json()["place_id"] == "ChIJSomePlaceId"
+        assert mock_http_client.get.call_count == 1
+        upserts = [args for name, args in fake_supabase["geocode_cache"].calls if name == "upsert"]
+        assert len(upserts) == 1
+        row = upserts[0][0]
+        assert (row["address_normalized"], row["country"]) == ("puerta del sol, madrid", "ES")
+        assert row["result"] == from_google.json()
+
     @pytest.mark.asyncio
     async def test_geocode_zero_results(self, client):
         """When Google returns ZERO_RESULTS, surface a 200 with success=False."""
@@ -239,10 +478,8 @@ class TestGeocodeEndpoint:
 
         mock_http_client = AsyncMock()
         mock_http_client.get.return_value = mock_response
-        mock_http_client.__aenter__.return_value = mock_http_client
-        mock_http_client.__aexit__.return_value = False
 
-        with patch("main.httpx.AsyncClient", return_value=mock_http_client), \
+        with patch("main.google_maps_client", return_value=mock_http_client), \
              patch("main.GOOGLE_API_KEY", "fake-key"):
             response = await client.post("/geocode", json={"address": "asdfghjkl qwerty"})
 
@@ -268,67 +505,153 @@ class TestGeocodeEndpoint:
 
 # === Routes CRUD Tests ===
 
-class TestRoutesList:
-    """Tests for GET /routes"""
+class _KeysetRoutesTable:
+    """In-memory `routes` table for GET /routes paging: applies the handler's
+    (created_at, id) cursor filter, the descending order and the limit the
+    way PostgREST would, so a test can walk every page."""
 
-    @pytest.mark.asyncio
-    async def test_list_routes_driver(self, client):
-        """Regular driver should see their own routes."""
-        with patch("main.supabase") as mock_sb:
-            # get_user_driver_id lookup
-            driver_lookup = MagicMock()
-            driver_lookup.data = [{"id": FAKE_DRIVER_ID, "company_id": None}]
+    _CURSOR_FILTER = re.compile(
+        r'created_at\.lt\."(?P<ts>[^"]+)",and\(created_at\.eq\."(?P=ts)",id\.lt\."(?P<id>[^"]+)"\)'
+    )
 
-            routes_data = [
-                {"id": "route-1", "driver_id": FAKE_DRIVER_ID, "status": "pending", "stops": []},
-            ]
-            routes_result = MagicMock()
-            routes_result.data = routes_data
+    def __init__(self, rows):
+        self.rows = rows
+        self.filters = []
 
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = driver_lookup
-                elif name == "routes":
-                    chain.select.return_value.eq.return_value.order.return_value.execute.return_value = routes_result
-                return chain
+    def select(self, *args):
+        self._after, self._limit = None, None
+        return self
 
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+    def eq(self, *args):
+        return self
 
-            response = await client.get("/routes")
+    def order(self, *args, **kwargs):
+        return self
 
-        assert response.status_code == 200
-        data = response.json()
-        assert "routes" in data
+    def or_(self, expr):
+        self.filters.append(expr)
+        match = self._CURSOR_FILTER.fullmatch(expr)
+        self._after = (match["ts"], match["id"])
+        return self
+
+    def limit(self, n):
+        self._limit = n
+        return self
+
+    def execute(self):
+        rows = sorted(self.rows, key=lambda r: (r["created_at"], r["id"]), reverse=True)
+        if self._after:
+            rows = [r for r in rows if (r["created_at"], r["id"]) < self._after]
+        return SBResult(data=rows[:self._limit])
+
+
+class TestRoutesList:
+    """Tests for GET /routes"""
 
     @pytest.mark.asyncio
-    async def test_list_routes_no_driver_profile(self, client):
-        """User without driver profile should get empty routes."""
-        with patch("main.supabase") as mock_sb:
-            no_driver = MagicMock()
-            no_driver.data = []
+    async def test_list_routes_driver(self, client, fake_supabase):
+        """Regular driver should see all their own routes, fetched in a single
+        routes query joined on drivers.user_id (no separate driver lookup).
+        Without limit/cursor nothing is paged."""
+        routes_data = [
+            {"id": "route-1", "driver_id": FAKE_DRIVER_ID, "status": "pending", "stops": []},
+        ]
+        routes = fake_supabase["routes"].on("select.eq.order.order", SBResult(data=routes_data))
 
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = no_driver
-                return chain
+        response = await client.get("/routes")
 
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+        assert response.status_code == 200
+        assert response.json() == {"routes": routes_data, "next_cursor": None}
+        assert list(fake_supabase) == ["routes"]
+        assert routes.paths == ["select.eq.order.order"]
+        assert routes.calls[-4:] == [
+            ("select", ("*, stops(*), drivers!inner()",)),
+            ("eq", ("drivers.user_id", FAKE_USER_ID)),
+            ("order", ("created_at",)),
+            ("order", ("id",)),
+        ]
 
-            response = await client.get("/routes")
+    @pytest.mark.asyncio
+    async def test_list_routes_keyset_pagination_shared_created_at(self, client, supabase_mock):
+        """Routes sharing created_at across a page edge are neither skipped
+        nor repeated: the cursor carries (created_at, id) and is opaque, with
+        no raw `+` from the ISO offset."""
+        same = "2026-10-16T10:00:00.123456+00:00"
+        table = _KeysetRoutesTable([
+            {"id": "route-5", "created_at": "2026-10-17T08:00:00+00:00", "stops": []},
+            {"id": "route-4", "created_at": same, "stops": []},
+            {"id": "route-3", "created_at": same, "stops": []},
+            {"id": "route-2", "created_at": same, "stops": []},
+            {"id": "route-1", "created_at": "2026-10-15T10:00:00+00:00", "stops": []},
+        ])
+        supabase_mock.table.return_value = table
+
+        seen, params = [], {"limit": 2}
+        while True:
+            response = await client.get("/routes", params=params)
+            assert response.status_code == 200
+            page = response.json()
+            seen += [route["id"] for route in page["routes"]]
+            if page["next_cursor"] is None:
+                break
+            assert "+" not in page["next_cursor"]
+            params = {"limit": 2, "cursor": page["next_cursor"]}
+
+        assert seen == ["route-5", "route-4", "route-3", "route-2", "route-1"]
+        assert len(table.filters) == 2
+
+    @pytest.mark.asyncio
+    async def test_list_routes_invalid_cursor(self, client, fake_supabase):
+        """A cursor that isn't one of ours is a 400, not a 500."""
+        response = await client.get("/routes", params={"cursor": "not-a-cursor"})
+
+        assert response.status_code == 400
+
+    @pytest.mark.asyncio
+    async def test_list_routes_no_driver_profile(self, client, fake_supabase):
+        """User without driver profile should get empty routes: the inner
+        join on drivers matches nothing."""
+        response = await client.get("/routes")
 
         assert response.status_code == 200
         data = response.json()
         assert data["routes"] == []
 
+    @pytest.mark.asyncio
+    async def test_list_routes_other_driver_forbidden(self, client, fake_supabase):
+        """Asking for another driver's routes still resolves the caller's
+        driver_id and answers 403."""
+        fake_supabase["drivers"].on("select.eq.limit", SBResult(data=[{"id": FAKE_DRIVER_ID, "company_id": None}]))
+
+        response = await client.get("/routes", params={"driver_id": "someone-else"})
+
+        assert response.status_code == 403
+
 
 class TestRoutesCreate:
     """Tests for POST /routes"""
 
+    @staticmethod
+    def _create_route_supabase(mock_sb, company_id=None):
+        """Wire main.supabase for POST /routes: the driver lookups return
+        FAKE_DRIVER_ID in `company_id`, and the create_route_with_stops RPC
+        echoes back the route it was given plus ids for its stops."""
+        mock_sb.table.return_value.select.return_value.eq.return_value.limit.return_value.execute.return_value = (
+            MagicMock(data=[{"id": FAKE_DRIVER_ID, "company_id": company_id}])
+        )
+
+        def rpc(name, params):
+            stops = [{"id": f"s{i}", **stop} for i, stop in enumerate(params["p_stops"], 1)]
+            call = MagicMock()
+            call.execute.return_value = MagicMock(data={"id": "new-route-id", **params["p_route"], "stops": stops})
+            return call
+
+        mock_sb.rpc.side_effect = rpc
+
     @pytest.mark.asyncio
     async def test_create_route_success(self, client):
-        """Creating a route for the authenticated user's driver should work."""
+        """Creating a route for the authenticated user's driver should work,
+        with the route and its stops inserted by one RPC call."""
         route_payload = {
             "driver_id": FAKE_DRIVER_ID,
             "name": "Test Route",
@@ -340,72 +663,33 @@ class TestRoutesCreate:
         }
 
         with patch("main.supabase") as mock_sb:
-            # get_user_driver_id
-            driver_lookup = MagicMock()
-            driver_lookup.data = [{"id": FAKE_DRIVER_ID, "company_id": None}]
-
-            # Insert route result -- must support attribute access because
-            # main.py reassigns the 'route' variable and then does route.stops
-            route_insert_result = MagicMock()
-            route_insert_result.data = [AttrDict({
-                "id": "new-route-id",
-                "driver_id": FAKE_DRIVER_ID,
-                "name": "Test Route",
-                "status": "pending",
-                "total_stops": 2,
-                "stops": [
-                    AttrDict({"address": "Calle Gran Via 1", "lat": 40.420, "lng": -3.705,
-                              "position": 0, "notes": None, "phone": None,
-                              "time_window_start": None, "time_window_end": None}),
-                    AttrDict({"address": "Calle Alcala 50", "lat": 40.418, "lng": -3.690,
-                              "position": 1, "notes": None, "phone": None,
-                              "time_window_start": None, "time_window_end": None}),
-                ],
-            })]
-
-            # Insert stops result (non-empty = success)
-            stops_insert_result = MagicMock()
-            stops_insert_result.data = [
-                {"id": "s1", "address": "Calle Gran Via 1"},
-                {"id": "s2", "address": "Calle Alcala 50"},
-            ]
-
-            # Final route fetch with stops
-            final_route = MagicMock()
-            final_route.data = {
-                "id": "new-route-id",
-                "driver_id": FAKE_DRIVER_ID,
-                "name": "Test Route",
-                "status": "pending",
-                "stops": [
-                    {"id": "s1", "address": "Calle Gran Via 1"},
-                    {"id": "s2", "address": "Calle Alcala 50"},
-                ],
-            }
+            self._create_route_supabase(mock_sb)
+            response = await client.post("/routes", json=route_payload)
 
-            call_count = {"routes": 0}
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = driver_lookup
-                elif name == "routes":
-                    call_count["routes"] += 1
-                    if call_count["routes"] <= 1:
-                        # insert call
-                        chain.insert.return_value.execute.return_value = route_insert_result
-                    else:
-                        # final select
-                        chain.select.return_value.eq.return_value.single.return_value.execute.return_value = final_route
-                elif name == "stops":
-                    chain.insert.return_value.execute.return_value = stops_insert_result
-                return chain
-
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+        assert response.status_code == 200
+        data = response.json()
+        assert data["id"] == "new-route-id"
+        assert [s["address"] for s in data["stops"]] == ["Calle Gran Via 1", "Calle Alcala 50"]
+        mock_sb.rpc.assert_called_once()
+        name, params = mock_sb.rpc.call_args.args
+        assert name == "create_route_with_stops"
+        assert params["p_route"]["total_stops"] == 2
+        assert all("route_id" not in stop for stop in params["p_stops"])
+        assert "routes" not in [c.args[0] for c in mock_sb.table.call_args_list]
 
+    @pytest.mark.asyncio
+    async def test_create_route_rpc_without_data_returns_500(self, client):
+        route_payload = {
+            "driver_id": FAKE_DRIVER_ID,
+            "stops": [{"address": "Calle Gran Via 1", "lat": 40.420, "lng": -3.705, "position": 0}],
+        }
+        with patch("main.supabase") as mock_sb:
+            self._create_route_supabase(mock_sb)
+            mock_sb.rpc.side_effect = None
+            mock_sb.rpc.return_value.execute.return_value = MagicMock(data=None)
             response = await client.post("/routes", json=route_payload)
 
-        assert response.status_code == 200
+        assert response.status_code == 500
 
     @pytest.mark.asyncio
     async def test_create_route_assigns_company_id_for_company_driver(self, client):
@@ -417,44 +701,13 @@ class TestRoutesCreate:
             "stops": [{"address": "Calle Gran Via 1", "lat": 40.420, "lng": -3.705, "position": 0}],
             "total_distance_km": 1.0,
         }
-        captured = {}
-        with patch("main.supabase") as mock_sb:
-            driver_lookup = MagicMock()
-            driver_lookup.data = [{"id": FAKE_DRIVER_ID, "company_id": "comp-xyz"}]
-            route_insert_result = MagicMock()
-            route_insert_result.data = [AttrDict({"id": "new-route-id", "driver_id": FAKE_DRIVER_ID,
-                                                  "name": "Ruta Empresa", "status": "pending",
-                                                  "total_stops": 1, "stops": []})]
-            stops_insert_result = MagicMock()
-            stops_insert_result.data = [{"id": "s1"}]
-            final_route = MagicMock()
-            final_route.data = {"id": "new-route-id", "company_id": "comp-xyz", "stops": []}
-            call_count = {"routes": 0}
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = driver_lookup
-                elif name == "routes":
-                    call_count["routes"] += 1
-                    if call_count["routes"] <= 1:
-                        def capture_insert(data):
-                            captured["route_data"] = data
-                            m = MagicMock()
-                            m.execute.return_value = route_insert_result
-                            return m
-                        chain.insert.side_effect = capture_insert
-                    else:
-                        chain.select.return_value.eq.return_value.single.return_value.execute.return_value = final_route
-                elif name == "stops":
-                    chain.insert.return_value.execute.return_value = stops_insert_result
-                return chain
-
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+        with patch("main.supabase") as mock_sb, \
+             patch("main.enrich_stops_from_directory", side_effect=lambda company_id, stops: (stops, 0)):
+            self._create_route_supabase(mock_sb, company_id="comp-xyz")
             response = await client.post("/routes", json=route_payload)
 
         assert response.status_code == 200
-        assert captured["route_data"].get("company_id") == "comp-xyz"
+        assert mock_sb.rpc.call_args.args[1]["p_route"].get("company_id") == "comp-xyz"
 
     @pytest.mark.asyncio
     async def test_create_route_no_company_id_for_solo_driver(self, client):
@@ -466,44 +719,12 @@ class TestRoutesCreate:
             "stops": [{"address": "Calle Gran Via 1", "lat": 40.420, "lng": -3.705, "position": 0}],
             "total_distance_km": 1.0,
         }
-        captured = {}
         with patch("main.supabase") as mock_sb:
-            driver_lookup = MagicMock()
-            driver_lookup.data = [{"id": FAKE_DRIVER_ID, "company_id": None}]
-            route_insert_result = MagicMock()
-            route_insert_result.data = [AttrDict({"id": "new-route-id", "driver_id": FAKE_DRIVER_ID,
-                                                  "name": "Ruta Solo", "status": "pending",
-                                                  "total_stops": 1, "stops": []})]
-            stops_insert_result = MagicMock()
-            stops_insert_result.data = [{"id": "s1"}]
-            final_route = MagicMock()
-            final_route.data = {"id": "new-route-id", "company_id": None, "stops": []}
-            call_count = {"routes": 0}
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = driver_lookup
-                elif name == "routes":
-                    call_count["routes"] += 1
-                    if call_count["routes"] <= 1:
-                        def capture_insert(data):
-                            captured["route_data"] = data
-                            m = MagicMock()
-                            m.execute.return_value = route_insert_result
-                            return m
-                        chain.insert.side_effect = capture_insert
-                    else:
-                        chain.select.return_value.eq.return_value.single.return_value.execute.return_value = final_route
-                elif name == "stops":
-                    chain.insert.return_value.execute.return_value = stops_insert_result
-                return chain
-
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+            self._create_route_supabase(mock_sb)
             response = await client.post("/routes", json=route_payload)
 
         assert response.status_code == 200
-        assert "company_id" not in captured["route_data"]
+        assert "company_id" not in mock_sb.rpc.call_args.args[1]["p_route"]
 
     @pytest.mark.asyncio
     async def test_create_route_empty_stops_rejected(self, client):
@@ -520,83 +741,31 @@ class TestRouteActions:
     """Tests for route start/complete/delete"""
 
     @pytest.mark.asyncio
-    async def test_start_route(self, client):
+    async def test_start_route(self, client, fake_supabase):
         """Starting a route should succeed with proper access."""
-        with patch("main.supabase") as mock_sb:
-            # verify_route_access needs route lookup + driver lookup
-            route_access = MagicMock()
-            route_access.data = [{"id": "route-1", "driver_id": FAKE_DRIVER_ID}]
-
-            driver_lookup = MagicMock()
-            driver_lookup.data = [{"id": FAKE_DRIVER_ID, "company_id": None}]
-
-            update_result = MagicMock()
-            update_result.data = [{"id": "route-1", "status": "in_progress"}]
-
-            call_count = {"routes": 0}
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "routes":
-                    call_count["routes"] += 1
-                    if call_count["routes"] == 1:
-                        # verify_route_access select
-                        chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = route_access
-                    else:
-                        # update call
-                        chain.update.return_value.eq.return_value.execute.return_value = update_result
-                elif name == "drivers":
-                    chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = driver_lookup
-                return chain
-
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-
-            response = await client.patch("/routes/route-1/start")
+        fake_supabase["routes"].on(_ACCESS_PATH, _OWN_ROUTE).on(
+            "update.eq", SBResult(data=[{"id": "route-1", "status": "in_progress"}])
+        )
+        response = await client.patch("/routes/route-1/start")
 
         assert response.status_code == 200
         data = response.json()
         assert data["success"] is True
 
     @pytest.mark.asyncio
-    async def test_complete_route(self, client):
+    async def test_complete_route(self, client, fake_supabase):
         """Completing a route flips status to 'completed' + stamps completed_at.
         The route stays visible in the history (NO deleted_at): UI / cold-start
         filters keep it off the home screen by status, not by soft-delete
         (Miguel, 12 may 2026: finalizada = en historial, no en pantalla)."""
-        with patch("main.supabase") as mock_sb:
-            route_access = MagicMock()
-            route_access.data = [{"id": "route-1", "driver_id": FAKE_DRIVER_ID}]
-
-            driver_lookup = MagicMock()
-            driver_lookup.data = [{"id": FAKE_DRIVER_ID, "company_id": None}]
-
-            update_result = MagicMock()
-            update_result.data = [{
-                "id": "route-1",
-                "status": "completed",
-                "completed_at": "2026-05-12T11:00:00+00:00",
-                "deleted_at": None,
-            }]
-
-            call_count = {"routes": 0}
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "routes":
-                    call_count["routes"] += 1
-                    if call_count["routes"] == 1:
-                        # verify_route_access → SELECT id, driver_id
-                        chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = route_access
-                    else:
-                        # UPDATE chain: .neq('status','completed') for idempotency
-                        chain.update.return_value.eq.return_value.neq.return_value.execute.return_value = update_result
-                elif name == "drivers":
-                    chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = driver_lookup
-                return chain
-
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-
-            response = await client.patch("/routes/route-1/complete")
+        # UPDATE chain: .neq('status','completed') for idempotency
+        fake_supabase["routes"].on(_ACCESS_PATH, _OWN_ROUTE).on("update.eq.neq", SBResult(data=[{
+            "id": "route-1",
+            "status": "completed",
+            "completed_at": "2026-05-12T11:00:00+00:00",
+            "deleted_at": None,
+        }]))
+        response = await client.patch("/routes/route-1/complete")
 
         assert response.status_code == 200
         data = response.json()
@@ -606,44 +775,19 @@ class TestRouteActions:
         assert data["route"]["deleted_at"] is None
 
     @pytest.mark.asyncio
-    async def test_complete_route_already_finalized_is_idempotent(self, client):
+    async def test_complete_route_already_finalized_is_idempotent(self, client, fake_supabase):
         """If the route was already completed, /complete returns 200 with
         already_finalized=true so the app cleans local state without
         raising. Prevents zombie routes from re-appearing on retry."""
-        with patch("main.supabase") as mock_sb:
-            route_access = MagicMock()
-            route_access.data = [{"id": "route-1", "driver_id": FAKE_DRIVER_ID}]
-            driver_lookup = MagicMock()
-            driver_lookup.data = [{"id": FAKE_DRIVER_ID, "company_id": None}]
-
-            empty_update = MagicMock()
-            empty_update.data = []  # nothing matched (already completed)
-            already_completed = MagicMock()
-            already_completed.data = [{
-                "id": "route-1",
-                "status": "completed",
-                "completed_at": "2026-05-12T09:00:00+00:00",
-                "deleted_at": None,
-            }]
-
-            call_count = {"routes": 0}
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "routes":
-                    call_count["routes"] += 1
-                    if call_count["routes"] == 1:
-                        chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = route_access
-                    elif call_count["routes"] == 2:
-                        chain.update.return_value.eq.return_value.neq.return_value.execute.return_value = empty_update
-                    else:
-                        chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = already_completed
-                elif name == "drivers":
-                    chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = driver_lookup
-                return chain
-
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-            response = await client.patch("/routes/route-1/complete")
+        already_completed = SBResult(data=[{
+            "id": "route-1",
+            "status": "completed",
+            "completed_at": "2026-05-12T09:00:00+00:00",
+            "deleted_at": None,
+        }])
+        # Access check, then the re-read after an UPDATE that matched nothing.
+        fake_supabase["routes"].on(_ACCESS_PATH, _OWN_ROUTE, already_completed).on("update.eq.neq", SBResult(data=[]))
+        response = await client.patch("/routes/route-1/complete")
 
         assert response.status_code == 200
         data = response.json()
@@ -651,43 +795,17 @@ class TestRouteActions:
         assert data.get("already_finalized") is True
 
     @pytest.mark.asyncio
-    async def test_clear_route(self, client):
+    async def test_clear_route(self, client, fake_supabase):
         """PATCH /routes/{id}/clear archives the route + cascades stops
         via trigger. Replaces the old client-side `supabase.update` that
         was hitting RLS 42501 when the JWT went stale (Sentry NATIVE-30)."""
-        with patch("main.supabase") as mock_sb:
-            route_access = MagicMock()
-            route_access.data = [{"id": "route-1", "driver_id": FAKE_DRIVER_ID}]
-            driver_lookup = MagicMock()
-            driver_lookup.data = [{"id": FAKE_DRIVER_ID, "company_id": None}]
-
-            update_result = MagicMock()
-            update_result.data = [{
-                "id": "route-1",
-                "status": "cancelled",
-                "deleted_at": "2026-05-12T11:30:00+00:00",
-            }]
-            stops_count = MagicMock()
-            stops_count.count = 5
-
-            call_count = {"routes": 0}
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "routes":
-                    call_count["routes"] += 1
-                    if call_count["routes"] == 1:
-                        chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = route_access
-                    else:
-                        chain.update.return_value.eq.return_value.is_.return_value.execute.return_value = update_result
-                elif name == "drivers":
-                    chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = driver_lookup
-                elif name == "stops":
-                    chain.select.return_value.eq.return_value.not_.is_.return_value.execute.return_value = stops_count
-                return chain
-
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-            response = await client.patch("/routes/route-1/clear")
+        fake_supabase["routes"].on(_ACCESS_PATH, _OWN_ROUTE).on("update.eq.is_", SBResult(data=[{
+            "id": "route-1",
+            "status": "cancelled",
+            "deleted_at": "2026-05-12T11:30:00+00:00",
+        }]))
+        fake_supabase["stops"].on("select.eq.not_.is_", SBResult(count=5))
+        response = await client.patch("/routes/route-1/clear")
 
         assert response.status_code == 200
         data = response.json()
@@ -696,39 +814,15 @@ class TestRouteActions:
         assert data["stops_cleared"] == 5
 
     @pytest.mark.asyncio
-    async def test_clear_route_already_archived_is_idempotent(self, client):
+    async def test_clear_route_already_archived_is_idempotent(self, client, fake_supabase):
         """Re-clearing an already-archived route returns 200 + already_archived=true."""
-        with patch("main.supabase") as mock_sb:
-            route_access = MagicMock()
-            route_access.data = [{"id": "route-1", "driver_id": FAKE_DRIVER_ID}]
-            driver_lookup = MagicMock()
-            driver_lookup.data = [{"id": FAKE_DRIVER_ID, "company_id": None}]
-            empty_update = MagicMock()
-            empty_update.data = []
-            already_archived = MagicMock()
-            already_archived.data = [{
-                "id": "route-1",
-                "status": "cancelled",
-                "deleted_at": "2026-05-12T08:00:00+00:00",
-            }]
-            call_count = {"routes": 0}
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "routes":
-                    call_count["routes"] += 1
-                    if call_count["routes"] == 1:
-                        chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = route_access
-                    elif call_count["routes"] == 2:
-                        chain.update.return_value.eq.return_value.is_.return_value.execute.return_value = empty_update
-                    else:
-                        chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = already_archived
-                elif name == "drivers":
-                    chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = driver_lookup
-                return chain
-
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-            response = await client.patch("/routes/route-1/clear")
+        already_archived = SBResult(data=[{
+            "id": "route-1",
+            "status": "cancelled",
+            "deleted_at": "2026-05-12T08:00:00+00:00",
+        }])
+        fake_supabase["routes"].on(_ACCESS_PATH, _OWN_ROUTE, already_archived).on("update.eq.is_", SBResult(data=[]))
+        response = await client.patch("/routes/route-1/clear")
 
         assert response.status_code == 200
         data = response.json()
@@ -736,29 +830,16 @@ class TestRouteActions:
         assert data.get("already_archived") is True
 
     @pytest.mark.asyncio
-    async def test_clear_route_requires_ownership(self, client):
+    async def test_clear_route_requires_ownership(self, client, fake_supabase):
         """clear_route must reject a driver who doesn't own the route."""
-        with patch("main.supabase") as mock_sb:
-            route_access = MagicMock()
-            route_access.data = [{"id": "route-1", "driver_id": "different-driver"}]
-            driver_lookup = MagicMock()
-            driver_lookup.data = [{"id": FAKE_DRIVER_ID, "company_id": None}]
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "routes":
-                    chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = route_access
-                elif name == "drivers":
-                    chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = driver_lookup
-                return chain
-
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-            response = await client.patch("/routes/route-1/clear")
+        fake_supabase["routes"].on(_ACCESS_PATH, _OTHER_ROUTE)
+        response = await client.patch("/routes/route-1/clear")
 
         assert response.status_code == 403
+        assert fake_supabase["routes"].paths == [_ACCESS_PATH]
 
     @pytest.mark.asyncio
-    async def test_delete_route_soft_deletes_never_hard(self, client):
+    async def test_delete_route_soft_deletes_never_hard(self, client, fake_supabase):
         """DELETE /routes/{id} must SOFT-delete (set deleted_at), NEVER hard-delete.
 
         The old hard-delete wiped completed stops from the 'trabajadas' count
@@ -766,165 +847,70 @@ class TestRouteActions:
         caused REACT-NATIVE-1E silent drops when an offline complete/fail op
         targeted a stop of the deleted route. trg_soft_delete_route_stops cascades
         deleted_at to the stops; proofs/tracking are kept."""
-        with patch("main.supabase") as mock_sb:
-            route_access = MagicMock()
-            route_access.data = [{"id": "route-1", "driver_id": FAKE_DRIVER_ID}]
-            driver_lookup = MagicMock()
-            driver_lookup.data = [{"id": FAKE_DRIVER_ID, "company_id": None}]
-            update_result = MagicMock()
-            update_result.data = [{"id": "route-1", "deleted_at": "2026-05-29T11:00:00+00:00"}]
-            stops_count = MagicMock()
-            stops_count.count = 7
-
-            hard_delete_called = {"any": False}
-            call_count = {"routes": 0}
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                # A .delete() on ANY table is a hard-delete → must NEVER happen.
-                def _mark_hard_delete(*a, **k):
-                    hard_delete_called["any"] = True
-                    return MagicMock()
-                chain.delete.side_effect = _mark_hard_delete
-                if name == "routes":
-                    call_count["routes"] += 1
-                    if call_count["routes"] == 1:
-                        chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = route_access
-                    else:
-                        chain.update.return_value.eq.return_value.is_.return_value.execute.return_value = update_result
-                elif name == "drivers":
-                    chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = driver_lookup
-                elif name == "stops":
-                    chain.select.return_value.eq.return_value.not_.is_.return_value.execute.return_value = stops_count
-                return chain
-
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-            response = await client.delete("/routes/route-1")
+        fake_supabase["routes"].on(_ACCESS_PATH, _OWN_ROUTE).on(
+            "update.eq.is_", SBResult(data=[{"id": "route-1", "deleted_at": "2026-05-29T11:00:00+00:00"}])
+        )
+        fake_supabase["stops"].on("select.eq.not_.is_", SBResult(count=7))
+        response = await client.delete("/routes/route-1")
 
         assert response.status_code == 200
         data = response.json()
         assert data["success"] is True
         assert data["stops_deleted"] == 7
-        assert hard_delete_called["any"] is False, "delete_route must NOT hard-delete any row"
+        # A .delete() on ANY table is a hard-delete → must NEVER happen.
+        hard_deletes = [name for table in fake_supabase.values() for name, _ in table.calls if name == "delete"]
+        assert not hard_deletes, "delete_route must NOT hard-delete any row"
 
     @pytest.mark.asyncio
-    async def test_delete_route_idempotent(self, client):
+    async def test_delete_route_idempotent(self, client, fake_supabase):
         """Re-deleting an already soft-deleted route → 200 + already_deleted=true."""
-        with patch("main.supabase") as mock_sb:
-            route_access = MagicMock()
-            route_access.data = [{"id": "route-1", "driver_id": FAKE_DRIVER_ID}]
-            driver_lookup = MagicMock()
-            driver_lookup.data = [{"id": FAKE_DRIVER_ID, "company_id": None}]
-            empty_update = MagicMock()
-            empty_update.data = []
-            already = MagicMock()
-            already.data = [{"id": "route-1", "deleted_at": "2026-05-29T08:00:00+00:00"}]
-            call_count = {"routes": 0}
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "routes":
-                    call_count["routes"] += 1
-                    if call_count["routes"] == 1:
-                        chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = route_access
-                    elif call_count["routes"] == 2:
-                        chain.update.return_value.eq.return_value.is_.return_value.execute.return_value = empty_update
-                    else:
-                        chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = already
-                elif name == "drivers":
-                    chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = driver_lookup
-                return chain
-
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-            response = await client.delete("/routes/route-1")
+        already = SBResult(data=[{"id": "route-1", "deleted_at": "2026-05-29T08:00:00+00:00"}])
+        fake_supabase["routes"].on(_ACCESS_PATH, _OWN_ROUTE, already).on("update.eq.is_", SBResult(data=[]))
+        response = await client.delete("/routes/route-1")
 
         assert response.status_code == 200
         assert response.json().get("already_deleted") is True
 
     @pytest.mark.asyncio
-    async def test_delete_route_requires_ownership(self, client):
+    async def test_delete_route_requires_ownership(self, client, fake_supabase):
         """delete_route must reject a driver who doesn't own the route."""
-        with patch("main.supabase") as mock_sb:
-            route_access = MagicMock()
-            route_access.data = [{"id": "route-1", "driver_id": "different-driver"}]
-            driver_lookup = MagicMock()
-            driver_lookup.data = [{"id": FAKE_DRIVER_ID, "company_id": None}]
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "routes":
-                    chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = route_access
-                elif name == "drivers":
-                    chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = driver_lookup
-                return chain
-
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
-            response = await client.delete("/routes/route-1")
+        fake_supabase["routes"].on(_ACCESS_PATH, _OTHER_ROUTE)
+        response = await client.delete("/routes/route-1")
 
         assert response.status_code == 403
+        assert fake_supabase["routes"].paths == [_ACCESS_PATH]
 
 
 class TestReconcileOptimization:
     """Tests for PATCH /routes/{route_id}/reconcile-optimization."""
 
-    def _mock_dispatch(self, existing_route: dict):
-        """Build a Supabase table mock that yields existing_route on the
-        first select+single chain (route lookup), and absorbs the UPDATE chain
-        used to persist hash + polyline."""
-        driver_lookup = MagicMock()
-        driver_lookup.data = [{"id": FAKE_DRIVER_ID, "company_id": None}]
-
-        route_access = MagicMock()
-        route_access.data = [{"id": "route-1", "driver_id": FAKE_DRIVER_ID}]
-
-        route_select = MagicMock()
-        route_select.data = existing_route
-
-        call_count = {"routes": 0}
-
-        def table_dispatch(name):
-            chain = MagicMock()
-            if name == "routes":
-                call_count["routes"] += 1
-                if call_count["routes"] == 1:
-                    chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = route_access
-                elif call_count["routes"] == 2:
-                    chain.select.return_value.eq.return_value.limit.return_value.single.return_value.execute.return_value = route_select
-                else:
-                    chain.update.return_value.eq.return_value.execute.return_value = MagicMock()
-            elif name == "drivers":
-                chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = driver_lookup
-            elif name == "stops":
-                chain.update.return_value.eq.return_value.eq.return_value.execute.return_value = MagicMock()
-            return chain
-
-        return table_dispatch
-
-    @pytest.mark.asyncio
-    async def test_persists_when_bd_has_no_hash(self, client):
+    @staticmethod
+    async def _reconcile(client, fake_supabase, existing_route: dict, body: dict):
+        """PATCH the reconcile endpoint with fake_supabase's route lookup
+        (select+single) yielding existing_route; the UPDATEs persisting hash +
+        polyline execute to empty results."""
+        fake_supabase["routes"].on(_ACCESS_PATH, _OWN_ROUTE).on("select.eq.limit.single", SBResult(data=existing_route))
+        return await client.patch("/routes/route-1/reconcile-optimization", json=body)
+
+    @pytest.mark.asyncio
+    async def test_persists_when_bd_has_no_hash(self, client, fake_supabase):
         """BD vacío + cliente envía hash → escribe, success=true."""
-        with patch("main.supabase") as mock_sb:
-            mock_sb.table = MagicMock(
-                side_effect=self._mock_dispatch({"id": "route-1", "status": "in_progress", "optimized_hash": None})
-            )
-            response = await client.patch(
-                "/routes/route-1/reconcile-optimization",
-                json={"optimized_hash": "abc123", "polyline_points": [[1.0, 2.0]]},
-            )
+        response = await self._reconcile(
+            client, fake_supabase,
+            {"id": "route-1", "status": "in_progress", "optimized_hash": None},
+            {"optimized_hash": "abc123", "polyline_points": [[1.0, 2.0]]},
+        )
         assert response.status_code == 200
         assert response.json()["success"] is True
 
     @pytest.mark.asyncio
-    async def test_rejects_hash_mismatch_without_force(self, client):
+    async def test_rejects_hash_mismatch_without_force(self, client, fake_supabase):
         """BD ya tiene hash distinto + force ausente → success=false hash_mismatch."""
-        with patch("main.supabase") as mock_sb:
-            mock_sb.table = MagicMock(
-                side_effect=self._mock_dispatch({"id": "route-1", "status": "in_progress", "optimized_hash": "old"})
-            )
-            response = await client.patch(
-                "/routes/route-1/reconcile-optimization",
-                json={"optimized_hash": "new"},
-            )
+        response = await self._reconcile(
+            client, fake_supabase,
+            {"id": "route-1", "status": "in_progress", "optimized_hash": "old"},
+            {"optimized_hash": "new"},
+        )
         body = response.json()
         assert response.status_code == 200
         assert body["success"] is False
@@ -932,28 +918,22 @@ class TestReconcileOptimization:
         assert body["current_hash"] == "old"
 
     @pytest.mark.asyncio
-    async def test_force_overwrites_existing_hash(self, client):
+    async def test_force_overwrites_existing_hash(self, client, fake_supabase):
         """BD tiene hash distinto + force=true (post-optimize) → sobrescribe."""
-        with patch("main.supabase") as mock_sb:
-            mock_sb.table = MagicMock(
-                side_effect=self._mock_dispatch({"id": "route-1", "status": "in_progress", "optimized_hash": "old"})
-            )
-            response = await client.patch(
-                "/routes/route-1/reconcile-optimization",
-                json={"optimized_hash": "new", "polyline_points": [[1.0, 2.0]], "force": True},
-            )
+        response = await self._reconcile(
+            client, fake_supabase,
+            {"id": "route-1", "status": "in_progress", "optimized_hash": "old"},
+            {"optimized_hash": "new", "polyline_points": [[1.0, 2.0]], "force": True},
+        )
         assert response.status_code == 200
         assert response.json()["success"] is True
 
     @pytest.mark.asyncio
-    async def test_refuses_completed_route(self, client):
+    async def test_refuses_completed_route(self, client, fake_supabase):
         """Ruta completed no es reconciliable (evita reabrir histórico)."""
-        with patch("main.supabase") as mock_sb:
-            mock_sb.table = MagicMock(
-                side_effect=self._mock_dispatch({"id": "route-1", "status": "completed", "optimized_hash": None})
-            )
-            response = await client.patch(
-                "/routes/route-1/reconcile-optimization",
-                json={"optimized_hash": "abc"},
-            )
+        response = await self._reconcile(
+            client, fake_supabase,
+            {"id": "route-1", "status": "completed", "optimized_hash": None},
+            {"optimized_hash": "abc"},
+        )
         assert response.status_code == 409
@@ -7,18 +7,11 @@ Cubre la fuga de raíz: el INSERT directo del cliente fallaba bajo RLS
   - límite free 10/día como 402 LIMPIO (no drop) → upsell.
   - idempotente por (route_id, client_id) → reintento de cola no duplica.
 """
-from unittest.mock import AsyncMock, MagicMock, patch
+from unittest.mock import AsyncMock, patch
 
 import pytest
 
-from tests.conftest import FAKE_DRIVER_ID
-
-
-def _mock(data):
-    m = MagicMock()
-    m.data = data
-    return m
-
+from tests.conftest import FAKE_DRIVER_ID, SBResult
 
 BODY = {
     "route_id": "11111111-1111-4111-8111-111111111111",
@@ -28,32 +21,23 @@ BODY = {
 }
 
 
-def _sb_for(existing=None, today_count=0, new_id="stop-new"):
-    """Mock de supabase: drivers lookup + existing check + upsert + rpc."""
-    mock_sb = MagicMock()
-
-    def table_dispatch(name):
-        chain = MagicMock()
-        if name == "drivers":
-            chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = _mock([{"id": FAKE_DRIVER_ID}])
-        elif name == "stops":
-            # existing check: select().eq().eq().is_().limit().execute()
-            chain.select.return_value.eq.return_value.eq.return_value.is_.return_value.limit.return_value.execute.return_value = _mock(existing or [])
-            # upsert(...).execute() — supabase-py devuelve la fila por defecto;
-            # NO se encadena .select() tras upsert (eso era el bug del smoke-test).
-            chain.upsert.return_value.execute.return_value = _mock([{"id": new_id}])
-        return chain
-
-    mock_sb.table = MagicMock(side_effect=table_dispatch)
-    mock_sb.rpc = MagicMock(return_value=MagicMock(execute=MagicMock(return_value=_mock(today_count))))
-    return mock_sb
+def _sb_for(fake, sb, existing=None, today_count=0, new_id="stop-new"):
+    """drivers lookup + existing check + upsert en `fake`; rpc del contador en `sb`."""
+    fake["drivers"].on("select.eq.limit", SBResult(data=[{"id": FAKE_DRIVER_ID}]))
+    # existing check: select().eq().eq().is_().limit().execute()
+    fake["stops"].on("select.eq.eq.is_.limit", SBResult(data=existing or []))
+    # upsert(...).execute() — supabase-py devuelve la fila por defecto;
+    # NO se encadena .select() tras upsert (eso era el bug del smoke-test).
+    fake["stops"].on("upsert", SBResult(data=[{"id": new_id}]))
+    sb.rpc.return_value.execute.return_value = SBResult(data=today_count)
+    return sb
 
 
 class TestStopAdd:
     @pytest.mark.asyncio
-    async def test_new_stop_paid_user_inserts(self, client):
-        with patch("main.supabase", _sb_for(existing=[], today_count=0)), \
-             patch("main.verify_route_access", new=AsyncMock(return_value=None)), \
+    async def test_new_stop_paid_user_inserts(self, client, fake_supabase, supabase_mock):
+        _sb_for(fake_supabase, supabase_mock, existing=[], today_count=0)
+        with patch("main.verify_route_access", new=AsyncMock(return_value=None)), \
              patch("main._resolve_user_tier", return_value=("pro", FAKE_DRIVER_ID)):
             resp = await client.post("/stops/add", json=BODY)
         assert resp.status_code == 200, resp.text
@@ -61,10 +45,9 @@ class TestStopAdd:
         assert d["success"] is True and d["existing"] is False and d["id"] == "stop-new"
 
     @pytest.mark.asyncio
-    async def test_idempotent_existing_returns_same_no_reinsert(self, client):
-        sb = _sb_for(existing=[{"id": "stop-existing"}])
-        with patch("main.supabase", sb), \
-             patch("main.verify_route_access", new=AsyncMock(return_value=None)), \
+    async def test_idempotent_existing_returns_same_no_reinsert(self, client, fake_supabase, supabase_mock):
+        sb = _sb_for(fake_supabase, supabase_mock, existing=[{"id": "stop-existing"}])
+        with patch("main.verify_route_access", new=AsyncMock(return_value=None)), \
              patch("main._resolve_user_tier", return_value=("free", FAKE_DRIVER_ID)):
             resp = await client.post("/stops/add", json=BODY)
         assert resp.status_code == 200, resp.text
@@ -74,10 +57,10 @@ class TestStopAdd:
         sb.rpc.assert_not_called()
 
     @pytest.mark.asyncio
-    async def test_free_over_limit_returns_402_not_silent_drop(self, client):
+    async def test_free_over_limit_returns_402_not_silent_drop(self, client, fake_supabase, supabase_mock):
         """El caso #82: free en el tope → 402 limpio con upsell, NO drop silencioso."""
-        with patch("main.supabase", _sb_for(existing=[], today_count=10)), \
-             patch("main.verify_route_access", new=AsyncMock(return_value=None)), \
+        _sb_for(fake_supabase, supabase_mock, existing=[], today_count=10)
+        with patch("main.verify_route_access", new=AsyncMock(return_value=None)), \
              patch("main._resolve_user_tier", return_value=("free", FAKE_DRIVER_ID)):
             resp = await client.post("/stops/add", json=BODY)
         assert resp.status_code == 402, resp.text
@@ -85,13 +68,12 @@ class TestStopAdd:
         assert detail["error"] == "free_daily_stop_limit" and detail["limit"] == 10
 
     @pytest.mark.asyncio
-    async def test_free_under_limit_inserts_without_backend_count(self, client):
+    async def test_free_under_limit_inserts_without_backend_count(self, client, fake_supabase, supabase_mock):
         """El backend solo LEE el contador para el 402; el CLIENTE sigue siendo el
         dueño del increment (trackStopAdded). Si el backend también contara, cada
         parada sumaría 2 → free bloqueado a 5 en vez de 10 (#82, diseño 10-jun)."""
-        sb = _sb_for(existing=[], today_count=3)
-        with patch("main.supabase", sb), \
-             patch("main.verify_route_access", new=AsyncMock(return_value=None)), \
+        sb = _sb_for(fake_supabase, supabase_mock, existing=[], today_count=3)
+        with patch("main.verify_route_access", new=AsyncMock(return_value=None)), \
              patch("main._resolve_user_tier", return_value=("free", FAKE_DRIVER_ID)):
             resp = await client.post("/stops/add", json=BODY)
         assert resp.status_code == 200, resp.text
@@ -100,21 +82,21 @@ class TestStopAdd:
         assert "increment_daily_usage" not in rpc_calls
 
     @pytest.mark.asyncio
-    async def test_malformed_uuid_returns_422_not_500(self, client):
+    async def test_malformed_uuid_returns_422_not_500(self, client, fake_supabase, supabase_mock):
         """client_id no-UUID antes llegaba a Postgres (22P02) → 500/503 y la cola
         reintentaba en bucle. Ahora 422 limpio = permanente, no se reintenta."""
         bad = {**BODY, "client_id": "not-a-uuid"}
-        with patch("main.supabase", _sb_for(existing=[])), \
-             patch("main.verify_route_access", new=AsyncMock(return_value=None)), \
+        _sb_for(fake_supabase, supabase_mock, existing=[])
+        with patch("main.verify_route_access", new=AsyncMock(return_value=None)), \
              patch("main._resolve_user_tier", return_value=("pro", FAKE_DRIVER_ID)):
             resp = await client.post("/stops/add", json=bad)
         assert resp.status_code == 422, resp.text
 
     @pytest.mark.asyncio
-    async def test_route_not_owned_403(self, client):
+    async def test_route_not_owned_403(self, client, fake_supabase, supabase_mock):
         from fastapi import HTTPException
-        with patch("main.supabase", _sb_for(existing=[])), \
-             patch("main.verify_route_access", new=AsyncMock(side_effect=HTTPException(status_code=403, detail="no"))), \
+        _sb_for(fake_supabase, supabase_mock, existing=[])
+        with patch("main.verify_route_access", new=AsyncMock(side_effect=HTTPException(status_code=403, detail="no"))), \
              patch("main._resolve_user_tier", return_value=("pro", FAKE_DRIVER_ID)):
             resp = await client.post("/stops/add", json=BODY)
         assert resp.status_code == 403
@@ -12,7 +12,7 @@ from unittest.mock import MagicMock, patch
 
 import pytest
 
-from tests.conftest import FAKE_USER_ID
+from tests.conftest import FAKE_USER_ID, SBResult
 
 # ===================== /stripe/create-checkout =====================
 
@@ -159,6 +159,42 @@ class TestStripeWebhookExtended:
             )
         assert response.status_code == 400
 
+    @pytest.mark.asyncio
+    async def test_webhook_oversized_payload_rejected(self, client):
+        """Payloads over 64 KB are refused with 413 before signature parsing."""
+        with patch("main.STRIPE_WEBHOOK_SECRET", "whsec_test"), \
+             patch("main.stripe") as mock_stripe:
+            response = await client.post(
+                "/stripe/webhook",
+                content=b"x" * 70_000,
+                headers={"content-type": "application/json", "stripe-signature": "test_sig"}
+            )
+        assert response.status_code == 413
+        mock_stripe.Webhook.construct_event.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_webhook_chunked_oversized_payload_stops_reading(self, client):
+        """Without Content-Length (chunked upload) the body is read chunk by
+        chunk and refused with 413 as soon as it passes 64 KB, without
+        consuming the rest of the upload."""
+        sent = []
+
+        async def chunks():
+            for _ in range(64):
+                sent.append(16_384)
+                yield b"x" * 16_384
+
+        with patch("main.STRIPE_WEBHOOK_SECRET", "whsec_test"), \
+             patch("main.stripe") as mock_stripe:
+            response = await client.post(
+                "/stripe/webhook",
+                content=chunks(),
+                headers={"content-type": "application/json", "stripe-signature": "test_sig"}
+            )
+        assert response.status_code == 413
+        assert len(sent) < 64
+        mock_stripe.Webhook.construct_event.assert_not_called()
+
     @pytest.mark.asyncio
     async def test_webhook_duplicate_event_idempotent(self, client):
         """Duplicate event IDs are processed only once."""
@@ -188,11 +224,10 @@ class TestStripeWebhookExtended:
         assert response.json()["status"] == "already_processed"
 
     @pytest.mark.asyncio
-    async def test_webhook_invoice_payment_succeeded_renewal(self, client):
+    async def test_webhook_invoice_payment_succeeded_renewal(self, client, fake_supabase, supabase_mock):
         """invoice.payment_succeeded with billing_reason=subscription_cycle extends plan."""
         with patch("main.STRIPE_WEBHOOK_SECRET", "whsec_test"), \
              patch("main.stripe") as mock_stripe, \
-             patch("main.supabase") as mock_sb, \
              patch("main._is_webhook_processed", return_value=False), patch("main._mark_webhook_processed"):
 
             mock_data_obj = MagicMock()
@@ -206,15 +241,7 @@ class TestStripeWebhookExtended:
             mock_event.get.return_value = "evt_renew"
             mock_stripe.Webhook.construct_event.return_value = mock_event
 
-            user_result = MagicMock()
-            user_result.data = [{"id": FAKE_USER_ID}]
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = user_result
-                chain.update.return_value.eq.return_value.execute.return_value = MagicMock()
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+            fake_supabase["*"].on("select.eq.limit.maybe_single", SBResult(data={"id": FAKE_USER_ID}))
 
             response = await client.post(
                 "/stripe/webhook",
@@ -223,6 +250,185 @@ class TestStripeWebhookExtended:
             )
         assert response.status_code == 200
         assert response.json()["received"] is True
+        # Renewal only moves the expiry, in a single RPC (no per-table updates).
+        supabase_mock.rpc.assert_called_once()
+        name, params = supabase_mock.rpc.call_args.args
+        assert name == "apply_plan_change"
+        assert params["p_user"] == FAKE_USER_ID
+        assert params["p_keep_plan"] is True
+        assert params["p_expires"]
+
+    @pytest.mark.asyncio
+    async def test_webhook_checkout_single_plan_write(self, client):
+        """checkout.session.completed writes drivers + users via one RPC call."""
+        with patch("main.STRIPE_WEBHOOK_SECRET", "whsec_test"), \
+             patch("main.stripe") as mock_stripe, \
+             patch("main.supabase") as mock_sb, \
+             patch("main._is_webhook_processed", return_value=False), patch("main._mark_webhook_processed"):
+
+            mock_data_obj = MagicMock()
+            mock_data_obj.client_reference_id = FAKE_USER_ID
+            mock_data_obj.metadata = {"plan": "pro_plus"}
+            mock_data_obj.customer = "cus_checkout"
+
+            mock_event = MagicMock()
+            mock_event.type = "checkout.session.completed"
+            mock_event.id = "evt_checkout"
+            mock_event.data.object = mock_data_obj
+            mock_event.get.return_value = "evt_checkout"
+            mock_stripe.Webhook.construct_event.return_value = mock_event
+
+            response = await client.post(
+                "/stripe/webhook",
+                content=b'{}',
+                headers={"content-type": "application/json", "stripe-signature": "test_sig"}
+            )
+        assert response.status_code == 200
+        mock_sb.table.return_value.update.assert_not_called()
+        mock_sb.rpc.assert_called_once()
+        name, params = mock_sb.rpc.call_args.args
+        assert name == "apply_plan_change"
+        assert params == {
+            "p_user": FAKE_USER_ID,
+            "p_plan": "pro_plus",
+            "p_expires": params["p_expires"],
+            "p_source": "stripe",
+            "p_customer": "cus_checkout",
+            "p_keep_plan": False,
+        }
+
+    @pytest.mark.asyncio
+    async def test_webhook_out_of_order_subscription_event_ignored(self, client):
+        """A subscription.updated older than an already-processed deleted is dropped."""
+        import main
+
+        main._stripe_subscription_last_created["cus_late"] = 2_000
+        with patch("main.STRIPE_WEBHOOK_SECRET", "whsec_test"), \
+             patch("main.stripe") as mock_stripe, \
+             patch("main.supabase") as mock_sb, \
+             patch("main._is_webhook_processed", return_value=False), patch("main._mark_webhook_processed"):
+
+            mock_data_obj = MagicMock()
+            mock_data_obj.customer = "cus_late"
+
+            mock_event = MagicMock()
+            mock_event.type = "customer.subscription.updated"
+            mock_event.id = "evt_late"
+            mock_event.created = 1_000
+            mock_event.data.object = mock_data_obj
+            mock_event.get.return_value = "evt_late"
+            mock_stripe.Webhook.construct_event.return_value = mock_event
+
+            response = await client.post(
+                "/stripe/webhook",
+                content=b'{}',
+                headers={"content-type": "application/json", "stripe-signature": "test_sig"}
+            )
+        assert response.status_code == 200
+        assert response.json()["status"] == "stale"
+        mock_sb.table.assert_not_called()
+        mock_sb.rpc.assert_not_called()
+
+    @staticmethod
+    def _subscription_event(event_type, created, customer="cus_race"):
+        data_obj = MagicMock()
+        data_obj.customer = customer
+        data_obj.status = "active"
+        data_obj.current_period_end = None
+        data_obj.items.data = [MagicMock()]
+        data_obj.items.data[0].price.id = "price_pro"
+        event = MagicMock()
+        event.type = event_type
+        event.created = created
+        event.data.object = data_obj
+        return event
+
+    @pytest.mark.asyncio
+    async def test_retried_update_does_not_override_later_delete(self, fake_supabase, supabase_mock):
+        """updated(created=100) fails its first attempt; deleted(created=200)
+        arrives and applies meanwhile. The retry must be dropped, not put the
+        cancelled user back on 'pro'."""
+        import asyncio
+
+        import main
+
+        fake_supabase["users"].on("select.eq.limit.maybe_single", SBResult(data={"id": FAKE_USER_ID}))
+        plans = []
+        failures = [Exception("DB timeout")]
+
+        def rpc(name, params):
+            if failures:
+                raise failures.pop()
+            plans.append(params["p_plan"])
+            return MagicMock()
+        supabase_mock.rpc.side_effect = rpc
+
+        updated = self._subscription_event("customer.subscription.updated", 100)
+        deleted = self._subscription_event("customer.subscription.deleted", 200)
+        with patch("main.STRIPE_PLANS", {"pro": {"name": "Pro", "price_id": "price_pro"}}), \
+             patch("main._STRIPE_WEBHOOK_RETRY_BASE_S", 0.05):
+            # Request-time guard, as /stripe/webhook does on arrival.
+            assert main._is_stale_subscription_event("cus_race", 100) is False
+            retrying = asyncio.create_task(main._process_stripe_event(updated))
+            await asyncio.sleep(0.01)  # first attempt fails, retry is sleeping
+            assert main._is_stale_subscription_event("cus_race", 200) is False
+            await main._process_stripe_event(deleted)
+            await retrying
+
+        assert plans == [None]
+
+    @pytest.mark.asyncio
+    async def test_events_of_one_customer_never_overlap(self):
+        """The webhook pool has 2 threads; two events of the same customer
+        still run one after the other."""
+        import asyncio
+        import threading
+        import time
+
+        import main
+
+        active, peak = [0], [0]
+        counter_lock = threading.Lock()
+
+        def apply(event):
+            with counter_lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.05)
+            with counter_lock:
+                active[0] -= 1
+
+        events = [self._subscription_event("invoice.paid", None, customer="cus_serial") for _ in range(2)]
+        with patch("main._apply_stripe_event", side_effect=apply):
+            await asyncio.gather(*(main._process_stripe_event(e) for e in events))
+
+        assert peak[0] == 1
+
+    @pytest.mark.asyncio
+    async def test_customer_lookup_cached_across_events(self):
+        """Repeated events for one customer resolve the user with a single SELECT."""
+        import main
+
+        with patch("main.supabase") as mock_sb:
+            mock_sb.table.return_value.select.return_value.eq.return_value.limit.return_value.maybe_single.return_value.execute.return_value = (
+                MagicMock(data={"id": FAKE_USER_ID})
+            )
+            assert main._resolve_stripe_customer_user("cus_burst") == FAKE_USER_ID
+            assert main._resolve_stripe_customer_user("cus_burst") == FAKE_USER_ID
+
+        assert mock_sb.table.call_count == 1
+
+    @pytest.mark.asyncio
+    async def test_customer_lookup_miss_not_cached(self):
+        import main
+
+        with patch("main.supabase") as mock_sb:
+            # postgrest devuelve None cuando maybe_single no encuentra fila.
+            mock_sb.table.return_value.select.return_value.eq.return_value.limit.return_value.maybe_single.return_value.execute.return_value = None
+            assert main._resolve_stripe_customer_user("cus_pending") is None
+            assert main._resolve_stripe_customer_user("cus_pending") is None
+
+        assert mock_sb.table.call_count == 2
 
     @pytest.mark.asyncio
     async def test_webhook_invoice_payment_succeeded_not_renewal(self, client):
@@ -361,11 +567,10 @@ class TestStripeWebhookExtended:
         mock_sb.table.assert_not_called()
 
     @pytest.mark.asyncio
-    async def test_webhook_subscription_deleted_no_matching_user(self, client):
+    async def test_webhook_subscription_deleted_no_matching_user(self, client, fake_supabase):
         """customer.subscription.deleted with no matching user is a no-op."""
         with patch("main.STRIPE_WEBHOOK_SECRET", "whsec_test"), \
              patch("main.stripe") as mock_stripe, \
-             patch("main.supabase") as mock_sb, \
              patch("main._is_webhook_processed", return_value=False), patch("main._mark_webhook_processed"):
 
             mock_data_obj = MagicMock()
@@ -378,14 +583,8 @@ class TestStripeWebhookExtended:
             mock_event.get.return_value = "evt_del_unknown"
             mock_stripe.Webhook.construct_event.return_value = mock_event
 
-            user_result = MagicMock()
-            user_result.data = []  # No matching user
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                chain.select.return_value.eq.return_value.limit.return_value.execute.return_value = user_result
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+            # No matching user
+            fake_supabase["*"].on("select.eq.limit.maybe_single", SBResult(data=None))
 
             response = await client.post(
                 "/stripe/webhook",
@@ -395,9 +594,11 @@ class TestStripeWebhookExtended:
         assert response.status_code == 200
 
     @pytest.mark.asyncio
-    async def test_webhook_processing_error_returns_500(self, client):
-        """Internal error during webhook processing returns 500."""
+    async def test_webhook_processing_error_retried_in_background(self, client):
+        """A DB error during processing no longer fails the request: Stripe is
+        acked with 200 and the background task retries before reporting."""
         with patch("main.STRIPE_WEBHOOK_SECRET", "whsec_test"), \
+             patch("main._STRIPE_WEBHOOK_RETRY_BASE_S", 0), \
              patch("main.stripe") as mock_stripe, \
              patch("main.supabase") as mock_sb, \
              patch("main._is_webhook_processed", return_value=False), patch("main._mark_webhook_processed"), \
@@ -415,21 +616,50 @@ class TestStripeWebhookExtended:
             mock_event.get.return_value = "evt_err"
             mock_stripe.Webhook.construct_event.return_value = mock_event
 
-            # Simulate supabase error during update
-            def table_dispatch(name):
-                chain = MagicMock()
-                chain.update.return_value.eq.return_value.execute.side_effect = Exception("DB down")
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+            # Simulate supabase error during the plan write
+            mock_sb.rpc.return_value.execute.side_effect = Exception("DB down")
 
             response = await client.post(
                 "/stripe/webhook",
                 content=b'{}',
                 headers={"content-type": "application/json", "stripe-signature": "test_sig"}
             )
-        assert response.status_code == 500
+        assert response.status_code == 200
+        assert mock_sb.rpc.return_value.execute.call_count == 6  # 1 + 5 reintentos
         mock_sentry.capture_exception.assert_called_once()
 
+    @pytest.mark.asyncio
+    async def test_webhook_transient_error_recovers_on_retry(self, client):
+        """A transient failure is retried and the event ends up applied."""
+        with patch("main.STRIPE_WEBHOOK_SECRET", "whsec_test"), \
+             patch("main._STRIPE_WEBHOOK_RETRY_BASE_S", 0), \
+             patch("main.stripe") as mock_stripe, \
+             patch("main.supabase") as mock_sb, \
+             patch("main._is_webhook_processed", return_value=False), patch("main._mark_webhook_processed"), \
+             patch("main.sentry_sdk") as mock_sentry:
+
+            mock_data_obj = MagicMock()
+            mock_data_obj.client_reference_id = FAKE_USER_ID
+            mock_data_obj.metadata = {"plan": "pro"}
+            mock_data_obj.customer = None
+
+            mock_event = MagicMock()
+            mock_event.type = "checkout.session.completed"
+            mock_event.data.object = mock_data_obj
+            mock_event.get.return_value = "evt_retry"
+            mock_stripe.Webhook.construct_event.return_value = mock_event
+
+            mock_sb.rpc.return_value.execute.side_effect = [Exception("timeout"), MagicMock()]
+
+            response = await client.post(
+                "/stripe/webhook",
+                content=b'{}',
+                headers={"content-type": "application/json", "stripe-signature": "test_sig"}
+            )
+        assert response.status_code == 200
+        assert mock_sb.rpc.return_value.execute.call_count == 2
+        mock_sentry.capture_exception.assert_not_called()
+
 
 # ===================== /stripe/portal =====================
 
@@ -447,7 +677,7 @@ class TestStripePortalExtended:
              patch("main.stripe") as mock_stripe:
             user_result = MagicMock()
             user_result.data = {"stripe_customer_id": "cus_123"}
-            mock_sb.table.return_value.select.return_value.eq.return_value.single.return_value.execute.return_value = user_result
+            mock_sb.table.return_value.select.return_value.eq.return_value.maybe_single.return_value.execute.return_value = user_result
 
             mock_stripe.StripeError = stripe_mod.StripeError
             mock_stripe.billing_portal.Session.create.side_effect = stripe_mod.StripeError("Stripe down")
@@ -460,7 +690,7 @@ class TestStripePortalExtended:
         """Database error when looking up customer returns 500."""
         with patch("main.STRIPE_SECRET_KEY", "sk_test_fake"), \
              patch("main.supabase") as mock_sb:
-            mock_sb.table.return_value.select.return_value.eq.return_value.single.return_value.execute.side_effect = Exception("DB timeout")
+            mock_sb.table.return_value.select.return_value.eq.return_value.maybe_single.return_value.execute.side_effect = Exception("DB timeout")
 
             response = await client.post("/stripe/portal")
         assert response.status_code == 500
@@ -472,7 +702,17 @@ class TestStripePortalExtended:
              patch("main.supabase") as mock_sb:
             user_result = MagicMock()
             user_result.data = None
-            mock_sb.table.return_value.select.return_value.eq.return_value.single.return_value.execute.return_value = user_result
+            mock_sb.table.return_value.select.return_value.eq.return_value.maybe_single.return_value.execute.return_value = user_result
+
+            response = await client.post("/stripe/portal")
+        assert response.status_code == 404
+
+    @pytest.mark.asyncio
+    async def test_portal_missing_user_row_returns_404(self, client):
+        """maybe_single() returns None for a missing users row: 404, not a 500."""
+        with patch("main.STRIPE_SECRET_KEY", "sk_test_fake"), \
+             patch("main.supabase") as mock_sb:
+            mock_sb.table.return_value.select.return_value.eq.return_value.maybe_single.return_value.execute.return_value = None
 
             response = await client.post("/stripe/portal")
         assert response.status_code == 404
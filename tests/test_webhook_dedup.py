@@ -66,3 +66,30 @@ class TestWebhookDedup:
             mock_sb.table.return_value.insert.return_value.execute.side_effect = Exception("duplicate key")
             # Should not raise
             main._mark_webhook_processed("evt-collision", "stripe")
+
+    def test_memory_set_is_ttl_bounded(self):
+        """The fast-path set expires entries instead of growing unbounded."""
+        assert main._processed_webhook_events.ttl == 86400
+        assert main._processed_webhook_events.maxsize >= 10000
+
+
+class TestStripeSubscriptionOrdering:
+    def setup_method(self):
+        main._stripe_subscription_last_created.clear()
+
+    def test_older_event_is_stale(self):
+        assert main._is_stale_subscription_event("cus_1", 200) is False
+        assert main._is_stale_subscription_event("cus_1", 100) is True
+
+    def test_newer_event_advances_watermark(self):
+        assert main._is_stale_subscription_event("cus_1", 100) is False
+        assert main._is_stale_subscription_event("cus_1", 200) is False
+        assert main._stripe_subscription_last_created["cus_1"] == 200
+
+    def test_customers_are_independent(self):
+        main._is_stale_subscription_event("cus_1", 200)
+        assert main._is_stale_subscription_event("cus_2", 100) is False
+
+    def test_missing_created_is_never_stale(self):
+        assert main._is_stale_subscription_event("cus_1", None) is False
+        assert main._is_stale_subscription_event(None, 100) is False
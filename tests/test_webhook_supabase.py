@@ -7,34 +7,26 @@ non-INSERT events are skipped, missing email is skipped, email log insertion,
 driver name lookup, and error handling.
 """
 
-from unittest.mock import MagicMock, patch
+from unittest.mock import patch
 
 import pytest
 
+from tests.conftest import SBResult
+
 # ===================== POST /webhooks/supabase-auth =====================
 
 
 class TestSupabaseAuthWebhook:
     """Tests for POST /webhooks/supabase-auth"""
 
+    @pytest.mark.slow
     @pytest.mark.asyncio
-    async def test_valid_insert_sends_welcome_email(self, client):
+    async def test_valid_insert_sends_welcome_email(self, client, fake_supabase):
         """INSERT event with email sends welcome email and logs it."""
         with patch("main.SUPABASE_WEBHOOK_SECRET", "test-secret"), \
-             patch("main.supabase") as mock_sb, \
              patch("main.send_welcome_email", return_value={"success": True, "id": "msg_welcome"}) as mock_send:
 
-            driver_result = MagicMock()
-            driver_result.data = [{"name": "Test User"}]
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.select.return_value.eq.return_value.execute.return_value = driver_result
-                elif name == "email_log":
-                    chain.insert.return_value.execute.return_value = MagicMock()
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+            fake_supabase["drivers"].on("select.eq", SBResult(data=[{"name": "Test User"}]))
 
             response = await client.post(
                 "/webhooks/supabase-auth",
@@ -163,24 +155,14 @@ class TestSupabaseAuthWebhook:
         assert response.json()["skipped"] is True
         mock_send.assert_not_called()
 
+    @pytest.mark.slow
     @pytest.mark.asyncio
-    async def test_driver_name_not_found_uses_email_fallback(self, client):
+    async def test_driver_name_not_found_uses_email_fallback(self, client, fake_supabase):
         """When driver name lookup fails, uses email-based name."""
         with patch("main.SUPABASE_WEBHOOK_SECRET", "test-secret"), \
-             patch("main.supabase") as mock_sb, \
              patch("main.send_welcome_email", return_value={"success": True, "id": "msg_fb"}) as mock_send:
 
-            driver_result = MagicMock()
-            driver_result.data = []  # No driver found
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.select.return_value.eq.return_value.execute.return_value = driver_result
-                elif name == "email_log":
-                    chain.insert.return_value.execute.return_value = MagicMock()
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+            fake_supabase["drivers"].on("select.eq", SBResult(data=[]))  # No driver found
 
             response = await client.post(
                 "/webhooks/supabase-auth",
@@ -194,21 +176,14 @@ class TestSupabaseAuthWebhook:
         # Fallback name from email: "john.doe" -> "John Doe"
         mock_send.assert_called_once_with("john.doe@test.com", "John Doe")
 
+    @pytest.mark.slow
     @pytest.mark.asyncio
-    async def test_driver_name_lookup_exception_uses_fallback(self, client):
+    async def test_driver_name_lookup_exception_uses_fallback(self, client, fake_supabase):
         """When driver lookup raises exception, fallback name is used."""
         with patch("main.SUPABASE_WEBHOOK_SECRET", "test-secret"), \
-             patch("main.supabase") as mock_sb, \
              patch("main.send_welcome_email", return_value={"success": True, "id": "msg_exc"}) as mock_send:
 
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.select.return_value.eq.return_value.execute.side_effect = Exception("DB down")
-                elif name == "email_log":
-                    chain.insert.return_value.execute.return_value = MagicMock()
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+            fake_supabase["drivers"].on("select.eq", Exception("DB down"))
 
             response = await client.post(
                 "/webhooks/supabase-auth",
@@ -222,22 +197,14 @@ class TestSupabaseAuthWebhook:
         # Fallback: "maria_garcia" -> "Maria Garcia"
         mock_send.assert_called_once_with("maria_garcia@test.com", "Maria Garcia")
 
+    @pytest.mark.slow
     @pytest.mark.asyncio
-    async def test_welcome_email_failure_still_returns_200(self, client):
+    async def test_welcome_email_failure_still_returns_200(self, client, fake_supabase):
         """Even if the welcome email fails, the webhook returns 200."""
         with patch("main.SUPABASE_WEBHOOK_SECRET", "test-secret"), \
-             patch("main.supabase") as mock_sb, \
              patch("main.send_welcome_email", return_value={"success": False, "error": "API error"}):
 
-            driver_result = MagicMock()
-            driver_result.data = [{"name": "User"}]
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.select.return_value.eq.return_value.execute.return_value = driver_result
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+            fake_supabase["drivers"].on("select.eq", SBResult(data=[{"name": "User"}]))
 
             response = await client.post(
                 "/webhooks/supabase-auth",
@@ -252,24 +219,15 @@ class TestSupabaseAuthWebhook:
         assert data["received"] is True
         assert data["email_sent"] is False
 
+    @pytest.mark.slow
     @pytest.mark.asyncio
-    async def test_email_log_failure_does_not_crash(self, client):
+    async def test_email_log_failure_does_not_crash(self, client, fake_supabase):
         """If logging the email fails, the webhook still succeeds."""
         with patch("main.SUPABASE_WEBHOOK_SECRET", "test-secret"), \
-             patch("main.supabase") as mock_sb, \
              patch("main.send_welcome_email", return_value={"success": True, "id": "msg_log_fail"}):
 
-            driver_result = MagicMock()
-            driver_result.data = [{"name": "User"}]
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.select.return_value.eq.return_value.execute.return_value = driver_result
-                elif name == "email_log":
-                    chain.insert.return_value.execute.side_effect = Exception("Log insert failed")
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+            fake_supabase["drivers"].on("select.eq", SBResult(data=[{"name": "User"}]))
+            fake_supabase["email_log"].on("insert", Exception("Log insert failed"))
 
             response = await client.post(
                 "/webhooks/supabase-auth",
@@ -310,24 +268,14 @@ class TestSupabaseAuthWebhook:
         assert response.json()["skipped"] is True
         mock_send.assert_not_called()
 
+    @pytest.mark.slow
     @pytest.mark.asyncio
-    async def test_driver_name_empty_string_uses_email_fallback(self, client):
+    async def test_driver_name_empty_string_uses_email_fallback(self, client, fake_supabase):
         """If driver exists but name is empty string, use email-based fallback."""
         with patch("main.SUPABASE_WEBHOOK_SECRET", "test-secret"), \
-             patch("main.supabase") as mock_sb, \
              patch("main.send_welcome_email", return_value={"success": True, "id": "msg_empty"}) as mock_send:
 
-            driver_result = MagicMock()
-            driver_result.data = [{"name": ""}]
-
-            def table_dispatch(name):
-                chain = MagicMock()
-                if name == "drivers":
-                    chain.select.return_value.eq.return_value.execute.return_value = driver_result
-                elif name == "email_log":
-                    chain.insert.return_value.execute.return_value = MagicMock()
-                return chain
-            mock_sb.table = MagicMock(side_effect=table_dispatch)
+            fake_supabase["drivers"].on("select.eq", SBResult(data=[{"name": ""}]))
 
             response = await client.post(
                 "/webhooks/supabase-auth",